@@ -13,6 +13,7 @@
 #
 # Copyright Buildbot Team Members
 
+import weakref
 from buildbot.util import lru
 
 class CacheManager(object):
@@ -32,6 +33,8 @@ class CacheManager(object):
     def __init__(self):
         self.config = {}
         self._caches = {}
+        # cache_name : WeakKeyDictionary mapping cache to default size
+        self._registered = {}
 
     def get_cache(self, cache_name, miss_fn):
         """
@@ -54,12 +57,54 @@ class CacheManager(object):
             c = self._caches[cache_name] = lru.AsyncLRUCache(miss_fn, max_size)
             return c
 
+    def register_cache(self, cache_name, cache, default_size=None):
+        """
+        Register a cache that is owned by some other object, such as the
+        L{SyncLRUCache} kept by each builder's status object.  Any number of
+        caches can be registered under the same name; they are all sized
+        according to the configuration for that name, and their metrics are
+        summed in L{get_metrics}.  Registering the same cache again has no
+        additional effect.
+
+        The manager keeps only weak references to registered caches, so they
+        need not be unregistered.
+
+        @param cache_name: name of the cache
+        @param cache: cache instance, which must support C{set_max_size}
+        @param default_size: size of the cache if C{cache_name} is not
+        configured; defaults to C{DEFAULT_CACHE_SIZE}
+        """
+        if default_size is None:
+            default_size = self.DEFAULT_CACHE_SIZE
+        caches = self._registered.setdefault(cache_name,
+                                             weakref.WeakKeyDictionary())
+        caches[cache] = default_size
+        cache.set_max_size(self.config.get(cache_name, default_size))
+
     def load_config(self, new_config):
         self.config = new_config
         for name, cache in self._caches.iteritems():
             cache.set_max_size(new_config.get(name, self.DEFAULT_CACHE_SIZE))
+        for name, caches in self._registered.iteritems():
+            for cache, default_size in caches.items():
+                cache.set_max_size(new_config.get(name, default_size))
 
     def get_metrics(self):
-        return dict([
-            (n, dict(hits=c.hits, refhits=c.refhits, misses=c.misses))
-            for n, c in self._caches.iteritems()])
+        """
+        Get the hits, refhits, misses, and evictions for each cache, as a
+        dictionary keyed by cache name.  The metrics for registered caches
+        sharing a name are summed.
+
+        @returns: dictionary
+        """
+        metric_names = ('hits', 'refhits', 'misses', 'evictions')
+        metrics = {}
+        for n, c in self._caches.iteritems():
+            metrics[n] = dict([ (m, getattr(c, m)) for m in metric_names ])
+        for n, caches in self._registered.iteritems():
+            totals = metrics.setdefault(n,
+                        dict([ (m, 0) for m in metric_names ]))
+            for c in caches.keys():
+                for m in metric_names:
+                    totals[m] += getattr(c, m)
+        return metrics
@@ -0,0 +1,154 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from twisted.python import failure, log
+from buildbot.util import subscription
+from buildbot.changes.filter import ChangeFilter
+
+class FilteredSubscription(subscription.Subscription):
+    """
+    A subscription to a L{ChangeDispatcher} which only receives changes
+    matching C{change_filter}.
+    """
+    def __init__(self, subpt, callback, change_filter):
+        subscription.Subscription.__init__(self, subpt, callback)
+        self.change_filter = change_filter
+        self.index_keys = []
+
+class ChangeDispatcher(subscription.SubscriptionPoint):
+    """
+    A subscription point for changes which indexes the
+    L{buildbot.changes.filter.ChangeFilter}s of its subscribers, so that a
+    new change is only checked against the filters which might match it.
+
+    Each filter is indexed on the first attribute (project, repository,
+    branch, or category) for which it lists exact values, looked up by hash;
+    failing that, on the first attribute for which it has a regular
+    expression, each distinct expression being matched only once per change.
+    Filters that only use C{filter_fn} or the C{*_fn} arguments cannot be
+    indexed, and are always evaluated, as are filters which are not
+    L{ChangeFilter}s or which override its C{filter_change} method.
+    Candidate subscribers' filters are then evaluated in full, so the index
+    only needs to be conservative.
+
+    @ivar evaluations: number of filters evaluated
+    @ivar evaluations_saved: number of filter evaluations avoided by the index
+    """
+
+    def __init__(self, name):
+        subscription.SubscriptionPoint.__init__(self, name)
+        # { attr : { value : set(subs) } }
+        self._exact = {}
+        # { (attr, regex) : set(subs) }
+        self._regexes = {}
+        self._unindexed = set()
+        self._filtered_count = 0
+        self.evaluations = 0
+        self.evaluations_saved = 0
+
+    def subscribe(self, callback, change_filter=None):
+        """Add C{callback} to the subscriptions, to be called with each change
+        that matches C{change_filter}, or with every change if
+        C{change_filter} is None; returns a L{Subscription} instance."""
+        if change_filter is None:
+            return subscription.SubscriptionPoint.subscribe(self, callback)
+
+        sub = FilteredSubscription(self, callback, change_filter)
+        sub.index_keys = self._getIndexKeys(change_filter)
+        for key in sub.index_keys:
+            self._getIndexSet(key, create=True).add(sub)
+        if not sub.index_keys:
+            self._unindexed.add(sub)
+        self._filtered_count += 1
+        return sub
+
+    def deliver(self, change):
+        """
+        Deliver the change to all of the current unfiltered subscribers, and
+        to each filtered subscriber whose filter matches it.
+        """
+        candidates = set(self._unindexed)
+        for attr, values in self._exact.iteritems():
+            subs = values.get(getattr(change, attr, ''))
+            if subs:
+                candidates.update(subs)
+        for (attr, filt_re), subs in self._regexes.iteritems():
+            chg_val = getattr(change, attr, '')
+            if chg_val is not None and filt_re.match(chg_val):
+                candidates.update(subs)
+
+        self.evaluations += len(candidates)
+        self.evaluations_saved += self._filtered_count - len(candidates)
+
+        subscription.SubscriptionPoint.deliver(self, change)
+        for sub in candidates:
+            # the subscription may have been cancelled by an earlier callback
+            if sub.subpt is None:
+                continue
+            try:
+                if sub.change_filter.filter_change(change):
+                    sub.callback(change)
+            except:
+                log.err(failure.Failure(),
+                        'while invoking callback %s to %s' % (sub.callback, self))
+
+    def _unsubscribe(self, sub):
+        if not isinstance(sub, FilteredSubscription):
+            return subscription.SubscriptionPoint._unsubscribe(self, sub)
+        for key in sub.index_keys:
+            subs = self._getIndexSet(key)
+            subs.discard(sub)
+            if not subs:
+                self._removeIndexSet(key)
+        self._unindexed.discard(sub)
+        self._filtered_count -= 1
+        sub.subpt = None
+
+    # index keys are ('exact', attr, value) or ('re', attr, regex)
+
+    def _getIndexKeys(self, change_filter):
+        # only a plain ChangeFilter is known to match no more than its checks
+        checks = getattr(change_filter, 'checks', None)
+        filter_change = getattr(change_filter.__class__, 'filter_change', None)
+        if (not checks or getattr(filter_change, 'im_func', None)
+                            is not ChangeFilter.filter_change.im_func):
+            return []
+        for filt_list, filt_re, filt_fn, chg_attr in checks:
+            if filt_list is not None:
+                return [ ('exact', chg_attr, v) for v in set(filt_list) ]
+        for filt_list, filt_re, filt_fn, chg_attr in checks:
+            if filt_re is not None:
+                return [ ('re', chg_attr, filt_re) ]
+        return []
+
+    def _getIndexSet(self, key, create=False):
+        kind, attr, value = key
+        if kind == 'exact':
+            if create:
+                return self._exact.setdefault(attr, {}).setdefault(value, set())
+            return self._exact[attr][value]
+        else:
+            if create:
+                return self._regexes.setdefault((attr, value), set())
+            return self._regexes[(attr, value)]
+
+    def _removeIndexSet(self, key):
+        kind, attr, value = key
+        if kind == 'exact':
+            del self._exact[attr][value]
+            if not self._exact[attr]:
+                del self._exact[attr]
+        else:
+            del self._regexes[(attr, value)]
@@ -27,7 +27,7 @@ class GitPoller(base.PollingChangeSource):
     """This source will poll a remote git repo for changes and submit
     them to the change master."""
     
-    compare_attrs = ["repourl", "branch", "workdir",
+    compare_attrs = ["repourl", "branch", "branches", "workdir",
                      "pollInterval", "gitbin", "usetimestamps",
                      "category", "project"]
                      
@@ -36,14 +36,20 @@ class GitPoller(base.PollingChangeSource):
                  gitbin='git', usetimestamps=True,
                  category=None, project=None,
                  pollinterval=-2, fetch_refspec=None,
-                 encoding='utf-8'):
+                 encoding='utf-8', branches=None):
         # for backward compatibility; the parameter used to be spelled with 'i'
         if pollinterval != -2:
             pollInterval = pollinterval
         if project is None: project = ''
+        # the first of several branches is the one checked out in workdir
+        if branches:
+            branch = branches[0]
+        else:
+            branches = [ branch ]
 
         self.repourl = repourl
         self.branch = branch
+        self.branches = branches
         self.pollInterval = pollInterval
         self.fetch_refspec = fetch_refspec
         self.encoding = encoding
@@ -55,6 +61,7 @@ class GitPoller(base.PollingChangeSource):
         self.category = category
         self.project = project
         self.changeCount = 0
+        self.changedBranches = []
         self.commitInfo  = {}
         self.initLock = defer.DeferredLock()
         
@@ -152,8 +159,12 @@ class GitPoller(base.PollingChangeSource):
         status = ""
         if not self.master:
             status = "[STOPPED - check log]"
-        str = 'GitPoller watching the remote git repository %s, branch: %s %s' \
-                % (self.repourl, self.branch, status)
+        if len(self.branches) > 1:
+            branches = 'branches: %s' % ', '.join(self.branches)
+        else:
+            branches = 'branch: %s' % self.branch
+        str = 'GitPoller watching the remote git repository %s, %s %s' \
+                % (self.repourl, branches, status)
         return str
 
     @deferredLocked('initLock')
@@ -165,55 +176,6 @@ class GitPoller(base.PollingChangeSource):
         d.addErrback(self._catch_up_failure)
         return d
 
-    def _get_commit_comments(self, rev):
-        args = ['log', rev, '--no-walk', r'--format=%s%n%b']
-        d = utils.getProcessOutput(self.gitbin, args, path=self.workdir, env=dict(PATH=os.environ['PATH']), errortoo=False )
-        def process(git_output):
-            stripped_output = git_output.strip().decode(self.encoding)
-            if len(stripped_output) == 0:
-                raise EnvironmentError('could not get commit comment for rev')
-            return stripped_output
-        d.addCallback(process)
-        return d
-
-    def _get_commit_timestamp(self, rev):
-        # unix timestamp
-        args = ['log', rev, '--no-walk', r'--format=%ct']
-        d = utils.getProcessOutput(self.gitbin, args, path=self.workdir, env=dict(PATH=os.environ['PATH']), errortoo=False )
-        def process(git_output):
-            stripped_output = git_output.strip()
-            if self.usetimestamps:
-                try:
-                    stamp = float(stripped_output)
-                except Exception, e:
-                        log.msg('gitpoller: caught exception converting output \'%s\' to timestamp' % stripped_output)
-                        raise e
-                return stamp
-            else:
-                return None
-        d.addCallback(process)
-        return d
-
-    def _get_commit_files(self, rev):
-        args = ['log', rev, '--name-only', '--no-walk', r'--format=%n']
-        d = utils.getProcessOutput(self.gitbin, args, path=self.workdir, env=dict(PATH=os.environ['PATH']), errortoo=False )
-        def process(git_output):
-            fileList = git_output.split()
-            return fileList
-        d.addCallback(process)
-        return d
-            
-    def _get_commit_name(self, rev):
-        args = ['log', rev, '--no-walk', r'--format=%aE']
-        d = utils.getProcessOutput(self.gitbin, args, path=self.workdir, env=dict(PATH=os.environ['PATH']), errortoo=False )
-        def process(git_output):
-            stripped_output = git_output.strip().decode(self.encoding)
-            if len(stripped_output) == 0:
-                raise EnvironmentError('could not get commit name for rev')
-            return stripped_output
-        d.addCallback(process)
-        return d
-
     def _get_changes(self):
         log.msg('gitpoller: polling git repo at %s' % self.repourl)
 
@@ -233,60 +195,106 @@ class GitPoller(base.PollingChangeSource):
 
         return d
 
-    @defer.deferredGenerator
-    def _process_changes(self, unused_output):
-        # get the change list
-        revListArgs = ['log', '%s..origin/%s' % (self.branch, self.branch), r'--format=%H']
-        self.changeCount = 0
-        d = utils.getProcessOutput(self.gitbin, revListArgs, path=self.workdir,
-                                   env=dict(PATH=os.environ['PATH']), errortoo=False )
-        wfd = defer.waitForDeferred(d)
-        yield wfd
-        results = wfd.getResult()
+    # each commit begins with \x01, and its fields are NUL-terminated
+    commitFormat = r'--format=%x01%H%x00%ct%x00%aE%x00%s%n%b%x00'
 
-        # process oldest change first
-        revList = results.split()
-        if not revList:
-            return
+    def _get_commits(self, branch):
+        """Get the commits on origin/branch that are not yet on branch, oldest
+        first, using a single 'git log' invocation.  The result is a list of
+        dictionaries with keys revision, timestamp, author, comments and
+        files."""
+        args = ['log', '--reverse', '-z', '--name-only', self.commitFormat,
+                '%s..origin/%s' % (branch, branch)]
+        d = utils.getProcessOutput(self.gitbin, args, path=self.workdir,
+                env=dict(PATH=os.environ['PATH']), errortoo=False )
+        d.addCallback(lambda git_output : list(self._parse_commits(git_output)))
+        return d
 
-        revList.reverse()
-        self.changeCount = len(revList)
-            
-        log.msg('gitpoller: processing %d changes: %s in "%s"'
-                % (self.changeCount, revList, self.workdir) )
+    def _parse_commits(self, git_output):
+        # With -z, each commit's formatted fields are followed by an empty
+        # field and then by its NUL-terminated filenames, the first of which
+        # is preceded by a newline.
+        commit = None
+        fields = git_output.split('\0')
+        i = 0
+        while i < len(fields):
+            field = fields[i]
+            if field.startswith('\x01'):
+                if commit:
+                    yield commit
+                rev, timestamp, author, comments = fields[i:i+4]
+                if self.usetimestamps:
+                    timestamp = float(timestamp)
+                else:
+                    timestamp = None
+                commit = dict(revision=rev[1:], timestamp=timestamp,
+                        author=author.strip().decode(self.encoding),
+                        comments=comments.strip().decode(self.encoding),
+                        files=[])
+                i += 5
+                continue
+            if field and commit:
+                if not commit['files'] and field.startswith('\n'):
+                    field = field[1:]
+                commit['files'].append(field)
+            i += 1
+        if commit:
+            yield commit
 
-        for rev in revList:
-            dl = defer.DeferredList([
-                self._get_commit_timestamp(rev),
-                self._get_commit_name(rev),
-                self._get_commit_files(rev),
-                self._get_commit_comments(rev),
-            ], consumeErrors=True)
+    @defer.deferredGenerator
+    def _process_changes(self, unused_output):
+        self.changeCount = 0
+        self.changedBranches = []
 
-            wfd = defer.waitForDeferred(dl)
+        # all of the branches were updated by the same fetch
+        for branch in self.branches:
+            wfd = defer.waitForDeferred(self._get_commits(branch))
             yield wfd
-            results = wfd.getResult()
+            try:
+                commits = wfd.getResult()
+            except EnvironmentError:
+                if branch == self.branch:
+                    raise
+                # this branch is probably new to the local repository; start
+                # tracking it from its current revision, like the initial
+                # branch.  If that fails too (e.g., the branch does not exist
+                # in the remote repository), skip it, but carry on with the
+                # other branches.
+                log.msg('gitpoller: creating local branch %s' % branch)
+                wfd = defer.waitForDeferred(
+                        self._run_git(['branch', '-f', branch,
+                                       'origin/%s' % branch]))
+                yield wfd
+                try:
+                    wfd.getResult()
+                except EnvironmentError:
+                    log.err(None, 'gitpoller: cannot track branch %s; '
+                                  'skipping it' % (branch,))
+                continue
+
+            if not commits:
+                continue
 
-            # check for failures
-            failures = [ r[1] for r in results if not r[0] ]
-            if failures:
-                # just fail on the first error; they're probably all related!
-                raise failures[0]
+            self.changeCount += len(commits)
+            self.changedBranches.append(branch)
+            log.msg('gitpoller: processing %d changes on branch %s: %s in "%s"'
+                    % (len(commits), branch,
+                       [ c['revision'] for c in commits ], self.workdir) )
 
-            timestamp, name, files, comments = [ r[1] for r in results ]
-            d = self.master.addChange(
-                   author=name,
-                   revision=rev,
-                   files=files,
-                   comments=comments,
-                   when_timestamp=epoch2datetime(timestamp),
-                   branch=self.branch,
-                   category=self.category,
-                   project=self.project,
-                   repository=self.repourl)
+            d = self.master.addChanges([ dict(
+                       author=commit['author'],
+                       revision=commit['revision'],
+                       files=commit['files'],
+                       comments=commit['comments'],
+                       when_timestamp=epoch2datetime(commit['timestamp']),
+                       branch=branch,
+                       category=self.category,
+                       project=self.project,
+                       repository=self.repourl)
+                    for commit in commits ])
             wfd = defer.waitForDeferred(d)
             yield wfd
-            results = wfd.getResult()
+            wfd.getResult()
 
     def _process_changes_failure(self, f):
         log.msg('gitpoller: repo poll failed')
@@ -294,12 +302,23 @@ class GitPoller(base.PollingChangeSource):
         # eat the failure to continue along the defered chain - we still want to catch up
         return None
         
+    @defer.deferredGenerator
     def _catch_up(self, res):
         if self.changeCount == 0:
             log.msg('gitpoller: no changes, no catch_up')
             return
-        log.msg('gitpoller: catching up tracking branch')
-        args = ['reset', '--hard', 'origin/%s' % (self.branch,)]
+        for branch in self.changedBranches:
+            log.msg('gitpoller: catching up tracking branch %s' % branch)
+            if branch == self.branch:
+                args = ['reset', '--hard', 'origin/%s' % (branch,)]
+            else:
+                # other branches are not checked out
+                args = ['branch', '-f', branch, 'origin/%s' % (branch,)]
+            wfd = defer.waitForDeferred(self._run_git(args))
+            yield wfd
+            wfd.getResult()
+
+    def _run_git(self, args):
         d = utils.getProcessOutputAndValue(self.gitbin, args, path=self.workdir, env=dict(PATH=os.environ['PATH']))
         d.addCallback(self._convert_nonzero_to_failure)
         return d
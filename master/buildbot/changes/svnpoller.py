@@ -348,10 +348,9 @@ class SVNPoller(base.PollingChangeSource, util.ComparableMixin):
 
     @defer.deferredGenerator
     def submit_changes(self, changes):
-        for chdict in changes:
-            wfd = defer.waitForDeferred(self.master.addChange(**chdict))
-            yield wfd
-            wfd.getResult()
+        wfd = defer.waitForDeferred(self.master.addChanges(changes))
+        yield wfd
+        wfd.getResult()
 
     def finished_ok(self, res):
         if self.cachepath:
@@ -17,6 +17,26 @@
 Base classes for database handling
 """
 
+# maximum number of values to put in a single SQL "IN (..)" clause; SQLite
+# limits the number of parameters in a single statement to 999, and other
+# databases perform poorly with very long lists
+MAX_IN_LIST = 500
+
+def chunkify(values, size=None):
+    """
+    Split the sequence C{values} into lists of at most C{size} elements, for
+    use in SQL "IN" clauses.
+
+    @param values: sequence to split
+    @param size: maximum length of each chunk (default L{MAX_IN_LIST})
+    @returns: iterator over lists
+    """
+    if size is None:
+        size = MAX_IN_LIST
+    values = list(values)
+    for i in xrange(0, len(values), size):
+        yield values[i:i+size]
+
 class DBConnectorComponent(object):
     """
     A fixed component of the DBConnector, handling one particular aspect of the
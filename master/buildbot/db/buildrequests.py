@@ -70,7 +70,7 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
         return self.db.pool.do(thd)
 
     def getBuildRequests(self, buildername=None, complete=None, claimed=None,
-            bsid=None):
+            bsid=None, after_brid=None):
         """
         Get a list of build requests matching the given characteristics.  Note
         that C{unclaimed}, C{my_claimed}, and C{other_claimed} all default to
@@ -83,7 +83,9 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
         builds claimed by this master instance.  A request is considered
         unclaimed if its C{claimed_at} column is either NULL or 0, and it is
         not complete.  If C{bsid} is specified, then only build requests for
-        that buildset will be returned.
+        that buildset will be returned.  If C{after_brid} is specified, then
+        only build requests with a greater brid will be returned; this is an
+        efficient way to find newly-added build requests.
 
         A build is considered completed if its C{complete} column is 1; the
         C{complete_at} column is not consulted.
@@ -102,6 +104,8 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
 
         @param bsid: see above
 
+        @param after_brid: see above
+
         @returns: List of build request dictionaries as above, via Deferred
         """
         def thd(conn):
@@ -137,6 +141,8 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
                     q = q.where(tbl.c.complete == 0)
             if bsid is not None:
                 q = q.where(tbl.c.buildsetid == bsid)
+            if after_brid is not None:
+                q = q.where(tbl.c.id > after_brid)
             res = conn.execute(q)
 
             return [ self._brdictFromRow(row) for row in res.fetchall() ]
@@ -147,8 +153,8 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
         Try to "claim" the indicated build requests for this buildmaster
         instance.  The resulting deferred will fire normally on success, or
         fail with L{AleadyClaimedError} if I{any} of the build requests are
-        already claimed by another master instance, or don't exist.  In this
-        case, none of the claims will take effect.
+        already claimed by another master instance, are complete, or don't
+        exist.  In this case, none of the claims will take effect.
 
         This can be used to re-claim build requests, too.  That is, it will
         succeed in claiming a build request that is already claimed by this
@@ -177,8 +183,15 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
         # claimed all of the desired build requests.  This will be most
         # effective in environments with lower transactional isolation levels,
         # which may incorrectly serialize the conflicting UPDATES.
+        #
+        # The brids are given to the database in "IN" lists, split into chunks
+        # for very large claims (e.g., when merging many requests).  Earlier
+        # versions used a temporary table for this purpose, but creating and
+        # dropping a table in every claim is expensive for some engines.
 
-        def alreadyClaimed(conn, tmp):
+        brid_chunks = list(base.chunkify(brids))
+
+        def alreadyClaimed(conn):
             # helper function to un-claim already-claimed requests, if we can't
             # claim all of them.  This may be redundant for the finer database
             # engines, but won't hurt.
@@ -187,89 +200,88 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
             tbl = self.db.model.buildrequests
 
             # only select *my builds* in this set of brids
-            q = tbl.update()
-            q = q.where((tbl.c.id.in_(tmp.select())) &
-                ((tbl.c.claimed_at != None) &
-                 (tbl.c.claimed_by_name == master_name) &
-                 (tbl.c.claimed_by_incarnation == master_incarnation)))
-            # and unclaim them
-            conn.execute(q,
-                claimed_at=None,
-                claimed_by_name=None,
-                claimed_by_incarnation=None)
+            for chunk in brid_chunks:
+                q = tbl.update()
+                q = q.where((tbl.c.id.in_(chunk)) &
+                    ((tbl.c.claimed_at != None) &
+                     (tbl.c.claimed_by_name == master_name) &
+                     (tbl.c.claimed_by_incarnation == master_incarnation)))
+                # and unclaim them
+                conn.execute(q,
+                    claimed_at=None,
+                    claimed_by_name=None,
+                    claimed_by_incarnation=None)
 
         def thd(conn):
-            # update conditioned on the request being unclaimed, or claimed by
-            # this instance.  In either case, the claimed_at is set to the
-            # current time, so this will re-claim an already-claimed requeset.
+            # update conditioned on the request being incomplete, and either
+            # unclaimed or claimed by this instance.  In either case, the
+            # claimed_at is set to the current time, so this will re-claim an
+            # already-claimed requeset.
             master_name = self.db.master.master_name
             master_incarnation = self.db.master.master_incarnation
             tbl = self.db.model.buildrequests
+            claimed_at = _reactor.seconds()
 
             transaction = conn.begin()
 
-            # first, create a temporary table containing all of the ID's
-            # we want to claim
-            tmp_meta = sa.MetaData(bind=conn)
-            tmp = sa.Table('bbtmp_claim_ids', tmp_meta,
-                    sa.Column('brid', sa.Integer),
-                    prefixes=['TEMPORARY'])
-            tmp.create()
-
-            try:
-                q = tmp.insert()
-                conn.execute(q, [ dict(brid=id) for id in brids ])
-
-                q = tbl.update(whereclause=(tbl.c.id.in_(tmp.select())))
+            updated_rows = 0
+            for chunk in brid_chunks:
+                q = tbl.update(whereclause=(tbl.c.id.in_(chunk)))
                 q = q.where(
-                    # unclaimed
-                    (((tbl.c.claimed_at == None) | (tbl.c.claimed_at == 0)) &
+                    # incomplete
+                    (tbl.c.complete == 0) &
+                    # .. and unclaimed
+                    ((((tbl.c.claimed_at == None) | (tbl.c.claimed_at == 0)) &
                     (tbl.c.claimed_by_name == None) &
                     (tbl.c.claimed_by_incarnation == None)) |
                     # .. or mine
                     ((tbl.c.claimed_at != None) &
                     (tbl.c.claimed_by_name == master_name) &
-                    (tbl.c.claimed_by_incarnation == master_incarnation)))
+                    (tbl.c.claimed_by_incarnation == master_incarnation))))
                 res = conn.execute(q,
-                    claimed_at=_reactor.seconds(),
-                    claimed_by_name=self.db.master.master_name,
-                    claimed_by_incarnation=self.db.master.master_incarnation)
-                updated_rows = res.rowcount
+                    claimed_at=claimed_at,
+                    claimed_by_name=master_name,
+                    claimed_by_incarnation=master_incarnation)
+                updated_rows += res.rowcount
                 res.close()
 
-                # if no rows or too few rows were updated, then we failed; this
-                # will roll back the transaction
-                if updated_rows != len(brids):
-                    # MySQL doesn't do transactions, so roll this back manually
-                    if conn.engine.dialect.name == 'mysql':
-                        alreadyClaimed(conn, tmp)
-                    transaction.rollback()
-                    raise AlreadyClaimedError
-
-                transaction.commit()
-
-                # testing hook to simulate a race condition
-                if _race_hook:
-                    _race_hook(conn)
-
-                # but double-check to be sure all of the desired build requests
-                # now belong to this master
+                # if too few rows were updated, then we failed; stop now,
+                # since this will roll back the transaction
+                if res.rowcount != len(chunk):
+                    break
+
+            # if no rows or too few rows were updated, then we failed; this
+            # will roll back the transaction
+            if updated_rows != len(brids):
+                # MySQL doesn't do transactions, so roll this back manually
+                if conn.engine.dialect.name == 'mysql':
+                    alreadyClaimed(conn)
+                transaction.rollback()
+                raise AlreadyClaimedError
+
+            transaction.commit()
+
+            # testing hook to simulate a race condition
+            if _race_hook:
+                _race_hook(conn)
+
+            # but double-check to be sure all of the desired build requests
+            # now belong to this master
+            for chunk in brid_chunks:
                 q = sa.select([tbl.c.claimed_by_name,
                             tbl.c.claimed_by_incarnation],
-                            whereclause=(tbl.c.id.in_(tmp.select())))
+                            whereclause=(tbl.c.id.in_(chunk)))
                 res = conn.execute(q)
                 for row in res:
                     if row.claimed_by_name != master_name or \
                             row.claimed_by_incarnation != master_incarnation:
-                        # note that the transaction is already committed here; too
-                        # bad!  We'll just fake it by unclaiming those requests (so
-                        # hopefully this was not a reclaim)
-                        alreadyClaimed(conn, tmp)
+                        res.close()
+                        # note that the transaction is already committed here;
+                        # too bad!  We'll just fake it by unclaiming those
+                        # requests (so hopefully this was not a reclaim)
+                        alreadyClaimed(conn)
                         raise AlreadyClaimedError
                 res.close()
-            finally:
-                # clean up after ourselves, even though it's a temporary table
-                tmp.drop(checkfirst=True)
 
         return self.db.pool.do(thd)
 
@@ -289,19 +301,21 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
             master_incarnation = self.db.master.master_incarnation
             tbl = self.db.model.buildrequests
 
-            q = tbl.update(whereclause=(tbl.c.id.in_(brids)))
-            q = q.where(
-                # incomplete
-                (tbl.c.complete == 0) &
-                # .. and mine only
-                (tbl.c.claimed_at != None) &
-                (tbl.c.claimed_by_name == master_name) &
-                (tbl.c.claimed_by_incarnation == master_incarnation))
-            res = conn.execute(q,
-                claimed_at=0,
-                claimed_by_name=None,
-                claimed_by_incarnation=None)
-            res.close()
+            for chunk in base.chunkify(brids):
+                q = tbl.update(whereclause=(tbl.c.id.in_(chunk)))
+                q = q.where(
+                    # incomplete
+                    (tbl.c.complete == 0) &
+                    # .. and mine only
+                    (tbl.c.claimed_at != None) &
+                    (tbl.c.claimed_by_name == master_name) &
+                    (tbl.c.claimed_by_incarnation == master_incarnation))
+                res = conn.execute(q,
+                    claimed_at=0,
+                    claimed_by_name=None,
+                    claimed_by_incarnation=None)
+                res.close()
+            self._notifyUnclaimed_thd(conn, brids)
         return self.db.pool.do(thd)
 
     def completeBuildRequests(self, brids, results, _reactor=reactor):
@@ -309,7 +323,7 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
         Complete a set of build requests, all of which are owned by this master
         instance.  This will fail with L{NotClaimedError} if the build request
         is not claimed by this instance, is already completed, or does not
-        exist.
+        exist; the other requests are completed nonetheless.
 
         @param brids: build request IDs to complete
         @type brids: integer
@@ -328,20 +342,26 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
             master_incarnation = self.db.master.master_incarnation
             tbl = self.db.model.buildrequests
 
-            q = tbl.update(whereclause=(tbl.c.id.in_(brids)))
-            q = q.where(
-                (tbl.c.claimed_at != None) &
-                (tbl.c.claimed_by_name == master_name) &
-                (tbl.c.claimed_by_incarnation == master_incarnation) &
-                (tbl.c.complete == 0))
-            res = conn.execute(q,
-                complete=1,
-                results=results,
-                complete_at=_reactor.seconds())
+            complete_at = _reactor.seconds()
 
-            # if no rows were updated, then we failed (and left things in an
-            # awkward state, at that!)
-            if res.rowcount != len(brids):
+            updated_rows = 0
+            for chunk in base.chunkify(brids):
+                q = tbl.update(whereclause=(tbl.c.id.in_(chunk)))
+                q = q.where(
+                    (tbl.c.claimed_at != None) &
+                    (tbl.c.claimed_by_name == master_name) &
+                    (tbl.c.claimed_by_incarnation == master_incarnation) &
+                    (tbl.c.complete == 0))
+                res = conn.execute(q,
+                    complete=1,
+                    results=results,
+                    complete_at=complete_at)
+                updated_rows += res.rowcount
+                res.close()
+
+            # if too few rows were updated, then we failed (and left things in
+            # an awkward state, at that!)
+            if updated_rows != len(brids):
                 raise NotClaimedError
         return self.db.pool.do(thd)
 
@@ -365,6 +385,8 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
                 claimed_at=0,
                 claimed_by_name=None,
                 claimed_by_incarnation=None)
+            if res.rowcount:
+                self._notifyUnclaimed_thd(conn)
             return res.rowcount
         d = self.db.pool.do(thd)
         def log_nonzero_count(count):
@@ -401,6 +423,8 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
                 claimed_at=0,
                 claimed_by_name=None,
                 claimed_by_incarnation=None)
+            if res.rowcount:
+                self._notifyUnclaimed_thd(conn)
             return res.rowcount
         d = self.db.pool.do(thd)
         def log_nonzero_count(count):
@@ -410,6 +434,19 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
         d.addCallback(log_nonzero_count)
         return d
 
+    # maximum length of the list of brids sent with an unclaim notification
+    MAX_NOTIFY_PAYLOAD = 4000
+
+    def _notifyUnclaimed_thd(self, conn, brids=None):
+        # let masters know that build requests have been unclaimed, listing
+        # their brids in the notification if we know them and they fit
+        payload = None
+        if brids:
+            payload = ','.join([ str(brid) for brid in brids ])
+            if len(payload) > self.MAX_NOTIFY_PAYLOAD:
+                payload = None
+        self.db.notifier.notify_thd(conn, 'buildrequests_unclaimed', payload)
+
     def _brdictFromRow(self, row):
         claimed = mine = False
         if (row.claimed_at
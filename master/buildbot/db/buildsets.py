@@ -100,6 +100,9 @@ class BuildsetsConnectorComponent(base.DBConnectorComponent):
 
             transaction.commit()
 
+            if brids:
+                self.db.notifier.notify_thd(conn, 'buildrequests')
+
             return (bsid, brids)
         return self.db.pool.do(thd)
 
@@ -110,16 +110,30 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
 
         @returns: new change's ID via Deferred
         """
-        assert project is not None, "project must be a string, not None"
-        assert repository is not None, "repository must be a string, not None"
+        d = self.addChanges([ dict(author=author, files=files,
+                comments=comments, is_dir=is_dir, links=links,
+                revision=revision, when_timestamp=when_timestamp,
+                branch=branch, category=category, revlink=revlink,
+                properties=properties, repository=repository,
+                project=project) ], _reactor=_reactor)
+        d.addCallback(lambda changeids : changeids[0])
+        return d
 
-        if when_timestamp is None:
-            when_timestamp = epoch2datetime(_reactor.seconds())
+    def addChanges(self, changes, _reactor=reactor):
+        """Add several changes to the database in a single transaction.  The
+        files, links, and properties of all of the changes are each inserted
+        with a single statement.
 
-        # verify that source is 'Change' for each property
-        for pv in properties.values():
-            assert pv[1] == 'Change', ("properties must be qualified with"
-                                       "source 'Change'")
+        @param changes: the changes to add, each a dictionary of keyword
+        arguments to L{addChange}
+        @type changes: list of dictionaries
+
+        @param _reactor: for testing
+
+        @returns: list of new change IDs via Deferred, in the order given
+        """
+        now = epoch2datetime(_reactor.seconds())
+        changes = [ self._prepareChange(now, **kwargs) for kwargs in changes ]
 
         def thd(conn):
             # note that in a read-uncommitted database like SQLite this
@@ -130,46 +144,67 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
 
             transaction = conn.begin()
 
+            # each change is inserted separately, to get its changeid
             ins = self.db.model.changes.insert()
-            r = conn.execute(ins, dict(
-                author=author,
-                comments=comments,
-                is_dir=is_dir,
-                branch=branch,
-                revision=revision,
-                revlink=revlink,
-                when_timestamp=datetime2epoch(when_timestamp),
-                category=category,
-                repository=repository,
-                project=project))
-            changeid = r.inserted_primary_key[0]
-            if links:
-                ins = self.db.model.change_links.insert()
-                conn.execute(ins, [
-                    dict(changeid=changeid, link=l)
-                        for l in links
-                    ])
-            if files:
-                ins = self.db.model.change_files.insert()
-                conn.execute(ins, [
-                    dict(changeid=changeid, filename=f)
-                        for f in files
-                    ])
-            if properties:
-                ins = self.db.model.change_properties.insert()
-                conn.execute(ins, [
-                    dict(changeid=changeid,
-                        property_name=k,
-                        property_value=json.dumps(v))
-                    for k,v in properties.iteritems()
-                ])
+            changeids = [ conn.execute(ins, row).inserted_primary_key[0]
+                          for row, files, links, properties in changes ]
+
+            link_rows = []
+            file_rows = []
+            property_rows = []
+            for changeid, (row, files, links, properties) in \
+                    zip(changeids, changes):
+                link_rows.extend([ dict(changeid=changeid, link=l)
+                                   for l in links ])
+                file_rows.extend([ dict(changeid=changeid, filename=f)
+                                   for f in files ])
+                property_rows.extend([ dict(changeid=changeid,
+                                            property_name=k,
+                                            property_value=json.dumps(v))
+                                       for k,v in properties.iteritems() ])
+            if link_rows:
+                conn.execute(self.db.model.change_links.insert(), link_rows)
+            if file_rows:
+                conn.execute(self.db.model.change_files.insert(), file_rows)
+            if property_rows:
+                conn.execute(self.db.model.change_properties.insert(),
+                             property_rows)
 
             transaction.commit()
 
-            return changeid
+            return changeids
         d = self.db.pool.do(thd)
         return d
 
+    def _prepareChange(self, now, author=None, files=None, comments=None,
+            is_dir=0, links=None, revision=None, when_timestamp=None,
+            branch=None, category=None, revlink='', properties={},
+            repository='', project=''):
+        # returns (row, files, links, properties) for a change
+        assert project is not None, "project must be a string, not None"
+        assert repository is not None, "repository must be a string, not None"
+
+        if when_timestamp is None:
+            when_timestamp = now
+
+        # verify that source is 'Change' for each property
+        for pv in properties.values():
+            assert pv[1] == 'Change', ("properties must be qualified with"
+                                       "source 'Change'")
+
+        row = dict(
+            author=author,
+            comments=comments,
+            is_dir=is_dir,
+            branch=branch,
+            revision=revision,
+            revlink=revlink,
+            when_timestamp=datetime2epoch(when_timestamp),
+            category=category,
+            repository=repository,
+            project=project)
+        return (row, files or [], links or [], properties)
+
     @base.cached("chdicts")
     def getChange(self, changeid):
         """
@@ -197,6 +232,57 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
         d = self.db.pool.do(thd)
         return d
 
+    def getChanges(self, changeids):
+        """
+        Get change dictionaries for all of the given changeids.  Changes that
+        are not already in the C{chdicts} cache are fetched using a fixed
+        number of queries, regardless of the number of changes, and added to
+        the cache.  Changeids for which no change exists are omitted from the
+        result.
+
+        @param changeids: ids of the changes to fetch
+        @type changeids: sequence of integers
+
+        @returns: list of change dictionaries via Deferred, in the order given
+        by C{changeids}
+        """
+        changeids = list(changeids)
+        cache = self.getChange.cache
+        found = {}
+        missing = set()
+        for changeid in changeids:
+            if changeid in found or changeid in missing:
+                continue
+            chdict = cache.peek(changeid)
+            if chdict is not None:
+                found[changeid] = chdict
+            else:
+                missing.add(changeid)
+
+        def result():
+            return [ found[changeid] for changeid in changeids
+                     if changeid in found ]
+
+        if not missing:
+            return defer.succeed(result())
+
+        def thd(conn):
+            changes_tbl = self.db.model.changes
+            rows = []
+            for ids in base.chunkify(missing):
+                q = changes_tbl.select(
+                        whereclause=(changes_tbl.c.changeid.in_(ids)))
+                rows.extend(conn.execute(q).fetchall())
+            return self._chdicts_from_change_rows_thd(conn, rows)
+        d = self.db.pool.do(thd)
+        def add_to_cache(chdicts):
+            for chdict in chdicts:
+                cache.add(chdict['changeid'], chdict)
+                found[chdict['changeid']] = chdict
+            return result()
+        d.addCallback(add_to_cache)
+        return d
+
     def getRecentChanges(self, count):
         """
         Get a list of the C{count} most recent changes, represented as
@@ -219,10 +305,7 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
         d = self.db.pool.do(thd)
 
         # then turn those into changes, using the cache
-        def get_changes(changeids):
-            return defer.gatherResults([ self.getChange(changeid)
-                                         for changeid in changeids ])
-        d.addCallback(get_changes)
+        d.addCallback(self.getChanges)
         return d
 
     def getLatestChangeid(self):
@@ -241,6 +324,30 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
         d = self.db.pool.do(thd)
         return d
 
+    def getChangeidsAfter(self, changeid, count=None):
+        """
+        Get the ids of changes with a changeid greater than C{changeid}, in
+        ascending order.  The ids need not be contiguous.
+
+        @param changeid: only return changeids greater than this
+        @param count: maximum number of changeids to return, or None for no
+        limit
+
+        @returns: list of changeids via Deferred
+        """
+        def thd(conn):
+            changes_tbl = self.db.model.changes
+            q = sa.select([ changes_tbl.c.changeid ],
+                    whereclause=(changes_tbl.c.changeid > changeid),
+                    order_by=changes_tbl.c.changeid,
+                    limit=count)
+            rp = conn.execute(q)
+            changeids = [ row.changeid for row in rp ]
+            rp.close()
+            return changeids
+        d = self.db.pool.do(thd)
+        return d
+
     def setChangeHorizon(self, changeHorizon): # TODO: remove
         "this method should go away"
         self.changeHorizon = changeHorizon
@@ -276,6 +383,13 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
     def _chdict_from_change_row_thd(self, conn, ch_row):
         # This method must be run in a db.pool thread, and returns a chdict
         # given a row from the 'changes' table
+        return self._chdicts_from_change_rows_thd(conn, [ ch_row ])[0]
+
+    def _chdicts_from_change_rows_thd(self, conn, ch_rows):
+        # This method must be run in a db.pool thread, and returns a list of
+        # chdicts given a list of rows from the 'changes' table.  The
+        # ancillary data is fetched with one query per table (per chunk of
+        # changeids), rather than with one query per table per change.
         change_links_tbl = self.db.model.change_links
         change_files_tbl = self.db.model.change_files
         change_properties_tbl = self.db.model.change_properties
@@ -284,33 +398,26 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
             if epoch:
                 return epoch2datetime(epoch)
 
-        chdict = ChDict(
-                changeid=ch_row.changeid,
-                author=ch_row.author,
-                files=[], # see below
-                comments=ch_row.comments,
-                is_dir=ch_row.is_dir,
-                links=[], # see below
-                revision=ch_row.revision,
-                when_timestamp=mkdt(ch_row.when_timestamp),
-                branch=ch_row.branch,
-                category=ch_row.category,
-                revlink=ch_row.revlink,
-                properties={}, # see below
-                repository=ch_row.repository,
-                project=ch_row.project)
-
-        query = change_links_tbl.select(
-                whereclause=(change_links_tbl.c.changeid == ch_row.changeid))
-        rows = conn.execute(query)
-        for r in rows:
-            chdict['links'].append(r.link)
-
-        query = change_files_tbl.select(
-                whereclause=(change_files_tbl.c.changeid == ch_row.changeid))
-        rows = conn.execute(query)
-        for r in rows:
-            chdict['files'].append(r.filename)
+        chdicts = []
+        by_changeid = {}
+        for ch_row in ch_rows:
+            chdict = ChDict(
+                    changeid=ch_row.changeid,
+                    author=ch_row.author,
+                    files=[], # see below
+                    comments=ch_row.comments,
+                    is_dir=ch_row.is_dir,
+                    links=[], # see below
+                    revision=ch_row.revision,
+                    when_timestamp=mkdt(ch_row.when_timestamp),
+                    branch=ch_row.branch,
+                    category=ch_row.category,
+                    revlink=ch_row.revlink,
+                    properties={}, # see below
+                    repository=ch_row.repository,
+                    project=ch_row.project)
+            chdicts.append(chdict)
+            by_changeid[ch_row.changeid] = chdict
 
         # and properties must be given without a source, so strip that, but
         # be flexible in case users have used a development version where the
@@ -324,11 +431,25 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
                 v,s = vs, "Change"
             return v, s
 
-        query = change_properties_tbl.select(
-                whereclause=(change_properties_tbl.c.changeid == ch_row.changeid))
-        rows = conn.execute(query)
-        for r in rows:
-            v, s = split_vs(json.loads(r.property_value))
-            chdict['properties'][r.property_name] = (v,s)
-
-        return chdict
+        for changeids in base.chunkify(by_changeid.keys()):
+            query = change_links_tbl.select(
+                    whereclause=(change_links_tbl.c.changeid.in_(changeids)))
+            rows = conn.execute(query)
+            for r in rows:
+                by_changeid[r.changeid]['links'].append(r.link)
+
+            query = change_files_tbl.select(
+                    whereclause=(change_files_tbl.c.changeid.in_(changeids)))
+            rows = conn.execute(query)
+            for r in rows:
+                by_changeid[r.changeid]['files'].append(r.filename)
+
+            query = change_properties_tbl.select(
+                    whereclause=(
+                        change_properties_tbl.c.changeid.in_(changeids)))
+            rows = conn.execute(query)
+            for r in rows:
+                v, s = split_vs(json.loads(r.property_value))
+                by_changeid[r.changeid]['properties'][r.property_name] = (v,s)
+
+        return chdicts
@@ -18,7 +18,7 @@ from twisted.application import internet, service
 from buildbot.db import enginestrategy
 
 from buildbot.db import pool, model, changes, schedulers, sourcestamps
-from buildbot.db import state, buildsets, buildrequests, builds
+from buildbot.db import state, buildsets, buildrequests, builds, notifier
 
 class DBConnector(service.MultiService):
     """
@@ -52,6 +52,9 @@ class DBConnector(service.MultiService):
         self.state = state.StateConnectorComponent(self)
         self.builds = builds.BuildsConnectorComponent(self)
 
+        self.notifier = notifier.get_notifier(self, self._engine)
+        self.notifier.setServiceParent(self)
+
         self.cleanup_timer = internet.TimerService(self.CLEANUP_PERIOD, self.doCleanup)
         self.cleanup_timer.setServiceParent(self)
 
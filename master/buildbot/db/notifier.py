@@ -0,0 +1,220 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+"""
+Support for notifying masters of changes to the database
+"""
+
+import sqlalchemy as sa
+from zope.interface import implements
+from twisted.python import log
+from twisted.internet import reactor, interfaces
+from twisted.application import service
+from buildbot.util import subscription
+
+class Notifier(service.Service):
+    """
+    Delivers notifications that something in the database has changed, so that
+    masters can re-poll the relevant tables immediately rather than waiting
+    for the next scheduled poll.  An instance is available at
+    C{master.db.notifier}.
+
+    Notifications are sent on named channels, and may carry a short string
+    payload.  Payloads are delivered on a best-effort basis: listeners must be
+    prepared to receive a payload of C{None} for any notification.
+
+    This base class only delivers notifications to the master that sent them;
+    other masters sharing the database will learn of the changes through their
+    regular database polling.  Subclasses may implement notifications between
+    masters for particular database engines; see L{get_notifier}.
+    """
+
+    def __init__(self, connector):
+        self.db = connector
+        self._subpts = {}
+
+    def listen(self, channel, callback):
+        """
+        Request that C{callback} be called with the payload (a string or
+        None) whenever a notification is received on C{channel}.
+
+        @param channel: channel name
+        @param callback: callable
+        @returns: L{buildbot.util.subscription.Subscription}
+        """
+        if channel not in self._subpts:
+            self._subpts[channel] = subscription.SubscriptionPoint(
+                    "notifications on %r" % (channel,))
+        return self._subpts[channel].subscribe(callback)
+
+    def notify_thd(self, conn, channel, payload=None):
+        """
+        Send a notification on C{channel}.  This must be called in a db.pool
+        thread, with the connection used to make the change, after the change
+        has been committed.
+
+        @param conn: database connection
+        @param channel: channel name
+        @param payload: optional payload
+        @type payload: short ASCII string
+        """
+        reactor.callFromThread(self._deliver, channel, payload)
+
+    def deliversRemoteNotifications(self):
+        """
+        Return True if notifications sent by other masters sharing the
+        database are currently being delivered to this master.
+        """
+        return False
+
+    def _deliver(self, channel, payload=None):
+        subpt = self._subpts.get(channel)
+        if subpt:
+            subpt.deliver(payload)
+
+class _PostgresListener(object):
+    # A reactor reader for a psycopg2 connection on which LISTEN has been
+    # executed.
+    implements(interfaces.IReadDescriptor)
+
+    def __init__(self, notifier, dbapi_conn):
+        self.notifier = notifier
+        self.dbapi_conn = dbapi_conn
+
+    def fileno(self):
+        return self.dbapi_conn.fileno()
+
+    def logPrefix(self):
+        return 'PostgresNotifier'
+
+    def doRead(self):
+        self.dbapi_conn.poll()
+        while self.dbapi_conn.notifies:
+            notify = self.dbapi_conn.notifies.pop(0)
+            # older versions of psycopg2 give (pid, channel) tuples, and
+            # no payload
+            if isinstance(notify, tuple):
+                pg_channel, payload = notify[1], None
+            else:
+                pg_channel, payload = notify.channel, notify.payload
+            self.notifier._pgDeliver(pg_channel, payload or None)
+
+    def connectionLost(self, reason):
+        self.notifier._listenerLost(reason)
+
+class PostgresNotifier(Notifier):
+    """
+    A notifier using PostgreSQL's LISTEN and NOTIFY, which delivers
+    notifications to every master sharing the database, usually within a few
+    milliseconds of the change being committed.  If the listening connection
+    fails, masters fall back to regular polling.
+
+    Payloads require PostgreSQL 9.0 or higher.  Unless C{send_payloads} is
+    set to True or False, the server version is checked before the first
+    notification is sent, and notifications without payloads are sent to
+    older servers.
+    """
+
+    PG_CHANNEL_PREFIX = 'buildbot_'
+
+    send_payloads = None
+
+    _listener = None
+
+    def __init__(self, connector, engine):
+        Notifier.__init__(self, connector)
+        self.engine = engine
+
+    def listen(self, channel, callback):
+        sub = Notifier.listen(self, channel, callback)
+        if self._listener:
+            self._listenOn(channel)
+        return sub
+
+    def notify_thd(self, conn, channel, payload=None):
+        # the notification is delivered to all listeners, including this
+        # master, when the enclosing transaction (if any) commits
+        if self.send_payloads is None:
+            version = getattr(conn.dialect, 'server_version_info', None)
+            self.send_payloads = bool(version and version >= (9, 0))
+        if payload and self.send_payloads:
+            conn.execute(sa.text("SELECT pg_notify(:channel, :payload)"),
+                    channel=self.PG_CHANNEL_PREFIX + channel, payload=payload)
+        else:
+            conn.execute("NOTIFY %s%s" % (self.PG_CHANNEL_PREFIX, channel))
+
+    def deliversRemoteNotifications(self):
+        return self._listener is not None
+
+    def startService(self):
+        Notifier.startService(self)
+        try:
+            # this connection is used only for listening, so it is taken out
+            # of the pool and placed in autocommit mode
+            conn = self.engine.raw_connection()
+            conn.detach()
+            conn.connection.set_isolation_level(0)
+            self._listener = _PostgresListener(self, conn.connection)
+            for channel in self._subpts:
+                self._listenOn(channel)
+            reactor.addReader(self._listener)
+        except:
+            log.err(None, "while starting PostgreSQL notification listener; "
+                          "falling back to polling")
+            self._listener = None
+
+    def stopService(self):
+        if self._listener:
+            reactor.removeReader(self._listener)
+            try:
+                self._listener.dbapi_conn.close()
+            except:
+                log.err()
+            self._listener = None
+        return Notifier.stopService(self)
+
+    def _listenOn(self, channel):
+        curs = self._listener.dbapi_conn.cursor()
+        curs.execute("LISTEN %s%s" % (self.PG_CHANNEL_PREFIX, channel))
+        curs.close()
+
+    def _pgDeliver(self, pg_channel, payload=None):
+        if pg_channel.startswith(self.PG_CHANNEL_PREFIX):
+            self._deliver(pg_channel[len(self.PG_CHANNEL_PREFIX):], payload)
+
+    def _listenerLost(self, reason):
+        log.msg("lost PostgreSQL notification listener (%s); falling back "
+                "to polling" % (reason.getErrorMessage(),))
+        self._listener = None
+
+notifier_classes = {
+    'postgresql' : PostgresNotifier,
+}
+
+def get_notifier(connector, engine):
+    """
+    Create a notifier appropriate to the given engine: a L{PostgresNotifier}
+    for PostgreSQL, and a plain L{Notifier} for other engines.  Other
+    implementations can be added to C{notifier_classes}, keyed by SQLAlchemy
+    dialect name.
+
+    @param connector: the DBConnector
+    @param engine: SQLAlchemy engine
+    @returns: L{Notifier} instance
+    """
+    cls = notifier_classes.get(engine.dialect.name)
+    if cls:
+        return cls(connector, engine)
+    return Notifier(connector)
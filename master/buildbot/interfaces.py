@@ -159,7 +159,7 @@ class IStatus(Interface):
 
     def generateFinishedBuilds(builders=[], branches=[],
                                num_builds=None, finished_before=None,
-                               max_search=200):
+                               max_search=200, results=None):
         """Return a generator that will produce IBuildStatus objects each
         time you invoke its .next() method, starting with the most recent
         finished build and working backwards.
@@ -189,6 +189,10 @@ class IStatus(Interface):
                            This argument imposes a hard limit on the number
                            of builds that will be examined within any given
                            Builder.
+
+        @param results: if not None, a list of results (SUCCESS, FAILURE,
+                        etc.); only builds with one of these results will be
+                        produced.
         """
 
     def subscribe(receiver):
@@ -33,6 +33,7 @@ from buildbot.process.builder import Builder
 from buildbot.status.master import Status
 from buildbot.changes import changes
 from buildbot.changes.manager import ChangeManager
+from buildbot.changes import dispatch
 from buildbot import interfaces, locks
 from buildbot.process.properties import Properties
 from buildbot.config import BuilderConfig
@@ -41,6 +42,7 @@ from buildbot.db import connector, exceptions
 from buildbot.schedulers.manager import SchedulerManager
 from buildbot.schedulers.base import isScheduler
 from buildbot.process.botmaster import BotMaster
+from buildbot.process.unclaimed import UnclaimedRequestIndex
 from buildbot.process import debug
 from buildbot.status.results import SUCCESS, WARNINGS, FAILURE
 from buildbot import monkeypatches
@@ -78,6 +80,29 @@ class BuildMaster(service.MultiService):
     # database poll operation.
     WARNING_UNCLAIMED_COUNT = 10000
 
+    # maximum number of changes to fetch from the database in a single
+    # query when polling for new changes
+    CHANGE_POLL_PAGE_SIZE = 100
+
+    # gaps in the changeid sequence are re-checked on every poll for this many
+    # seconds, in case a change with a lower id is committed after one with a
+    # higher id by a concurrent transaction; gaps of more than CHANGE_GAP_LIMIT
+    # ids (e.g., after a sequence reset) are not tracked.
+    CHANGE_GAP_TIMEOUT = 5*60
+    CHANGE_GAP_LIMIT = 1000
+
+    # interval, in seconds, at which to re-scan all unclaimed build requests
+    # for requests which have been unclaimed since the last scan, when the
+    # database delivers notifications from other masters (which trigger an
+    # immediate re-scan).  Without such notifications, the re-scan happens on
+    # every poll.  Newly added requests are found on every poll without a
+    # full scan.
+    UNCLAIMED_RESCAN_INTERVAL = 5*60
+
+    # number of brids below the highest brid seen so far which are re-read on
+    # every poll, to find requests committed out of order
+    BRID_RESCAN_WINDOW = 100
+
     def __init__(self, basedir, configFileName="master.cfg"):
         service.MultiService.__init__(self)
         self.setName("buildmaster")
@@ -102,6 +127,8 @@ class BuildMaster(service.MultiService):
         self.master_name = "%s:%s" % (hostname, os.path.abspath(self.basedir))
         self.master_incarnation = "pid%d-boot%d" % (os.getpid(), time.time())
 
+        self.unclaimed_requests = UnclaimedRequestIndex(self)
+
         self.botmaster = BotMaster(self)
         self.botmaster.setName("botmaster")
         self.botmaster.setServiceParent(self)
@@ -119,6 +146,8 @@ class BuildMaster(service.MultiService):
         self.db = None
         self.db_url = None
         self.db_poll_interval = _Unset
+        self._buildrequest_poll_lock = defer.DeferredLock()
+        self._change_gaps = {}
 
         # note that "read" here is taken in the past participal (i.e., "I read
         # the config already") rather than the imperative ("you should read the
@@ -130,7 +159,7 @@ class BuildMaster(service.MultiService):
 
         # subscription points
         self._change_subs = \
-                subscription.SubscriptionPoint("changes")
+                dispatch.ChangeDispatcher("changes")
         self._new_buildrequest_subs = \
                 subscription.SubscriptionPoint("buildrequest_additions")
         self._new_buildset_subs = \
@@ -239,6 +268,7 @@ class BuildMaster(service.MultiService):
                           "logHorizon", "buildHorizon", "changeHorizon",
                           "logMaxSize", "logMaxTailSize", "logCompressionMethod",
                           "db_url", "multiMaster", "db_poll_interval",
+                          "caches", "builderConcurrency",
                           )
             for k in config.keys():
                 if k not in known_keys:
@@ -268,6 +298,21 @@ class BuildMaster(service.MultiService):
                 properties = config.get('properties', {})
                 buildCacheSize = config.get('buildCacheSize', None)
                 changeCacheSize = config.get('changeCacheSize', None)
+                caches = config.get('caches', {})
+                if not isinstance(caches, dict):
+                    raise ValueError("c['caches'] must be a dictionary")
+                caches = caches.copy()
+                # the older size parameters apply to caches that are not
+                # configured explicitly
+                if buildCacheSize is not None:
+                    caches.setdefault('Builds', buildCacheSize)
+                if changeCacheSize is not None:
+                    caches.setdefault('Changes', changeCacheSize)
+                    caches.setdefault('chdicts', changeCacheSize)
+                for name, size in caches.iteritems():
+                    if not isinstance(size, int) or size < 1:
+                        raise ValueError("size of cache '%s' must be a "
+                                         "positive integer" % (name,))
                 eventHorizon = config.get('eventHorizon', 50)
                 logHorizon = config.get('logHorizon', None)
                 buildHorizon = config.get('buildHorizon', None)
@@ -292,6 +337,11 @@ class BuildMaster(service.MultiService):
                 prioritizeBuilders = config.get('prioritizeBuilders')
                 if prioritizeBuilders is not None and not callable(prioritizeBuilders):
                     raise ValueError("prioritizeBuilders must be callable")
+                builderConcurrency = config.get('builderConcurrency', 1)
+                if not isinstance(builderConcurrency, int) or \
+                        builderConcurrency < 1:
+                    raise ValueError("builderConcurrency must be a positive "
+                                     "integer")
                 changeHorizon = config.get("changeHorizon")
                 if changeHorizon is not None and not isinstance(changeHorizon, int):
                     raise ValueError("changeHorizon needs to be an int")
@@ -486,9 +536,11 @@ class BuildMaster(service.MultiService):
                 self.botmaster.mergeRequests = mergeRequests
             if prioritizeBuilders is not None:
                 self.botmaster.prioritizeBuilders = prioritizeBuilders
+            self.botmaster.brd.concurrency = builderConcurrency
 
             self.buildCacheSize = buildCacheSize
             self.changeCacheSize = changeCacheSize
+            self.caches.load_config(caches)
             self.eventHorizon = eventHorizon
             self.logHorizon = logHorizon
             self.buildHorizon = buildHorizon
@@ -578,6 +630,13 @@ class BuildMaster(service.MultiService):
             if db_poll_interval:
                 t1 = TimerService(db_poll_interval, self.pollDatabase)
                 t1.setServiceParent(self)
+
+                # and poll immediately when the database announces new or
+                # newly-unclaimed build requests
+                self.db.notifier.listen('buildrequests',
+                        self._buildRequestsNotified)
+                self.db.notifier.listen('buildrequests_unclaimed',
+                        self._unclaimedBuildRequestsNotified)
             # adding schedulers (like when loadConfig happens) will trigger the
             # scheduler loop at least once, which we need to jump-start things
             # like Periodic.
@@ -797,6 +856,67 @@ class BuildMaster(service.MultiService):
         @returns: L{Change} instance via Deferred
         """
 
+        d = self.db.changes.addChange(**self._prepareChange(who=who,
+                files=files, comments=comments, author=author, isdir=isdir,
+                is_dir=is_dir, links=links, revision=revision, when=when,
+                when_timestamp=when_timestamp, branch=branch,
+                category=category, revlink=revlink, properties=properties,
+                repository=repository, project=project))
+
+        # convert the changeid to a Change instance
+        d.addCallback(lambda changeid :
+                self.db.changes.getChange(changeid))
+        d.addCallback(lambda chdict :
+                changes.Change.fromChdict(self, chdict))
+
+        def notify(change):
+            self._notifyChange(change)
+            return change
+        d.addCallback(notify)
+        return d
+
+    def addChanges(self, changelist):
+        """
+        Add several changes to the buildmaster and act on them.
+
+        This is a wrapper around L{ChangesConnectorComponent.addChanges},
+        which adds all of the changes in a single database transaction.  The
+        changes are then delivered to subscribers in the order given, which
+        should be the order in which they occurred.
+
+        @param changelist: the changes to add, each a dictionary of keyword
+        arguments to L{addChange}
+        @type changelist: list of dictionaries
+
+        @returns: list of L{Change} instances via Deferred
+        """
+        if not changelist:
+            return defer.succeed([])
+
+        d = self.db.changes.addChanges([ self._prepareChange(**kwargs)
+                                         for kwargs in changelist ])
+        d.addCallback(lambda changeids :
+                self.db.changes.getChanges(changeids))
+        def convert(chdicts):
+            return defer.gatherResults([
+                    changes.Change.fromChdict(self, chdict)
+                    for chdict in chdicts ])
+        d.addCallback(convert)
+
+        def notify(chobjs):
+            for change in chobjs:
+                self._notifyChange(change)
+            return chobjs
+        d.addCallback(notify)
+        return d
+
+    def _prepareChange(self, who=None, files=None, comments=None,
+            author=None, isdir=None, is_dir=None, links=None, revision=None,
+            when=None, when_timestamp=None, branch=None, category=None,
+            revlink='', properties={}, repository='', project=''):
+        # translate the arguments of addChange into those of
+        # ChangesConnectorComponent.addChange
+
         # handle translating deprecated names into new names for db.changes
         def handle_deprec(oldname, old, newname, new, default=None,
                           converter = lambda x:x):
@@ -819,39 +939,36 @@ class BuildMaster(service.MultiService):
                                 converter=epoch2datetime)
 
         # add a source to each property
-        for n in properties:
-            properties[n] = (properties[n], 'Change')
+        properties = dict([ (n, (v, 'Change'))
+                            for n, v in properties.iteritems() ])
 
-        d = self.db.changes.addChange(author=author, files=files,
+        return dict(author=author, files=files,
                 comments=comments, is_dir=is_dir, links=links,
                 revision=revision, when_timestamp=when_timestamp,
                 branch=branch, category=category, revlink=revlink,
                 properties=properties, repository=repository, project=project)
 
-        # convert the changeid to a Change instance
-        d.addCallback(lambda changeid :
-                self.db.changes.getChange(changeid))
-        d.addCallback(lambda chdict :
-                changes.Change.fromChdict(self, chdict))
-
-        def notify(change):
-            msg = u"added change %s to database" % change
-            log.msg(msg.encode('utf-8', 'replace'))
-            # only deliver messages immediately if we're not polling
-            if not self.db_poll_interval:
-                self._change_subs.deliver(change)
-            return change
-        d.addCallback(notify)
-        return d
+    def _notifyChange(self, change):
+        msg = u"added change %s to database" % change
+        log.msg(msg.encode('utf-8', 'replace'))
+        # only deliver messages immediately if we're not polling
+        if not self.db_poll_interval:
+            self._change_subs.deliver(change)
 
-    def subscribeToChanges(self, callback):
+    def subscribeToChanges(self, callback, change_filter=None):
         """
         Request that C{callback} be called with each Change object added to the
-        cluster.
+        cluster.  If C{change_filter} is given, then only changes matching that
+        filter will be delivered.  Filters given here are indexed, so this is
+        much more efficient than filtering the changes in the callback.
 
         Note: this method will go away in 0.9.x
+
+        @param change_filter: filter for the changes to deliver
+        @type change_filter: L{buildbot.changes.filter.ChangeFilter} instance
         """
-        return self._change_subs.subscribe(callback)
+        return self._change_subs.subscribe(callback,
+                                           change_filter=change_filter)
 
     def addBuildset(self, **kwargs):
         """
@@ -949,9 +1066,24 @@ class BuildMaster(service.MultiService):
         @param brid: buildrequest ID
         @param buildername: builder named by the build request
         """
+        # update the index before any subscribers (such as the botmaster) go
+        # looking for the new request
+        self.unclaimed_requests.requestAdded(brid, buildername)
         self._new_buildrequest_subs.deliver(
                 dict(bsid=bsid, brid=brid, buildername=buildername))
 
+    def buildRequestsClaimed(self, brids):
+        """
+        Notifies the master that this master has claimed the given build
+        requests, so that they are no longer tracked as unclaimed.
+
+        @param brids: buildrequest IDs
+        @returns: Deferred
+        """
+        if self._last_unclaimed_brids_set:
+            self._last_unclaimed_brids_set.difference_update(brids)
+        return self.unclaimed_requests.removeRequests(brids)
+
     def subscribeToBuildRequests(self, callback):
         """
         Request that C{callback} be invoked with a dictionary with keys C{brid}
@@ -1019,27 +1151,68 @@ class BuildMaster(service.MultiService):
         if self._last_processed_change is None:
             return
 
+        # first, look again for any changes missing from the sequence on
+        # earlier polls, forgetting those that have been missing for too long
+        if self._change_gaps:
+            now = reactor.seconds()
+            for changeid, missed_at in self._change_gaps.items():
+                if now - missed_at >= self.CHANGE_GAP_TIMEOUT:
+                    del self._change_gaps[changeid]
+
+        if self._change_gaps:
+            wfd = defer.waitForDeferred(
+                self.db.changes.getChanges(sorted(self._change_gaps)))
+            yield wfd
+            chdicts = wfd.getResult()
+
+            for chdict in chdicts:
+                del self._change_gaps[chdict['changeid']]
+
+            wfd = defer.waitForDeferred(
+                self._deliverChdicts(chdicts))
+            yield wfd
+            wfd.getResult()
+
+        # fetch the changes in pages of ids greater than the last processed
+        # change, so that a burst of changes is handled with a few bulk
+        # queries.  Gaps in the changeid sequence (e.g., from multi-master
+        # MySQL auto-increment settings, or from transactions which have not
+        # yet committed) do not stop the poll, but are remembered so that they
+        # can be re-checked later.
         while True:
-            changeid = self._last_processed_change + 1
             wfd = defer.waitForDeferred(
-                self.db.changes.getChange(changeid))
+                self.db.changes.getChangeidsAfter(self._last_processed_change,
+                                    count=self.CHANGE_POLL_PAGE_SIZE))
             yield wfd
-            chdict = wfd.getResult()
+            changeids = wfd.getResult()
 
-            # if there's no such change, we've reached the end and can
+            # if there are no such changes, we've reached the end and can
             # stop polling
-            if not chdict:
+            if not changeids:
                 break
 
             wfd = defer.waitForDeferred(
-                changes.Change.fromChdict(self, chdict))
+                self.db.changes.getChanges(changeids))
             yield wfd
-            change = wfd.getResult()
+            chdicts = wfd.getResult()
 
-            self._change_subs.deliver(change)
+            wfd = defer.waitForDeferred(
+                self._deliverChdicts(chdicts))
+            yield wfd
+            wfd.getResult()
 
-            self._last_processed_change = changeid
-            need_setState = True
+            # write back the updated state once per page
+            self._noteChangeGaps(self._last_processed_change, changeids)
+            self._last_processed_change = changeids[-1]
+            wfd = defer.waitForDeferred(
+                self._setState('last_processed_change',
+                               self._last_processed_change))
+            yield wfd
+            wfd.getResult()
+            need_setState = False
+
+            if len(changeids) < self.CHANGE_POLL_PAGE_SIZE:
+                break
 
         # write back the updated state, if it's changed
         if need_setState:
@@ -1049,10 +1222,53 @@ class BuildMaster(service.MultiService):
             yield wfd
             wfd.getResult()
 
+    @defer.deferredGenerator
+    def _deliverChdicts(self, chdicts):
+        for chdict in chdicts:
+            wfd = defer.waitForDeferred(
+                changes.Change.fromChdict(self, chdict))
+            yield wfd
+            change = wfd.getResult()
+
+            self._change_subs.deliver(change)
+
+    def _noteChangeGaps(self, last_changeid, changeids):
+        # remember any changeids between last_changeid and the (sorted)
+        # changeids which were not found
+        now = reactor.seconds()
+        for changeid in changeids:
+            if changeid - last_changeid - 1 <= self.CHANGE_GAP_LIMIT:
+                for missing in xrange(last_changeid + 1, changeid):
+                    self._change_gaps.setdefault(missing, now)
+            last_changeid = changeid
+
+    def _buildRequestsNotified(self, payload=None):
+        d = self.pollDatabaseBuildRequests()
+        d.addErrback(log.err, 'while polling for new build requests')
+
+    def _unclaimedBuildRequestsNotified(self, payload=None):
+        # the payload, if given, lists the brids that were unclaimed; forget
+        # that we have seen them unclaimed before, so that the re-scan will
+        # notify for them again
+        if payload and self._last_unclaimed_brids_set:
+            for brid in payload.split(','):
+                self._last_unclaimed_brids_set.discard(int(brid))
+        self._unclaimed_rescan_needed = True
+        self._buildRequestsNotified()
+
+    def pollDatabaseBuildRequests(self):
+        # polls may be triggered both by the timer and by notifications from
+        # the database, so ensure that they run one at a time
+        return self._buildrequest_poll_lock.run(
+                self._pollDatabaseBuildRequests)
+
     _last_unclaimed_brids_set = None
+    _last_seen_brid = None
+    _last_unclaimed_rescan = None
+    _unclaimed_rescan_needed = False
     _last_claim_cleanup = None
     @defer.deferredGenerator
-    def pollDatabaseBuildRequests(self):
+    def _pollDatabaseBuildRequests(self):
         # deal with cleaning up unclaimed requests, and (if necessary)
         # requests from a previous instance of this master
         if self._last_claim_cleanup is None:
@@ -1082,6 +1298,14 @@ class BuildMaster(service.MultiService):
         # the last poll, it notifies the subscribers.  It only tracks that
         # state within the master instance, though; on startup, it notifies for
         # all unclaimed requests in the database.
+        #
+        # Newly-added build requests are found on every poll by looking for
+        # brids greater than (or just below) any seen so far, which does not
+        # require scanning the whole table.  Requests which are unclaimed after
+        # having been claimed are only found by a full scan of the unclaimed
+        # requests.  If the database notifies us of such unclaims, even by
+        # other masters, then the scan occurs when notified and every
+        # UNCLAIMED_RESCAN_INTERVAL; otherwise, it occurs on every poll.
 
         last_unclaimed = self._last_unclaimed_brids_set or set()
         if len(last_unclaimed) > self.WARNING_UNCLAIMED_COUNT:
@@ -1089,12 +1313,45 @@ class BuildMaster(service.MultiService):
                     "producing builds for which no builder is running?"
                     % len(last_unclaimed))
 
-        # get the current set of unclaimed buildrequests
-        wfd = defer.waitForDeferred(
-            self.db.buildrequests.getBuildRequests(claimed=False))
-        yield wfd
-        now_unclaimed_brdicts = wfd.getResult()
-        now_unclaimed = set([ brd['brid'] for brd in now_unclaimed_brdicts ])
+        now = reactor.seconds()
+        if (self._last_unclaimed_brids_set is None
+                or self._unclaimed_rescan_needed
+                or not self.db.notifier.deliversRemoteNotifications()
+                or now - self._last_unclaimed_rescan
+                        >= self.UNCLAIMED_RESCAN_INTERVAL):
+            self._unclaimed_rescan_needed = False
+            self._last_unclaimed_rescan = now
+
+            # get the current set of unclaimed buildrequests
+            wfd = defer.waitForDeferred(
+                self.db.buildrequests.getBuildRequests(claimed=False))
+            yield wfd
+            now_unclaimed_brdicts = wfd.getResult()
+            now_unclaimed = set([ brd['brid']
+                                  for brd in now_unclaimed_brdicts ])
+
+            if now_unclaimed:
+                self._last_seen_brid = max(self._last_seen_brid,
+                                           max(now_unclaimed))
+        else:
+            # get all of the buildrequests added since the last poll, and add
+            # the unclaimed ones to those we already know about.  A window of
+            # brids below the highest seen is included, since a request may be
+            # committed after another with a higher brid.
+            after_brid = max(0, (self._last_seen_brid or 0)
+                                - self.BRID_RESCAN_WINDOW)
+            wfd = defer.waitForDeferred(
+                self.db.buildrequests.getBuildRequests(after_brid=after_brid))
+            yield wfd
+            new_brdicts = wfd.getResult()
+            now_unclaimed_brdicts = [ brd for brd in new_brdicts
+                    if not brd['claimed'] and not brd['complete'] ]
+            now_unclaimed = last_unclaimed | set([ brd['brid']
+                                  for brd in now_unclaimed_brdicts ])
+
+            if new_brdicts:
+                self._last_seen_brid = max(self._last_seen_brid,
+                        max([ brd['brid'] for brd in new_brdicts ]))
 
         # and store that for next time
         self._last_unclaimed_brids_set = now_unclaimed
@@ -1103,7 +1360,7 @@ class BuildMaster(service.MultiService):
         new_unclaimed = now_unclaimed - last_unclaimed
         if new_unclaimed:
             brdicts = dict((brd['brid'], brd) for brd in now_unclaimed_brdicts)
-            for brid in new_unclaimed:
+            for brid in sorted(new_unclaimed):
                 brd = brdicts[brid]
                 self.buildRequestAdded(brd['buildsetid'], brd['brid'],
                                        brd['buildername'])
@@ -14,6 +14,7 @@
 # Copyright Buildbot Team Members
 
 
+import heapq
 from twisted.python import log
 from twisted.python.failure import Failure
 from twisted.internet import defer, reactor
@@ -346,29 +347,68 @@ class BuildRequestDistributor(service.Service):
     are still working on the previous build request, then this class will
     correctly re-prioritize invocations of builders' C{maybeStartBuild}
     methods.
+
+    The builders waiting to be invoked are kept in a priority queue.  With
+    the default prioritization, builders are keyed by the submission time of
+    their oldest unclaimed request, as known to
+    L{buildbot.process.unclaimed.UnclaimedRequestIndex}, so adding a builder
+    to the queue is O(log n) and does not query the database, apart from the
+    single query that loads the index the first time builders are queued.
+    A custom
+    C{prioritizeBuilders} function is instead called to re-sort all of the
+    waiting builders whenever new builders are added.
     """
 
-    def __init__(self, botmaster):
+    concurrency = 1
+    """The maximum number of builders whose C{maybeStartBuild} methods may
+    run at once.  Builders that share slaves are never run at the same
+    time."""
+
+    def __init__(self, botmaster, _reactor=reactor):
         self.botmaster = botmaster
         self.master = botmaster.master
+        self._reactor = _reactor
 
         # lock to ensure builders are only sorted once at any time
         self.builder_sorting_lock = defer.DeferredLock()
 
-        # sorted list of names of builders that need their maybeStartBuild
-        # method invoked.
-        self._pending_builders = []
+        # heap of (sort key, sequence, buildername) for the builders that need
+        # their maybeStartBuild method invoked, and a dictionary mapping those
+        # builders to their heap entries; entries no longer in the dictionary
+        # are skipped when they reach the top of the heap.
+        self._pending_heap = []
+        self._pending_builders = {}
+        self._pending_seq = 0
+        # buildername : time it was first queued
+        self._queued_at = {}
         self.activity_lock = defer.DeferredLock()
         self.active = False
 
+        # buildername : slavenames, for each builder whose maybeStartBuild
+        # is running
+        self._active_builders = {}
+        # Deferred fired to wake the activity loop
+        self._activity_waiter = None
+        # buildername : dictionary of statistics (see getMetrics)
+        self._metrics = {}
+
     def stopService(self):
-        # let the parent stopService succeed between activity; then the loop
-        # will stop calling itself, since self.running is false
+        # let the parent stopService succeed between activity, once any
+        # active builders are finished; then the loop will stop calling
+        # itself, since self.running is false
         d = self.activity_lock.acquire()
+        d.addCallback(lambda _ : self._waitForActiveBuilders())
         d.addCallback(lambda _ : service.Service.stopService(self))
         d.addBoth(lambda _ : self.activity_lock.release())
         return d
 
+    @defer.deferredGenerator
+    def _waitForActiveBuilders(self):
+        while self._active_builders:
+            wfd = defer.waitForDeferred(self._waitForActivity())
+            yield wfd
+            wfd.getResult()
+
     def maybeStartBuildsOn(self, new_builders):
         """
         Try ot start any builds that can be started right now.  This function
@@ -381,7 +421,16 @@ class BuildRequestDistributor(service.Service):
         existing_pending = set(self._pending_builders)
 
         # if we haven't added any builders, there's nothing to do
-        if new_builders < existing_pending:
+        if not new_builders - existing_pending:
+            return
+
+        if not self.botmaster.prioritizeBuilders:
+            # add the new builders to the queue, keyed by the time of their
+            # oldest request; the unclaimed request index is loaded first,
+            # which only takes a query the first time
+            d = self.master.unclaimed_requests.load()
+            d.addErrback(log.err, 'while loading unclaimed build requests')
+            d.addCallback(lambda _ : self._queueBuilders(new_builders))
             return
 
         # reset the list of pending builders; this is async, so begin
@@ -390,15 +439,20 @@ class BuildRequestDistributor(service.Service):
 
         # then sort the new, expanded set of builders
         d.addCallback(lambda _ : self._sortBuilders(list(
-                                    existing_pending | new_builders)))
+                                    set(self._pending_builders) | new_builders)))
         def keep_new_builders(result):
-            self._pending_builders = result
+            self._pending_heap = []
+            self._pending_builders = {}
+            for i, bldr_name in enumerate(result):
+                self._pushPendingBuilder(i, bldr_name)
         d.addCallback(keep_new_builders)
 
         # start the activity loop, if we aren't already working on that.
         def start_loop(_):
             if not self.active:
                 self._activityLoop()
+            else:
+                self._wakeActivityLoop()
         d.addCallback(start_loop)
 
         # and release the lock in any case
@@ -409,32 +463,33 @@ class BuildRequestDistributor(service.Service):
 
         d.addErrback(log.err, 'while sorting builders')
 
-    @defer.deferredGenerator
-    def _defaultSorter(self, master, builders):
-        # perform an asynchronous schwarzian transform, transforming None
-        # into sys.maxint so that it sorts to the end
-        def xform(bldr):
-            d = defer.maybeDeferred(lambda :
-                    bldr.getOldestRequestTime())
-            d.addCallback(lambda time :
-                (((time is None) and None or time),bldr))
-            return d
-        wfd = defer.waitForDeferred(
-            defer.gatherResults(
-                [ xform(bldr) for bldr in builders ]))
-        yield wfd
-        xformed = wfd.getResult()
-
-        # sort the transformed list synchronously, comparing None to the end of
-        # the list
-        def nonecmp(a,b):
-            if a[0] is None: return 1
-            if b[0] is None: return -1
-            return cmp(a,b)
-        xformed.sort(cmp=nonecmp)
-
-        # and reverse the transform
-        yield [ xf[1] for xf in xformed ]
+    def _queueBuilders(self, new_builders):
+        builders_dict = self.botmaster.builders
+        unclaimed_requests = self.master.unclaimed_requests
+        for bldr_name in new_builders - set(self._pending_builders):
+            if bldr_name not in builders_dict:
+                continue
+            rqtime = unclaimed_requests.peekOldestRequestTime(bldr_name)
+            # builders without requests sort to the end
+            self._pushPendingBuilder((rqtime is None, rqtime), bldr_name)
+        if not self.active:
+            self._activityLoop()
+        else:
+            self._wakeActivityLoop()
+
+    def _pushPendingBuilder(self, key, bldr_name):
+        self._queued_at.setdefault(bldr_name, self._reactor.seconds())
+        self._pending_seq += 1
+        entry = (key, self._pending_seq, bldr_name)
+        self._pending_builders[bldr_name] = entry
+        heapq.heappush(self._pending_heap, entry)
+
+    def _popPendingEntry(self):
+        while self._pending_heap:
+            entry = heapq.heappop(self._pending_heap)
+            if self._pending_builders.get(entry[2]) is entry:
+                del self._pending_builders[entry[2]]
+                return entry
 
     @defer.deferredGenerator
     def _sortBuilders(self, buildernames):
@@ -446,10 +501,9 @@ class BuildRequestDistributor(service.Service):
                      for n in buildernames
                      if n in builders_dict ]
 
-        # find a sorting function
+        # sort them with the configured function; without one, builders are
+        # queued by maybeStartBuildsOn and never sorted here
         sorter = self.botmaster.prioritizeBuilders
-        if not sorter:
-            sorter = self._defaultSorter
 
         # run it
         try:
@@ -476,26 +530,121 @@ class BuildRequestDistributor(service.Service):
             wfd.getResult()
 
             # bail out if we shouldn't keep looping
-            if not self.running or not self._pending_builders:
+            if not self.running:
                 self.activity_lock.release()
                 break
 
-            bldr_name = self._pending_builders.pop(0)
-
-            try:
-                wfd = defer.waitForDeferred(
-                    self._callABuilder(bldr_name))
-                yield wfd
-                wfd.getResult()
-            except:
-                log.err(Failure(),
-                        "from maybeStartBuild for builder '%s'" % (bldr_name,))
+            # start as many builders as we can
+            while len(self._active_builders) < self.concurrency:
+                bldr_name = self._popRunnableBuilder()
+                if bldr_name is None:
+                    break
+                self._startBuilder(bldr_name)
 
             self.activity_lock.release()
 
+            # if nothing was started, then there is nothing left to do
+            if not self._active_builders:
+                break
+
+            # wait for a builder to finish or for new builders to be queued
+            wfd = defer.waitForDeferred(self._waitForActivity())
+            yield wfd
+            wfd.getResult()
+
         self.active = False
         self._quiet()
 
+    def _waitForActivity(self):
+        # returns a Deferred that fires when a builder finishes or new
+        # builders are queued
+        if not self._activity_waiter:
+            self._activity_waiter = defer.Deferred()
+        d = defer.Deferred()
+        self._activity_waiter.addCallback(d.callback)
+        return d
+
+    def _wakeActivityLoop(self):
+        if self._activity_waiter:
+            d, self._activity_waiter = self._activity_waiter, None
+            d.callback(None)
+
+    def _popRunnableBuilder(self):
+        # pop the highest-priority builder that does not share any slaves
+        # with the active builders, or return None
+        if not self._active_builders:
+            entry = self._popPendingEntry()
+            return entry and entry[2]
+
+        busy_slaves = set()
+        for slavenames in self._active_builders.itervalues():
+            busy_slaves.update(slavenames)
+        skipped = []
+        try:
+            while 1:
+                entry = self._popPendingEntry()
+                if entry is None:
+                    return None
+                bldr_name = entry[2]
+                # builders already active are never started twice at once
+                if (bldr_name not in self._active_builders and
+                        busy_slaves.isdisjoint(
+                            self._getSlavenames(bldr_name))):
+                    return bldr_name
+                skipped.append(entry)
+        finally:
+            for entry in skipped:
+                self._pending_builders[entry[2]] = entry
+                heapq.heappush(self._pending_heap, entry)
+
+    def _getSlavenames(self, bldr_name):
+        bldr = self.botmaster.builders.get(bldr_name)
+        if not bldr:
+            return []
+        return bldr.slavenames
+
+    def _startBuilder(self, bldr_name):
+        now = self._reactor.seconds()
+        queued_at = self._queued_at.pop(bldr_name, now)
+        if self.concurrency > 1:
+            self._active_builders[bldr_name] = self._getSlavenames(bldr_name)
+        else:
+            self._active_builders[bldr_name] = []
+
+        d = defer.maybeDeferred(self._callABuilder, bldr_name)
+        d.addErrback(log.err,
+                "from maybeStartBuild for builder '%s'" % (bldr_name,))
+        def finished(_):
+            del self._active_builders[bldr_name]
+            self._recordActivity(bldr_name, now - queued_at,
+                                 self._reactor.seconds() - now)
+            self._wakeActivityLoop()
+        d.addCallback(finished)
+        d.addErrback(log.err, 'while finishing builder activity')
+
+    def _recordActivity(self, bldr_name, wait, duration):
+        m = self._metrics.get(bldr_name)
+        if m is None:
+            m = self._metrics[bldr_name] = dict(calls=0, wait=0.0,
+                                    duration=0.0, max_duration=0.0)
+        m['calls'] += 1
+        m['wait'] += wait
+        m['duration'] += duration
+        m['max_duration'] = max(m['max_duration'], duration)
+
+    def getMetrics(self):
+        """
+        Get statistics on the invocations of each builder's
+        C{maybeStartBuild}, as a dictionary keyed by builder name.  Each value
+        is a dictionary with keys C{calls}, the number of invocations;
+        C{wait}, the total time in seconds builders waited in the queue;
+        C{duration}, the total time spent in C{maybeStartBuild}; and
+        C{max_duration}, the longest single invocation.
+
+        @returns: dictionary
+        """
+        return dict([ (name, dict(m)) for name, m in self._metrics.iteritems() ])
+
     def _callABuilder(self, bldr_name):
         # get the actual builder object
         bldr = self.botmaster.builders.get(bldr_name)
@@ -123,6 +123,11 @@ class Builder(pb.Referenceable, service.MultiService):
         # Build is about to start, to make sure that they're still alive.
         self.slaves = []
 
+        # merge keys (see BuildRequest.mergeKeyFromBrdict) for unclaimed
+        # build requests, keyed by brid; these never change, so they are kept
+        # for as long as the request remains unclaimed
+        self._merge_keys = {}
+
         self.builder_status = builder_status
         self.builder_status.setSlavenames(self.slavenames)
         self.builder_status.buildHorizon = self.buildHorizon
@@ -192,26 +197,13 @@ class Builder(pb.Referenceable, service.MultiService):
     def __repr__(self):
         return "<Builder '%r' at %d>" % (self.name, id(self))
 
-    @defer.deferredGenerator
     def getOldestRequestTime(self):
-
         """Returns the submitted_at of the oldest unclaimed build request for
         this builder, or None if there are no build requests.
 
         @returns: datetime instance or None, via Deferred
         """
-        wfd = defer.waitForDeferred(
-            self.master.db.buildrequests.getBuildRequests(
-                        buildername=self.name, claimed=False))
-        yield wfd
-        unclaimed = wfd.getResult()
-
-        if unclaimed:
-            unclaimed = [ brd['submitted_at'] for brd in unclaimed ]
-            unclaimed.sort()
-            yield unclaimed[0]
-        else:
-            yield None
+        return self.master.unclaimed_requests.getOldestRequestTime(self.name)
 
     def consumeTheSoulOfYourPredecessor(self, old):
         """Suck the brain out of an old Builder.
@@ -556,6 +548,12 @@ class Builder(pb.Referenceable, service.MultiService):
             brids = [br.id for br in build.requests]
             db = self.master.db
             d = db.buildrequests.completeBuildRequests(brids, results)
+            def notClaimed(f):
+                # the requests still claimed by this master were completed
+                f.trap(buildrequests.NotClaimedError)
+                log.msg("some build requests of %s were no longer claimed "
+                        "by this master" % (brids,))
+            d.addErrback(notClaimed)
             d.addCallback(
                 lambda _ : self._maybeBuildsetsComplete(build.requests))
             # nothing in particular to do with this deferred, so just log it if
@@ -576,7 +574,10 @@ class Builder(pb.Referenceable, service.MultiService):
 
     def _resubmit_buildreqs(self, build):
         brids = [br.id for br in build.requests]
-        return self.db.buildrequests.unclaimBuildRequests(brids)
+        d = self.db.buildrequests.unclaimBuildRequests(brids)
+        d.addCallback(lambda _ :
+                self.master.unclaimed_requests.invalidate(self.name))
+        return d
 
     def setExpectations(self, progress):
         """Mark the build as successful and update expectations for the next
@@ -617,15 +618,19 @@ class Builder(pb.Referenceable, service.MultiService):
             self.updateBigStatus()
             return
 
-        # now, get the available build requests
+        # now, get the available build requests, sorted so that the first
+        # is the oldest
         wfd = defer.waitForDeferred(
-                self.master.db.buildrequests.getBuildRequests(
-                        buildername=self.name, claimed=False))
+                self.master.unclaimed_requests.getUnclaimedRequests(self.name))
         yield wfd
         unclaimed_requests = wfd.getResult()
 
-        # sort by submitted_at, so the first is the oldest
-        unclaimed_requests.sort(key=lambda brd : brd['submitted_at'])
+        # forget the merge keys for requests that are no longer unclaimed
+        unclaimed_brids = set([ brdict['brid']
+                                for brdict in unclaimed_requests ])
+        for brid in self._merge_keys.keys():
+            if brid not in unclaimed_brids:
+                del self._merge_keys[brid]
 
         # get the mergeRequests function for later
         mergeRequests_fn = self._getMergeRequestsFn()
@@ -680,19 +685,27 @@ class Builder(pb.Referenceable, service.MultiService):
                 # re-fetch the now-partially-claimed build requests and keep
                 # trying to match them
                 self._breakBrdictRefloops(unclaimed_requests)
+                self.master.unclaimed_requests.invalidate(self.name)
                 wfd = defer.waitForDeferred(
-                        self.master.db.buildrequests.getBuildRequests(
-                                buildername=self.name, claimed=False))
+                        self.master.unclaimed_requests.getUnclaimedRequests(
+                                self.name))
                 yield wfd
                 unclaimed_requests = wfd.getResult()
 
                 # go around the loop again
                 continue
 
-            # claim was successful, so initiate a build for this set of
-            # requests.  Note that if the build fails from here on out (e.g.,
-            # because a slave has failed), it will be handled outside of this
-            # loop. TODO: test that!
+            # claim was successful, so let the master know that the requests
+            # are no longer unclaimed
+            wfd = defer.waitForDeferred(
+                    self.master.buildRequestsClaimed(
+                        [ brdict['brid'] for brdict in brdicts ]))
+            yield wfd
+            wfd.getResult()
+
+            # and initiate a build for this set of requests.  Note that if the
+            # build fails from here on out (e.g., because a slave has failed),
+            # it will be handled outside of this loop. TODO: test that!
 
             # _startBuildFor expects BuildRequest objects, so cook some up
             wfd = defer.waitForDeferred(
@@ -781,7 +794,26 @@ class Builder(pb.Referenceable, service.MultiService):
             yield [ breq ]
             return
 
-        # we'll need BuildRequest objects, so get those first
+        # the default function can be applied to merge keys, which are much
+        # cheaper to calculate than BuildRequest objects
+        if mergeRequests_fn == buildrequest.BuildRequest.canBeMergedWith:
+            wfd = defer.waitForDeferred(
+                defer.gatherResults(
+                    [ self._getMergeKey(brdict)
+                      for brdict in unclaimed_requests ]))
+            yield wfd
+            merge_keys = wfd.getResult()
+
+            breq_key = merge_keys[unclaimed_requests.index(breq)]
+            merged_requests = [ breq ]
+            if breq_key is not None:
+                merged_requests.extend([ brdict
+                    for brdict, key in zip(unclaimed_requests, merge_keys)
+                    if key == breq_key and brdict is not breq ])
+            yield merged_requests
+            return
+
+        # otherwise, we'll need BuildRequest objects, so get those first
         wfd = defer.waitForDeferred(
             defer.gatherResults(
                 [ self._brdictToBuildRequest(brdict)
@@ -805,6 +837,24 @@ class Builder(pb.Referenceable, service.MultiService):
         merged_requests = [ br.brdict for br in merged_request_objects ]
         yield merged_requests
 
+    def _getMergeKey(self, brdict):
+        """
+        Get the merge key for a build request dictionary, using the cached
+        value if possible.
+
+        @param brdict: build request dictionary
+        @returns: merge key via Deferred
+        """
+        brid = brdict['brid']
+        if brid in self._merge_keys:
+            return defer.succeed(self._merge_keys[brid])
+        d = buildrequest.BuildRequest.mergeKeyFromBrdict(self.master, brdict)
+        def keep(merge_key):
+            self._merge_keys[brid] = merge_key
+            return merge_key
+        d.addCallback(keep)
+        return d
+
     def _brdictToBuildRequest(self, brdict):
         """
         Convert a build request dictionary to a L{buildrequest.BuildRequest}
@@ -885,9 +935,8 @@ class BuilderControl:
     def getPendingBuildRequestControls(self):
         master = self.original.master
         wfd = defer.waitForDeferred(
-            master.db.buildrequests.getBuildRequests(
-                buildername=self.original.name,
-                claimed=False))
+            master.unclaimed_requests.getUnclaimedRequests(
+                self.original.name))
         yield wfd
         brdicts = wfd.getResult()
 
@@ -135,6 +135,34 @@ class BuildRequest(object):
 
         yield buildrequest # return value
 
+    @classmethod
+    @defer.deferredGenerator
+    def mergeKeyFromBrdict(cls, master, brdict):
+        """
+        Calculate a key for the given build request such that two requests
+        can be merged by L{canBeMergedWith} exactly when their keys are equal
+        and not None.  This requires far fewer database queries than
+        constructing a L{BuildRequest}.
+
+        @param master: current build master
+        @param brdict: build request dictionary
+
+        @returns: hashable key or None, via Deferred
+        """
+        wfd = defer.waitForDeferred(
+            master.db.buildsets.getBuildset(brdict['buildsetid']))
+        yield wfd
+        buildset = wfd.getResult()
+        assert buildset # schema should guarantee this
+
+        wfd = defer.waitForDeferred(
+            master.db.sourcestamps.getSourceStamp(buildset['sourcestampid']))
+        yield wfd
+        ssdict = wfd.getResult()
+        assert ssdict # db schema should enforce this anyway
+
+        yield sourcestamp.SourceStamp.mergeKeyFromSsdict(ssdict)
+
     def canBeMergedWith(self, other):
         return self.source.canBeMergedWith(other.source)
 
@@ -174,6 +202,13 @@ class BuildRequest(object):
         yield wfd
         wfd.getResult()
 
+        # the request is no longer available to be built, so drop it from the
+        # master's index of unclaimed requests
+        wfd = defer.waitForDeferred(
+            self.master.buildRequestsClaimed([self.id]))
+        yield wfd
+        wfd.getResult()
+
         # and let the master know that the enclosing buildset may be complete
         wfd = defer.waitForDeferred(
                 self.master.maybeBuildsetComplete(self.bsid))
@@ -15,6 +15,7 @@
 
 
 import re
+import zlib
 
 from zope.interface import implements
 from twisted.internet import reactor, defer, error
@@ -268,6 +269,10 @@ class LoggedRemoteCommand(RemoteCommand):
 
     rc = None
     debug = False
+    # format of the output updates asked from slaves that support it: 'list'
+    # for ordered lists of (logname, data) records, 'zlib' for the same,
+    # compressed when that helps, None for one update per log
+    logUpdates = 'zlib'
 
     def __init__(self, *args, **kwargs):
         self.logs = {}
@@ -322,6 +327,10 @@ class LoggedRemoteCommand(RemoteCommand):
                     "it isn't being logged to anything. This seems unusual."
                     % self)
         self.updates = {}
+        if (self.logUpdates and
+            not self.step.slaveVersionIsOlderThan(self.remote_command, "2.16")):
+            self.args = self.args.copy()
+            self.args['logUpdates'] = self.logUpdates
         return RemoteCommand.start(self)
 
     def addStdout(self, data):
@@ -365,17 +374,44 @@ class LoggedRemoteCommand(RemoteCommand):
             # 'log': (logname, data)
             logname, data = update['log']
             self.addToLog(logname, data)
+        if update.has_key('logs'):
+            # 'logs': [(logname, data), ...], in the order it was produced
+            for logname, data in update['logs']:
+                self.addRecord(logname, data)
+        if update.has_key('zlogs'):
+            # 'zlogs': ([(logname, length), ...], compressed data)
+            lengths, compressed = update['zlogs']
+            data = zlib.decompress(compressed)
+            offset = 0
+            for logname, length in lengths:
+                self.addRecord(logname, data[offset:offset+length])
+                offset += length
         if update.has_key('rc'):
             rc = self.rc = update['rc']
             log.msg("%s rc=%s" % (self, rc))
             self.addHeader("program finished with exit code %d\n" % rc)
 
         for k in update:
-            if k not in ('stdout', 'stderr', 'header', 'rc'):
+            if k not in ('stdout', 'stderr', 'header', 'rc', 'logs', 'zlogs'):
                 if k not in self.updates:
                     self.updates[k] = []
                 self.updates[k].append(update[k])
 
+    def addRecord(self, logname, data):
+        """Add data from a 'logs' or 'zlogs' update, as if it came in an
+        update with a key for its log"""
+        if logname == 'stdout':
+            self.addStdout(data)
+        elif logname == 'stderr':
+            self.addStderr(data)
+        elif logname == 'header':
+            self.addHeader(data)
+        else:
+            # ('log', name)
+            name = logname[1]
+            self.addToLog(name, data)
+            self.updates.setdefault('log', []).append((name, data))
+
     def remoteComplete(self, maybeFailure):
         for name,loog in self.logs.items():
             if self._closeWhenFinished[name]:
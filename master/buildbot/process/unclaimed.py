@@ -0,0 +1,225 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import bisect
+from twisted.python import log
+from twisted.internet import defer, reactor
+from buildbot.util import epoch2datetime
+
+class UnclaimedRequestIndex(object):
+    """
+    An in-memory index of the unclaimed build requests in the database, keyed
+    by buildername and ordered by submission time.  An instance is available
+    at C{master.unclaimed_requests}, and is shared by all builders, so that
+    asking every builder whether it can start a build does not require a
+    database query per builder.
+
+    The index is loaded from the database when it is first used, and is kept
+    up to date from build request notifications (see
+    L{buildbot.master.BuildMaster.buildRequestAdded}) and from the claims
+    made by this master's builders.  Requests claimed by other masters
+    are only discovered when a claim fails, or when the index is reconciled
+    with the database every C{RECONCILE_INTERVAL} seconds.
+    """
+
+    # interval, in seconds, after which the index is re-loaded from the
+    # database, dropping any requests claimed by other masters
+    RECONCILE_INTERVAL = 60
+
+    def __init__(self, master, _reactor=reactor):
+        self.master = master
+        self._reactor = _reactor
+
+        # buildername : list of (submitted_at, brid, brdict), sorted
+        self._requests = None
+        # brid : (buildername, entry)
+        self._entries = {}
+        # buildername : set of brids announced but not yet fetched
+        self._pending = {}
+        # buildernames whose requests must be re-fetched
+        self._stale = set()
+        self._last_reconcile = None
+
+        self._lock = defer.DeferredLock()
+
+    def load(self):
+        """
+        Load the index from the database with a single query, if that has not
+        been done yet, so that L{peekOldestRequestTime} knows about every
+        request.
+
+        @returns: Deferred
+        """
+        if self._requests is not None:
+            return defer.succeed(None)
+        return self._lock.run(self._update, None)
+
+    def getUnclaimedRequests(self, buildername):
+        """
+        Get the unclaimed build requests for the given builder, oldest first.
+        The result is a list of fresh copies of the build request
+        dictionaries, which the caller may modify.
+
+        @param buildername: name of the builder
+        @returns: list of build request dictionaries, via Deferred
+        """
+        d = self._lock.run(self._update, buildername)
+        d.addCallback(lambda _ :
+            [ dict(entry[2]) for entry in self._requests.get(buildername, []) ])
+        return d
+
+    def getOldestRequestTime(self, buildername):
+        """
+        Get the submission time of the oldest unclaimed build request for the
+        given builder.
+
+        @param buildername: name of the builder
+        @returns: datetime instance or None, via Deferred
+        """
+        d = self._lock.run(self._update, buildername)
+        def oldest(_):
+            entries = self._requests.get(buildername)
+            if entries:
+                return entries[0][0]
+        d.addCallback(oldest)
+        return d
+
+    def peekOldestRequestTime(self, buildername):
+        """
+        Get the submission time of the oldest unclaimed build request for the
+        given builder that is already known to the index, without querying
+        the database.  If the builder's only requests have been announced but
+        not yet fetched, then they are assumed to have been submitted now.
+
+        @param buildername: name of the builder
+        @returns: datetime instance or None
+        """
+        if self._requests is not None:
+            entries = self._requests.get(buildername)
+            if entries:
+                return entries[0][0]
+        if buildername in self._pending:
+            return epoch2datetime(self._reactor.seconds())
+        return None
+
+    def requestAdded(self, brid, buildername):
+        """
+        Note that a build request is available to be claimed.  It will be
+        fetched from the database on the next access to C{buildername}'s
+        requests.
+
+        @param brid: build request ID
+        @param buildername: name of the builder
+        """
+        self._pending.setdefault(buildername, set()).add(brid)
+
+    def removeRequests(self, brids):
+        """
+        Remove the given build requests from the index, generally because
+        they have just been claimed.
+
+        @param brids: build request IDs
+        @returns: Deferred
+        """
+        return self._lock.run(self._remove, brids)
+
+    def invalidate(self, buildername):
+        """
+        Note that the index's requests for C{buildername} may not match the
+        database, for example because a claim has failed or requests were
+        unclaimed; they will be re-fetched on the next access.
+
+        @param buildername: name of the builder
+        """
+        self._stale.add(buildername)
+
+    # private methods
+
+    @defer.deferredGenerator
+    def _update(self, buildername):
+        # note that notifications may arrive while the queries below are in
+        # progress, so the pending and stale markers are cleared *before*
+        # each query
+        now = self._reactor.seconds()
+        if (self._requests is None
+                or now - self._last_reconcile >= self.RECONCILE_INTERVAL):
+            self._pending = {}
+            self._stale = set()
+            self._last_reconcile = now
+
+            wfd = defer.waitForDeferred(
+                self.master.db.buildrequests.getBuildRequests(claimed=False))
+            yield wfd
+            brdicts = wfd.getResult()
+
+            self._requests = {}
+            self._entries = {}
+            for brdict in brdicts:
+                self._insert(brdict)
+
+        elif buildername in self._stale:
+            self._stale.discard(buildername)
+            self._pending.pop(buildername, None)
+
+            wfd = defer.waitForDeferred(
+                self.master.db.buildrequests.getBuildRequests(
+                    buildername=buildername, claimed=False))
+            yield wfd
+            brdicts = wfd.getResult()
+
+            for entry in self._requests.pop(buildername, []):
+                del self._entries[entry[1]]
+            for brdict in brdicts:
+                self._insert(brdict)
+
+        elif buildername in self._pending:
+            # fetch everything at least as new as the oldest announced
+            # request; requests already in the index are ignored
+            brids = self._pending.pop(buildername)
+
+            wfd = defer.waitForDeferred(
+                self.master.db.buildrequests.getBuildRequests(
+                    buildername=buildername, claimed=False,
+                    after_brid=min(brids) - 1))
+            yield wfd
+            brdicts = wfd.getResult()
+
+            for brdict in brdicts:
+                self._insert(brdict)
+
+    def _insert(self, brdict):
+        brid = brdict['brid']
+        if brid in self._entries:
+            return
+        buildername = brdict['buildername']
+        entry = (brdict['submitted_at'], brid, brdict)
+        bisect.insort(self._requests.setdefault(buildername, []), entry)
+        self._entries[brid] = (buildername, entry)
+
+    def _remove(self, brids):
+        if self._requests is None:
+            return
+        for brid in brids:
+            if brid not in self._entries:
+                continue
+            buildername, entry = self._entries.pop(brid)
+            entries = self._requests[buildername]
+            i = bisect.bisect_left(entries, entry)
+            if i < len(entries) and entries[i][1] == brid:
+                del entries[i]
+            else: # pragma: no cover
+                log.msg("unclaimed request %d not found in index" % (brid,))
+            if not entries:
+                del self._requests[buildername]
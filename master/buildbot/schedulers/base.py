@@ -181,8 +181,6 @@ class BaseScheduler(service.MultiService, ComparableMixin):
             if not self._change_subscription:
                 return
 
-            if change_filter and not change_filter.filter_change(change):
-                return
             if fileIsImportant:
                 try:
                     important = fileIsImportant(change)
@@ -201,7 +199,9 @@ class BaseScheduler(service.MultiService, ComparableMixin):
                 self._change_consumption_lock.release()
             d.addBoth(release)
             d.addErrback(log.err, 'while processing change')
-        self._change_subscription = self.master.subscribeToChanges(changeCallback)
+        # the master only delivers changes matching change_filter
+        self._change_subscription = self.master.subscribeToChanges(
+                changeCallback, change_filter=change_filter or None)
 
         return defer.succeed(None)
 
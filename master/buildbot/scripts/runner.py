@@ -500,6 +500,27 @@ def upgradeMaster(config):
         yield rc
 
 
+class RebuildIndexOptions(MakerBase):
+    def getSynopsis(self):
+        return "Usage:    buildbot rebuild-index [<basedir>]"
+
+    longdesc = """
+    This command re-creates the index of finished builds for each builder in
+    an existing buildmaster directory, from the build pickles on disk.  The
+    buildmaster maintains this index itself, and also adds any builds that are
+    missing from it as they are loaded, so this is only needed to speed up
+    status displays on a master that has been upgraded from an older version.
+    The buildmaster should not be running while this command runs.
+    """
+
+def rebuildIndex(config):
+    from buildbot.status import buildindex
+    basedir = os.path.expanduser(config['basedir'])
+    for builder_dir in buildindex.rebuildIndexes(basedir):
+        if not config['quiet']: print "indexed %s" % builder_dir
+    return 0
+
+
 class MasterOptions(MakerBase):
     optFlags = [
         ["force", "f",
@@ -1140,6 +1161,8 @@ class Options(usage.Options):
          "Create and populate a directory for a new buildmaster"],
         ['upgrade-master', None, UpgradeMasterOptions,
          "Upgrade an existing buildmaster directory for the current version"],
+        ['rebuild-index', None, RebuildIndexOptions,
+         "Re-create the index of finished builds in a buildmaster directory"],
         ['start', None, StartOptions, "Start a buildmaster"],
         ['stop', None, StopOptions, "Stop a buildmaster"],
         ['restart', None, RestartOptions,
@@ -1205,6 +1228,11 @@ def run():
         createMaster(so)
     elif command == "upgrade-master":
         upgradeMaster(so)
+    elif command == "rebuild-index":
+        if not isBuildmasterDir(so['basedir']):
+            print "not a buildmaster directory"
+            sys.exit(1)
+        rebuildIndex(so)
     elif command == "start":
         from buildbot.scripts.startup import start
 
@@ -106,13 +106,10 @@ class SourceStamp(util.ComparableMixin, styles.Versioned):
         if ssdict['changeids']:
             # sort the changeids in order, oldest to newest
             sorted_changeids = sorted(ssdict['changeids'])
-            def gci(id):
-                d = master.db.changes.getChange(id)
-                d.addCallback(lambda chdict :
-                    Change.fromChdict(master, chdict))
-                return d
-            d = defer.gatherResults([ gci(id)
-                                for id in sorted_changeids ])
+            d = master.db.changes.getChanges(sorted_changeids)
+            d.addCallback(lambda chdicts :
+                defer.gatherResults([ Change.fromChdict(master, chdict)
+                                      for chdict in chdicts ]))
         else:
             d = defer.succeed([])
         def got_changes(changes):
@@ -152,10 +149,30 @@ class SourceStamp(util.ComparableMixin, styles.Versioned):
         self.revision = revision
         self._getSourceStampId_lock = defer.DeferredLock();
 
+    @staticmethod
+    def mergeKeyFromSsdict(ssdict):
+        """
+        Calculate a key for the source stamp represented by C{ssdict}, such
+        that two source stamps can be merged (see L{canBeMergedWith}) exactly
+        when their keys are equal and not None.  This allows compatible source
+        stamps to be grouped without constructing L{SourceStamp} instances.
+
+        @param ssdict: source stamp dictionary
+        @returns: hashable key, or None if the source stamp cannot be merged
+        """
+        # this must remain consistent with canBeMergedWith!
+        if ssdict['changeids']:
+            return ('changes', ssdict['repository'], ssdict['branch'],
+                    ssdict['project'])
+        if ssdict['patch_body']:
+            return None
+        return ('revision', ssdict['repository'], ssdict['branch'],
+                ssdict['project'], ssdict['revision'])
+
     def canBeMergedWith(self, other):
         # this algorithm implements the "compatible" mergeRequests defined in
-        # detail in cfg-buidlers.texinfo; change that documentation if the
-        # algorithm changes!
+        # detail in cfg-buidlers.texinfo; change that documentation, and
+        # mergeKeyFromSsdict, if the algorithm changes!
         if other.repository != self.repository:
             return False
         if other.branch != self.branch:
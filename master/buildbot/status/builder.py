@@ -14,7 +14,6 @@
 # Copyright Buildbot Team Members
 
 
-import weakref
 import gc
 import os, re, itertools
 from cPickle import load, dump
@@ -23,9 +22,11 @@ from zope.interface import implements
 from twisted.python import log, runtime
 from twisted.persisted import styles
 from buildbot import interfaces, util
+from buildbot.util import lru
 from buildbot.status.event import Event
 from buildbot.status.build import BuildStatus
 from buildbot.status.buildrequest import BuildRequestStatus
+from buildbot.status.buildindex import BuildIndex, patchKey
 
 # user modules expect these symbols to be present here
 from buildbot.status.results import SUCCESS, WARNINGS, FAILURE, SKIPPED
@@ -70,6 +71,7 @@ class BuilderStatus(styles.Versioned):
     category = None
     currentBigState = "offline" # or idle/waiting/interlocked/building
     basedir = None # filled in by our parent
+    status = None # filled in by our parent
 
     def __init__(self, buildername, category=None):
         self.name = buildername
@@ -85,8 +87,9 @@ class BuilderStatus(styles.Versioned):
         self.currentBuilds = []
         self.nextBuild = None
         self.watchers = []
-        self.buildCache = weakref.WeakValueDictionary()
-        self.buildCache_LRU = []
+        self.buildCache = lru.SyncLRUCache(self._loadBuild,
+                                           self.buildCacheSize)
+        self.buildIndex = None
         self.logCompressionLimit = False # default to no compression for tests
         self.logCompressionMethod = "bz2"
         self.logMaxSize = None # No default limit
@@ -102,7 +105,7 @@ class BuilderStatus(styles.Versioned):
         d = styles.Versioned.__getstate__(self)
         d['watchers'] = []
         del d['buildCache']
-        del d['buildCache_LRU']
+        d.pop('buildIndex', None)
         for b in self.currentBuilds:
             b.saveYourself()
             # TODO: push a 'hey, build was interrupted' event
@@ -118,8 +121,9 @@ class BuilderStatus(styles.Versioned):
         # when loading, re-initialize the transient stuff. Remember that
         # upgradeToVersion1 and such will be called after this finishes.
         styles.Versioned.__setstate__(self, d)
-        self.buildCache = weakref.WeakValueDictionary()
-        self.buildCache_LRU = []
+        self.buildCache = lru.SyncLRUCache(self._loadBuild,
+                                           self.buildCacheSize)
+        self.buildIndex = None
         self.currentBuilds = []
         self.watchers = []
         self.slavenames = []
@@ -128,9 +132,11 @@ class BuilderStatus(styles.Versioned):
 
     def reconfigFromBuildmaster(self, buildmaster):
         # Note that we do not hang onto the buildmaster, since this object
-        # gets pickled and unpickled.
-        if buildmaster.buildCacheSize is not None:
-            self.buildCacheSize = buildmaster.buildCacheSize
+        # gets pickled and unpickled.  The size of the build cache is
+        # configured with the master's other caches, as 'Builds'.
+        buildmaster.caches.register_cache("Builds", self.buildCache,
+                default_size=BuilderStatus.buildCacheSize)
+        self.buildCacheSize = self.buildCache.max_size
 
     def upgradeToVersion1(self):
         if hasattr(self, 'slavename'):
@@ -193,28 +199,34 @@ class BuilderStatus(styles.Versioned):
         return os.path.join(self.basedir, "%d" % number)
 
     def touchBuildCache(self, build):
-        self.buildCache[build.number] = build
-        if build in self.buildCache_LRU:
-            self.buildCache_LRU.remove(build)
-        self.buildCache_LRU = self.buildCache_LRU[-(self.buildCacheSize-1):] + [ build ]
+        self.buildCache.add(build.number, build)
         return build
 
+    def getBuildIndex(self):
+        """Get the L{BuildIndex} summarizing this builder's finished builds"""
+        if self.buildIndex is None or self.buildIndex.basedir != self.basedir:
+            self.buildIndex = BuildIndex(self.basedir)
+        return self.buildIndex
+
     def getBuildByNumber(self, number):
         # first look in currentBuilds
         for b in self.currentBuilds:
             if b.number == number:
                 return self.touchBuildCache(b)
 
-        # then in the buildCache
-        if number in self.buildCache:
-            return self.touchBuildCache(self.buildCache[number])
+        # then in the buildCache, which falls back to loading it from disk
+        return self.buildCache.get(number)
 
-        # then fall back to loading it from disk
+    def _loadBuild(self, number):
         filename = self.makeBuildFilename(number)
         try:
             log.msg("Loading builder %s's build %d from on-disk pickle"
                 % (self.name, number))
-            build = load(open(filename, "rb"))
+            f = open(filename, "rb")
+            try:
+                build = load(f)
+            finally:
+                f.close()
             build.builder = self
 
             # (bug #1068) if we need to upgrade, we probably need to rewrite
@@ -232,7 +244,12 @@ class BuilderStatus(styles.Versioned):
             build.upgradeLogfiles()
             # check that logfiles exist
             build.checkLogfiles()
-            return self.touchBuildCache(build)
+
+            # builds from older versions may not be in the index yet
+            index = self.getBuildIndex()
+            if index.get(number) is None:
+                index.add(build)
+            return build
         except IOError:
             raise IndexError("no such build %d" % number)
         except EOFError:
@@ -264,7 +281,14 @@ class BuilderStatus(styles.Versioned):
         if earliest_build == 0:
             return
 
-        # skim the directory and delete anything that shouldn't be there anymore
+        self.getBuildIndex().prune(earliest_build)
+        if self.status is not None:
+            self.status.getBuildTimeline().prune(self.name, earliest_build)
+            self.status.getSourceStampIndex().prune(self.name, earliest_build)
+
+        # skim the directory and delete anything that shouldn't be there
+        # anymore, other than builds that are still in memory
+        cached_builds = set(self.buildCache.keys())
         build_re = re.compile(r"^([0-9]+)$")
         build_log_re = re.compile(r"^([0-9]+)-.*$")
         # if the directory doesn't exist, bail out here
@@ -284,7 +308,7 @@ class BuilderStatus(styles.Versioned):
                     is_logfile = True
 
             if num is None: continue
-            if num in self.buildCache: continue
+            if num in cached_builds: continue
 
             if (is_logfile and num < earliest_log) or num < earliest_build:
                 pathname = os.path.join(self.basedir, filename)
@@ -303,9 +327,8 @@ class BuilderStatus(styles.Versioned):
         return [self.status.getSlave(name) for name in self.slavenames]
 
     def getPendingBuildRequestStatuses(self):
-        db = self.status.master.db
-        d = db.buildrequests.getBuildRequests(claimed=False,
-                                              buildername=self.name)
+        unclaimed_requests = self.status.master.unclaimed_requests
+        d = unclaimed_requests.getUnclaimedRequests(self.name)
         def make_statuses(brdicts):
             return [BuildRequestStatus(self.name, brdict['brid'],
                                        self.status)
@@ -336,6 +359,31 @@ class BuilderStatus(styles.Versioned):
         except IndexError:
             return None
 
+    def getBuildSummary(self, number):
+        """Get a summary of a finished build from the build index (see
+        L{BuildIndex}), without loading the build itself if possible.
+
+        @param number: build number; negative numbers count back from the
+        most recent build, as for L{getBuild}
+        @returns: dictionary, or None if the build does not exist or is not
+        finished
+        """
+        if number < 0:
+            number = self.nextBuildNumber + number
+        if number < 0 or number >= self.nextBuildNumber:
+            return None
+
+        summary = self.getBuildIndex().get(number)
+        if summary is not None:
+            return summary
+
+        # fall back to loading the build, which will add it to the index
+        build = self.getBuild(number)
+        if build is None or not build.isFinished():
+            return None
+        return self.getBuildIndex().get(number) or \
+               self.getBuildIndex().add(build)
+
     def getEvent(self, number):
         try:
             return self.events[number]
@@ -353,21 +401,24 @@ class BuilderStatus(styles.Versioned):
                 break
             if Nb > max_search:
                 break
-            build = self.getBuild(-Nb)
-            if build is None:
-                continue
+            number = self.nextBuildNumber - Nb
             if max_buildnum is not None:
-                if build.getNumber() > max_buildnum:
+                if number > max_buildnum:
                     continue
-            if not build.isFinished():
+            # filter using the build index, so that only matching builds are
+            # loaded
+            summary = self.getBuildSummary(number)
+            if summary is None:
                 continue
             if finished_before is not None:
-                start, end = build.getTimes()
-                if end >= finished_before:
+                if summary['end'] >= finished_before:
                     continue
             if branches:
-                if build.getSourceStamp().branch not in branches:
+                if summary['branch'] not in branches:
                     continue
+            build = self.getBuild(number)
+            if build is None:
+                continue
             got += 1
             yield build
             if num_builds is not None:
@@ -391,6 +442,17 @@ class BuilderStatus(styles.Versioned):
         eventIndex = -1
         e = self.getEvent(eventIndex)
         for Nb in range(1, self.nextBuildNumber+1):
+            # filter finished builds using the build index, so that only
+            # matching builds are loaded
+            summary = self.getBuildSummary(-Nb)
+            if summary is not None:
+                if summary['start'] < minTime:
+                    break
+                if branches and not summary['branch'] in branches:
+                    continue
+                if committers and not [True for c in summary['committers']
+                                       if c in committers]:
+                    continue
             b = self.getBuild(-Nb)
             if not b:
                 # HACK: If this is the first build we are looking at, it is
@@ -508,6 +570,11 @@ class BuilderStatus(styles.Versioned):
         assert s not in self.currentBuilds
         self.currentBuilds.append(s)
         self.touchBuildCache(s)
+        if self.status is not None:
+            ss = s.getSourceStamp(absolute=True)
+            self.status.getSourceStampIndex().add(self.name, s.getNumber(),
+                    ss.branch, ss.revision, s.getTimes()[0],
+                    patchKey(ss.patch))
 
         # now that the BuildStatus is prepared to answer queries, we can
         # announce the new build to all our watchers
@@ -529,6 +596,14 @@ class BuilderStatus(styles.Versioned):
     def _buildFinished(self, s):
         assert s in self.currentBuilds
         s.saveYourself()
+        summary = self.getBuildIndex().add(s)
+        if self.status is not None:
+            self.status.getBuildTimeline().add(self.name, summary)
+            # the build's revision is now known
+            self.status.getSourceStampIndex().add(self.name,
+                    summary['number'], summary['branch'],
+                    summary['got_revision'], summary['start'],
+                    summary['patch'])
         self.currentBuilds.remove(s)
 
         name = self.getName()
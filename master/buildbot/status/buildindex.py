@@ -0,0 +1,557 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os, re, bisect
+from cPickle import load
+from twisted.python import log, runtime
+from twisted.persisted import styles
+from buildbot.util import json
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+def patchKey(patch):
+    """
+    Get a short string identifying a source stamp's patch, for use in keys.
+
+    @param patch: patch tuple, as in L{buildbot.sourcestamp.SourceStamp}
+    @returns: string, or None if there is no patch
+    """
+    if not patch:
+        return None
+    return sha1(repr(tuple(patch))).hexdigest()
+
+class BuildIndex(object):
+    """
+    A compact index of the finished builds of a single builder, stored in the
+    builder's directory alongside the build pickles.  Each entry is a
+    dictionary summarizing a build, with keys C{number}, C{start}, C{end},
+    C{results}, C{branch}, C{revision}, C{got_revision}, C{patch} (see
+    L{patchKey}), C{slavename}, C{blamelist} and C{committers}.  This allows
+    list-style status displays to filter builds without unpickling them.
+
+    The index is stored as one JSON object per line, so that adding a build
+    only requires appending a line.  If the file does not exist, as in a
+    master upgraded from an older version, it is created from the build
+    pickles when the index is first used; L{rebuild} will re-create it at any
+    time.
+    """
+
+    filename = "builds.index"
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self._summaries = None
+
+    @staticmethod
+    def summarize(build):
+        """
+        Create a summary dictionary for the given finished build.
+
+        @param build: L{buildbot.status.build.BuildStatus} instance
+        @returns: dictionary
+        """
+        start, end = build.getTimes()
+        ss = build.getSourceStamp()
+        got_revision = build.getSourceStamp(absolute=True).revision
+        return dict(number=build.getNumber(), start=start, end=end,
+                results=build.getResults(), branch=ss.branch,
+                revision=ss.revision, got_revision=got_revision,
+                patch=patchKey(ss.patch), slavename=build.getSlavename(),
+                blamelist=list(build.getResponsibleUsers()),
+                committers=[ c.who for c in build.getChanges() ])
+
+    def get(self, number):
+        """
+        Get the summary of the given build.
+
+        @param number: build number
+        @returns: dictionary, or None if the build is not in the index
+        """
+        if self._summaries is None:
+            self._load()
+        return self._summaries.get(number)
+
+    def add(self, build):
+        """
+        Add the given finished build to the index, and return its summary.
+
+        @param build: L{buildbot.status.build.BuildStatus} instance
+        @returns: dictionary
+        """
+        if self._summaries is None:
+            self._load()
+        summary = self.summarize(build)
+        self._summaries[summary['number']] = summary
+        try:
+            f = open(self._getFilename(), "a")
+            try:
+                f.write(json.dumps(summary) + "\n")
+            finally:
+                f.close()
+        except IOError:
+            log.err(None, "while adding build %d to %s"
+                            % (summary['number'], self._getFilename()))
+        return summary
+
+    def getSummaries(self):
+        """
+        Get the summaries of all of the builds in the index, in order by build
+        number.
+
+        @returns: list of dictionaries
+        """
+        if self._summaries is None:
+            self._load()
+        return [ self._summaries[n] for n in sorted(self._summaries) ]
+
+    def prune(self, earliest_build):
+        """
+        Remove the summaries of any builds numbered lower than
+        C{earliest_build}.
+
+        @param earliest_build: number of the earliest build to keep
+        """
+        if self._summaries is None:
+            self._load()
+        pruned = [ n for n in self._summaries if n < earliest_build ]
+        if pruned:
+            for n in pruned:
+                del self._summaries[n]
+            self._save()
+
+    def rebuild(self):
+        """
+        Re-create the index from the build pickles in the builder directory.
+        """
+        self._summaries = {}
+        build_re = re.compile(r"^([0-9]+)$")
+        for filename in os.listdir(self.basedir):
+            if not build_re.match(filename):
+                continue
+            try:
+                f = open(os.path.join(self.basedir, filename), "rb")
+                try:
+                    build = load(f)
+                finally:
+                    f.close()
+                styles.doUpgrade()
+            except:
+                log.err(None, "while loading build pickle '%s'"
+                                % os.path.join(self.basedir, filename))
+                continue
+            summary = self.summarize(build)
+            self._summaries[summary['number']] = summary
+        self._save()
+
+    # private methods
+
+    def _getFilename(self):
+        return os.path.join(self.basedir, self.filename)
+
+    def _load(self):
+        self._summaries = {}
+        if not os.path.exists(self._getFilename()):
+            # a builder from an older version, whose builds were never indexed
+            if os.path.isdir(self.basedir):
+                log.msg("creating build index in '%s'" % self.basedir)
+                self.rebuild()
+            return
+        try:
+            f = open(self._getFilename(), "r")
+        except IOError:
+            log.err(None, "while reading '%s'" % self._getFilename())
+            return
+        try:
+            for line in f:
+                # a crash may leave a partial line at the end of the file
+                try:
+                    summary = json.loads(line)
+                except ValueError:
+                    log.msg("ignoring corrupt line in '%s'"
+                            % self._getFilename())
+                    continue
+                self._summaries[summary['number']] = summary
+        finally:
+            f.close()
+
+    def _save(self):
+        _writeLines(self._getFilename(),
+                    [ self._summaries[n] for n in sorted(self._summaries) ])
+
+class BuildTimeline(object):
+    """
+    A master-wide index of finished builds, ordered by the time they finished,
+    stored in the master's base directory.  Each entry is a tuple (finish
+    time, builder name, build number, results, branch), so that the most
+    recent builds across all builders can be found without consulting each
+    builder.
+
+    Like L{BuildIndex}, the timeline is stored as one JSON object per line.
+    Entries for builds which have been pruned are removed from memory
+    immediately, and a line recording the pruning is appended to the file, to
+    be applied again when the file is loaded.  The file is only re-written
+    once it contains more pruned entries than live ones.
+    """
+
+    filename = "builds.timeline"
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self._entries = None
+        # (buildername, number) : entry
+        self._keys = None
+        # buildername : sorted list of build numbers
+        self._numbers = None
+        self._pruned = 0
+
+    def exists(self):
+        """
+        @returns: true if the timeline file exists
+        """
+        return os.path.exists(self._getFilename())
+
+    def add(self, buildername, summary):
+        """
+        Add a finished build to the timeline.
+
+        @param buildername: name of the build's builder
+        @param summary: the build's summary, from L{BuildIndex.summarize}
+        """
+        if self._entries is None:
+            self._load()
+        entry = self._insert(buildername, summary)
+        if entry is None:
+            return
+        self._append(self._entry2dict(entry))
+
+    def prune(self, buildername, earliest_build):
+        """
+        Remove the entries for any builds of C{buildername} numbered lower
+        than C{earliest_build}.
+
+        @param buildername: name of the builder
+        @param earliest_build: number of the earliest build to keep
+        """
+        if self._entries is None:
+            self._load()
+        count = self._prune(buildername, earliest_build)
+        if not count:
+            return
+        self._pruned += count
+        if self._pruned > len(self._entries):
+            self._save()
+        else:
+            self._append(dict(builder=buildername, prune=earliest_build))
+
+    def generateEntries(self, finished_before=None):
+        """
+        Generate the entries in the timeline, most recent first.
+
+        @param finished_before: if not None, only generate builds which
+        finished before this time
+        @returns: generator of (finish time, builder name, build number,
+        results, branch) tuples
+        """
+        if self._entries is None:
+            self._load()
+        if finished_before is None:
+            i = len(self._entries)
+        else:
+            i = bisect.bisect_left(self._entries, (finished_before,))
+        # note that the list may be modified while this generator is
+        # suspended
+        while i > 0:
+            i = min(i, len(self._entries)) - 1
+            yield self._entries[i]
+
+    def rebuild(self, builders):
+        """
+        Re-create the timeline from the build indexes of the given builders.
+
+        @param builders: list of L{buildbot.status.builder.BuilderStatus}
+        instances
+        """
+        self._entries = []
+        self._keys = {}
+        self._numbers = {}
+        for b in builders:
+            for summary in b.getBuildIndex().getSummaries():
+                self._insert(b.getName(), summary)
+        self._save()
+
+    # private methods
+
+    def _getFilename(self):
+        return os.path.join(self.basedir, self.filename)
+
+    def _entry2dict(self, entry):
+        end, buildername, number, results, branch = entry
+        return dict(end=end, builder=buildername, number=number,
+                    results=results, branch=branch)
+
+    def _insert(self, buildername, summary):
+        key = (buildername, summary['number'])
+        if key in self._keys or summary['end'] is None:
+            return None
+        entry = (summary['end'], buildername, summary['number'],
+                 summary['results'], summary['branch'])
+        bisect.insort(self._entries, entry)
+        self._keys[key] = entry
+        bisect.insort(self._numbers.setdefault(buildername, []),
+                      summary['number'])
+        return entry
+
+    def _prune(self, buildername, earliest_build):
+        # remove the entries, returning the number removed
+        numbers = self._numbers.get(buildername)
+        if not numbers:
+            return 0
+        i = bisect.bisect_left(numbers, earliest_build)
+        for number in numbers[:i]:
+            entry = self._keys.pop((buildername, number))
+            j = bisect.bisect_left(self._entries, entry)
+            del self._entries[j]
+        del numbers[:i]
+        return i
+
+    def _append(self, d):
+        try:
+            f = open(self._getFilename(), "a")
+            try:
+                f.write(json.dumps(d) + "\n")
+            finally:
+                f.close()
+        except IOError:
+            log.err(None, "while appending to %s" % self._getFilename())
+
+    def _load(self):
+        self._entries = []
+        self._keys = {}
+        self._numbers = {}
+        self._pruned = 0
+        try:
+            f = open(self._getFilename(), "r")
+        except IOError:
+            return
+        try:
+            for line in f:
+                # a crash may leave a partial line at the end of the file
+                try:
+                    d = json.loads(line)
+                except ValueError:
+                    log.msg("ignoring corrupt line in '%s'"
+                            % self._getFilename())
+                    continue
+                if 'prune' in d:
+                    self._pruned += self._prune(d['builder'], d['prune'])
+                else:
+                    self._insert(d['builder'], d)
+        finally:
+            f.close()
+
+    def _save(self):
+        self._pruned = 0
+        _writeLines(self._getFilename(),
+                    [ self._entry2dict(e) for e in self._entries ])
+
+class SourceStampIndex(object):
+    """
+    An in-memory index of the builds of each source stamp, across all
+    builders, keyed by (branch, revision, patch).  The revision is the one the
+    build actually used (its got_revision property), where that is known, and
+    the patch is given by L{patchKey}, so that patched (e.g., try) builds are
+    kept apart from the unpatched builds of the same revision.  The
+    index is created from the builders' build indexes, and kept up to date as
+    builds start and finish, so that status displays which show builds by
+    source stamp need only load the builds they display.
+    """
+
+    def __init__(self):
+        # (buildername, number) : ((branch, revision, patch), start)
+        self._builds = {}
+        # (branch, revision, patch) :
+        #               { buildername : sorted list of build numbers }
+        self._stamps = {}
+        # (branch, revision, patch) : [ earliest start, latest start ]
+        self._times = {}
+        # sorted list of (latest start, (branch, revision, patch))
+        self._order = []
+        # buildername : sorted list of build numbers
+        self._history = {}
+
+    def add(self, buildername, number, branch, revision, start, patch=None):
+        """
+        Add a build to the index, or move it to a new source stamp, as when
+        its revision becomes known.
+
+        @param buildername: name of the build's builder
+        @param number: build number
+        @param branch: branch the build used
+        @param revision: revision the build used
+        @param start: time the build started
+        @param patch: the build's patch, from L{patchKey}
+        """
+        key = (branch, revision, patch)
+        old = self._builds.get((buildername, number))
+        if old is not None:
+            if old[0] == key:
+                return
+            self._remove(buildername, number)
+
+        self._builds[(buildername, number)] = (key, start)
+        bisect.insort(self._stamps.setdefault(key, {})
+                                  .setdefault(buildername, []), number)
+        bisect.insort(self._history.setdefault(buildername, []), number)
+
+        times = self._times.get(key)
+        if times is None:
+            self._times[key] = [ start, start ]
+            bisect.insort(self._order, (start, key))
+        else:
+            if start < times[0]:
+                times[0] = start
+            if start > times[1]:
+                self._removeOrder(times[1], key)
+                times[1] = start
+                bisect.insort(self._order, (start, key))
+
+    def prune(self, buildername, earliest_build):
+        """
+        Remove any builds of C{buildername} numbered lower than
+        C{earliest_build}.
+
+        @param buildername: name of the builder
+        @param earliest_build: number of the earliest build to keep
+        """
+        numbers = self._history.get(buildername, [])
+        i = bisect.bisect_left(numbers, earliest_build)
+        for number in numbers[:i]:
+            self._remove(buildername, number)
+
+    def getBuilds(self, branch, revision, patch=None):
+        """
+        Get the builds of the given source stamp.
+
+        @returns: dictionary mapping builder names to lists of build numbers,
+        most recent first
+        """
+        builds = self._stamps.get((branch, revision, patch), {})
+        return dict([ (bn, numbers[::-1])
+                      for (bn, numbers) in builds.iteritems() ])
+
+    def getHistory(self, buildername):
+        """
+        Get the builds of the given builder, with their source stamps.
+
+        @returns: list of (build number, branch, revision) tuples, most recent
+        first
+        """
+        history = []
+        for number in reversed(self._history.get(buildername, [])):
+            (branch, revision, patch), start = \
+                    self._builds[(buildername, number)]
+            history.append((number, branch, revision))
+        return history
+
+    def generateStamps(self, branches=None, builders=None):
+        """
+        Generate the source stamps in the index, most recently built first.
+
+        @param branches: if not None, only generate stamps on these branches
+        @param builders: if not None, only generate stamps built by at least
+        one of these builders
+        @returns: generator of ((branch, revision, patch), earliest start)
+        tuples
+        """
+        i = len(self._order)
+        # note that the list may be modified while this generator is
+        # suspended
+        while i > 0:
+            i = min(i, len(self._order)) - 1
+            latest, key = self._order[i]
+            if branches is not None and key[0] not in branches:
+                continue
+            if builders is not None:
+                built_by = self._stamps[key]
+                for bn in builders:
+                    if bn in built_by:
+                        break
+                else:
+                    continue
+            yield key, self._times[key][0]
+
+    # private methods
+
+    def _remove(self, buildername, number):
+        key, start = self._builds.pop((buildername, number))
+        history = self._history[buildername]
+        del history[bisect.bisect_left(history, number)]
+
+        builds = self._stamps[key]
+        numbers = builds[buildername]
+        del numbers[bisect.bisect_left(numbers, number)]
+        if not numbers:
+            del builds[buildername]
+        if not builds:
+            # the stamp's earliest start is not updated when a build other
+            # than the last is removed; it is only used for ordering
+            del self._stamps[key]
+            self._removeOrder(self._times.pop(key)[1], key)
+
+    def _removeOrder(self, latest, key):
+        i = bisect.bisect_left(self._order, (latest, key))
+        del self._order[i]
+
+def _writeLines(filename, objects):
+    # atomically replace filename with the given objects, one per line
+    tmpfilename = filename + ".tmp"
+    try:
+        f = open(tmpfilename, "w")
+        try:
+            for o in objects:
+                f.write(json.dumps(o) + "\n")
+        finally:
+            f.close()
+        if runtime.platformType == 'win32':
+            # windows cannot rename a file on top of an existing one
+            if os.path.exists(filename):
+                os.unlink(filename)
+        os.rename(tmpfilename, filename)
+    except (IOError, OSError):
+        log.err(None, "while writing '%s'" % filename)
+
+def rebuildIndexes(basedir):
+    """
+    Re-create the build index for each builder in the given master directory.
+    The master-wide L{BuildTimeline} is removed, and will be re-created from
+    the builders' indexes when the master next starts.
+
+    @param basedir: master base directory
+    @returns: list of the builder directories that were indexed
+    """
+    timeline = os.path.join(basedir, BuildTimeline.filename)
+    if os.path.exists(timeline):
+        os.unlink(timeline)
+    indexed = []
+    for dirname in sorted(os.listdir(basedir)):
+        builder_dir = os.path.join(basedir, dirname)
+        if not os.path.isfile(os.path.join(builder_dir, "builder")):
+            continue
+        BuildIndex(builder_dir).rebuild()
+        indexed.append(builder_dir)
+    return indexed
@@ -219,6 +219,7 @@ class BuildStepStatus(styles.Versioned):
         log.logMaxSize = self.build.builder.logMaxSize
         log.logMaxTailSize = self.build.builder.logMaxTailSize
         log.compressMethod = self.build.builder.logCompressionMethod
+        log.logCompressionLimit = self.build.builder.logCompressionLimit
         self.logs.append(log)
         for w in self.watchers:
             receiver = w.logStarted(self.build, self, log)
@@ -0,0 +1,369 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+"""
+Block-compressed log files.
+
+A log is compressed as a sequence of independently-compressed blocks, each
+a complete bz2 stream or gzip member, so the result is still a valid
+(multi-stream) bz2 or gzip file.  A sidecar file records the offset of each
+block in the uncompressed and compressed data, so that a reader can seek to
+any point in the log by decompressing only a single block, and so that the
+blocks can be compressed in parallel.
+"""
+
+import os
+import bz2
+import zlib
+import struct
+import bisect
+from twisted.internet import defer, threads
+
+# size of the uncompressed data in each block
+BLOCK_SIZE = 1024*1024
+
+# uncompressed offset, compressed offset
+blockRecordFormat = "!QQ"
+blockRecordSize = struct.calcsize(blockRecordFormat)
+
+METHODS = ('bz2', 'gz')
+
+def compressBlock(method, data):
+    """Compress C{data} as a complete stream in the given format.  This
+    is safe to call from a thread."""
+    if method == 'bz2':
+        return bz2.compress(data, 9)
+    elif method == 'gz':
+        # wbits of 16+MAX_WBITS produces a gzip header and trailer
+        c = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return c.compress(data) + c.flush()
+    raise ValueError("unknown compression method '%s'" % (method,))
+
+def decompressBlock(method, data):
+    """Decompress a single block produced by L{compressBlock}."""
+    if method == 'bz2':
+        return bz2.decompress(data)
+    elif method == 'gz':
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return d.decompress(data) + d.flush()
+    raise ValueError("unknown compression method '%s'" % (method,))
+
+def readBlocks(blocksfilename):
+    """Read a block index, returning a list of (uncompressed offset,
+    compressed offset) tuples."""
+    f = open(blocksfilename, "rb")
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    count = len(data) // blockRecordSize
+    return [ struct.unpack(blockRecordFormat,
+                data[i*blockRecordSize:(i+1)*blockRecordSize])
+             for i in range(count) ]
+
+def compressFile(infile, filename, blocksfilename, method,
+                 blockSize=BLOCK_SIZE):
+    """Compress the whole of C{infile} to C{filename} in blocks, writing the
+    block index to C{blocksfilename}.  This runs synchronously, and is
+    intended to be called in a thread."""
+    outfile = open(filename, "wb")
+    blocksfile = open(blocksfilename, "wb")
+    try:
+        offset = compressedOffset = 0
+        infile.seek(0)
+        while True:
+            data = infile.read(blockSize)
+            if not data:
+                break
+            compressed = compressBlock(method, data)
+            blocksfile.write(struct.pack(blockRecordFormat,
+                                         offset, compressedOffset))
+            outfile.write(compressed)
+            offset += len(data)
+            compressedOffset += len(compressed)
+    finally:
+        outfile.close()
+        blocksfile.close()
+
+class LogCompressor:
+    """I compress a log as it is written.  Data is collected into blocks of
+    C{blockSize} bytes, and each block is compressed in a thread as soon as
+    it is full, so several blocks may be compressed at once.  The blocks
+    are written to the output file in order as their compression
+    completes.
+
+    If C{source} is given, it is a file containing everything passed to
+    L{write}.  At most C{maxPendingBlocks} blocks are then compressed at
+    once; while compression is behind, written data is dropped, and read
+    back from C{source} as blocks finish.  Without C{source}, the number of
+    blocks held in memory is not limited."""
+
+    blockSize = BLOCK_SIZE
+    maxPendingBlocks = 4
+
+    def __init__(self, filename, blocksfilename, method, source=None):
+        if method not in METHODS:
+            raise ValueError("unknown compression method '%s'" % (method,))
+        self.method = method
+        self.source = source
+        self.outfile = open(filename, "wb")
+        self.blocksfile = open(blocksfilename, "wb")
+        self.pending = []
+        self.pendingSize = 0
+        self.received = 0 # all data passed to write()
+        self.offset = 0 # uncompressed data submitted for compression
+        self.compressedOffset = 0
+        self.inFlight = 0 # blocks being compressed
+        self.lagging = False # data after offset is only in source
+        self.finishing = None
+        self.writing = defer.succeed(None)
+
+    def write(self, data):
+        self.received += len(data)
+        if self.lagging:
+            return
+        self.pending.append(data)
+        self.pendingSize += len(data)
+        if self.pendingSize >= self.blockSize:
+            if (self.source is not None
+                    and self.inFlight >= self.maxPendingBlocks):
+                # compression is falling behind, so leave this data in the
+                # source until it catches up
+                self.pending = []
+                self.pendingSize = 0
+                self.lagging = True
+            else:
+                self._flushBlock()
+
+    def finish(self):
+        """Compress any remaining data and close the output files.
+
+        @returns: Deferred that fires when all blocks are written
+        """
+        self.finishing = defer.Deferred()
+        d = self.finishing
+        self._catchUp()
+        return d
+
+    def _catchUp(self):
+        # submit blocks read back from the source while there is room
+        while self.lagging and self.inFlight < self.maxPendingBlocks:
+            self.source.seek(self.offset)
+            data = self.source.read(min(self.blockSize,
+                                        self.received - self.offset))
+            self.pending = [ data ]
+            self.pendingSize = len(data)
+            if len(data) < self.blockSize:
+                self.lagging = False
+            else:
+                self._flushBlock()
+
+        if self.finishing and not self.lagging:
+            if self.pendingSize:
+                self._flushBlock()
+            finishing = self.finishing
+            self.finishing = None
+            d = self.writing
+            self.writing = None
+            def close(res):
+                self.outfile.close()
+                self.blocksfile.close()
+                return res
+            d.addBoth(close)
+            d.chainDeferred(finishing)
+
+    def _flushBlock(self):
+        data = "".join(self.pending)
+        self.pending = []
+        self.pendingSize = 0
+        offset = self.offset
+        self.offset += len(data)
+
+        self.inFlight += 1
+        compress_d = threads.deferToThread(compressBlock, self.method, data)
+        compress_d.addBoth(self._blockCompressed)
+        # wait for the previous block to be written first
+        self.writing.addCallback(lambda _ : compress_d)
+        self.writing.addCallback(self._writeBlock, offset)
+
+    def _blockCompressed(self, res):
+        self.inFlight -= 1
+        if self.lagging:
+            self._catchUp()
+        return res
+
+    def _writeBlock(self, compressed, offset):
+        self.blocksfile.write(struct.pack(blockRecordFormat,
+                                          offset, self.compressedOffset))
+        self.outfile.write(compressed)
+        self.compressedOffset += len(compressed)
+
+class BlockCompressedFile:
+    """A read-only file-like object giving the uncompressed contents of a
+    block-compressed log.  Seeking decompresses only the block containing
+    the new position, and at most one block is held in memory."""
+
+    def __init__(self, filename, blocksfilename, method):
+        if method not in METHODS:
+            raise ValueError("unknown compression method '%s'" % (method,))
+        self.method = method
+        self.blocks = readBlocks(blocksfilename)
+        self.offsets = [ b[0] for b in self.blocks ]
+        self.f = open(filename, "rb")
+        self.pos = 0
+        self.buf = ""
+        self.bufOffset = 0
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self._getSize()
+        self.pos = max(0, offset)
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            start = self.pos - self.bufOffset
+            if not (0 <= start < len(self.buf)):
+                if not self._loadBlock(self.pos):
+                    break
+                start = self.pos - self.bufOffset
+            if size < 0:
+                piece = self.buf[start:]
+            else:
+                piece = self.buf[start:start+size]
+                size -= len(piece)
+            pieces.append(piece)
+            self.pos += len(piece)
+        return "".join(pieces)
+
+    def close(self):
+        self.f.close()
+        self.buf = ""
+
+    def _loadBlock(self, pos):
+        i = bisect.bisect_right(self.offsets, pos) - 1
+        if i < 0:
+            return False
+        offset, compressedOffset = self.blocks[i]
+        self.f.seek(compressedOffset)
+        if i + 1 < len(self.blocks):
+            data = self.f.read(self.blocks[i+1][1] - compressedOffset)
+        else:
+            data = self.f.read()
+        self.buf = decompressBlock(self.method, data)
+        self.bufOffset = offset
+        return pos - offset < len(self.buf)
+
+    def _getSize(self):
+        if not self.blocks:
+            return 0
+        self._loadBlock(self.blocks[-1][0])
+        return self.bufOffset + len(self.buf)
+
+class MultiStreamBZ2File:
+    """A read-only file-like object giving the uncompressed contents of a bz2
+    file which may hold several streams, as a block-compressed log does.
+    Python 2's BZ2File stops at the end of the first stream, so this is used
+    when the block index is missing.  The streams are decompressed one after
+    another; like BZ2File, seeking backwards starts again from the
+    beginning."""
+
+    readSize = 64*1024
+
+    def __init__(self, filename):
+        self.f = open(filename, "rb")
+        self._rewind()
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            while self._fill():
+                pass
+            offset += self.pos + len(self.buf)
+        offset = max(0, offset)
+        if offset < self.pos:
+            self._rewind()
+        while self.pos < offset:
+            if not self.buf and not self._fill():
+                break
+            skip = self.buf[:offset - self.pos]
+            self.buf = self.buf[len(skip):]
+            self.pos += len(skip)
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            if not self._fill():
+                break
+        if size < 0:
+            data, self.buf = self.buf, ""
+        else:
+            data, self.buf = self.buf[:size], self.buf[size:]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+        self.buf = ""
+
+    def _rewind(self):
+        self.f.seek(0)
+        self.decompressor = bz2.BZ2Decompressor()
+        # uncompressed data starting at pos
+        self.buf = ""
+        self.pos = 0
+
+    def _fill(self):
+        # decompress more of the file into buf, returning False at its end
+        while True:
+            data = self.f.read(self.readSize)
+            if not data:
+                return False
+            pieces = []
+            while data:
+                try:
+                    pieces.append(self.decompressor.decompress(data))
+                except EOFError:
+                    # the previous stream ended exactly at a read boundary
+                    self.decompressor = bz2.BZ2Decompressor()
+                    continue
+                data = self.decompressor.unused_data
+                if data:
+                    # the rest belongs to the next stream
+                    self.decompressor = bz2.BZ2Decompressor()
+            data = "".join(pieces)
+            if data:
+                self.buf += data
+                return True
+
+def openCompressedLog(basename):
+    """Open the block-compressed version of the log file C{basename}, if it
+    exists, returning a L{BlockCompressedFile} or None."""
+    blocksfilename = basename + ".blocks"
+    if not os.path.exists(blocksfilename):
+        return None
+    for method in METHODS:
+        filename = basename + "." + method
+        if os.path.exists(filename):
+            return BlockCompressedFile(filename, blocksfilename, method)
+    return None
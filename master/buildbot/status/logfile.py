@@ -14,14 +14,14 @@
 # Copyright Buildbot Team Members
 
 import os
-from cStringIO import StringIO
-from bz2 import BZ2File
+import struct
 from gzip import GzipFile
 
 from zope.interface import implements
 from twisted.python import log, runtime
 from twisted.internet import defer, threads, reactor
 from buildbot.util import netstrings
+from buildbot.status import logcompress
 from buildbot.util.eventual import eventually
 from buildbot import interfaces
 
@@ -29,6 +29,12 @@ STDOUT = interfaces.LOG_CHANNEL_STDOUT
 STDERR = interfaces.LOG_CHANNEL_STDERR
 HEADER = interfaces.LOG_CHANNEL_HEADER
 ChunkTypes = ["stdout", "stderr", "header"]
+# channels whose chunks make up the text of a log, as returned by getText
+TextChannels = (STDOUT, STDERR)
+
+# filenames of logs whose compression is in progress, and whose temporary
+# output files must not be removed as stale
+_compressingLogs = set()
 
 class LogFileScanner(netstrings.NetstringParser):
     def __init__(self, chunk_cb, channels=[]):
@@ -41,6 +47,150 @@ class LogFileScanner(netstrings.NetstringParser):
         if not self.channels or (channel in self.channels):
             self.chunk_cb((channel, line[1:]))
 
+def readChunks(f, offset=0, remaining=None, bufsize=2048):
+    """Generate (fileOffset, channel, text) for each of the netstring-encoded
+    chunks in the log file C{f}, starting at C{offset}, which must be the
+    beginning of a chunk.  If C{remaining} is not None, no more than that many
+    bytes are read.  The file is re-positioned before every read, so it may
+    be shared with a writer, as is the case for a running log."""
+    buf = ""
+    bufOffset = offset # file offset of buf[0]
+    readOffset = offset
+
+    def read(size):
+        if remaining is not None:
+            size = min(size, remaining - (readOffset - offset))
+            if size <= 0:
+                return ""
+        f.seek(readOffset)
+        return f.read(size)
+
+    while True:
+        colon = buf.find(":")
+        while colon < 0:
+            data = read(bufsize)
+            if not data:
+                return
+            readOffset += len(data)
+            buf += data
+            colon = buf.find(":")
+        length = int(buf[:colon])
+        end = colon + 1 + length + 1 # including the trailing comma
+        while len(buf) < end:
+            data = read(max(bufsize, end - len(buf)))
+            if not data:
+                return # a partially-written chunk
+            readOffset += len(data)
+            buf += data
+        yield (bufOffset, int(buf[colon+1]), buf[colon+2:end-1])
+        buf = buf[end:]
+        bufOffset += end
+
+class LogChunkIndex:
+    """An index of the chunks in a log file, kept in a sidecar file next to
+    it and written as the chunks are merged into the log.  Each record gives a
+    chunk's channel, its offset in the log file, and the offset and size of
+    its text within the text of the log (as returned by L{LogFile.getText}).
+    Chunks on other channels, such as headers, have an offset but do not add
+    to the text of the log.
+
+    The records have a fixed size, so any chunk can be found without reading
+    the records before it, and a text offset can be found with a binary
+    search.  The index for a log that predates this class is built by
+    L{rebuild}."""
+
+    recordFormat = "!BQQL" # channel, file offset, text offset, size
+    recordSize = struct.calcsize(recordFormat)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.appendfile = None
+        self.textLength = 0
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def create(self):
+        """Start a new, empty index, replacing any existing one, and keep it
+        open for L{append}."""
+        self.appendfile = open(self.filename, "wb")
+        self.textLength = 0
+
+    def append(self, channel, fileOffset, size):
+        """Add a record for a chunk that has just been written to the end of
+        the log file."""
+        self.appendfile.write(struct.pack(self.recordFormat, channel,
+                                          fileOffset, self.textLength, size))
+        # readers use their own file handle
+        self.appendfile.flush()
+        if channel in TextChannels:
+            self.textLength += size
+
+    def close(self):
+        if self.appendfile:
+            self.appendfile.close()
+            self.appendfile = None
+
+    def rebuild(self, f):
+        """Re-create the index from the complete log file C{f}."""
+        self.create()
+        try:
+            for fileOffset, channel, text in readChunks(f):
+                self.append(channel, fileOffset, len(text))
+        finally:
+            self.close()
+
+    def __len__(self):
+        try:
+            return os.path.getsize(self.filename) // self.recordSize
+        except OSError:
+            return 0
+
+    def getChunk(self, n):
+        """Return the record for chunk C{n} as a tuple (channel, fileOffset,
+        textOffset, size)."""
+        if n < 0 or n >= len(self):
+            raise IndexError("no such chunk %d" % n)
+        f = open(self.filename, "rb")
+        try:
+            return self._readRecord(f, n)
+        finally:
+            f.close()
+
+    def getTextLength(self):
+        """Return the length of the text of the indexed chunks."""
+        n = len(self)
+        if not n:
+            return 0
+        channel, fileOffset, textOffset, size = self.getChunk(n - 1)
+        if channel in TextChannels:
+            return textOffset + size
+        return textOffset
+
+    def findTextOffset(self, textOffset):
+        """Return the number of the chunk containing the given offset into the
+        text of the log, or the number of chunks if the offset is beyond the
+        end of the indexed text."""
+        lo, hi = 0, len(self)
+        f = open(self.filename, "rb")
+        try:
+            while lo < hi:
+                mid = (lo + hi) // 2
+                channel, _, chunkOffset, size = self._readRecord(f, mid)
+                if channel not in TextChannels:
+                    size = 0
+                if chunkOffset + size <= textOffset:
+                    lo = mid + 1
+                else:
+                    hi = mid
+        finally:
+            f.close()
+        return lo
+
+    def _readRecord(self, f, n):
+        f.seek(n * self.recordSize)
+        return struct.unpack(self.recordFormat, f.read(self.recordSize))
+
 class LogFileProducer:
     """What's the plan?
 
@@ -87,20 +237,8 @@ class LogFileProducer:
 
     def getChunks(self):
         f = self.logfile.getFile()
-        offset = 0
-        chunks = []
-        p = LogFileScanner(chunks.append)
-        f.seek(offset)
-        data = f.read(self.BUFFERSIZE)
-        offset = f.tell()
-        while data:
-            p.dataReceived(data)
-            while chunks:
-                c = chunks.pop(0)
-                yield c
-            f.seek(offset)
-            data = f.read(self.BUFFERSIZE)
-            offset = f.tell()
+        for fileOffset, channel, text in readChunks(f, bufsize=self.BUFFERSIZE):
+            yield (channel, text)
         del f
 
         # now subscribe them to receive new entries
@@ -205,7 +343,12 @@ class LogFile:
     BUFFERSIZE = 2048
     filename = None # relative to the Builder's basedir
     openfile = None
+    chunkIndex = None
     compressMethod = "bz2"
+    # compress the log while it is written, once it exceeds this size; this
+    # is set from the builder's logCompressionLimit
+    logCompressionLimit = False
+    compressor = None
 
     def __init__(self, parent, name, logfilename):
         """
@@ -230,6 +373,8 @@ class LogFile:
         if not os.path.exists(dirname):
             os.makedirs(dirname)
         self.openfile = open(fn, "w+")
+        self.chunkIndex = LogChunkIndex(self.getIndexFilename())
+        self.chunkIndex.create()
         self.runEntries = []
         self.watchers = []
         self.finishedWatchers = []
@@ -238,6 +383,23 @@ class LogFile:
     def getFilename(self):
         return os.path.join(self.step.build.builder.basedir, self.filename)
 
+    def getIndexFilename(self):
+        return self.getFilename() + ".idx"
+
+    def getBlocksFilename(self):
+        return self.getFilename() + ".blocks"
+
+    def getChunkIndex(self):
+        """Return the L{LogChunkIndex} for this log, building it from the log
+        file if the log was written before indexes were kept."""
+        if self.chunkIndex is None:
+            index = LogChunkIndex(self.getIndexFilename())
+            if not index.exists():
+                log.msg("building chunk index for %s" % self.getFilename())
+                index.rebuild(self.getFile())
+            self.chunkIndex = index
+        return self.chunkIndex
+
     def hasContents(self):
         return os.path.exists(self.getFilename() + '.bz2') or \
             os.path.exists(self.getFilename() + '.gz') or \
@@ -265,9 +427,16 @@ class LogFile:
             # don't close it!
             return self.openfile
         # otherwise they get their own read-only handle
-        # try a compressed log first
+        self._removeStaleCompressFiles()
+        # try a block-compressed log first, which can be read from any offset
+        # without decompressing what comes before it
+        f = logcompress.openCompressedLog(self.getFilename())
+        if f:
+            return f
+        # then logs compressed by older versions, or whose block index is
+        # missing; these may hold several bz2 streams
         try:
-            return BZ2File(self.getFilename() + ".bz2", "r")
+            return logcompress.MultiStreamBZ2File(self.getFilename() + ".bz2")
         except IOError:
             pass
         try:
@@ -318,31 +487,14 @@ class LogFile:
 
     def _generateChunks(self, f, offset, remaining, leftover,
                         channels, onlyText):
-        chunks = []
-        p = LogFileScanner(chunks.append, channels)
-        f.seek(offset)
-        if remaining is not None:
-            data = f.read(min(remaining, self.BUFFERSIZE))
-            remaining -= len(data)
-        else:
-            data = f.read(self.BUFFERSIZE)
-
-        offset = f.tell()
-        while data:
-            p.dataReceived(data)
-            while chunks:
-                channel, text = chunks.pop(0)
-                if onlyText:
-                    yield text
-                else:
-                    yield (channel, text)
-            f.seek(offset)
-            if remaining is not None:
-                data = f.read(min(remaining, self.BUFFERSIZE))
-                remaining -= len(data)
+        for fileOffset, channel, text in readChunks(f, offset, remaining,
+                                                    self.BUFFERSIZE):
+            if channels and channel not in channels:
+                continue
+            if onlyText:
+                yield text
             else:
-                data = f.read(self.BUFFERSIZE)
-            offset = f.tell()
+                yield (channel, text)
         del f
 
         if leftover:
@@ -353,13 +505,94 @@ class LogFile:
 
     def readlines(self, channel=STDOUT):
         """Return an iterator that produces newline-terminated lines,
-        excluding header chunks."""
-        # TODO: make this memory-efficient, by turning it into a generator
-        # that retrieves chunks as necessary, like a pull-driven version of
-        # twisted.protocols.basic.LineReceiver
-        alltext = "".join(self.getChunks([channel], onlyText=True))
-        io = StringIO(alltext)
-        return io.readlines()
+        excluding header chunks.  Chunks are read from the log file as the
+        lines are consumed."""
+        pieces = []
+        for text in self.getChunks([channel], onlyText=True):
+            start = 0
+            nl = text.find("\n")
+            while nl >= 0:
+                pieces.append(text[start:nl+1])
+                yield "".join(pieces)
+                pieces = []
+                start = nl + 1
+                nl = text.find("\n", start)
+            if start < len(text):
+                pieces.append(text[start:])
+        if pieces:
+            yield "".join(pieces)
+
+    def getTailLines(self, count, channels=[STDOUT, STDERR]):
+        """Return a list of the last C{count} lines of the given channels of
+        the log, reading only as many chunks as necessary from the end of the
+        log file.  The last line may not be newline-terminated."""
+        pieces = []
+        newlines = 0
+        for channel, text in reversed(self.runEntries):
+            if channel in channels:
+                pieces.append(text)
+                newlines += text.count("\n")
+
+        # a line is only complete once the newline before it has been read
+        index = self.getChunkIndex()
+        f = None
+        n = len(index) - 1
+        while n >= 0 and newlines <= count:
+            channel, fileOffset, textOffset, size = index.getChunk(n)
+            if channel in channels:
+                if f is None:
+                    f = self.getFile()
+                text = readChunks(f, fileOffset).next()[2]
+                pieces.append(text)
+                newlines += text.count("\n")
+            n -= 1
+        del f
+
+        pieces.reverse()
+        lines = "".join(pieces).splitlines(True)
+        return lines[-count:]
+
+    def getTextLength(self):
+        """Return the length of the text of the log, as would be returned by
+        L{getText}."""
+        length = self.getChunkIndex().getTextLength()
+        for channel, text in self.runEntries:
+            if channel in TextChannels:
+                length += len(text)
+        return length
+
+    def getTextRange(self, start, end=None):
+        """Return the text of the log from offset C{start} up to, but not
+        including, offset C{end}, or the end of the log if C{end} is None.
+        This is equivalent to C{getText()[start:end]} for non-negative
+        offsets, but reads only the chunks that contain the text."""
+        index = self.getChunkIndex()
+        n = index.findTextOffset(start)
+        pieces = []
+        if n < len(index):
+            channel, fileOffset, firstOffset, size = index.getChunk(n)
+            textOffset = firstOffset
+            f = self.getFile()
+            for fileOffset, channel, text in readChunks(f, fileOffset,
+                                                    bufsize=self.BUFFERSIZE):
+                if end is not None and textOffset >= end:
+                    break
+                if channel in TextChannels:
+                    pieces.append(text)
+                    textOffset += len(text)
+            del f
+        else:
+            firstOffset = index.getTextLength()
+
+        # the not-yet-merged text follows the indexed chunks
+        for channel, text in self.runEntries:
+            if channel in TextChannels:
+                pieces.append(text)
+
+        text = "".join(pieces)
+        if end is None:
+            return text[start-firstOffset:]
+        return text[start-firstOffset:end-firstOffset]
 
     def subscribe(self, receiver, catchup):
         if self.finished:
@@ -394,13 +627,42 @@ class LogFile:
         offset = 0
         while offset < len(text):
             size = min(len(text)-offset, self.chunkSize)
-            f.write("%d:%d" % (1 + size, channel))
-            f.write(text[offset:offset+size])
-            f.write(",")
+            if self.chunkIndex is not None:
+                self.chunkIndex.append(channel, f.tell(), size)
+            data = "%d:%d%s," % (1 + size, channel, text[offset:offset+size])
+            f.write(data)
+            if self.compressor:
+                self.compressor.write(data)
             offset += size
         self.runEntries = []
         self.runLength = 0
 
+        if (self.compressor is None and self.logCompressionLimit is not False
+                and f.tell() > self.logCompressionLimit):
+            self._startCompressor()
+
+    def _startCompressor(self):
+        # from now on, compress each chunk as it is merged, beginning with
+        # what has already been written, so that compressLog need not
+        # re-read the whole log
+        f = self.openfile
+        try:
+            self.compressor = logcompress.LogCompressor(
+                    self.getFilename() + "." + self.compressMethod + ".tmp",
+                    self.getBlocksFilename() + ".tmp", self.compressMethod,
+                    source=f)
+        except (IOError, ValueError):
+            log.err(None, "while starting compression of %s"
+                                % self.getFilename())
+            return
+        _compressingLogs.add(self.getFilename())
+        f.seek(0)
+        while True:
+            data = f.read(logcompress.BLOCK_SIZE)
+            if not data:
+                break
+            self.compressor.write(data)
+
     def addEntry(self, channel, text):
         assert not self.finished
 
@@ -470,6 +732,8 @@ class LogFile:
             # filehandle will be released and automatically closed.
             self.openfile.flush()
             del self.openfile
+        if self.chunkIndex is not None:
+            self.chunkIndex.close()
         self.finished = True
         watchers = self.finishedWatchers
         self.finishedWatchers = []
@@ -479,47 +743,56 @@ class LogFile:
 
 
     def compressLog(self):
-        # bail out if there's no compression support
-        if self.compressMethod == "bz2":
-            compressed = self.getFilename() + ".bz2.tmp"
-        elif self.compressMethod == "gz":
-            compressed = self.getFilename() + ".gz.tmp"
-        d = threads.deferToThread(self._compressLog, compressed)
-        d.addCallback(self._renameCompressedLog, compressed)
-        d.addErrback(self._cleanupFailedCompress, compressed)
+        compressed = self.getFilename() + "." + self.compressMethod + ".tmp"
+        blocks = self.getBlocksFilename() + ".tmp"
+        _compressingLogs.add(self.getFilename())
+        if self.compressor:
+            # most of the log has been compressed already
+            d = self.compressor.finish()
+            self.compressor = None
+        else:
+            d = threads.deferToThread(logcompress.compressFile,
+                    self.getFile(), compressed, blocks, self.compressMethod)
+        d.addCallback(self._renameCompressedLog, compressed, blocks)
+        d.addErrback(self._cleanupFailedCompress, compressed, blocks)
+        def done(res):
+            _compressingLogs.discard(self.getFilename())
+            return res
+        d.addBoth(done)
         return d
 
-    def _compressLog(self, compressed):
-        infile = self.getFile()
-        if self.compressMethod == "bz2":
-            cf = BZ2File(compressed, 'w')
-        elif self.compressMethod == "gz":
-            cf = GzipFile(compressed, 'w')
-        bufsize = 1024*1024
-        while True:
-            buf = infile.read(bufsize)
-            cf.write(buf)
-            if len(buf) < bufsize:
-                break
-        cf.close()
-    def _renameCompressedLog(self, rv, compressed):
-        if self.compressMethod == "bz2":
-            filename = self.getFilename() + '.bz2'
-        else:
-            filename = self.getFilename() + '.gz'
-        if runtime.platformType  == 'win32':
-            # windows cannot rename a file on top of an existing one, so
-            # fall back to delete-first. There are ways this can fail and
-            # lose the builder's history, so we avoid using it in the
-            # general (non-windows) case
-            if os.path.exists(filename):
-                os.unlink(filename)
-        os.rename(compressed, filename)
+    def _renameCompressedLog(self, rv, compressed, blocks):
+        filename = self.getFilename() + '.' + self.compressMethod
+        # the block index goes first, since the compressed log is not used
+        # without it
+        for tmpname, name in [ (blocks, self.getBlocksFilename()),
+                               (compressed, filename) ]:
+            if runtime.platformType  == 'win32':
+                # windows cannot rename a file on top of an existing one, so
+                # fall back to delete-first. There are ways this can fail and
+                # lose the builder's history, so we avoid using it in the
+                # general (non-windows) case
+                if os.path.exists(name):
+                    os.unlink(name)
+            os.rename(tmpname, name)
         _tryremove(self.getFilename(), 1, 5)
-    def _cleanupFailedCompress(self, failure, compressed):
+    def _removeStaleCompressFiles(self):
+        # remove the temporary output of a compression that never completed,
+        # e.g., because the master stopped before the step finished
+        filename = self.getFilename()
+        if filename in _compressingLogs:
+            return
+        for tmpname in [ filename + "." + self.compressMethod + ".tmp",
+                         self.getBlocksFilename() + ".tmp" ]:
+            if os.path.exists(tmpname):
+                log.msg("removing stale %s" % tmpname)
+                _tryremove(tmpname, 1, 5)
+
+    def _cleanupFailedCompress(self, failure, compressed, blocks):
         log.msg("failed to compress %s" % self.getFilename())
-        if os.path.exists(compressed):
-            _tryremove(compressed, 1, 5)
+        for tmpname in compressed, blocks:
+            if os.path.exists(tmpname):
+                _tryremove(tmpname, 1, 5)
         failure.trap() # reraise the failure
 
     # persistence stuff
@@ -533,6 +806,8 @@ class LogFile:
             del d['finished']
         if d.has_key('openfile'):
             del d['openfile']
+        d.pop('chunkIndex', None)
+        d.pop('compressor', None)
         return d
 
     def __setstate__(self, d):
@@ -549,6 +824,8 @@ class LogFile:
         self.filename = logfilename
         if not os.path.exists(self.getFilename()):
             self.openfile = open(self.getFilename(), "w")
+            self.chunkIndex = LogChunkIndex(self.getIndexFilename())
+            self.chunkIndex.create()
             self.finished = False
             for channel,text in self.entries:
                 self.addEntry(channel, text)
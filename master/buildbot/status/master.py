@@ -23,7 +23,7 @@ from buildbot import interfaces
 from buildbot.util import bbcollections
 from buildbot.util.eventual import eventually
 from buildbot.changes import changes
-from buildbot.status import buildset, builder, buildrequest
+from buildbot.status import buildset, builder, buildrequest, buildindex
 
 class Status:
     """
@@ -55,6 +55,8 @@ class Status:
         self._builder_observers = bbcollections.KeyedSets()
         self._buildreq_observers = bbcollections.KeyedSets()
         self._buildset_finished_waiters = bbcollections.KeyedSets()
+        self._buildTimeline = None
+        self._sourceStampIndex = None
 
     @property
     def shuttingDown(self):
@@ -179,65 +181,78 @@ class Status:
         d.addCallback(make_status_objects)
         return d
 
+    def getBuildTimeline(self):
+        """
+        Get the master-wide index of finished builds, re-creating it from the
+        builders' build indexes if it does not exist yet.
+
+        @rtype: L{buildbot.status.buildindex.BuildTimeline}
+        """
+        if self._buildTimeline is None:
+            self._buildTimeline = buildindex.BuildTimeline(self.basedir)
+            if not self._buildTimeline.exists():
+                log.msg("creating build timeline")
+                self._buildTimeline.rebuild([ self.getBuilder(bn)
+                                for bn in self.getBuilderNames() ])
+        return self._buildTimeline
+
+    def getSourceStampIndex(self):
+        """
+        Get the index of builds by source stamp, creating it from the
+        builders' build indexes and current builds if necessary.
+
+        @rtype: L{buildbot.status.buildindex.SourceStampIndex}
+        """
+        if self._sourceStampIndex is None:
+            index = buildindex.SourceStampIndex()
+            for bn in self.getBuilderNames():
+                b = self.getBuilder(bn)
+                for summary in b.getBuildIndex().getSummaries():
+                    revision = summary.get('got_revision', summary['revision'])
+                    index.add(bn, summary['number'], summary['branch'],
+                              revision, summary['start'],
+                              summary.get('patch'))
+                for build in b.getCurrentBuilds():
+                    ss = build.getSourceStamp(absolute=True)
+                    index.add(bn, build.getNumber(), ss.branch, ss.revision,
+                              build.getTimes()[0],
+                              buildindex.patchKey(ss.patch))
+            self._sourceStampIndex = index
+        return self._sourceStampIndex
+
     def generateFinishedBuilds(self, builders=[], branches=[],
                                num_builds=None, finished_before=None,
-                               max_search=200):
-
-        def want_builder(bn):
-            if builders:
-                return bn in builders
-            return True
-        builder_names = [bn
-                         for bn in self.getBuilderNames()
-                         if want_builder(bn)]
-
-        # 'sources' is a list of generators, one for each Builder we're
-        # using. When the generator is exhausted, it is replaced in this list
-        # with None.
-        sources = []
-        for bn in builder_names:
-            b = self.getBuilder(bn)
-            g = b.generateFinishedBuilds(branches,
-                                         finished_before=finished_before,
-                                         max_search=max_search)
-            sources.append(g)
-
-        # next_build the next build from each source
-        next_build = [None] * len(sources)
-
-        def refill():
-            for i,g in enumerate(sources):
-                if next_build[i]:
-                    # already filled
-                    continue
-                if not g:
-                    # already exhausted
-                    continue
-                try:
-                    next_build[i] = g.next()
-                except StopIteration:
-                    next_build[i] = None
-                    sources[i] = None
-
+                               max_search=200, results=None):
+        builder_names = set(self.getBuilderNames())
+        if builders:
+            builder_names &= set(builders)
+
+        # walk the timeline, most recent first, counting the builds examined
+        # for each builder; builders whose max_search is used up are removed
+        # from builder_names
+        searched = {}
         got = 0
-        while True:
-            refill()
-            # find the latest build among all the candidates
-            candidates = [(i, b, b.getTimes()[1])
-                          for i,b in enumerate(next_build)
-                          if b is not None]
-            candidates.sort(lambda x,y: cmp(x[2], y[2]))
-            if not candidates:
+        for (end, bn, number, build_results, branch) in \
+                self.getBuildTimeline().generateEntries(finished_before):
+            if not builder_names:
                 return
-
-            # and remove it from the list
-            i, build, finshed_time = candidates[-1]
-            next_build[i] = None
+            if bn not in builder_names:
+                continue
+            searched[bn] = searched.get(bn, 0) + 1
+            if max_search is not None and searched[bn] >= max_search:
+                builder_names.discard(bn)
+            if branches and branch not in branches:
+                continue
+            if results is not None and build_results not in results:
+                continue
+            # the build may have been deleted from disk
+            build = self.getBuilder(bn).getBuild(number)
+            if build is None:
+                continue
             got += 1
             yield build
-            if num_builds is not None:
-                if got >= num_builds:
-                    return
+            if num_builds is not None and got >= num_builds:
+                return
 
     def subscribe(self, target):
         self.watchers.append(target)
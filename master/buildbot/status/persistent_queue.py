@@ -17,6 +17,8 @@
 from collections import deque
 import os
 import pickle
+import struct
+import sys
 
 from zope.interface import implements, Interface
 
@@ -37,6 +39,10 @@ def WriteFile(path, buf):
         f.close()
 
 
+_HEADER = '>I'
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+
 class IQueue(Interface):
     """Abstraction of a queue."""
     def pushItem(item):
@@ -127,20 +133,102 @@ class MemoryQueue(object):
         return self._maxItems
 
 
+class _Segment(object):
+    """One segment file of a DiskQueue.
+
+    Each item is stored as its length, a 4 bytes big-endian integer, followed
+    by its pickled data. offsets holds the position of every item in the
+    file."""
+
+    def __init__(self, path, id):
+        self.path = path
+        self.id = id
+        self.offsets = []
+        self.size = 0
+
+    def scan(self):
+        """Builds the offset index from the file, truncating a partially
+        written item at its end."""
+        self.offsets = []
+        self.size = 0
+        fileSize = os.path.getsize(self.path)
+        f = open(self.path, 'rb')
+        try:
+            while True:
+                header = f.read(_HEADER_SIZE)
+                if len(header) < _HEADER_SIZE:
+                    break
+                length = struct.unpack(_HEADER, header)[0]
+                end = self.size + _HEADER_SIZE + length
+                if end > fileSize:
+                    break
+                f.seek(length, 1)
+                self.offsets.append(self.size)
+                self.size = end
+        finally:
+            f.close()
+        if fileSize > self.size:
+            f = open(self.path, 'r+b')
+            try:
+                f.truncate(self.size)
+            finally:
+                f.close()
+
+    def read(self, index, count):
+        """Returns the pickled data of count items starting at index."""
+        if count <= 0:
+            return []
+        start = self.offsets[index]
+        if index + count < len(self.offsets):
+            end = self.offsets[index + count]
+        else:
+            end = self.size
+        f = open(self.path, 'rb')
+        try:
+            f.seek(start)
+            buf = f.read(end - start)
+        finally:
+            f.close()
+        ret = []
+        pos = 0
+        while pos < len(buf):
+            length = struct.unpack(_HEADER, buf[pos:pos + _HEADER_SIZE])[0]
+            pos += _HEADER_SIZE
+            ret.append(buf[pos:pos + length])
+            pos += length
+        return ret
+
+
 class DiskQueue(object):
     """Keeps a list of abstract items and serializes it to the disk.
 
+    The items are appended to segment files, 'segment.<id>', holding up to
+    segmentItems items each. The offset of every item is kept in memory and
+    the read pointer is checkpointed to the 'state' file, so popping items
+    doesn't touch them on disk; a segment file is deleted once all of its
+    items were popped.
+
+    Appended items are flushed and fsync'ed every syncItems items and on
+    save(). A crash can lose the items pushed since the last sync and
+    deliver again the items popped since the last checkpoint.
+
+    Items left by the older layout, one file per item, are moved to a
+    segment when the queue is loaded.
+
     Use pickle for serialization."""
     implements(IQueue)
 
     def __init__(self, path, maxItems=None, pickleFn=pickle.dumps,
-                 unpickleFn=pickle.loads):
+                 unpickleFn=pickle.loads, segmentItems=1000, syncItems=100):
         """
         @path: directory to save the items.
         @maxItems: maximum number of items to keep on disk, flush the
         older ones.
         @pickleFn: function used to pack the items to disk.
         @unpickleFn: function used to unpack items from disk.
+        @segmentItems: number of items appended to a segment file before
+        starting a new one.
+        @syncItems: number of items appended between two fsync.
         """
         self.path = path
         self._maxItems = maxItems
@@ -150,29 +238,31 @@ class DiskQueue(object):
             os.mkdir(self.path)
         self.pickleFn = pickleFn
         self.unpickleFn = unpickleFn
+        self.segmentItems = segmentItems
+        self.syncItems = syncItems
 
         # Total number of items.
         self._nbItems = 0
-        # The actual items id start at one.
-        self.firstItemId = 0
-        self.lastItemId = 0
+        # Segments, oldest first.
+        self._segments = deque()
+        # Index of the first item not yet popped in self._segments[0].
+        self._readIndex = 0
+        # File object appending to self._segments[-1].
+        self._tail = None
+        # Number of items appended since the last fsync.
+        self._unsynced = 0
+        # True if the read pointer moved since the last checkpoint.
+        self._dirty = False
         self._loadFromDisk()
 
     def pushItem(self, item):
         ret = None
         if self._nbItems == self._maxItems:
-            id = self._findNext(self.firstItemId)
-            path = os.path.join(self.path, str(id))
-            ret = self.unpickleFn(ReadFile(path))
-            os.remove(path)
-            self.firstItemId = id + 1
+            ret = self.unpickleFn(self._readRaw(1)[0])
+            self._advance(1)
         else:
             self._nbItems += 1
-        self.lastItemId += 1
-        path = os.path.join(self.path, str(self.lastItemId))
-        if os.path.exists(path):
-            raise IOError('%s already exists.' % path)
-        WriteFile(path, self.pickleFn(item))
+        self._append(self.pickleFn(item))
         return ret
 
     def insertBackChunk(self, chunk):
@@ -181,41 +271,30 @@ class DiskQueue(object):
         if excess > 0:
             ret = chunk[0:excess]
             chunk = chunk[excess:]
-        for i in reversed(chunk):
-            self.firstItemId -= 1
-            path = os.path.join(self.path, str(self.firstItemId))
-            if os.path.exists(path):
-                raise IOError('%s already exists.' % path)
-            WriteFile(path, self.pickleFn(i))
-            self._nbItems += 1
+        if chunk:
+            self._insertBackRaw([self.pickleFn(i) for i in chunk])
         return ret
 
     def popChunk(self, nbItems=None):
         if nbItems is None:
             nbItems = self._maxItems
-        ret = []
-        for i in range(nbItems):
-            if self._nbItems == 0:
-                break
-            id = self._findNext(self.firstItemId)
-            path = os.path.join(self.path, str(id))
-            ret.append(self.unpickleFn(ReadFile(path)))
-            os.remove(path)
-            self._nbItems -= 1
-            self.firstItemId = id + 1
+        nbItems = min(nbItems, self._nbItems)
+        if nbItems <= 0:
+            return []
+        ret = [self.unpickleFn(x) for x in self._readRaw(nbItems)]
+        self._nbItems -= nbItems
+        if self._nbItems:
+            self._advance(nbItems)
+            self._checkpoint()
+        else:
+            self._clear()
         return ret
 
     def save(self):
-        pass
+        self._sync()
 
     def items(self):
-        """Warning, very slow."""
-        ret = []
-        for id in range(self.firstItemId, self.lastItemId + 1):
-            path = os.path.join(self.path, str(id))
-            if os.path.exists(path):
-                ret.append(self.unpickleFn(ReadFile(path)))
-        return ret
+        return [self.unpickleFn(x) for x in self._readRaw(self._nbItems)]
 
     def nbItems(self):
         return self._nbItems
@@ -225,17 +304,147 @@ class DiskQueue(object):
 
     #### Protected functions
 
-    def _findNext(self, id):
+    def _segmentPath(self, id):
+        return os.path.join(self.path, 'segment.%d' % id)
+
+    def _readSegment(self, segment, index, count):
+        if self._tail and segment is self._segments[-1]:
+            self._tail.flush()
+        return segment.read(index, count)
+
+    def _readRaw(self, nbItems):
+        """Returns the pickled data of the nbItems oldest items."""
+        ret = []
+        index = self._readIndex
+        for segment in self._segments:
+            count = min(nbItems - len(ret), len(segment.offsets) - index)
+            ret.extend(self._readSegment(segment, index, count))
+            if len(ret) >= nbItems:
+                break
+            index = 0
+        return ret
+
+    def _advance(self, nbItems):
+        """Moves the read pointer by nbItems, deleting the segments that were
+        completely read."""
+        dropped = []
         while True:
-            path = os.path.join(self.path, str(id))
-            if os.path.isfile(path):
-                return id
-            id += 1
-        return None
+            head = self._segments[0]
+            count = min(nbItems, len(head.offsets) - self._readIndex)
+            self._readIndex += count
+            nbItems -= count
+            if (self._readIndex < len(head.offsets) or
+                len(self._segments) == 1):
+                break
+            dropped.append(self._segments.popleft())
+            self._readIndex = 0
+        assert nbItems == 0, "advanced past the last item"
+        self._dirty = True
+        if dropped:
+            # Checkpoint first so the state never points to a deleted segment.
+            self._checkpoint()
+            for segment in dropped:
+                os.remove(segment.path)
+
+    def _append(self, buf):
+        if (not self._segments or
+            len(self._segments[-1].offsets) >= self.segmentItems):
+            self._closeTail()
+            if self._segments:
+                id = self._segments[-1].id + 1
+            else:
+                id = 0
+            self._segments.append(_Segment(self._segmentPath(id), id))
+            self._tail = open(self._segments[-1].path, 'wb')
+        elif self._tail is None:
+            self._tail = open(self._segments[-1].path, 'ab')
+        segment = self._segments[-1]
+        segment.offsets.append(segment.size)
+        self._tail.write(struct.pack(_HEADER, len(buf)) + buf)
+        segment.size += _HEADER_SIZE + len(buf)
+        self._unsynced += 1
+        if self._unsynced >= self.syncItems:
+            self._sync()
+
+    def _insertBackRaw(self, bufs):
+        """Puts pickled items in front of the queue.
+
+        The unread items of the first segment are rewritten with them to a new
+        segment taking its place."""
+        count = len(bufs)
+        if self._segments:
+            head = self._segments[0]
+            id = head.id - 1
+            bufs = bufs + self._readSegment(head, self._readIndex,
+                                            len(head.offsets) - self._readIndex)
+        else:
+            head = None
+            id = 0
+        segment = _Segment(self._segmentPath(id), id)
+        f = open(segment.path, 'wb')
+        try:
+            for buf in bufs:
+                segment.offsets.append(segment.size)
+                f.write(struct.pack(_HEADER, len(buf)) + buf)
+                segment.size += _HEADER_SIZE + len(buf)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        if head is not None:
+            if head is self._segments[-1]:
+                self._closeTail()
+            self._segments.popleft()
+        self._segments.appendleft(segment)
+        self._nbItems += count
+        self._readIndex = 0
+        self._checkpoint()
+        if head is not None:
+            os.remove(head.path)
+
+    def _sync(self):
+        if self._tail:
+            self._tail.flush()
+            os.fsync(self._tail.fileno())
+        self._unsynced = 0
+        if self._dirty:
+            self._checkpoint()
+
+    def _checkpoint(self):
+        """Atomically saves the read pointer."""
+        self._dirty = False
+        if not self._segments:
+            return
+        path = os.path.join(self.path, 'state')
+        WriteFile(path + '.tmp',
+                  '%d %d\n' % (self._segments[0].id, self._readIndex))
+        if os.path.exists(path) and sys.platform == 'win32':
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+    def _closeTail(self):
+        if self._tail:
+            self._tail.flush()
+            os.fsync(self._tail.fileno())
+            self._tail.close()
+            self._tail = None
+            self._unsynced = 0
+
+    def _clear(self):
+        """Deletes everything once the queue is empty."""
+        self._closeTail()
+        for segment in self._segments:
+            os.remove(segment.path)
+        self._segments.clear()
+        self._readIndex = 0
+        self._dirty = False
+        path = os.path.join(self.path, 'state')
+        if os.path.exists(path):
+            os.remove(path)
 
     def _loadFromDisk(self):
-        """Loads the queue from disk upto self.maxMemoryItems items into
-        self.items.
+        """Loads the segments index and the read pointer from disk, and
+        migrates the items left in the older one file per item layout.
         """
         def SafeInt(item):
             try:
@@ -243,12 +452,49 @@ class DiskQueue(object):
             except ValueError:
                 return None
 
-        files = filter(None, [SafeInt(x) for x in os.listdir(self.path)])
-        files.sort()
-        self._nbItems = len(files)
-        if self._nbItems:
-            self.firstItemId = files[0]
-            self.lastItemId = files[-1]
+        legacy = []
+        segments = []
+        for name in os.listdir(self.path):
+            if name.startswith('segment.'):
+                id = SafeInt(name[len('segment.'):])
+                if id is not None:
+                    segments.append(id)
+            elif name == 'state.tmp':
+                os.remove(os.path.join(self.path, name))
+            else:
+                id = SafeInt(name)
+                if id is not None:
+                    legacy.append(id)
+        segments.sort()
+        legacy.sort()
+
+        headId, readIndex = None, 0
+        path = os.path.join(self.path, 'state')
+        if os.path.exists(path):
+            try:
+                headId, readIndex = [int(x) for x in ReadFile(path).split()]
+            except ValueError:
+                pass
+        for id in segments:
+            segment = _Segment(self._segmentPath(id), id)
+            if headId is not None and id < headId:
+                # Read before the last checkpoint but not deleted yet.
+                os.remove(segment.path)
+                continue
+            segment.scan()
+            self._segments.append(segment)
+        if self._segments and self._segments[0].id == headId:
+            self._readIndex = min(readIndex, len(self._segments[0].offsets))
+        self._nbItems = (sum([len(s.offsets) for s in self._segments]) -
+                         self._readIndex)
+
+        if legacy:
+            self._insertBackRaw([ReadFile(os.path.join(self.path, str(id)))
+                                 for id in legacy])
+            for id in legacy:
+                os.remove(os.path.join(self.path, str(id)))
+        if not self._nbItems:
+            self._clear()
 
 
 class PersistentQueue(object):
@@ -327,6 +573,7 @@ class PersistentQueue(object):
 
     def save(self):
         self.secondaryQueue.insertBackChunk(self.primaryQueue.popChunk())
+        self.secondaryQueue.save()
 
     def items(self):
         return self.primaryQueue.items() + self.secondaryQueue.items()
@@ -23,6 +23,7 @@ import logging
 import os
 import urllib
 import urlparse
+import weakref
 
 try:
     import simplejson as json
@@ -39,6 +40,45 @@ from twisted.python import log
 from twisted.web import client
 
 
+class SerializationCache(object):
+    """Memoizes the dictionaries of the status objects pushed by StatusPush.
+
+    Each object has a version, bumped by changed() when the object is
+    modified. asDict() only calls the object's asDict() again when its version
+    changed since the cached copy was made.
+    """
+
+    def __init__(self, filter=True):
+        """
+        @filter: when True, the dictionaries are passed through FilterOut.
+        """
+        self.filter = filter
+        self._versions = weakref.WeakKeyDictionary()
+        self._dicts = weakref.WeakKeyDictionary()
+
+    def changed(self, *objs):
+        for obj in objs:
+            try:
+                self._versions[obj] = self._versions.get(obj, 0) + 1
+            except TypeError:
+                # Not weakly referenceable, it is never cached.
+                pass
+
+    def asDict(self, obj):
+        try:
+            version = self._versions.get(obj, 0)
+            cached = self._dicts.get(obj)
+        except TypeError:
+            version, cached = None, None
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        data = obj.asDict()
+        if self.filter:
+            data = FilterOut(data)
+        if version is not None:
+            self._dicts[obj] = (version, data)
+        return data
+
 
 class StatusPush(StatusReceiverMultiService):
     """Event streamer to a abstract channel.
@@ -50,7 +90,8 @@ class StatusPush(StatusReceiverMultiService):
     """
 
     def __init__(self, serverPushCb, queue=None, path=None, filter=True,
-                 bufferDelay=1, retryDelay=5, blackList=None):
+                 bufferDelay=1, retryDelay=5, blackList=None,
+                 propertyDeltas=False):
         """
         @serverPushCb: callback to be used. It receives 'self' as parameter. It
         should call self.queueNextServerPush() when it's done to queue the next
@@ -66,6 +107,10 @@ class StatusPush(StatusReceiverMultiService):
         @retryDelay: amount of time between retries when no items were pushed on
         last serverPushCb call.
         @blackList: events that shouldn't be sent.
+        @propertyDeltas: when True, step events carry the build properties
+        set or changed since the previous event of the same build, as
+        'propertiesChanged', and the names of those removed, as
+        'propertiesRemoved', instead of the full 'properties' list.
         """
         StatusReceiverMultiService.__init__(self)
 
@@ -89,6 +134,10 @@ class StatusPush(StatusReceiverMultiService):
             return serverPushCb(self)
         self.serverPushCb = hookPushCb
         self.blackList = blackList
+        self.propertyDeltas = propertyDeltas
+        self.cache = SerializationCache(filter)
+        # Build properties last sent for each running build, by name.
+        self.sentProperties = weakref.WeakKeyDictionary()
 
         # Other defaults.
         # IDelayedCall object that represents the next queued push.
@@ -214,7 +263,7 @@ class StatusPush(StatusReceiverMultiService):
         - Queued to disk when the sink server is down
         - Pushed (along the other queued items) to the server
         """
-        if self.blackList and event in self.blackList:
+        if self.isBlackListed(event):
             return
         # First, generate the packet.
         packet = {}
@@ -227,8 +276,9 @@ class StatusPush(StatusReceiverMultiService):
         packet['payload'] = {}
         for obj_name, obj in objs.items():
             if hasattr(obj, 'asDict'):
-                obj = obj.asDict()
-            if self.filter:
+                # Already filtered.
+                obj = self.cache.asDict(obj)
+            elif self.filter:
                 obj = FilterOut(obj)
             packet['payload'][obj_name] = obj
         self.queue.pushItem(packet)
@@ -236,25 +286,59 @@ class StatusPush(StatusReceiverMultiService):
             # No task queued since it was probably idle, let's queue a task.
             return self.queueNextServerPush()
 
+    def isBlackListed(self, event):
+        """Returns True if the event is never pushed."""
+        return bool(self.blackList and event in self.blackList)
+
+    def stepProperties(self, build):
+        """Returns the build properties to send with a step event."""
+        properties = build.getProperties().asList()
+        if not self.propertyDeltas:
+            return {'properties': properties}
+        sent = self.sentProperties.get(build, {})
+        current = dict((p[0], p) for p in properties)
+        self.sentProperties[build] = current
+        return {
+            'propertiesChanged': [p for p in properties
+                                  if sent.get(p[0]) != p],
+            'propertiesRemoved': [name for name in sent
+                                  if name not in current],
+        }
+
+    def pushStep(self, event, build, step, **objs):
+        """Push an event for a step that changed."""
+        self.cache.changed(build, step)
+        # Property deltas are only recorded as sent when they are.
+        if self.isBlackListed(event):
+            return
+        objs.update(self.stepProperties(build))
+        self.push(event, step=step, **objs)
+
     #### Events
 
     def initialPush(self):
         # Push everything we want to push from the initial configuration.
+        self.cache.changed(self.status)
         self.push('start', status=self.status)
 
     def finalPush(self):
+        self.cache.changed(self.status)
         self.push('shutdown', status=self.status)
 
     def requestSubmitted(self, request):
+        self.cache.changed(request)
         self.push('requestSubmitted', request=request)
 
     def requestCancelled(self, builder, request):
+        self.cache.changed(builder, request)
         self.push('requestCancelled', builder=builder, request=request)
 
     def buildsetSubmitted(self, buildset):
+        self.cache.changed(buildset)
         self.push('buildsetSubmitted', buildset=buildset)
 
     def builderAdded(self, builderName, builder):
+        self.cache.changed(builder)
         self.push('builderAdded', builderName=builderName, builder=builder)
         return self
 
@@ -262,52 +346,49 @@ class StatusPush(StatusReceiverMultiService):
         self.push('builderChangedState', builderName=builderName, state=state)
 
     def buildStarted(self, builderName, build):
+        self.cache.changed(build)
+        if self.propertyDeltas and not self.isBlackListed('buildStarted'):
+            # The build carries the full list of properties.
+            self.sentProperties[build] = dict(
+                (p[0], p) for p in build.getProperties().asList())
         self.push('buildStarted', build=build)
         return self
 
     def buildETAUpdate(self, build, ETA):
+        # The build didn't change, only its ETA which is sent along.
         self.push('buildETAUpdate', build=build, ETA=ETA)
 
     def stepStarted(self, build, step):
-        self.push('stepStarted',
-                  properties=build.getProperties().asList(),
-                  step=step)
+        self.pushStep('stepStarted', build, step)
 
     def stepTextChanged(self, build, step, text):
-        self.push('stepTextChanged',
-                  properties=build.getProperties().asList(),
-                  step=step,
-                  text=text)
+        self.pushStep('stepTextChanged', build, step, text=text)
 
     def stepText2Changed(self, build, step, text2):
-        self.push('stepText2Changed',
-                  properties=build.getProperties().asList(),
-                  step=step,
-                  text2=text2)
+        self.pushStep('stepText2Changed', build, step, text2=text2)
 
     def stepETAUpdate(self, build, step, ETA, expectations):
+        # Like buildETAUpdate, the cached step is still valid.
+        if self.isBlackListed('stepETAUpdate'):
+            return
         self.push('stepETAUpdate',
-                  properties=build.getProperties().asList(),
                   step=step,
                   ETA=ETA,
-                  expectations=expectations)
+                  expectations=expectations,
+                  **self.stepProperties(build))
 
     def logStarted(self, build, step, log):
-        self.push('logStarted',
-                  properties=build.getProperties().asList(),
-                  step=step)
+        self.pushStep('logStarted', build, step)
 
     def logFinished(self, build, step, log):
-        self.push('logFinished',
-                  properties=build.getProperties().asList(),
-                  step=step)
+        self.pushStep('logFinished', build, step)
 
     def stepFinished(self, build, step, results):
-        self.push('stepFinished',
-                  properties=build.getProperties().asList(),
-                  step=step)
+        self.pushStep('stepFinished', build, step)
 
     def buildFinished(self, builderName, build, results):
+        self.cache.changed(build)
+        self.sentProperties.pop(build, None)
         self.push('buildFinished', build=build)
 
     def builderRemoved(self, builderName):
@@ -317,7 +398,9 @@ class StatusPush(StatusReceiverMultiService):
         self.push('changeAdded', change=change)
 
     def slaveConnected(self, slavename):
-        self.push('slaveConnected', slave=self.status.getSlave(slavename))
+        slave = self.status.getSlave(slavename)
+        self.cache.changed(slave)
+        self.push('slaveConnected', slave=slave)
 
     def slaveDisconnected(self, slavename):
         self.push('slaveDisconnected', slavename=slavename)
@@ -366,7 +449,9 @@ class HttpStatusPush(StatusPush):
     def popChunk(self):
         """Pops items from the pending list.
 
-        They must be queued back on failure."""
+        Each item is encoded once; the items that don't fit in
+        maxHttpRequestSize are queued back right away. The items returned must
+        be queued back on failure."""
         if self.wasLastPushSuccessful():
             chunkSize = self.chunkSize
         else:
@@ -375,23 +460,41 @@ class HttpStatusPush(StatusPush):
         while True:
             items = self.queue.popChunk(chunkSize)
             if self.debug:
-                packets = json.dumps(items, indent=2, sort_keys=True)
-            else:
-                packets = json.dumps(items, separators=(',',':'))
-            data = urllib.urlencode({'packets': packets})
-            if (not self.maxHttpRequestSize or
-                len(data) < self.maxHttpRequestSize):
-                return (data, items)
-
-            if chunkSize == 1:
-                # This packet is just too large. Drop this packet.
-                log.msg("ERROR: packet %s was dropped, too large: %d > %d" %
-                        (items[0]['id'], len(data), self.maxHttpRequestSize))
-                chunkSize = self.chunkSize
+                separator = ',\n'
+                encoded = [json.dumps(i, indent=2, sort_keys=True)
+                           for i in items]
             else:
-                # Try with half the packets.
-                chunkSize /= 2
-                self.queue.insertBackChunk(items)
+                separator = ','
+                encoded = [json.dumps(i, separators=(',',':')) for i in items]
+            # urlencode() quotes each character on its own, so the request
+            # size is the sum of the quoted items.
+            separator = urllib.quote_plus(separator)
+            size = len(urllib.urlencode({'packets': '[]'}))
+            quoted = []
+            for packet in encoded:
+                packet = urllib.quote_plus(packet)
+                size += len(packet)
+                if quoted:
+                    size += len(separator)
+                if self.maxHttpRequestSize and size >= self.maxHttpRequestSize:
+                    break
+                quoted.append(packet)
+
+            if quoted or not items:
+                if len(quoted) < len(items):
+                    self.queue.insertBackChunk(items[len(quoted):])
+                data = 'packets=%s%s%s' % (urllib.quote_plus('['),
+                                           separator.join(quoted),
+                                           urllib.quote_plus(']'))
+                return (data, items[:len(quoted)])
+
+            # This packet is just too large. Drop this packet.
+            log.msg("ERROR: packet %s was dropped, too large: %d > %d" %
+                    (items[0]['id'], len(urllib.quote_plus(encoded[0])),
+                     self.maxHttpRequestSize))
+            if len(items) > 1:
+                self.queue.insertBackChunk(items[1:])
+            chunkSize = self.chunkSize
 
     def pushHttp(self):
         """Do the HTTP POST to the server."""
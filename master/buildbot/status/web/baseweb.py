@@ -464,6 +464,9 @@ class WebStatus(service.MultiService):
         self.channels[channel] = 1 # weakrefs
 
     def stopService(self):
+        for child in self.childrenToBeAdded.itervalues():
+            if isinstance(child, WaterfallStatusResource):
+                child.cache.unsubscribe()
         for channel in self.channels:
             try:
                 channel.transport.loseConnection()
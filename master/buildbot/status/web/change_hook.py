@@ -117,8 +117,7 @@ class ChangeHookResource(resource.Resource):
     @defer.deferredGenerator
     def submitChanges(self, changes, request):
         master = request.site.buildbot_service.master
-        for chdict in changes:
-            wfd = defer.waitForDeferred(master.addChange(**chdict))
-            yield wfd
-            change = wfd.getResult()
+        wfd = defer.waitForDeferred(master.addChanges(changes))
+        yield wfd
+        for change in wfd.getResult():
             log.msg("injected change %s" % change)
@@ -145,19 +145,22 @@ class ConsoleStatusResource(HtmlResource):
         
         allChanges = list()
         build_count = 0
+        index = status.getSourceStampIndex()
         for builderName in status.getBuilderNames()[:]:
             if build_count > max_builds:
                 break
             
             builder = status.getBuilder(builderName)
-            build = self.getHeadBuild(builder)
-            depth = 0
-            while build and depth < max_depth and build_count < max_builds:
-                depth += 1
+            history = index.getHistory(builderName)[:max_depth]
+            for number, branch, revision in history:
+                if build_count >= max_builds:
+                    break
+                build = builder.getBuild(number)
+                if not build:
+                    continue
                 build_count += 1
                 sourcestamp = build.getSourceStamp()
                 allChanges.extend(sourcestamp.changes[:])
-                build = build.getPreviousBuild()
 
         debugInfo["source_fetch_len"] = len(allChanges)
         return allChanges                
@@ -234,12 +237,26 @@ class ConsoleStatusResource(HtmlResource):
 
         revision = lastRevision 
 
+        # the source stamp index records the revision each finished build
+        # used, so finished builds without a valid revision need not be
+        # loaded; running builds may not have their revision yet
+        index = self.getStatus(request).getSourceStampIndex()
+        running = set([ b.getNumber() for b in builder.getCurrentBuilds() ])
+
         builds = []
-        build = self.getHeadBuild(builder)
         number = 0
-        while build and number < numBuilds:
-            debugInfo["builds_scanned"] += 1
+        for buildnum, branch, index_rev in index.getHistory(builderName):
+            if number >= numBuilds:
+                break
             number += 1
+            if buildnum not in running:
+                if not index_rev or \
+                        not self.comparator.isValidRevision(index_rev):
+                    continue
+            build = builder.getBuild(buildnum)
+            if not build:
+                continue
+            debugInfo["builds_scanned"] += 1
 
             # Get the last revision in this build.
             # We first try "got_revision", but if it does not work, then
@@ -276,8 +293,6 @@ class ConsoleStatusResource(HtmlResource):
                     devBuild, current_revision):
                     break
 
-            build = build.getPreviousBuild()
-
         return builds
 
     def getChangeForBuild(self, build, revision):
@@ -410,13 +425,11 @@ class ConsoleStatusResource(HtmlResource):
                 else:
                     # If not offline, then display the result of the last
                     # finished build.
-                    build = self.getHeadBuild(status.getBuilder(builder))
-                    while build and not build.isFinished():
-                        build = build.getPreviousBuild()
-
-                    if build:
-                        s["color"] = getResultsClass(build.getResults(), None,
-                                                      False)
+                    builds = list(status.generateFinishedBuilds(
+                                    builders=[builder], num_builds=1))
+                    if builds:
+                        s["color"] = getResultsClass(builds[0].getResults(),
+                                                     None, False)
 
                 slaves[category].append(s)
 
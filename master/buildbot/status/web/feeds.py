@@ -86,7 +86,6 @@ class FeedResource(XmlResource):
         return fallback
 
     def getBuilds(self, request):
-        builds = []
         # THIS is lifted straight from the WaterfallStatusResource Class in
         # status/web/waterfall.py
         #
@@ -113,48 +112,22 @@ class FeedResource(XmlResource):
             builders = [b for b in builders if b.category in showCategories]
 
         failures_only = request.args.get("failures_only", "false")
+        results = None
+        if failures_only != "false":
+            results = [ FAILURE ]
 
         maxFeeds = 25
 
-        # Copy all failed builds in a new list.
-        # This could clearly be implemented much better if we had
-        # access to a global list of builds.
-        for b in builders:
-            lastbuild = b.getLastFinishedBuild()
-            if lastbuild is None:
-                continue
-
-            lastnr = lastbuild.getNumber()
-
-            totalbuilds = 0
-            i = lastnr
-            while i >= 0:
-                build = b.getBuild(i)
-                i -= 1
-                if not build:
-                    continue
-
-                results = build.getResults()
-
-                if failures_only == "false" or results == FAILURE:
-                    totalbuilds += 1
-                    builds.append(build)
-
-                # stop for this builder when our total nr. of feeds is reached
-                if totalbuilds >= maxFeeds:
-                    break
-
-        # Sort build list by date, youngest first.
-        # To keep compatibility with python < 2.4, use this for sorting instead:
-        # We apply Decorate-Sort-Undecorate
-        deco = [(build.getTimes(), build) for build in builds]
-        deco.sort()
-        deco.reverse()
-        builds = [build for (b1, build) in deco]
-
-        if builds:
-            builds = builds[:min(len(builds), maxFeeds)]
-        return builds
+        # an empty list of builders would mean all builders
+        if not builders:
+            return []
+
+        # the status' timeline of finished builds gives the most recent
+        # builds across all of these builders, youngest first
+        return list(self.status.generateFinishedBuilds(
+                        builders=[ b.getName() for b in builders ],
+                        num_builds=maxFeeds, max_search=None,
+                        results=results))
 
     def content(self, request):
         builds = self.getBuilds(request)
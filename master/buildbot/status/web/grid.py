@@ -90,66 +90,73 @@ class GridStatusMixin(object):
 
         yield cxt
 
-    def getSourceStampKey(self, ss):
-        """Given two source stamps, we want to assign them to the same row if
-        they are the same version of code, even if they differ in minor detail.
-
-        This function returns an appropriate comparison key for that.
+    def getRecentSourcestamps(self, status, numBuilds, builderNames, branch):
         """
-        return (ss.branch, ss.revision, ss.patch)
-
-    def getRecentBuilds(self, builder, numBuilds, branch):
+        get a list of the most recent NUMBUILDS (branch, revision, patch)
+        tuples built by any of the given builders, sorted by the earliest start
+        we've seen for them.  Builds of the same revision with different
+        patches (e.g., try builds) are in separate tuples.
         """
-        get a list of most recent builds on given builder
+        if branch == ANYBRANCH:
+            branches = None
+        else:
+            branches = [ branch ]
+        sourcestamps = []
+        index = status.getSourceStampIndex()
+        for key, start in index.generateStamps(branches=branches,
+                                               builders=builderNames):
+            sourcestamps.append((start, key))
+            if len(sourcestamps) >= numBuilds:
+                break
+        sourcestamps.sort()
+        return [ key for (start, key) in sourcestamps ]
+
+    def getStampBuilds(self, status, builder, stamps):
         """
-        build = builder.getBuild(-1)
-        num = 0
-        while build and num < numBuilds:
-            start = build.getTimes()[0]
-            ss = build.getSourceStamp(absolute=True)
-
-            okay_build = True
-
-            # skip un-started builds
-            if not start:
-                okay_build = False
-
-            # skip non-matching branches
-            if branch != ANYBRANCH and ss.branch != branch:
-                okay_build = False
-
-            if okay_build:
-                num += 1
-                yield build
-
-            build = build.getPreviousBuild()
-        return
-
-    def getRecentSourcestamps(self, status, numBuilds, categories, branch):
+        get a list of the most recent build of the given builder for each
+        of the given (branch, revision, patch) tuples, or None where it has no
+        build
+        """
+        index = status.getSourceStampIndex()
+        builds = []
+        for branch, revision, patch in stamps:
+            numbers = index.getBuilds(branch, revision, patch).get(
+                                                    builder.getName())
+            build = None
+            if numbers:
+                build = builder.getBuild(numbers[0])
+            builds.append(build)
+        return builds
+
+    def getStampDicts(self, stamps, builder_builds):
+        """
+        get a SourceStamp dictionary for each of the given (branch, revision,
+        patch) tuples, taken from one of the builds in the corresponding
+        column of builder_builds, a list of lists as returned from
+        getStampBuilds
         """
-        get a list of the most recent NUMBUILDS SourceStamp tuples, sorted
-        by the earliest start we've seen for them
+        dicts = []
+        for i, (branch, revision, patch) in enumerate(stamps):
+            ss = SourceStamp(branch=branch, revision=revision)
+            for builds in builder_builds:
+                if builds[i]:
+                    ss = builds[i].getSourceStamp(absolute=True)
+                    break
+            dicts.append(ss.asDict())
+        return dicts
+
+    def getBuilderNames(self, status, categories):
         """
-        # TODO: use baseweb's getLastNBuilds?
-        sourcestamps = { } # { ss-tuple : earliest time }
+        get the sorted names of the builders in the given categories
+        """
+        builderNames = []
         for bn in status.getBuilderNames():
             builder = status.getBuilder(bn)
             if categories and builder.category not in categories:
                 continue
-            for build in self.getRecentBuilds(builder, numBuilds, branch):
-                ss = build.getSourceStamp(absolute=True)
-                key= self.getSourceStampKey(ss)
-                start = build.getTimes()[0]
-                if key not in sourcestamps or sourcestamps[key][1] > start:
-                    sourcestamps[key] = (ss, start)
-
-        # now sort those and take the NUMBUILDS most recent
-        sourcestamps = sourcestamps.values()
-        sourcestamps.sort(lambda x, y: cmp(x[1], y[1]))
-        sourcestamps = map(lambda tup : tup[0], sourcestamps)
-        sourcestamps = sourcestamps[-numBuilds:]
-
-        return sourcestamps
+            builderNames.append(bn)
+        builderNames.sort()
+        return builderNames
 
 class GridStatusResource(HtmlResource, GridStatusMixin):
     # TODO: docs
@@ -170,34 +177,19 @@ class GridStatusResource(HtmlResource, GridStatusMixin):
 
         # and the data we want to render
         status = self.getStatus(request)
-        stamps = self.getRecentSourcestamps(status, numBuilds, categories, branch)
+        sortedBuilderNames = self.getBuilderNames(status, categories)
+        stamps = self.getRecentSourcestamps(status, numBuilds,
+                                            sortedBuilderNames, branch)
 
         cxt['refresh'] = self.get_reload_time(request)
 
-        cxt.update({'categories': categories,
-                    'branch': branch,
-                    'ANYBRANCH': ANYBRANCH,
-                    'stamps': map(SourceStamp.asDict, stamps)
-                   })
-        
-        sortedBuilderNames = status.getBuilderNames()[:]
-        sortedBuilderNames.sort()
-        
         cxt['builders'] = []
+        all_builds = []
 
         for bn in sortedBuilderNames:
-            builds = [None] * len(stamps)
-
             builder = status.getBuilder(bn)
-            if categories and builder.category not in categories:
-                continue
-
-            for build in self.getRecentBuilds(builder, numBuilds, branch):
-                ss = build.getSourceStamp(absolute=True)
-                key= self.getSourceStampKey(ss)
-                for i in range(len(stamps)):
-                    if key == self.getSourceStampKey(stamps[i]) and builds[i] is None:
-                        builds[i] = build
+            builds = self.getStampBuilds(status, builder, stamps)
+            all_builds.append(builds)
 
             wfd = defer.waitForDeferred(
                     self.builder_cxt(request, builder))
@@ -209,6 +201,12 @@ class GridStatusResource(HtmlResource, GridStatusMixin):
                 b['builds'].append(self.build_cxt(request, build))
             cxt['builders'].append(b)
 
+        cxt.update({'categories': categories,
+                    'branch': branch,
+                    'ANYBRANCH': ANYBRANCH,
+                    'stamps': self.getStampDicts(stamps, all_builds)
+                   })
+
         template = request.site.buildbot_service.templates.get_template("grid.html")
         yield template.render(**cxt)
 
@@ -239,37 +237,22 @@ class TransposedGridStatusResource(HtmlResource, GridStatusMixin):
 
         # and the data we want to render
         status = self.getStatus(request)
-        stamps = self.getRecentSourcestamps(status, numBuilds, categories, branch)
-
-        cxt.update({'categories': categories,
-                    'branch': branch,
-                    'ANYBRANCH': ANYBRANCH,
-                    'stamps': map(SourceStamp.asDict, stamps),
-                    })
+        sortedBuilderNames = self.getBuilderNames(status, categories)
+        stamps = self.getRecentSourcestamps(status, numBuilds,
+                                            sortedBuilderNames, branch)
 
-        sortedBuilderNames = status.getBuilderNames()[:]
-        sortedBuilderNames.sort()
-        
         cxt['sorted_builder_names'] = sortedBuilderNames
         cxt['builder_builds'] = builder_builds = []
         cxt['builders'] = builders = []
         cxt['range'] = range(len(stamps))
         if rev_order == "desc":
             cxt['range'].reverse()
-        
-        for bn in sortedBuilderNames:
-            builds = [None] * len(stamps)
+        all_builds = []
 
+        for bn in sortedBuilderNames:
             builder = status.getBuilder(bn)
-            if categories and builder.category not in categories:
-                continue
-
-            for build in self.getRecentBuilds(builder, numBuilds, branch):
-                ss = build.getSourceStamp(absolute=True)
-                key = self.getSourceStampKey(ss)
-                for i in range(len(stamps)):
-                    if key == self.getSourceStampKey(stamps[i]) and builds[i] is None:
-                        builds[i] = build
+            builds = self.getStampBuilds(status, builder, stamps)
+            all_builds.append(builds)
 
             wfd = defer.waitForDeferred(
                     self.builder_cxt(request, builder))
@@ -278,6 +261,12 @@ class TransposedGridStatusResource(HtmlResource, GridStatusMixin):
 
             builder_builds.append(map(lambda b: self.build_cxt(request, b), builds))
 
+        cxt.update({'categories': categories,
+                    'branch': branch,
+                    'ANYBRANCH': ANYBRANCH,
+                    'stamps': self.getStampDicts(stamps, all_builds),
+                    })
+
         template = request.site.buildbot_service.templates.get_template('grid_transposed.html')
         yield template.render(**cxt)
 
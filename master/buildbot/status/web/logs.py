@@ -14,10 +14,11 @@
 # Copyright Buildbot Team Members
 
 
+import re
 from zope.interface import implements
 from twisted.python import components
 from twisted.spread import pb
-from twisted.web import server
+from twisted.web import server, http
 from twisted.web.resource import Resource
 from twisted.web.error import NoResource
 
@@ -103,6 +104,15 @@ class TextLog(Resource):
         self._setContentType(req)
         self.req = req
 
+        # finished plain-text logs can be read in pieces, e.g., to follow the
+        # end of a very large log
+        if self.asText and isinstance(self.original, logfile.LogFile) \
+                and self.original.isFinished():
+            req.setHeader("accept-ranges", "bytes")
+            byterange = self._getRange(req)
+            if byterange:
+                return self._renderRange(req, byterange)
+
         if not self.asText:
             self.template = req.site.buildbot_service.templates.get_template("logs.html")                
             
@@ -116,6 +126,41 @@ class TextLog(Resource):
         self.original.subscribeConsumer(ChunkConsumer(req, self))
         return server.NOT_DONE_YET
 
+    range_re = re.compile(r"^bytes=(\d*)-(\d*)$")
+    def _getRange(self, req):
+        # only single ranges are supported; anything else gets the full log
+        header = req.getHeader("range")
+        if not header:
+            return None
+        mo = self.range_re.match(header.strip())
+        if not mo or mo.groups() == ('', ''):
+            return None
+        return mo.groups()
+
+    def _renderRange(self, req, byterange):
+        self.req = None
+        first, last = byterange
+        length = self.original.getTextLength()
+        if first == '':
+            # a suffix range: the last N bytes
+            start, end = max(0, length - int(last)), length
+        else:
+            start = int(first)
+            end = length
+            if last != '':
+                end = min(int(last) + 1, length)
+        if start >= end:
+            req.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            req.setHeader("content-range", "bytes */%d" % length)
+            return ''
+
+        req.setResponseCode(http.PARTIAL_CONTENT)
+        req.setHeader("content-range",
+                      "bytes %d-%d/%d" % (start, end - 1, length))
+        data = self.original.getTextRange(start, end)
+        req.setHeader("content-length", len(data))
+        return data
+
     def _setContentType(self, req):
         if self.asText:
             req.setHeader("content-type", "text/plain; charset=utf-8")
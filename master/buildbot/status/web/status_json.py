@@ -649,12 +649,12 @@ class SlaveJsonResource(JsonResource):
             builds = []
             builder_status = self.status.getBuilder(builderName)
             for i in range(1, builder_status.buildCacheSize - 1):
-                build_status = builder_status.getBuild(-i)
-                if not build_status or not build_status.isFinished():
+                summary = builder_status.getBuildSummary(-i)
+                if not summary:
                     # If not finished, it will appear in runningBuilds.
                     break
-                if build_status.getSlavename() == self.name:
-                    builds.append(build_status.getNumber())
+                if summary['slavename'] == self.name:
+                    builds.append(summary['number'])
             results['builders'][builderName] = builds
         return results
 
@@ -17,13 +17,19 @@
 from zope.interface import implements
 from twisted.python import log, components
 from twisted.internet import defer
+from twisted.web import http
 import urllib
 
 import time, locale
 import operator
 
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
 from buildbot import interfaces, util
-from buildbot.status import builder, buildstep, build
+from buildbot.status import builder, buildstep, build, base
 from buildbot.changes import changes
 
 from buildbot.status.web.base import Box, HtmlResource, IBox, ICurrentBox, \
@@ -326,6 +332,157 @@ class ChangeEventSource(object):
                 continue
             yield change
 
+class WaterfallCache(base.StatusReceiver):
+    """
+    A cache of rendered waterfall pages, keyed by the request path and
+    arguments (and thus by the branch, category, and committer filters).
+
+    The cache subscribes to the master's status, and any status event that
+    could change the waterfall (a builder changing state, a build or step
+    starting or finishing, a new change or build request, and so on)
+    increments C{generation}, invalidating all cached pages.  Builder events
+    are not announced to status receivers, so they are detected by examining
+    each builder's event list.  While any builder is building, pages also
+    expire every C{etaInterval} seconds, so that ETAs are updated.
+
+    The same information is used to compute an ETag for each page, so that
+    auto-refreshing browsers can re-validate their copy without the page
+    being rendered at all.
+    """
+
+    etaInterval = 15
+    maxEntries = 50
+
+    def __init__(self):
+        self.status = None
+        self.watched = []
+        self.generation = 0
+        # distinguishes ETags from those of another cache or master process
+        self.instance = "%x-%x" % (id(self), int(util.now()))
+        self._stamp = None
+        self._pages = {}
+        self.hits = self.misses = 0
+
+    def subscribe(self, status):
+        """Subscribe to C{status}, if not already subscribed."""
+        if status is self.status:
+            return
+        self.unsubscribe()
+        self.status = status
+        status.subscribe(self)
+
+    def unsubscribe(self):
+        """Stop watching the status."""
+        if self.status is not None:
+            self.status.unsubscribe(self)
+            self.status = None
+        for w in self.watched:
+            w.unsubscribe(self)
+        self.watched = []
+        self.invalidate()
+
+    def invalidate(self):
+        self.generation += 1
+        self._pages = {}
+
+    def getKey(self, request):
+        """Get the cache key for the page requested by C{request}."""
+        args = [ (k, tuple(v)) for k, v in request.args.iteritems() ]
+        args.sort()
+        return (tuple(request.prepath), tuple(args))
+
+    def getStamp(self, status):
+        """Get a value which changes whenever any cached page becomes
+        invalid."""
+        building = False
+        events = []
+        for name in status.getBuilderNames():
+            bs = status.getBuilder(name)
+            if bs.getState()[0] == 'building':
+                building = True
+            if bs.events:
+                events.append((len(bs.events), bs.events[-1],
+                               bs.events[-1].finished))
+            else:
+                events.append(None)
+        if building:
+            eta_bucket = int(util.now()) // self.etaInterval
+        else:
+            eta_bucket = None
+        return (self.generation, eta_bucket, tuple(events))
+
+    def getETag(self, key, stamp):
+        """Get the ETag for the page with the given key and stamp."""
+        # builder events are identified by their id, so this is only
+        # valid within this process
+        h = sha1(repr((key, stamp[:2], [ e and (e[0], id(e[1]), e[2])
+                                         for e in stamp[2] ])))
+        return '"%s-%d-%s"' % (self.instance, stamp[0], h.hexdigest()[:16])
+
+    def get(self, key, stamp):
+        """Get the cached page for C{key}, or None if it is not cached or no
+        longer valid."""
+        if stamp != self._stamp:
+            self._stamp = stamp
+            self._pages = {}
+        data = self._pages.get(key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def put(self, key, stamp, data):
+        """Cache the page for C{key}, rendered when the stamp was
+        C{stamp}."""
+        if stamp != self._stamp:
+            return
+        if len(self._pages) >= self.maxEntries:
+            self._pages = {}
+        self._pages[key] = data
+
+    # IStatusReceiver methods
+
+    def builderAdded(self, builderName, builder):
+        self.invalidate()
+        self.watched.append(builder)
+        return self
+
+    def builderRemoved(self, builderName):
+        self.invalidate()
+        self.watched = [ w for w in self.watched if w.getName() != builderName ]
+
+    def builderChangedState(self, builderName, state):
+        self.invalidate()
+
+    def requestSubmitted(self, request):
+        self.invalidate()
+
+    def requestCancelled(self, builder, request):
+        self.invalidate()
+
+    def buildStarted(self, builderName, build):
+        self.invalidate()
+        return self
+
+    def stepStarted(self, build, step):
+        self.invalidate()
+
+    def stepTextChanged(self, build, step, text):
+        self.invalidate()
+
+    def stepText2Changed(self, build, step, text2):
+        self.invalidate()
+
+    def stepFinished(self, build, step, results):
+        self.invalidate()
+
+    def buildFinished(self, builderName, build, results):
+        self.invalidate()
+
+    def changeAdded(self, change):
+        self.invalidate()
+
 class WaterfallStatusResource(HtmlResource):
     """This builds the main status page, with the waterfall display, and
     all child pages."""
@@ -335,6 +492,7 @@ class WaterfallStatusResource(HtmlResource):
         self.categories = categories
         self.num_events=num_events
         self.num_events_max=num_events_max
+        self.cache = WaterfallCache()
         self.putChild("help", WaterfallHelp(categories))
 
     def getPageTitle(self, request):
@@ -387,6 +545,27 @@ class WaterfallStatusResource(HtmlResource):
         return True
 
     def content(self, request, ctx):
+        status = self.getStatus(request)
+        self.cache.subscribe(status)
+
+        # answer conditional requests and repeated requests from the cache;
+        # note that rendering may modify request.args
+        key = self.cache.getKey(request)
+        stamp = self.cache.getStamp(status)
+        if request.setETag(self.cache.getETag(key, stamp)) is http.CACHED:
+            return ''
+        data = self.cache.get(key, stamp)
+        if data is not None:
+            return data
+
+        d = self.content_uncached(request, ctx)
+        def keep(data):
+            self.cache.put(key, stamp, data)
+            return data
+        d.addCallback(keep)
+        return d
+
+    def content_uncached(self, request, ctx):
         status = self.getStatus(request)
         master = request.site.buildbot_service.master
 
@@ -533,7 +712,6 @@ class WaterfallStatusResource(HtmlResource):
     
     def buildGrid(self, request, builders, changes):
         debug = False
-        # TODO: see if we can use a cached copy
 
         showEvents = False
         if request.args.get("show_events", ["false"])[0].lower() == "true":
@@ -14,21 +14,62 @@
 # Copyright Buildbot Team Members
 
 
-import os.path, tarfile, tempfile
+import os.path, tarfile, tempfile, shutil, threading, zlib
+from collections import deque
+try:
+    from hashlib import md5, sha1
+except ImportError:
+    from md5 import new as md5
+    from sha import new as sha1
 try:
     from cStringIO import StringIO
     assert StringIO
 except ImportError:
     from StringIO import StringIO
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, threads
 from twisted.spread import pb
-from twisted.python import log
+from twisted.python import log, failure
 from buildbot.process.buildstep import RemoteCommand, BuildStep
 from buildbot.process.buildstep import SUCCESS, FAILURE, SKIPPED
 from buildbot.interfaces import BuildSlaveTooOldError
 from buildbot.util import json
 
 
+def _digest(fp):
+    """Return the SHA-1 hex digest of the contents of fp"""
+    h = sha1()
+    fp.seek(0)
+    while True:
+        data = fp.read(65536)
+        if not data:
+            break
+        h.update(data)
+    return h.hexdigest()
+
+def _fileDigest(filename):
+    """Return the SHA-1 hex digest of the file filename, or None if it does
+    not exist"""
+    if not os.path.isfile(filename):
+        return None
+    fp = open(filename, 'rb')
+    try:
+        return _digest(fp)
+    finally:
+        fp.close()
+
+def _signature(fp, blocksize, first, count):
+    """Return the weak (adler32) and strong (md5) checksums of the count
+    blocks of fp starting at block first"""
+    fp.seek(first * blocksize)
+    signature = []
+    while len(signature) < count:
+        data = fp.read(blocksize)
+        if not data:
+            break
+        signature.append((zlib.adler32(data) & 0xffffffff,
+                          md5(data).digest()))
+    return signature
+
 class _FileWriter(pb.Referenceable):
     """
     Helper class that acts as a file-object with write access
@@ -46,6 +87,9 @@ class _FileWriter(pb.Referenceable):
         fd, self.tmpname = tempfile.mkstemp(dir=dirname)
         self.fp = os.fdopen(fd, 'wb')
         self.remaining = maxsize
+        # previous destfile, which delta uploads copy blocks from
+        self.basis = None
+        self.blocksize = None
 
     def remote_write(self, data):
         """
@@ -63,15 +107,69 @@ class _FileWriter(pb.Referenceable):
         else:
             self.fp.write(data)
 
+    def remote_digest(self):
+        """
+        Called from remote slave to compare its file with L{destfile}
+
+        @return: SHA-1 hex digest of L{destfile}, or None if it does not
+                 exist, via Deferred
+        """
+        return threads.deferToThread(_fileDigest, self.destfile)
+
+    def remote_signature(self, blocksize, first, count):
+        """
+        Called from remote slave to get the checksums of L{count} blocks of
+        L{destfile}, starting at block L{first}, before sending the
+        differences with writeDelta
+
+        @return: list of (weak, strong) checksums, via Deferred
+        """
+        if self.basis is None:
+            self.basis = open(self.destfile, 'rb')
+        self.blocksize = blocksize
+        return threads.deferToThread(_signature, self.basis, blocksize,
+                                     first, count)
+
+    def remote_writeDelta(self, instructions):
+        """
+        Called from remote slave with a list of instructions to write to
+        L{fp}: strings of data, and indexes of blocks of L{destfile} to copy
+
+        @type  instructions: C{list}
+        @param instructions: strings and block indexes
+        """
+        for item in instructions:
+            if isinstance(item, str):
+                data = item
+            else:
+                self.basis.seek(item * self.blocksize)
+                data = self.basis.read(self.blocksize)
+            self.remote_write(data)
+
     def remote_utime(self, accessed_modified):
         os.utime(self.destfile,accessed_modified)
 
+    def remote_keep(self):
+        """
+        Called by remote slave, instead of close, when L{destfile} is already
+        identical to its file
+        """
+        self.fp.close()
+        self.fp = None
+        os.unlink(self.tmpname)
+        self.tmpname = None
+        if self.mode is not None:
+            os.chmod(self.destfile, self.mode)
+
     def remote_close(self):
         """
         Called by remote slave to state that no more data will be transfered
         """
         self.fp.close()
         self.fp = None
+        if self.basis is not None:
+            self.basis.close()
+            self.basis = None
         # on windows, os.rename does not automatically unlink, so do it manually
         if os.path.exists(self.destfile):
             os.unlink(self.destfile)
@@ -126,45 +224,240 @@ def _extractall(self, path=".", members=None):
             else:
                 self._dbg(1, "tarfile: %s" % e)
 
-class _DirectoryWriter(_FileWriter):
+def _moveTree(src, dst):
+    """Move the contents of directory src into dst, replacing existing files,
+    and remove src."""
+    if not os.path.exists(dst):
+        os.rename(src, dst)
+        return
+    for name in os.listdir(src):
+        srcpath = os.path.join(src, name)
+        dstpath = os.path.join(dst, name)
+        srcdir = os.path.isdir(srcpath) and not os.path.islink(srcpath)
+        dstdir = os.path.isdir(dstpath) and not os.path.islink(dstpath)
+        if srcdir and dstdir:
+            _moveTree(srcpath, dstpath)
+            continue
+        if dstdir:
+            shutil.rmtree(dstpath)
+        elif os.path.islink(dstpath) or os.path.exists(dstpath):
+            os.unlink(dstpath)
+        os.rename(srcpath, dstpath)
+    shutil.rmtree(src)
+
+class _DirectoryWriter(pb.Referenceable):
     """
-    A DirectoryWriter is implemented as a FileWriter, with an added post-processing
-    step to unpack the archive, once the transfer has completed.
+    Helper class that extracts a tar archive as it is written by the remote
+    slave.
+
+    The archive is read by a thread, and its entries extracted into a
+    temporary directory beside destroot, whose contents are moved to destroot
+    once the slave calls unpack.  Only a few blocks are buffered: when more
+    are waiting to be extracted, remote_write does not return until the
+    thread catches up.
+
+    The thread is dedicated to this writer, so that a stalled upload does not
+    tie up the reactor's thread pool.  If the slave sends nothing for
+    idleTimeout seconds, or the master shuts down, the upload is aborted.
     """
 
+    # blocks waiting to be extracted before remote_write holds its answer
+    maxPending = 4
+    # seconds without data from the slave before the upload is aborted
+    idleTimeout = 1200
+
     def __init__(self, destroot, maxsize, compress, mode):
-        self.destroot = destroot
+        self.destroot = os.path.abspath(destroot)
         self.compress = compress
-
-        self.fd, self.tarname = tempfile.mkstemp()
-        os.close(self.fd)
-
-        _FileWriter.__init__(self, self.tarname, maxsize, mode)
-
-    def remote_unpack(self):
-        """
-        Called by remote slave to state that no more data will be transfered
-        """
-        # Make sure remote_close is called, otherwise atomic rename wont happen
-        self.remote_close()
+        self.remaining = maxsize
 
         # Map configured compression to a TarFile setting
         if self.compress == 'bz2':
-            mode='r|bz2'
+            tarmode = 'r|bz2'
         elif self.compress == 'gz':
-            mode='r|gz'
+            tarmode = 'r|gz'
+        else:
+            tarmode = 'r|'
+
+        dirname = os.path.dirname(self.destroot)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.tmpdir = tempfile.mkdtemp(dir=dirname)
+
+        # blocks received and not yet read by the thread, protected by cond
+        self.pending = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        # Deferreds of the writes waiting for the thread
+        self.waiting = []
+        self.done = False
+        self.failure = None
+        self.aborted = None
+
+        self.extracted = defer.Deferred()
+        self.extracted.addErrback(self._extractFailed)
+        self.extracted.addCallback(self._extractDone)
+
+        self.idleTimer = reactor.callLater(self.idleTimeout, self._abort,
+                                           "no data from the slave")
+        self.shutdownTrigger = reactor.addSystemEventTrigger('before',
+                'shutdown', self._abort, "master shutting down")
+
+        thread = threading.Thread(target=self._run, args=(tarmode,),
+                                  name="DirectoryUpload %s" % self.destroot)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _run(self, tarmode):
+        try:
+            self._extract(tarmode)
+        except:
+            reactor.callFromThread(self.extracted.errback, failure.Failure())
         else:
-            mode = 'r'
+            reactor.callFromThread(self.extracted.callback, None)
 
+    def _extract(self, tarmode):
         # Support old python
         if not hasattr(tarfile.TarFile, 'extractall'):
             tarfile.TarFile.extractall = _extractall
 
-        # Unpack archive and clean up after self
-        archive = tarfile.open(name=self.tarname, mode=mode)
-        archive.extractall(path=self.destroot)
+        archive = tarfile.open(mode=tarmode, fileobj=self)
+        archive.extractall(path=self.tmpdir)
         archive.close()
-        os.remove(self.tarname)
+
+    def _extractFailed(self, why):
+        if self.aborted:
+            log.msg("directory upload to %s aborted: %s"
+                    % (self.destroot, self.aborted))
+        else:
+            log.msg("error while extracting the uploaded directory")
+            log.err(why)
+        self.failure = why
+
+    def _extractDone(self, _):
+        # nothing reads the remaining blocks any more
+        self.done = True
+        self.cond.acquire()
+        self.pending.clear()
+        self.cond.release()
+        self._stopTimers()
+        self._wakeWriters()
+        if self.aborted:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _stopTimers(self):
+        if self.idleTimer.active():
+            self.idleTimer.cancel()
+        if self.shutdownTrigger is not None:
+            reactor.removeSystemEventTrigger(self.shutdownTrigger)
+            self.shutdownTrigger = None
+
+    def _abort(self, reason):
+        """
+        Stop the extraction thread, whatever the slave does, and discard the
+        archive
+        """
+        if self.aborted:
+            return
+        self.aborted = reason
+        self._stopTimers()
+        self._close()
+        if self.done:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _wakeWriters(self):
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def read(self, size):
+        """
+        Called from the extraction thread, returns the next L{size} bytes at
+        most of the archive, blocking until some are available
+        """
+        self.cond.acquire()
+        try:
+            while not self.pending and not self.closed:
+                self.cond.wait()
+            if self.aborted:
+                raise IOError("upload aborted: %s" % self.aborted)
+            if not self.pending:
+                return ''
+            data = self.pending.popleft()
+            if len(data) > size:
+                self.pending.appendleft(data[size:])
+                data = data[:size]
+            wake = len(self.pending) < self.maxPending
+        finally:
+            self.cond.release()
+        if wake:
+            reactor.callFromThread(self._wakeWriters)
+        return data
+
+    def remote_write(self, data):
+        """
+        Called from remote slave to pass L{data} to the extraction thread
+        within boundaries of L{maxsize}
+
+        @type  data: C{string}
+        @param data: String of data to write
+        """
+        if self.remaining is not None:
+            if len(data) > self.remaining:
+                data = data[:self.remaining]
+            self.remaining = self.remaining - len(data)
+        if self.aborted:
+            raise IOError("upload aborted: %s" % self.aborted)
+        if self.done or self.closed or not data:
+            return
+        self.idleTimer.reset(self.idleTimeout)
+        self.cond.acquire()
+        try:
+            self.pending.append(data)
+            full = len(self.pending) > self.maxPending
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        if full:
+            d = defer.Deferred()
+            self.waiting.append(d)
+            return d
+
+    def _close(self):
+        self.cond.acquire()
+        self.closed = True
+        self.cond.notify()
+        self.cond.release()
+
+    def remote_unpack(self):
+        """
+        Called by remote slave to state that no more data will be transfered;
+        returns once the archive is extracted and moved into place
+        """
+        if self.aborted:
+            return defer.fail(IOError("upload aborted: %s" % self.aborted))
+        # what remains to extract is already buffered
+        if self.idleTimer.active():
+            self.idleTimer.cancel()
+        self._close()
+        def moveIntoPlace(_):
+            if self.failure:
+                shutil.rmtree(self.tmpdir, ignore_errors=True)
+                return self.failure
+            if self.aborted:
+                raise IOError("upload aborted: %s" % self.aborted)
+            _moveTree(self.tmpdir, self.destroot)
+        self.extracted.addCallback(moveIntoPlace)
+        return self.extracted
+
+    def cancel(self):
+        """
+        Called when the transfer ends, to discard the archive unless it was
+        unpacked
+        """
+        if self.closed:
+            return
+        self._abort("transfer ended")
 
 
 class StatusRemoteCommand(RemoteCommand):
@@ -190,6 +483,7 @@ class _TransferBuildStep(BuildStep):
 
     haltOnFailure = True
     flunkOnFailure = True
+    delta = False
 
     def setDefaultWorkdir(self, workdir):
         if self.workdir is None:
@@ -203,6 +497,17 @@ class _TransferBuildStep(BuildStep):
             workdir = self.workdir
         return properties.render(workdir)
 
+    def _useDelta(self, command):
+        """Whether the slave should compare files before transferring
+        them"""
+        if not self.delta or self.maxsize is not None:
+            return False
+        if self.slaveVersionIsOlderThan(command, "2.15"):
+            log.msg("slave %s is too old for delta transfers, "
+                    "sending the whole file" % self.build.slavename)
+            return False
+        return True
+
     def interrupt(self, reason):
         self.addCompleteLog('interrupt', str(reason))
         if self.cmd:
@@ -239,6 +544,13 @@ class FileUpload(_TransferBuildStep):
                      The default (=None) is to leave it up to the umask of
                      the buildmaster process.
     - ['keepstamp']  whether to preserve file modified and accessed times
+    - ['window']     number of blocks the slave sends before waiting for the
+                     first one to be written. Slaves older than 0.8.4 send
+                     one block at a time.
+    - ['delta']      whether to skip the upload when masterdest is identical
+                     to the slave's file, and otherwise send only the blocks
+                     masterdest lacks. Not used with maxsize, nor with slaves
+                     older than 0.8.4.
 
     """
 
@@ -246,7 +558,7 @@ class FileUpload(_TransferBuildStep):
 
     def __init__(self, slavesrc, masterdest,
                  workdir=None, maxsize=None, blocksize=16*1024, mode=None, keepstamp=False,
-                 **buildstep_kwargs):
+                 window=8, delta=False, **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
         self.addFactoryArguments(slavesrc=slavesrc,
                                  masterdest=masterdest,
@@ -255,6 +567,8 @@ class FileUpload(_TransferBuildStep):
                                  blocksize=blocksize,
                                  mode=mode,
                                  keepstamp=keepstamp,
+                                 window=window,
+                                 delta=delta,
                                  )
 
         self.slavesrc = slavesrc
@@ -265,6 +579,8 @@ class FileUpload(_TransferBuildStep):
         assert isinstance(mode, (int, type(None)))
         self.mode = mode
         self.keepstamp = keepstamp
+        self.window = window
+        self.delta = delta
 
     def start(self):
         version = self.slaveVersion("uploadFile")
@@ -302,7 +618,10 @@ class FileUpload(_TransferBuildStep):
             'maxsize': self.maxsize,
             'blocksize': self.blocksize,
             'keepstamp': self.keepstamp,
+            'window': self.window,
             }
+        if self._useDelta("uploadFile"):
+            args['delta'] = True
 
         self.cmd = StatusRemoteCommand('uploadFile', args)
         d = self.runCommand(self.cmd)
@@ -323,6 +642,8 @@ class DirectoryUpload(BuildStep):
                      whole directory
     - ['blocksize']  maximum size of each block being transfered
     - ['compress']   compression type to use: one of [None, 'gz', 'bz2']
+    - ['window']     number of blocks the slave sends before waiting for the
+                     first one to be written
 
     """
 
@@ -330,7 +651,7 @@ class DirectoryUpload(BuildStep):
 
     def __init__(self, slavesrc, masterdest,
                  workdir="build", maxsize=None, blocksize=16*1024,
-                 compress=None, **buildstep_kwargs):
+                 compress=None, window=8, **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
         self.addFactoryArguments(slavesrc=slavesrc,
                                  masterdest=masterdest,
@@ -338,6 +659,7 @@ class DirectoryUpload(BuildStep):
                                  maxsize=maxsize,
                                  blocksize=blocksize,
                                  compress=compress,
+                                 window=window,
                                  )
 
         self.slavesrc = slavesrc
@@ -347,6 +669,7 @@ class DirectoryUpload(BuildStep):
         self.blocksize = blocksize
         assert compress in (None, 'gz', 'bz2')
         self.compress = compress
+        self.window = window
 
     def start(self):
         version = self.slaveVersion("uploadDirectory")
@@ -367,7 +690,7 @@ class DirectoryUpload(BuildStep):
                 % (source, masterdest))
 
         self.step_status.setText(['uploading', os.path.basename(source)])
-        
+
         # we use maxsize to limit the amount of data on both sides
         dirWriter = _DirectoryWriter(masterdest, self.maxsize, self.compress, 0600)
 
@@ -378,11 +701,17 @@ class DirectoryUpload(BuildStep):
             'writer': dirWriter,
             'maxsize': self.maxsize,
             'blocksize': self.blocksize,
-            'compress': self.compress
+            'compress': self.compress,
+            'window': self.window,
             }
 
         self.cmd = StatusRemoteCommand('uploadDirectory', args)
         d = self.runCommand(self.cmd)
+        def cancel(res):
+            # the extraction thread must not wait for data that won't come
+            dirWriter.cancel()
+            return res
+        d.addBoth(cancel)
         d.addCallback(self.finished).addErrback(self.failed)
 
     def finished(self, result):
@@ -409,12 +738,15 @@ class _FileReader(pb.Referenceable):
     def __init__(self, fp):
         self.fp = fp
 
-    def remote_read(self, maxlength):
+    def remote_read(self, maxlength, offset=None):
         """
         Called from remote slave to read at most L{maxlength} bytes of data
 
         @type  maxlength: C{integer}
         @param maxlength: Maximum number of data bytes that can be returned
+        @type  offset: C{integer}
+        @param offset: Where to read from, or None to read on from the last
+                       read
 
         @return: Data read from L{fp}
         @rtype: C{string} of bytes read from file
@@ -422,9 +754,34 @@ class _FileReader(pb.Referenceable):
         if self.fp is None:
             return ''
 
+        if offset is not None:
+            self.fp.seek(offset)
         data = self.fp.read(maxlength)
         return data
 
+    def remote_digest(self):
+        """
+        Called from remote slave to compare its file with L{fp}
+
+        @return: SHA-1 hex digest of L{fp}, via Deferred
+        """
+        def digest(fp):
+            digest = _digest(fp)
+            fp.seek(0)
+            return digest
+        return threads.deferToThread(digest, self.fp)
+
+    def remote_signature(self, blocksize, first, count):
+        """
+        Called from remote slave to get the checksums of L{count} blocks of
+        L{fp}, starting at block L{first}, before reading the blocks its file
+        lacks
+
+        @return: list of (weak, strong) checksums, via Deferred
+        """
+        return threads.deferToThread(_signature, self.fp, blocksize,
+                                     first, count)
+
     def remote_close(self):
         """
         Called by remote slave to state that no more data will be transfered
@@ -454,13 +811,20 @@ class FileDownload(_TransferBuildStep):
                    the buildslave account, or 0755 to be world-executable.
                    The default (=None) is to leave it up to the umask of
                    the buildslave process.
+     ['window']    number of blocks the slave requests before waiting for
+                   the first one to arrive. Slaves older than 0.8.4 request
+                   one block at a time.
+     ['delta']     whether to keep slavedest when it is identical to
+                   mastersrc, and otherwise send only the blocks slavedest
+                   lacks. Not used with maxsize, nor with slaves older than
+                   0.8.4.
 
     """
     name = 'download'
 
     def __init__(self, mastersrc, slavedest,
                  workdir=None, maxsize=None, blocksize=16*1024, mode=None,
-                 **buildstep_kwargs):
+                 window=8, delta=False, **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
         self.addFactoryArguments(mastersrc=mastersrc,
                                  slavedest=slavedest,
@@ -468,6 +832,8 @@ class FileDownload(_TransferBuildStep):
                                  maxsize=maxsize,
                                  blocksize=blocksize,
                                  mode=mode,
+                                 window=window,
+                                 delta=delta,
                                  )
 
         self.mastersrc = mastersrc
@@ -477,6 +843,8 @@ class FileDownload(_TransferBuildStep):
         self.blocksize = blocksize
         assert isinstance(mode, (int, type(None)))
         self.mode = mode
+        self.window = window
+        self.delta = delta
 
     def start(self):
         properties = self.build.getProperties()
@@ -517,7 +885,10 @@ class FileDownload(_TransferBuildStep):
             'blocksize': self.blocksize,
             'workdir': self._getWorkdir(),
             'mode': self.mode,
+            'window': self.window,
             }
+        if self._useDelta("downloadFile"):
+            args['delta'] = True
 
         self.cmd = StatusRemoteCommand('downloadFile', args)
         d = self.runCommand(self.cmd)
@@ -543,12 +914,14 @@ class StringDownload(_TransferBuildStep):
                    the buildslave account, or 0755 to be world-executable.
                    The default (=None) is to leave it up to the umask of
                    the buildslave process.
+     ['window']    number of blocks the slave requests before waiting for
+                   the first one to arrive
     """
     name = 'string_download'
 
     def __init__(self, s, slavedest,
                  workdir=None, maxsize=None, blocksize=16*1024, mode=None,
-                 **buildstep_kwargs):
+                 window=8, **buildstep_kwargs):
         BuildStep.__init__(self, **buildstep_kwargs)
         self.addFactoryArguments(s=s,
                                  slavedest=slavedest,
@@ -556,6 +929,7 @@ class StringDownload(_TransferBuildStep):
                                  maxsize=maxsize,
                                  blocksize=blocksize,
                                  mode=mode,
+                                 window=window,
                                  )
 
         self.s = s
@@ -565,6 +939,7 @@ class StringDownload(_TransferBuildStep):
         self.blocksize = blocksize
         assert isinstance(mode, (int, type(None)))
         self.mode = mode
+        self.window = window
 
     def start(self):
         properties = self.build.getProperties()
@@ -594,6 +969,7 @@ class StringDownload(_TransferBuildStep):
             'blocksize': self.blocksize,
             'workdir': self._getWorkdir(),
             'mode': self.mode,
+            'window': self.window,
             }
 
         self.cmd = StatusRemoteCommand('downloadFile', args)
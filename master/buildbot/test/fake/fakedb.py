@@ -23,7 +23,7 @@ import base64
 from buildbot.util import json, epoch2datetime
 from twisted.python import failure
 from twisted.internet import defer, reactor
-from buildbot.db import buildrequests
+from buildbot.db import buildrequests, notifier
 from buildbot.process import properties
 
 # Fake DB Rows
@@ -346,8 +346,23 @@ class FakeChangesComponent(FakeDBComponent):
             ch = None
         return defer.succeed(self._ch2chdict(ch))
 
+    def getChanges(self, changeids):
+        return defer.succeed([ self._ch2chdict(self.changes[changeid])
+                               for changeid in changeids
+                               if changeid in self.changes ])
+
+    def getChangeidsAfter(self, changeid, count=None):
+        changeids = sorted([ id for id in self.changes.iterkeys()
+                             if id > changeid ])
+        if count is not None:
+            changeids = changeids[:count]
+        return defer.succeed(changeids)
+
+    def getRecentChanges(self, count):
+        changeids = sorted(self.changes.iterkeys())[-count:]
+        return self.getChanges(changeids)
+
     # TODO: addChange
-    # TODO: getRecentChanges
 
     # utilities
 
@@ -801,7 +816,7 @@ class FakeBuildRequestsComponent(FakeDBComponent):
             return defer.succeed(None)
 
     def getBuildRequests(self, buildername=None, complete=None, claimed=None,
-                         bsid=None):
+                         bsid=None, after_brid=None):
         rv = []
         for br in self.reqs.itervalues():
             if buildername and br.buildername != buildername:
@@ -826,6 +841,9 @@ class FakeBuildRequestsComponent(FakeDBComponent):
             if bsid is not None:
                 if br.buildsetid != bsid:
                     continue
+            if after_brid is not None:
+                if br.id <= after_brid:
+                    continue
             rv.append(self._brdictFromRow(br))
         return defer.succeed(rv)
 
@@ -835,7 +853,7 @@ class FakeBuildRequestsComponent(FakeDBComponent):
                 return defer.fail(
                         failure.Failure(buildrequests.AlreadyClaimedError))
             br = self.reqs[brid]
-            if br.claimed_at and (
+            if br.complete or br.claimed_at and (
                     br.claimed_by_name != self.MASTER_NAME or
                     br.claimed_by_incarnation != self.MASTER_INCARNATION):
                 return defer.fail(
@@ -848,6 +866,23 @@ class FakeBuildRequestsComponent(FakeDBComponent):
             br.claimed_by_incarnation = self.MASTER_INCARNATION
         return defer.succeed(None)
 
+    def completeBuildRequests(self, brids, results):
+        # requests owned by this master are completed even if some are not
+        notclaimed = False
+        for brid in brids:
+            br = self.reqs.get(brid)
+            if (not br or br.complete or not br.claimed_at or
+                    br.claimed_by_name != self.MASTER_NAME or
+                    br.claimed_by_incarnation != self.MASTER_INCARNATION):
+                notclaimed = True
+                continue
+            br.complete = 1
+            br.results = results
+            br.complete_at = self._reactor.seconds()
+        if notclaimed:
+            return defer.fail(failure.Failure(buildrequests.NotClaimedError))
+        return defer.succeed(None)
+
     def unclaimOldIncarnationRequests(self):
         for br in self.reqs.itervalues():
             if (not br.complete and br.claimed_at and
@@ -1020,6 +1055,7 @@ class FakeDBConnector(object):
         self._components.append(comp)
         self.builds = comp = FakeBuildsComponent(self, testcase)
         self._components.append(comp)
+        self.notifier = notifier.Notifier(self)
 
     def insertTestData(self, rows):
         """Insert a list of Row instances into the database; this method can be
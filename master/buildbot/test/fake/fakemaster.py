@@ -14,6 +14,7 @@
 # Copyright Buildbot Team Members
 
 import mock
+from buildbot.process import unclaimed
 
 def make_master():
     """
@@ -21,6 +22,8 @@ def make_master():
     implementations:
 
     - Non-caching implementation for C{self.caches}
+    - A real L{UnclaimedRequestIndex} for C{self.unclaimed_requests}, reading
+      from C{self.db}, which is updated by C{self.buildRequestsClaimed}
     """
 
     fakemaster = mock.Mock(name="fakemaster")
@@ -29,7 +32,14 @@ def make_master():
     def fake_get_cache(name, miss_fn):
         fake_cache = mock.Mock(name='fakemaster.caches[%r]' % name)
         fake_cache.get = miss_fn
+        fake_cache.peek = lambda key : None
+        fake_cache.add = lambda key, value : None
         return fake_cache
     fakemaster.caches.get_cache = fake_get_cache
 
+    # set up the unclaimed request index
+    fakemaster.unclaimed_requests = unclaimed.UnclaimedRequestIndex(fakemaster)
+    fakemaster.buildRequestsClaimed = \
+            fakemaster.unclaimed_requests.removeRequests
+
     return fakemaster
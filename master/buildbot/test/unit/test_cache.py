@@ -15,6 +15,7 @@
 
 from twisted.trial import unittest
 from buildbot import cache
+from buildbot.util import lru
 
 class CacheManager(unittest.TestCase):
 
@@ -35,3 +36,31 @@ class CacheManager(unittest.TestCase):
         bar_cache = self.caches.get_cache("bar", None)
         self.assertEqual((foo_cache.max_size, bar_cache.max_size),
                          (5, 6))
+
+    def test_register_cache(self):
+        self.caches.load_config({'foo' : 5})
+        foo_cache = lru.SyncLRUCache(None, 2)
+        bar_cache = lru.SyncLRUCache(None, 2)
+        self.caches.register_cache("foo", foo_cache)
+        self.caches.register_cache("bar", bar_cache, default_size=7)
+        self.assertEqual((foo_cache.max_size, bar_cache.max_size), (5, 7))
+
+        self.caches.load_config({'bar' : 3})
+        self.assertEqual((foo_cache.max_size, bar_cache.max_size),
+                         (self.caches.DEFAULT_CACHE_SIZE, 3))
+
+    def test_get_metrics(self):
+        foo_cache = self.caches.get_cache("foo", None)
+        foo_cache.hits = 3
+        bar_caches = [ lru.SyncLRUCache(None, 2) for i in range(2) ]
+        for i, c in enumerate(bar_caches):
+            self.caches.register_cache("bar", c)
+            c.misses = i + 1
+            c.evictions = 4
+        self.assertEqual(self.caches.get_metrics(), {
+            'foo' : dict(hits=3, refhits=0, misses=0, evictions=0),
+            'bar' : dict(hits=0, refhits=0, misses=3, evictions=8) })
+
+        # registered caches are only weakly referenced
+        del bar_caches, c
+        self.assertEqual(self.caches.get_metrics()['bar']['misses'], 0)
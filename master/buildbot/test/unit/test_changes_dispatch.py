@@ -0,0 +1,145 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from twisted.trial import unittest
+from buildbot.changes import dispatch
+from buildbot.changes.filter import ChangeFilter
+
+class Change(object):
+    project = ''
+    repository = ''
+    branch = None
+    category = None
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class TestChangeDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = dispatch.ChangeDispatcher("changes")
+        self.delivered = []
+
+    def subscribe(self, name, change_filter=None):
+        def cb(change):
+            self.delivered.append((name, change))
+        return self.dispatcher.subscribe(cb, change_filter=change_filter)
+
+    def assertDelivered(self, change, exp_names):
+        self.delivered = []
+        self.dispatcher.deliver(change)
+        self.assertEqual(sorted([ n for n, ch in self.delivered ]),
+                         sorted(exp_names))
+        for n, ch in self.delivered:
+            self.assertIdentical(ch, change)
+
+    def test_unfiltered(self):
+        self.subscribe('all')
+        self.assertDelivered(Change(), [ 'all' ])
+
+    def test_exact(self):
+        self.subscribe('trunk', ChangeFilter(branch='trunk'))
+        self.subscribe('both', ChangeFilter(branch=['trunk', 'dev']))
+        self.subscribe('dev-docs', ChangeFilter(branch='dev', category='docs'))
+        self.assertDelivered(Change(branch='trunk'), [ 'trunk', 'both' ])
+        self.assertDelivered(Change(branch='dev'), [ 'both' ])
+        self.assertDelivered(Change(branch='dev', category='docs'),
+                             [ 'both', 'dev-docs' ])
+        self.assertDelivered(Change(branch='other'), [])
+
+    def test_exact_None(self):
+        self.subscribe('default', ChangeFilter(branch=None))
+        self.assertDelivered(Change(branch=None), [ 'default' ])
+        self.assertDelivered(Change(branch='trunk'), [])
+
+    def test_regex(self):
+        self.subscribe('rel', ChangeFilter(branch_re='release-'))
+        self.subscribe('rel-docs', ChangeFilter(branch_re='release-',
+                                                category='docs'))
+        self.subscribe('proj', ChangeFilter(project_re='bb'))
+        self.assertDelivered(Change(branch='release-1'), [ 'rel' ])
+        self.assertDelivered(Change(branch='release-1', category='docs'),
+                             [ 'rel', 'rel-docs' ])
+        self.assertDelivered(Change(branch=None, project='bbot'), [ 'proj' ])
+
+    def test_filter_fn(self):
+        self.subscribe('fn', ChangeFilter(filter_fn=lambda ch : ch.x))
+        self.subscribe('fn-trunk', ChangeFilter(filter_fn=lambda ch : ch.x,
+                                                branch='trunk'))
+        self.assertDelivered(Change(x=True, branch='trunk'),
+                             [ 'fn', 'fn-trunk' ])
+        self.assertDelivered(Change(x=False, branch='trunk'), [])
+        self.assertDelivered(Change(x=True, branch='dev'), [ 'fn' ])
+
+    def test_filter_change_overridden(self):
+        class AlsoDocs(ChangeFilter):
+            def filter_change(self, change):
+                return (change.category == 'docs' or
+                        ChangeFilter.filter_change(self, change))
+        self.subscribe('trunk-or-docs', AlsoDocs(branch='trunk'))
+        self.assertDelivered(Change(branch='trunk'), [ 'trunk-or-docs' ])
+        self.assertDelivered(Change(branch='dev', category='docs'),
+                             [ 'trunk-or-docs' ])
+        self.assertDelivered(Change(branch='dev'), [])
+
+    def test_duck_typed_filter(self):
+        class OddRevisions(object):
+            def filter_change(self, change):
+                return change.revision % 2
+        self.subscribe('odd', OddRevisions())
+        self.assertDelivered(Change(revision=3), [ 'odd' ])
+        self.assertDelivered(Change(revision=4), [])
+
+    def test_evaluations_saved(self):
+        for branch in range(10):
+            self.subscribe(branch, ChangeFilter(branch=str(branch)))
+        self.subscribe('fn', ChangeFilter(filter_fn=lambda ch : True))
+        self.assertDelivered(Change(branch='3'), [ 3, 'fn' ])
+        self.assertEqual(self.dispatcher.evaluations, 2)
+        self.assertEqual(self.dispatcher.evaluations_saved, 9)
+
+    def test_unsubscribe(self):
+        sub = self.subscribe('trunk', ChangeFilter(branch='trunk'))
+        self.subscribe('trunk2', ChangeFilter(branch='trunk'))
+        sub.unsubscribe()
+        self.assertDelivered(Change(branch='trunk'), [ 'trunk2' ])
+        self.assertEqual(self.dispatcher.evaluations_saved, 0)
+
+    def test_unsubscribe_last(self):
+        self.subscribe('all')
+        sub = self.subscribe('rel', ChangeFilter(branch_re='rel'))
+        sub.unsubscribe()
+        self.assertEqual(self.dispatcher._regexes, {})
+        self.assertDelivered(Change(branch='rel'), [ 'all' ])
+
+    def test_unsubscribe_during_delivery(self):
+        subs = []
+        def cb(change):
+            self.delivered.append(change)
+            for sub in subs:
+                sub.unsubscribe()
+            del subs[:]
+        subs.append(self.dispatcher.subscribe(cb, ChangeFilter(branch='b')))
+        subs.append(self.dispatcher.subscribe(cb, ChangeFilter(branch='b')))
+        self.dispatcher.deliver(Change(branch='b'))
+        self.assertEqual(len(self.delivered), 1)
+
+    def test_callback_exception(self):
+        def cb(change):
+            raise RuntimeError("oh noes")
+        self.dispatcher.subscribe(cb, ChangeFilter(branch='b'))
+        self.subscribe('b', ChangeFilter(branch='b'))
+        self.assertDelivered(Change(branch='b'), [ 'b' ])
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
@@ -15,90 +15,10 @@
 
 from twisted.trial import unittest
 from twisted.internet import defer
-from exceptions import Exception
 from buildbot.changes import gitpoller
 from buildbot.test.util import changesource, gpo
 from buildbot.util import epoch2datetime
 
-class GitOutputParsing(gpo.GetProcessOutputMixin, unittest.TestCase):
-    """Test GitPoller methods for parsing git output"""
-    def setUp(self):
-        self.poller = gitpoller.GitPoller('git@example.com:foo/baz.git')
-        self.setUpGetProcessOutput()
-
-    def tearDown(self):
-        self.tearDownGetProcessOutput()
-        
-    def _perform_git_output_test(self, methodToTest,
-                                 desiredGoodOutput, desiredGoodResult,
-                                 emptyRaisesException=True):
-        dummyRevStr = '12345abcde'
-
-        # make this call to self.patch here so that we raise a SkipTest if it
-        # is not supported
-        self.addGetProcessOutputResult(self.gpoAnyPattern(), '')
-
-        d = defer.succeed(None)
-        def call_empty(_):
-            # we should get an Exception with empty output from git
-            return methodToTest(dummyRevStr)
-        d.addCallback(call_empty)
-    
-        def cb_empty(_):
-            if emptyRaisesException:
-                self.fail("getProcessOutput should have failed on empty output")
-        def eb_empty(f):
-            if not emptyRaisesException:
-                self.fail("getProcessOutput should NOT have failed on empty output")
-        d.addCallbacks(cb_empty, eb_empty)
-
-        # and the method shouldn't supress any exceptions
-        def call_exception(_):
-            # we should get an Exception with empty output from git
-            self.addGetProcessOutputResult(self.gpoAnyPattern(),
-                    lambda b, a, **k: defer.fail(Exception('fake')))
-            return methodToTest(dummyRevStr)
-        d.addCallback(call_exception)
-    
-        def cb_exception(_):
-            self.fail("getProcessOutput should have failed on empty output")
-        def eb_exception(f):
-            pass
-        d.addCallbacks(cb_exception, eb_exception)
-
-        # finally we should get what's expected from good output
-        def call_desired(_):
-            self.addGetProcessOutputResult(self.gpoAnyPattern(),
-                desiredGoodOutput)
-            return methodToTest(dummyRevStr)
-        d.addCallback(call_desired)
-    
-        def cb_desired(r):
-            self.assertEquals(r, desiredGoodResult)
-        d.addCallback(cb_desired)
-        
-    def test_get_commit_name(self):
-        nameStr = 'Sammy Jankis'
-        return self._perform_git_output_test(self.poller._get_commit_name,
-                nameStr, nameStr)
-        
-    def test_get_commit_comments(self):
-        commentStr = 'this is a commit message\n\nthat is multiline'
-        return self._perform_git_output_test(self.poller._get_commit_comments,
-                commentStr, commentStr)
-        
-    def test_get_commit_files(self):
-        filesStr = 'file1\nfile2'
-        return self._perform_git_output_test(self.poller._get_commit_files, filesStr, 
-                                      filesStr.split(), emptyRaisesException=False)    
-        
-    def test_get_commit_timestamp(self):
-        stampStr = '1273258009'
-        return self._perform_git_output_test(self.poller._get_commit_timestamp,
-                stampStr, float(stampStr))
-
-    # _get_changes is tested in TestGitPoller, below
-
 class TestGitPoller(gpo.GetProcessOutputMixin,
                     changesource.ChangeSourceMixin,
                     unittest.TestCase):
@@ -119,6 +39,37 @@ class TestGitPoller(gpo.GetProcessOutputMixin,
     def test_describe(self):
         self.assertSubstring("GitPoller", self.poller.describe())
 
+    def gitLogOutput(self, *commits):
+        # format commits as 'git log -z --name-only' does with commitFormat
+        output = []
+        for rev, name, files in commits:
+            output.append('\x01%s\x001273258009\x00by:%s\x00hello!\n\x00\x00'
+                          % (rev, name))
+            if files:
+                output.append('\n' + ''.join([ f + '\x00' for f in files ]))
+        return ''.join(output)
+
+    def test_parse_commits(self):
+        output = self.gitLogOutput(
+                ('4423cdbcbb89c14e50dd5f4152415afd686c5241', 'dustin',
+                    [ 'a file', 'b' ]),
+                ('64a5dc2a4bd4f558b5dd193d47c83c7d7abc9a1a', 'warner', []),
+                ('0c79c685f0d2bc6a19beeb09332adcdc00598abf', 'tom', [ 'c' ]))
+        commits = list(self.poller._parse_commits(output))
+        self.assertEqual([ c['revision'][:4] for c in commits ],
+                         [ '4423', '64a5', '0c79' ])
+        self.assertEqual([ c['files'] for c in commits ],
+                         [ [ 'a file', 'b' ], [], [ 'c' ] ])
+        self.assertEqual(commits[1]['author'], 'by:warner')
+        self.assertEqual(commits[1]['comments'], 'hello!')
+        self.assertEqual(commits[1]['timestamp'], 1273258009.0)
+
+    def test_parse_commits_no_timestamps(self):
+        self.poller.usetimestamps = False
+        output = self.gitLogOutput(('4423cdbc', 'dustin', []))
+        commits = list(self.poller._parse_commits(output))
+        self.assertEqual(commits[0]['timestamp'], None)
+
     def test_poll(self):
         # patch out getProcessOutput and getProcessOutputAndValue for the
         # benefit of the _get_changes method
@@ -127,28 +78,15 @@ class TestGitPoller(gpo.GetProcessOutputMixin,
                 "no interesting output")
         self.addGetProcessOutputResult(
                 self.gpoSubcommandPattern('git', 'log'),
-                '\n'.join([
-                    '64a5dc2a4bd4f558b5dd193d47c83c7d7abc9a1a',
-                    '4423cdbcbb89c14e50dd5f4152415afd686c5241']))
+                self.gitLogOutput(
+                    ('4423cdbcbb89c14e50dd5f4152415afd686c5241', '4423cdbc',
+                        [ '/etc/442' ]),
+                    ('64a5dc2a4bd4f558b5dd193d47c83c7d7abc9a1a', '64a5dc2a',
+                        [ '/etc/64a' ])))
         self.addGetProcessOutputAndValueResult(
                 self.gpoSubcommandPattern('git', 'reset'),
                 ('done', '', 0))
 
-        # and patch out the _get_commit_foo methods which were already tested
-        # above
-        def timestamp(rev):
-            return defer.succeed(1273258009.0)
-        self.patch(self.poller, '_get_commit_timestamp', timestamp)
-        def name(rev):
-            return defer.succeed('by:' + rev[:8])
-        self.patch(self.poller, '_get_commit_name', name)
-        def files(rev):
-            return defer.succeed(['/etc/' + rev[:3]])
-        self.patch(self.poller, '_get_commit_files', files)
-        def comments(rev):
-            return defer.succeed('hello!')
-        self.patch(self.poller, '_get_commit_comments', comments)
-
         # do the poll
         d = self.poller.poll()
 
@@ -166,6 +104,91 @@ class TestGitPoller(gpo.GetProcessOutputMixin,
                                         epoch2datetime(1273258009))
             self.assertEqual(self.changes_added[1]['comments'], 'hello!')
             self.assertEqual(self.changes_added[1]['files'], [ '/etc/64a' ])
+            # everything was done with a single 'git log'
+            self.assertEqual(self._gpo_patterns, [])
         d.addCallback(check)
 
         return d
+
+    def test_poll_branches(self):
+        self.poller = gitpoller.GitPoller('git@example.com:foo/baz.git',
+                                          branches=['master', 'release'])
+        self.poller.master = self.master
+        git_args = []
+        def record(bin, args, **kwargs):
+            git_args.append(args)
+            return ('', '', 0)
+
+        self.addGetProcessOutputResult(
+                self.gpoSubcommandPattern('git', 'fetch'), '')
+        self.addGetProcessOutputResult(
+                self.gpoSubcommandPattern('git', 'log'), '')
+        self.addGetProcessOutputResult(
+                self.gpoSubcommandPattern('git', 'log'),
+                self.gitLogOutput(('4423cdbc', 'dustin', [ 'a' ])))
+        self.addGetProcessOutputAndValueResult(
+                self.gpoSubcommandPattern('git', 'branch'), record)
+
+        d = self.poller.poll()
+        def check(_):
+            self.assertEqual([ c['branch'] for c in self.changes_added ],
+                             [ 'release' ])
+            self.assertEqual(git_args,
+                    [ [ 'branch', '-f', 'release', 'origin/release' ] ])
+        d.addCallback(check)
+        return d
+
+    def test_poll_new_branch(self):
+        self.poller = gitpoller.GitPoller('git@example.com:foo/baz.git',
+                                          branches=['master', 'release'])
+        self.poller.master = self.master
+
+        self.addGetProcessOutputResult(
+                self.gpoSubcommandPattern('git', 'fetch'), '')
+        self.addGetProcessOutputResult(
+                self.gpoSubcommandPattern('git', 'log'), '')
+        self.addGetProcessOutputResult(
+                self.gpoSubcommandPattern('git', 'log'),
+                lambda bin, args, **kwargs :
+                    defer.fail(IOError("unknown revision")))
+        self.addGetProcessOutputAndValueResult(
+                self.gpoSubcommandPattern('git', 'branch'), ('', '', 0))
+
+        d = self.poller.poll()
+        def check(_):
+            self.assertEqual(self.changes_added, [])
+            self.assertEqual(self._gpoav_patterns, [])
+        d.addCallback(check)
+        return d
+
+    def test_poll_missing_branch(self):
+        # a branch that does not exist in the remote repository doesn't stop
+        # changes on the other branches
+        self.poller = gitpoller.GitPoller('git@example.com:foo/baz.git',
+                branches=['master', 'missing', 'release'])
+        self.poller.master = self.master
+
+        self.addGetProcessOutputResult(
+                self.gpoSubcommandPattern('git', 'fetch'), '')
+        self.addGetProcessOutputResult(
+                self.gpoSubcommandPattern('git', 'log'), '')
+        self.addGetProcessOutputResult(
+                self.gpoSubcommandPattern('git', 'log'),
+                lambda bin, args, **kwargs :
+                    defer.fail(IOError("unknown revision")))
+        self.addGetProcessOutputAndValueResult(
+                self.gpoSubcommandPattern('git', 'branch'),
+                ('', 'not a valid object name', 128))
+        self.addGetProcessOutputResult(
+                self.gpoSubcommandPattern('git', 'log'),
+                self.gitLogOutput(('4423cdbc', 'dustin', [ 'a' ])))
+        self.addGetProcessOutputAndValueResult(
+                self.gpoSubcommandPattern('git', 'branch'), ('', '', 0))
+
+        d = self.poller.poll()
+        def check(_):
+            self.assertEqual([ c['branch'] for c in self.changes_added ],
+                             [ 'release' ])
+            self.assertEqual(len(self.flushLoggedErrors(EnvironmentError)), 1)
+        d.addCallback(check)
+        return d
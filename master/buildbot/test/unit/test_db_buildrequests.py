@@ -14,9 +14,13 @@
 # Copyright Buildbot Team Members
 
 import datetime
+import time
+import random
+import mock
 import sqlalchemy as sa
 from twisted.trial import unittest
-from twisted.internet import task
+from twisted.internet import task, defer
+from twisted.python import log
 from buildbot.db import buildrequests
 from buildbot.test.util import connector_component
 from buildbot.test.fake import fakedb
@@ -181,6 +185,16 @@ class TestBuildsetsConnectorComponent(
                 buildername='dd',
                 expected=[])
 
+    def test_getBuildRequests_after_brid(self):
+        return self.do_test_getBuildRequests_buildername_arg(
+                after_brid=8,
+                expected=[9,10])
+
+    def test_getBuildRequests_after_brid_and_buildername(self):
+        return self.do_test_getBuildRequests_buildername_arg(
+                after_brid=9, buildername='cc',
+                expected=[10])
+
     def do_test_getBuildRequests_complete_arg(self, **kwargs):
         expected = kwargs.pop('expected')
         d = self.insertTestData([
@@ -463,6 +477,17 @@ class TestBuildsetsConnectorComponent(
             ], 1300305712, [ 44 ],
             expfailure=buildrequests.AlreadyClaimedError)
 
+    def test_claimBuildRequests_reclaim_complete(self):
+        # a completed request (e.g., a cancelled one) can't be re-claimed,
+        # even by the master that completed it
+        return self.do_test_claimBuildRequests([
+                fakedb.BuildRequest(id=44, buildsetid=self.BSID,
+                    complete=1, complete_at=1300104190,
+                    claimed_at=1300103810, claimed_by_name=self.MASTER_NAME,
+                    claimed_by_incarnation=self.MASTER_INCARN),
+            ], 1300305712, [ 44 ],
+            expfailure=buildrequests.AlreadyClaimedError)
+
     def test_claimBuildRequests_other_master_claim_stress(self):
         d = self.do_test_claimBuildRequests([
                 fakedb.BuildRequest(id=id, buildsetid=self.BSID,
@@ -556,8 +581,47 @@ class TestBuildsetsConnectorComponent(
               (46, 1, 7, 1300305712),
             ], brids=[44, 46])
 
-    def test_completeBuildRequests_multiple_notmine(self):
+    def test_completeBuildRequests_chunked(self):
+        self.patch(buildrequests.base, 'MAX_IN_LIST', 2)
         return self.do_test_completeBuildRequests([
+            fakedb.BuildRequest(id=id, buildsetid=self.BSID,
+                claimed_at=1300103810, claimed_by_name=self.MASTER_NAME,
+                claimed_by_incarnation=self.MASTER_INCARN)
+                for id in range(44, 49)
+            ], 1300305712,
+            [ (id, 1, 7, 1300305712) for id in range(44, 49) ],
+            brids=range(44, 49))
+
+    def test_completeBuildRequests_chunked_notmine(self):
+        self.patch(buildrequests.base, 'MAX_IN_LIST', 2)
+        d = self.do_test_completeBuildRequests([
+            fakedb.BuildRequest(id=44, buildsetid=self.BSID,
+                claimed_at=1300103810, claimed_by_name=self.MASTER_NAME,
+                claimed_by_incarnation=self.MASTER_INCARN),
+            fakedb.BuildRequest(id=45, buildsetid=self.BSID,
+                claimed_at=1300103811, claimed_by_name=self.MASTER_NAME,
+                claimed_by_incarnation=self.MASTER_INCARN),
+            fakedb.BuildRequest(id=46, buildsetid=self.BSID,
+                claimed_at=1300103812, claimed_by_name="some other",
+                claimed_by_incarnation="master"),
+            ], 1300305712,
+            brids=[44, 45, 46],
+            expfailure=buildrequests.NotClaimedError)
+        d.addCallback(lambda _ : self.checkCompleted([44, 45]))
+        return d
+
+    def checkCompleted(self, brids):
+        def thd(conn):
+            tbl = self.db.model.buildrequests
+            q = sa.select([ tbl.c.id ], (tbl.c.complete != 0))
+            self.assertEqual(sorted([ r.id for r in conn.execute(q) ]),
+                             brids)
+        return self.db.pool.do(thd)
+
+    def test_completeBuildRequests_multiple_notmine(self):
+        # a merged set, one of whose requests was taken over by another
+        # master: the requests still owned are completed anyway
+        d = self.do_test_completeBuildRequests([
             fakedb.BuildRequest(id=44, buildsetid=self.BSID,
                 claimed_at=1300103810, claimed_by_name=self.MASTER_NAME,
                 claimed_by_incarnation=self.MASTER_INCARN),
@@ -570,6 +634,8 @@ class TestBuildsetsConnectorComponent(
             ], 1300305712,
             brids=[44, 45, 46],
             expfailure=buildrequests.NotClaimedError)
+        d.addCallback(lambda _ : self.checkCompleted([44, 46]))
+        return d
 
     def test_completeBuildRequests_unclaimed(self):
         return self.do_test_completeBuildRequests([
@@ -690,3 +756,125 @@ class TestBuildsetsConnectorComponent(
             lambda : self.db.buildrequests.unclaimBuildRequests(to_unclaim),
             [45, 47])
 
+    def test_unclaimBuildRequests_chunked(self):
+        self.patch(buildrequests.base, 'MAX_IN_LIST', 2)
+        return self.test_unclaimBuildRequests()
+
+    def test_unclaimBuildRequests_notifies(self):
+        self.db.notifier = mock.Mock()
+        d = self.insertTestData([
+            fakedb.BuildRequest(id=45, buildsetid=self.BSID,
+                complete=0,
+                claimed_at=self.CLAIMED_AT_EPOCH,
+                claimed_by_name=self.MASTER_NAME,
+                claimed_by_incarnation=self.MASTER_INCARN),
+        ])
+        d.addCallback(lambda _ :
+                self.db.buildrequests.unclaimBuildRequests([45, 46]))
+        def check(_):
+            args = self.db.notifier.notify_thd.call_args[0]
+            self.assertEqual(args[1:], ('buildrequests_unclaimed', '45,46'))
+        d.addCallback(check)
+        return d
+
+class ClaimBenchmark(
+            connector_component.ConnectorComponentMixin,
+            unittest.TestCase):
+    """
+    Several masters, sharing a database, race to claim a queue of build
+    requests.  This checks that no build request is claimed twice, and logs
+    the claim rate achieved (see C{_trial_temp/test.log}).
+    """
+
+    NUM_MASTERS = 4
+    NUM_REQUESTS = 100
+    BSID = 567
+
+    def setUp(self):
+        d = self.setUpConnectorComponent(
+            table_names=[ 'patches', 'changes', 'sourcestamp_changes',
+                'buildsets', 'buildset_properties', 'buildrequests',
+                'sourcestamps' ])
+
+        def finish_setup(_):
+            # one connector component per master, all sharing the same pool
+            self.masters = []
+            for i in range(self.NUM_MASTERS):
+                conn = connector_component.FakeDBConnector()
+                conn.pool = self.db.pool
+                conn.model = self.db.model
+                conn.notifier = self.db.notifier
+                conn.master = mock.Mock()
+                conn.master.master_name = 'master%d' % i
+                conn.master.master_incarnation = 'incarn'
+                conn.buildrequests = \
+                    buildrequests.BuildRequestsConnectorComponent(conn)
+                self.masters.append(conn)
+        d.addCallback(finish_setup)
+
+        d.addCallback(lambda _ :
+            self.insertTestData([
+                fakedb.SourceStamp(id=234),
+                fakedb.Buildset(id=self.BSID, sourcestampid=234),
+            ] + [
+                fakedb.BuildRequest(id=id, buildsetid=self.BSID,
+                    claimed_at=0, claimed_by_name=None,
+                    claimed_by_incarnation=None)
+                for id in range(1, self.NUM_REQUESTS+1)
+            ]))
+
+        return d
+
+    def tearDown(self):
+        return self.tearDownConnectorComponent()
+
+    @defer.deferredGenerator
+    def claimLoop(self, master, claims):
+        # repeatedly claim the oldest few unclaimed requests, as a builder
+        # merging requests would
+        batch = random.randint(1, 3)
+        while True:
+            wfd = defer.waitForDeferred(
+                master.buildrequests.getBuildRequests(claimed=False))
+            yield wfd
+            brids = sorted([ br['brid'] for br in wfd.getResult() ])
+            if not brids:
+                return
+
+            wfd = defer.waitForDeferred(
+                master.buildrequests.claimBuildRequests(brids[:batch]))
+            yield wfd
+            try:
+                wfd.getResult()
+                claims.extend([ (brid, master.master.master_name)
+                                for brid in brids[:batch] ])
+            except buildrequests.AlreadyClaimedError:
+                pass
+
+    def test_concurrent_masters(self):
+        claims = []
+        start = time.time()
+        d = defer.gatherResults([ self.claimLoop(master, claims)
+                                  for master in self.masters ])
+        def check(_):
+            elapsed = time.time() - start
+            log.msg("ClaimBenchmark: %d masters claimed %d requests in "
+                    "%0.3fs (%0.1f claims/s)" % (self.NUM_MASTERS,
+                        len(claims), elapsed, len(claims) / elapsed))
+
+            # every request was claimed exactly once..
+            self.assertEqual(sorted([ brid for brid, _ in claims ]),
+                             range(1, self.NUM_REQUESTS+1))
+
+            # ..by the master that thinks it claimed it
+            def thd(conn):
+                tbl = self.db.model.buildrequests
+                q = sa.select([ tbl.c.id, tbl.c.claimed_by_name ])
+                return dict((row.id, row.claimed_by_name)
+                            for row in conn.execute(q).fetchall())
+            d = self.db.pool.do(thd)
+            d.addCallback(lambda owners :
+                self.assertEqual(owners, dict(claims)))
+            return d
+        d.addCallback(check)
+        return d
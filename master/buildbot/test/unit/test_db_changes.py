@@ -19,6 +19,7 @@ import sqlalchemy as sa
 from twisted.trial import unittest
 from twisted.internet import defer, task
 from buildbot.changes.changes import Change
+from buildbot import cache
 from buildbot.db import changes
 from buildbot.test.util import connector_component
 from buildbot.test.fake import fakedb
@@ -159,6 +160,115 @@ class TestChangesConnectorComponent(
         d.addCallback(check14)
         return d
 
+    def test_getChanges(self):
+        d = self.insertTestData(self.change13_rows + self.change14_rows)
+        d.addCallback(lambda _ :
+                self.db.changes.getChanges([14, 13]))
+        def check(chdicts):
+            self.assertEqual([ c['changeid'] for c in chdicts ], [14, 13])
+            self.assertEqual(chdicts[0], self.change14_dict)
+            self.assertEqual(sorted(chdicts[1]['files']),
+                        sorted(['master/README.txt', 'slave/README.txt']))
+            self.assertEqual(sorted(chdicts[1]['links']),
+                        sorted(['http://buildbot.net',
+                                'http://sf.net/projects/buildbot']))
+            self.assertEqual(chdicts[1]['properties'],
+                        { 'notest' : ('no', 'Change') })
+        d.addCallback(check)
+        return d
+
+    def test_getChanges_missing(self):
+        d = self.insertTestData(self.change14_rows)
+        d.addCallback(lambda _ :
+                self.db.changes.getChanges([13, 14, 15]))
+        def check(chdicts):
+            self.assertEqual(chdicts, [ self.change14_dict ])
+        d.addCallback(check)
+        return d
+
+    def test_getChanges_empty(self):
+        d = self.db.changes.getChanges([])
+        def check(chdicts):
+            self.assertEqual(chdicts, [])
+        d.addCallback(check)
+        return d
+
+    def useRealCache(self):
+        self.db.master.caches = cache.CacheManager()
+        self.db.master.caches.load_config(dict(chdicts=10))
+        self.db.changes = changes.ChangesConnectorComponent(self.db)
+
+    def test_getChanges_populates_cache(self):
+        self.useRealCache()
+        d = self.insertTestData(self.change13_rows + self.change14_rows)
+        d.addCallback(lambda _ :
+                self.db.changes.getChanges([13, 14]))
+        def check(chdicts):
+            # the subsequent getChange calls should be cache hits, returning
+            # the identical objects
+            cache = self.db.changes.getChange.cache
+            misses = cache.misses
+            d = defer.gatherResults([ self.db.changes.getChange(13),
+                                      self.db.changes.getChange(14) ])
+            def check_cached(cached):
+                self.assertIdentical(cached[0], chdicts[0])
+                self.assertIdentical(cached[1], chdicts[1])
+                self.assertEqual(cache.misses, misses)
+            d.addCallback(check_cached)
+            return d
+        d.addCallback(check)
+        return d
+
+    def test_getChanges_uses_cache(self):
+        self.useRealCache()
+        d = self.insertTestData(self.change13_rows + self.change14_rows)
+        d.addCallback(lambda _ :
+                self.db.changes.getChange(13))
+        def get_both(chdict13):
+            self.chdict13 = chdict13
+            return self.db.changes.getChanges([13, 14])
+        d.addCallback(get_both)
+        def check(chdicts):
+            self.assertIdentical(chdicts[0], self.chdict13)
+            self.assertEqual(chdicts[1], self.change14_dict)
+        d.addCallback(check)
+        return d
+
+    def test_getChanges_chunked(self):
+        self.patch(changes.base, 'MAX_IN_LIST', 2)
+        rows = [ fakedb.Change(changeid=id) for id in range(20, 27) ]
+        rows += [ fakedb.ChangeFile(changeid=id, filename='f%d' % id)
+                  for id in range(20, 27) ]
+        d = self.insertTestData(rows)
+        d.addCallback(lambda _ :
+                self.db.changes.getChanges(range(20, 27)))
+        def check(chdicts):
+            self.assertEqual([ (c['changeid'], c['files']) for c in chdicts ],
+                    [ (id, [ 'f%d' % id ]) for id in range(20, 27) ])
+        d.addCallback(check)
+        return d
+
+    def test_getChangeidsAfter(self):
+        d = self.insertTestData([
+            fakedb.Change(changeid=8),
+            fakedb.Change(changeid=10),
+            fakedb.Change(changeid=11),
+            fakedb.Change(changeid=15),
+        ])
+        d.addCallback(lambda _ :
+                self.db.changes.getChangeidsAfter(9))
+        d.addCallback(lambda changeids :
+                self.assertEqual(changeids, [10, 11, 15]))
+        d.addCallback(lambda _ :
+                self.db.changes.getChangeidsAfter(9, count=2))
+        d.addCallback(lambda changeids :
+                self.assertEqual(changeids, [10, 11]))
+        d.addCallback(lambda _ :
+                self.db.changes.getChangeidsAfter(15))
+        d.addCallback(lambda changeids :
+                self.assertEqual(changeids, []))
+        return d
+
     def test_getLatestChangeid(self):
         d = self.insertTestData(self.change13_rows)
         def get(_):
@@ -251,6 +361,40 @@ class TestChangesConnectorComponent(
         d.addCallback(check_change_properties)
         return d
 
+    def test_addChanges(self):
+        d = self.db.changes.addChanges([
+            dict(author=u'dustin', files=[u'a', u'b'], comments=u'first',
+                 links=[u'http://slashdot.org'], revision=u'1234',
+                 when_timestamp=epoch2datetime(266738400), branch=u'master',
+                 properties={u'platform': (u'linux', 'Change')}),
+            dict(author=u'warner', files=[u'c'], comments=u'second',
+                 revision=u'5678', when_timestamp=epoch2datetime(266738404),
+                 branch=u'master'),
+            ])
+        def check_changeids(changeids):
+            self.assertEqual(changeids, [ 1, 2 ])
+            return self.db.changes.getChanges(changeids)
+        d.addCallback(check_changeids)
+        def check_chdicts(chdicts):
+            self.assertEqual([ (ch['changeid'], ch['author'], ch['comments'],
+                                sorted(ch['files']), ch['links'],
+                                ch['properties'])
+                               for ch in chdicts ], [
+                (1, u'dustin', u'first', [ u'a', u'b' ],
+                    [ u'http://slashdot.org' ],
+                    { u'platform' : (u'linux', 'Change') }),
+                (2, u'warner', u'second', [ u'c' ], [], {}),
+            ])
+        d.addCallback(check_chdicts)
+        return d
+
+    def test_addChanges_empty(self):
+        d = self.db.changes.addChanges([])
+        def check(changeids):
+            self.assertEqual(changeids, [])
+        d.addCallback(check)
+        return d
+
     def test_addChange_when_timestamp_None(self):
         clock = task.Clock()
         clock.advance(1239898353)
@@ -0,0 +1,138 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import mock
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, threads
+from buildbot.db import notifier
+
+class Notifier(unittest.TestCase):
+
+    def setUp(self):
+        self.notifier = notifier.Notifier(mock.Mock())
+
+    def notify_in_thread(self, channel, payload=None):
+        return threads.deferToThread(
+                lambda : self.notifier.notify_thd(None, channel, payload))
+
+    def wait_for_delivery(self, _):
+        # notify_thd uses callFromThread, so delivery happens on the next
+        # reactor iteration
+        d = defer.Deferred()
+        reactor.callLater(0, d.callback, None)
+        return d
+
+    def test_notify_delivers_locally(self):
+        calls = []
+        self.notifier.listen('chan', lambda p : calls.append(('chan', p)))
+        self.notifier.listen('other', lambda p : calls.append(('other', p)))
+        d = self.notify_in_thread('chan')
+        d.addCallback(self.wait_for_delivery)
+        def check(_):
+            self.assertEqual(calls, [ ('chan', None) ])
+        d.addCallback(check)
+        return d
+
+    def test_notify_unsubscribed(self):
+        calls = []
+        sub = self.notifier.listen('chan', calls.append)
+        sub.unsubscribe()
+        d = self.notify_in_thread('chan')
+        d.addCallback(self.wait_for_delivery)
+        def check(_):
+            self.assertEqual(calls, [])
+        d.addCallback(check)
+        return d
+
+    def test_notify_payload(self):
+        calls = []
+        self.notifier.listen('chan', calls.append)
+        d = self.notify_in_thread('chan', '1,2')
+        d.addCallback(self.wait_for_delivery)
+        def check(_):
+            self.assertEqual(calls, [ '1,2' ])
+        d.addCallback(check)
+        return d
+
+    def test_deliversRemoteNotifications(self):
+        self.assertFalse(self.notifier.deliversRemoteNotifications())
+
+    def test_notify_no_listeners(self):
+        d = self.notify_in_thread('chan')
+        d.addCallback(self.wait_for_delivery)
+        return d
+
+class GetNotifier(unittest.TestCase):
+
+    def make_engine(self, dialect_name):
+        engine = mock.Mock()
+        engine.dialect.name = dialect_name
+        return engine
+
+    def test_sqlite(self):
+        n = notifier.get_notifier(mock.Mock(), self.make_engine('sqlite'))
+        self.assertEqual(n.__class__, notifier.Notifier)
+
+    def test_postgresql(self):
+        n = notifier.get_notifier(mock.Mock(), self.make_engine('postgresql'))
+        self.assertIsInstance(n, notifier.PostgresNotifier)
+
+class PostgresNotifier(unittest.TestCase):
+
+    def test_notify_thd(self):
+        n = notifier.PostgresNotifier(mock.Mock(), mock.Mock())
+        conn = mock.Mock()
+        n.notify_thd(conn, 'buildrequests')
+        conn.execute.assert_called_with('NOTIFY buildbot_buildrequests')
+
+    def test_notify_thd_payload(self):
+        n = notifier.PostgresNotifier(mock.Mock(), mock.Mock())
+        conn = mock.Mock()
+        conn.dialect.server_version_info = (9, 0, 4)
+        n.notify_thd(conn, 'buildrequests', '1,2')
+        args, kwargs = conn.execute.call_args
+        self.assertEqual(str(args[0]), 'SELECT pg_notify(:channel, :payload)')
+        self.assertEqual(kwargs, dict(channel='buildbot_buildrequests',
+                                      payload='1,2'))
+
+    def test_notify_thd_payload_unsupported(self):
+        n = notifier.PostgresNotifier(mock.Mock(), mock.Mock())
+        n.send_payloads = False
+        conn = mock.Mock()
+        n.notify_thd(conn, 'buildrequests', '1,2')
+        conn.execute.assert_called_with('NOTIFY buildbot_buildrequests')
+
+    def test_notify_thd_payload_old_server(self):
+        n = notifier.PostgresNotifier(mock.Mock(), mock.Mock())
+        conn = mock.Mock()
+        conn.dialect.server_version_info = (8, 4, 7)
+        n.notify_thd(conn, 'buildrequests', '1,2')
+        conn.execute.assert_called_with('NOTIFY buildbot_buildrequests')
+        self.assertEqual(n.send_payloads, False)
+
+    def test_deliversRemoteNotifications(self):
+        n = notifier.PostgresNotifier(mock.Mock(), mock.Mock())
+        self.assertFalse(n.deliversRemoteNotifications())
+        n._listener = mock.Mock()
+        self.assertTrue(n.deliversRemoteNotifications())
+
+    def test_pgDeliver(self):
+        n = notifier.PostgresNotifier(mock.Mock(), mock.Mock())
+        calls = []
+        n.listen('buildrequests', calls.append)
+        n._pgDeliver('buildbot_buildrequests')
+        n._pgDeliver('buildbot_buildrequests', '12')
+        n._pgDeliver('somebody_elses_channel')
+        self.assertEqual(calls, [ None, '12' ])
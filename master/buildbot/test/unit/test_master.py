@@ -155,6 +155,50 @@ class Subscriptions(dirs.DirsMixin, unittest.TestCase):
                 args=('me', ['a'], 'com'),
                 exp_db_kwargs=dict(author='me', files=['a'], comments='com'))
 
+    def test_addChanges(self):
+        self.master.db = mock.Mock()
+        self.master.db.changes.addChanges.return_value = \
+            defer.succeed([ 14, 15 ])
+        self.master.db.changes.getChanges.return_value = \
+            defer.succeed([ dict(changeid=14), dict(changeid=15) ])
+        self.patch(changes.Change, 'fromChdict',
+                classmethod(lambda cls, master, chdict :
+                                defer.succeed('change%d' % chdict['changeid'])))
+
+        delivered = []
+        self.master.subscribeToChanges(delivered.append)
+
+        d = self.master.addChanges([ dict(who='me', properties={ 'a' : 'b' }),
+                                     dict(author='you') ])
+        def check(chobjs):
+            # all of the changes went to the db in a single call, translated
+            # as for addChange
+            kwargs = dict(files=None, comments=None, is_dir=0, links=None,
+                revision=None, when_timestamp=None, branch=None,
+                category=None, revlink='', properties={}, repository='',
+                project='')
+            exp1 = kwargs.copy()
+            exp1.update(author='me', properties={ 'a' : ('b', 'Change') })
+            exp2 = kwargs.copy()
+            exp2.update(author='you')
+            self.master.db.changes.addChanges.assert_called_with(
+                    [ exp1, exp2 ])
+            self.master.db.changes.getChanges.assert_called_with([ 14, 15 ])
+            self.assertEqual(chobjs, [ 'change14', 'change15' ])
+            # and they were delivered in order
+            self.assertEqual(delivered, [ 'change14', 'change15' ])
+        d.addCallback(check)
+        return d
+
+    def test_addChanges_empty(self):
+        self.master.db = mock.Mock()
+        d = self.master.addChanges([])
+        def check(chobjs):
+            self.assertEqual(chobjs, [])
+            self.assertFalse(self.master.db.changes.addChanges.called)
+        d.addCallback(check)
+        return d
+
     def test_buildset_subscription(self):
         self.master.db = mock.Mock()
         self.master.db.buildsets.addBuildset.return_value = \
@@ -200,6 +244,7 @@ class Polling(dirs.DirsMixin, unittest.TestCase):
             self.master = master.BuildMaster(basedir)
 
             self.db = self.master.db = fakedb.FakeDBConnector(self)
+            self.db.master = self.master
 
             self.master.db_poll_interval = 10
 
@@ -285,6 +330,100 @@ class Polling(dirs.DirsMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_pollDatabaseChanges_gaps(self):
+        self.db.insertTestData([
+            fakedb.Object(id=53, name='master',
+                          class_name='buildbot.master.BuildMaster'),
+            fakedb.ObjectState(objectid=53, name='last_processed_change',
+                               value_json='10'),
+            fakedb.Change(changeid=10),
+            fakedb.Change(changeid=13),
+            fakedb.Change(changeid=17),
+        ])
+        d = self.master.pollDatabaseChanges()
+        def check(_):
+            self.assertEqual([ ch.number for ch in self.gotten_changes],
+                             [ 13, 17 ])
+            self.db.state.assertState(53, last_processed_change=17)
+        d.addCallback(check)
+        return d
+
+    def test_pollDatabaseChanges_out_of_order(self):
+        # change 12 is committed (by another master) after change 13, so the
+        # first poll sees a gap at 12; the next poll should still find it
+        self.db.insertTestData([
+            fakedb.Object(id=53, name='master',
+                          class_name='buildbot.master.BuildMaster'),
+            fakedb.ObjectState(objectid=53, name='last_processed_change',
+                               value_json='10'),
+            fakedb.Change(changeid=10),
+            fakedb.Change(changeid=11),
+            fakedb.Change(changeid=13),
+        ])
+        d = self.master.pollDatabaseChanges()
+        def insert12(_):
+            self.gotten_changes.append('MARK')
+            self.db.insertTestData([
+                fakedb.Change(changeid=12),
+            ])
+        d.addCallback(insert12)
+        d.addCallback(lambda _ : self.master.pollDatabaseChanges())
+        d.addCallback(lambda _ : self.master.pollDatabaseChanges())
+        def check(_):
+            self.assertEqual([ getattr(ch, 'number', ch)
+                               for ch in self.gotten_changes],
+                             [ 11, 13, 'MARK', 12 ])
+            self.assertEqual(self.master._change_gaps, {})
+            self.db.state.assertState(53, last_processed_change=13)
+        d.addCallback(check)
+        return d
+
+    def test_pollDatabaseChanges_gap_timeout(self):
+        self.master.CHANGE_GAP_TIMEOUT = 0
+        self.db.insertTestData([
+            fakedb.Object(id=53, name='master',
+                          class_name='buildbot.master.BuildMaster'),
+            fakedb.ObjectState(objectid=53, name='last_processed_change',
+                               value_json='10'),
+            fakedb.Change(changeid=10),
+            fakedb.Change(changeid=13),
+        ])
+        d = self.master.pollDatabaseChanges()
+        def check_gaps(_):
+            self.assertEqual(sorted(self.master._change_gaps), [ 11, 12 ])
+        d.addCallback(check_gaps)
+        d.addCallback(lambda _ : self.master.pollDatabaseChanges())
+        def check(_):
+            self.assertEqual([ ch.number for ch in self.gotten_changes],
+                             [ 13 ])
+            self.assertEqual(self.master._change_gaps, {})
+        d.addCallback(check)
+        return d
+
+    def test_pollDatabaseChanges_paged(self):
+        self.master.CHANGE_POLL_PAGE_SIZE = 2
+        self.db.insertTestData([
+            fakedb.Object(id=53, name='master',
+                          class_name='buildbot.master.BuildMaster'),
+            fakedb.ObjectState(objectid=53, name='last_processed_change',
+                               value_json='10'),
+        ] + [ fakedb.Change(changeid=id) for id in range(10, 16) ])
+        setState_calls = []
+        real_setState = self.master._setState
+        def setState(name, value):
+            setState_calls.append(value)
+            return real_setState(name, value)
+        self.master._setState = setState
+        d = self.master.pollDatabaseChanges()
+        def check(_):
+            self.assertEqual([ ch.number for ch in self.gotten_changes],
+                             [ 11, 12, 13, 14, 15 ])
+            # state is written once per page
+            self.assertEqual(setState_calls, [ 12, 14, 15 ])
+            self.db.state.assertState(53, last_processed_change=15)
+        d.addCallback(check)
+        return d
+
     def test_pollDatabaseChanges_nothing_new(self):
         self.db.insertTestData([
             fakedb.Object(id=53, name='master',
@@ -325,6 +464,8 @@ class Polling(dirs.DirsMixin, unittest.TestCase):
         return d
 
     def test_pollDatabaseBuildRequests_incremental(self):
+        # rescan for unclaimed requests on every poll
+        self.master.UNCLAIMED_RESCAN_INTERVAL = 0
         d = defer.succeed(None)
         def insert1(_):
             self.db.insertTestData([
@@ -362,3 +503,195 @@ class Polling(dirs.DirsMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+
+    def test_pollDatabaseBuildRequests_new_without_rescan(self):
+        self.db.notifier.deliversRemoteNotifications = lambda : True
+        self.master.BRID_RESCAN_WINDOW = 0
+        d = defer.succeed(None)
+        def insert1(_):
+            self.db.insertTestData([
+                fakedb.BuildRequest(id=11, buildsetid=9,
+                                        buildername='eleventy'),
+            ])
+        d.addCallback(insert1)
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def insert2_and_unclaim(_):
+            self.gotten_buildrequest_additions.append('MARK')
+            self.db.insertTestData([
+                fakedb.BuildRequest(id=20, buildsetid=9,
+                                        buildername='twenty'),
+                fakedb.BuildRequest(id=21, buildsetid=9,
+                                        buildername='twenty-one'),
+            ])
+            self.db.buildrequests.fakeClaimBuildRequest(11)
+            self.db.buildrequests.fakeClaimBuildRequest(21)
+            # the full scan should not be performed on this poll
+            self.db.buildrequests.getBuildRequests = mock.Mock(
+                    wraps=self.db.buildrequests.getBuildRequests)
+        d.addCallback(insert2_and_unclaim)
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def unclaim(_):
+            self.gotten_buildrequest_additions.append('MARK')
+            self.db.buildrequests.getBuildRequests.assert_called_with(
+                    after_brid=11)
+            self.db.buildrequests.fakeUnclaimBuildRequest(11)
+            # with no notification and no rescan, this unclaim is not seen
+        d.addCallback(unclaim)
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def check(_):
+            self.assertEqual(self.gotten_buildrequest_additions, [
+                dict(bsid=9, brid=11, buildername='eleventy'),
+                'MARK',
+                dict(bsid=9, brid=20, buildername='twenty'),
+                'MARK',
+            ])
+            self.db.buildrequests.getBuildRequests.assert_called_with(
+                    after_brid=21)
+        d.addCallback(check)
+        return d
+
+    def test_pollDatabaseBuildRequests_out_of_order(self):
+        # brid 12 is committed after brid 13, but is still found without a
+        # full re-scan
+        self.db.notifier.deliversRemoteNotifications = lambda : True
+        d = defer.succeed(None)
+        def insert1(_):
+            self.db.insertTestData([
+                fakedb.BuildRequest(id=11, buildsetid=9,
+                                        buildername='eleventy'),
+                fakedb.BuildRequest(id=13, buildsetid=9,
+                                        buildername='thirteen'),
+            ])
+        d.addCallback(insert1)
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def insert2(_):
+            self.gotten_buildrequest_additions.append('MARK')
+            self.db.insertTestData([
+                fakedb.BuildRequest(id=12, buildsetid=9,
+                                        buildername='twelve'),
+            ])
+            self.db.buildrequests.getBuildRequests = mock.Mock(
+                    wraps=self.db.buildrequests.getBuildRequests)
+        d.addCallback(insert2)
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def check(_):
+            self.assertEqual(self.gotten_buildrequest_additions, [
+                dict(bsid=9, brid=11, buildername='eleventy'),
+                dict(bsid=9, brid=13, buildername='thirteen'),
+                'MARK',
+                dict(bsid=9, brid=12, buildername='twelve'),
+            ])
+            self.db.buildrequests.getBuildRequests.assert_called_with(
+                    after_brid=0)
+        d.addCallback(check)
+        return d
+
+    def test_pollDatabaseBuildRequests_rescan_without_notifications(self):
+        # without notifications from other masters, an unclaim by another
+        # master is found on the next poll
+        d = defer.succeed(None)
+        def insert1(_):
+            self.db.insertTestData([
+                fakedb.BuildRequest(id=11, buildsetid=9,
+                                        buildername='eleventy'),
+            ])
+        d.addCallback(insert1)
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        d.addCallback(lambda _ :
+            self.db.buildrequests.fakeClaimBuildRequest(11))
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def unclaim(_):
+            self.gotten_buildrequest_additions.append('MARK')
+            self.db.buildrequests.fakeUnclaimBuildRequest(11)
+        d.addCallback(unclaim)
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def check(_):
+            self.assertEqual(self.gotten_buildrequest_additions, [
+                dict(bsid=9, brid=11, buildername='eleventy'),
+                'MARK',
+                dict(bsid=9, brid=11, buildername='eleventy'),
+            ])
+        d.addCallback(check)
+        return d
+
+    def test_buildRequestsClaimed(self):
+        self.db.notifier.deliversRemoteNotifications = lambda : True
+        d = defer.succeed(None)
+        def insert1(_):
+            self.db.insertTestData([
+                fakedb.BuildRequest(id=11, buildsetid=9,
+                                        buildername='eleventy'),
+                fakedb.BuildRequest(id=12, buildsetid=9,
+                                        buildername='twelve'),
+            ])
+        d.addCallback(insert1)
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def claim(_):
+            self.db.buildrequests.fakeClaimBuildRequest(11)
+            return self.master.buildRequestsClaimed([ 11 ])
+        d.addCallback(claim)
+        def check(_):
+            self.assertEqual(self.master._last_unclaimed_brids_set,
+                             set([ 12 ]))
+        d.addCallback(check)
+        return d
+
+    def test_pollDatabaseBuildRequests_unclaim_notification(self):
+        d = defer.succeed(None)
+        def insert1(_):
+            self.db.insertTestData([
+                fakedb.BuildRequest(id=11, buildsetid=9,
+                                        buildername='eleventy'),
+            ])
+        d.addCallback(insert1)
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        d.addCallback(lambda _ :
+            self.db.buildrequests.fakeClaimBuildRequest(11))
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def unclaim_and_notify(_):
+            self.gotten_buildrequest_additions.append('MARK')
+            self.db.buildrequests.fakeUnclaimBuildRequest(11)
+            self.master._unclaimedBuildRequestsNotified('11')
+        d.addCallback(unclaim_and_notify)
+        # wait for the poll triggered by the notification to finish
+        d.addCallback(lambda _ :
+                self.master._buildrequest_poll_lock.run(lambda : None))
+        def check(_):
+            self.assertEqual(self.gotten_buildrequest_additions, [
+                dict(bsid=9, brid=11, buildername='eleventy'),
+                'MARK',
+                dict(bsid=9, brid=11, buildername='eleventy'),
+            ])
+        d.addCallback(check)
+        return d
+
+    def test_pollDatabaseBuildRequests_unclaim_notification_no_payload(self):
+        d = defer.succeed(None)
+        def insert1(_):
+            self.db.insertTestData([
+                fakedb.BuildRequest(id=11, buildsetid=9,
+                                        buildername='eleventy'),
+            ])
+        d.addCallback(insert1)
+        d.addCallback(lambda _ : self.master.pollDatabaseBuildRequests())
+        def insert2_and_notify(_):
+            self.gotten_buildrequest_additions.append('MARK')
+            # a request added by another master, and found by a full re-scan
+            # triggered by a notification without a payload
+            self.master._last_seen_brid = 20
+            self.db.insertTestData([
+                fakedb.BuildRequest(id=20, buildsetid=9,
+                                        buildername='twenty'),
+            ])
+            self.master._unclaimedBuildRequestsNotified(None)
+        d.addCallback(insert2_and_notify)
+        d.addCallback(lambda _ :
+                self.master._buildrequest_poll_lock.run(lambda : None))
+        def check(_):
+            self.assertEqual(self.gotten_buildrequest_additions, [
+                dict(bsid=9, brid=11, buildername='eleventy'),
+                'MARK',
+                dict(bsid=9, brid=20, buildername='twenty'),
+            ])
+        d.addCallback(check)
+        return d
@@ -15,7 +15,7 @@
 
 import mock
 from twisted.trial import unittest
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 from buildbot.test.util import compat
 from buildbot.process import botmaster
 from buildbot.util import epoch2datetime
@@ -97,6 +97,26 @@ class Test(unittest.TestCase):
         self.quiet_deferred.addCallback(check)
         return self.quiet_deferred
 
+    def test_maybeStartBuildsOn_default_priority_loads_index(self):
+        # the first builders are only queued once the unclaimed request index
+        # has loaded, so that their oldest requests are known
+        self.botmaster.prioritizeBuilders = None
+        self.addBuilders(['bldr1', 'bldr2'])
+        times = {}
+        peek = self.master.unclaimed_requests.peekOldestRequestTime
+        peek.side_effect = lambda n : times.get(n)
+        loaded = defer.Deferred()
+        self.master.unclaimed_requests.load.side_effect = lambda : loaded
+
+        self.brd.maybeStartBuildsOn(['bldr1', 'bldr2'])
+        self.assertEqual(self.maybeStartBuild_calls, [])
+        times.update(bldr1=epoch2datetime(200), bldr2=epoch2datetime(100))
+        loaded.callback(None)
+        def check(_):
+            self.assertEqual(self.maybeStartBuild_calls, ['bldr2', 'bldr1'])
+        self.quiet_deferred.addCallback(check)
+        return self.quiet_deferred
+
     def test_maybeStartBuildsOn_builders_missing(self):
         self.addBuilders(['bldr1', 'bldr2', 'bldr3'])
         self.brd.maybeStartBuildsOn(['bldr1', 'bldr2', 'bldr3'])
@@ -109,16 +129,133 @@ class Test(unittest.TestCase):
         self.quiet_deferred.addCallback(check)
         return self.quiet_deferred
 
+    def test_maybeStartBuildsOn_default_priority(self):
+        # with the default prioritization, builders are invoked in order of
+        # their oldest request, as known to the unclaimed request index
+        self.botmaster.prioritizeBuilders = None
+        self.addBuilders(['bldr1', 'bldr2', 'bldr3', 'bldr4'])
+        times = dict(bldr1=epoch2datetime(300), bldr2=epoch2datetime(100),
+                     bldr3=None, bldr4=epoch2datetime(200))
+        peek = self.master.unclaimed_requests.peekOldestRequestTime
+        peek.side_effect = lambda n : times[n]
+        self.master.unclaimed_requests.load.side_effect = \
+                lambda : defer.succeed(None)
+
+        # hold the activity lock so that all of the builders are queued
+        # before any are invoked
+        d = self.brd.activity_lock.acquire()
+        def queue(_):
+            self.brd.maybeStartBuildsOn(['bldr1', 'bldr3'])
+            self.brd.maybeStartBuildsOn(['bldr2', 'bldr5'])
+            self.brd.maybeStartBuildsOn(['bldr4', 'bldr1'])
+            self.brd.activity_lock.release()
+        d.addCallback(queue)
+        d.addCallback(lambda _ : self.quiet_deferred)
+        def check(_):
+            self.assertEqual(self.maybeStartBuild_calls,
+                    ['bldr2', 'bldr4', 'bldr1', 'bldr3'])
+            # the builders were not asked for their oldest request
+            for bldr in self.builders.values():
+                self.assertFalse(bldr.getOldestRequestTime.called)
+        d.addCallback(check)
+        return d
+
+    def addManualBuilders(self, slavenames):
+        # add builders with the given slavenames, whose maybeStartBuild
+        # methods only finish when self.finishBuilder is called
+        self.running = {}
+        for name, slaves in slavenames.iteritems():
+            bldr = mock.Mock(name=name)
+            bldr.name = name
+            bldr.slavenames = slaves
+            def maybeStartBuild(n=name):
+                self.maybeStartBuild_calls.append(n)
+                d = self.running[n] = defer.Deferred()
+                return d
+            bldr.maybeStartBuild = maybeStartBuild
+            self.botmaster.builders[name] = self.builders[name] = bldr
+
+    def finishBuilder(self, name):
+        self.running.pop(name).callback(None)
+
+    def test_concurrency(self):
+        self.brd.concurrency = 2
+        self.addManualBuilders(dict(A=['s1'], B=['s2'], C=['s1', 's3'],
+                                    D=['s4']))
+        self.brd.maybeStartBuildsOn(['A', 'B', 'C', 'D'])
+        # A and B run together
+        self.assertEqual(self.maybeStartBuild_calls, ['A', 'B'])
+        self.finishBuilder('A')
+        # C shares a slave with A, so it could not start until A finished
+        self.assertEqual(self.maybeStartBuild_calls, ['A', 'B', 'C'])
+        self.finishBuilder('B')
+        self.assertEqual(self.maybeStartBuild_calls, ['A', 'B', 'C', 'D'])
+        self.finishBuilder('C')
+        self.finishBuilder('D')
+        return self.quiet_deferred
+
+    def test_concurrency_shared_slaves(self):
+        self.brd.concurrency = 3
+        self.addManualBuilders(dict(A=['s1'], B=['s1', 's2'], C=['s3']))
+        self.brd.maybeStartBuildsOn(['A', 'B', 'C'])
+        # B is skipped while A is running, but keeps its place in the queue
+        self.assertEqual(self.maybeStartBuild_calls, ['A', 'C'])
+        self.finishBuilder('C')
+        self.assertEqual(self.maybeStartBuild_calls, ['A', 'C'])
+        self.finishBuilder('A')
+        self.assertEqual(self.maybeStartBuild_calls, ['A', 'C', 'B'])
+        self.finishBuilder('B')
+        return self.quiet_deferred
+
+    def test_concurrency_new_builders(self):
+        # newly-queued builders start while others are still running
+        self.brd.concurrency = 2
+        self.addManualBuilders(dict(A=['s1'], B=['s2']))
+        self.brd.maybeStartBuildsOn(['A'])
+        self.brd.maybeStartBuildsOn(['B'])
+        self.assertEqual(self.maybeStartBuild_calls, ['A', 'B'])
+        self.finishBuilder('A')
+        self.finishBuilder('B')
+        return self.quiet_deferred
+
+    def test_concurrency_stopService(self):
+        self.brd.concurrency = 2
+        self.addManualBuilders(dict(A=['s1'], B=['s2'], C=['s3']))
+        self.brd.maybeStartBuildsOn(['A', 'B', 'C'])
+        stopped = []
+        d = self.brd.stopService()
+        d.addCallback(stopped.append)
+        self.finishBuilder('A')
+        # the service does not stop until B is also finished
+        self.assertEqual(stopped, [])
+        self.finishBuilder('B')
+        self.assertEqual(len(stopped), 1)
+        # and C never runs
+        self.assertEqual(self.maybeStartBuild_calls, ['A', 'B'])
+        return self.quiet_deferred
+
+    def test_getMetrics(self):
+        clock = task.Clock()
+        self.brd._reactor = clock
+        self.addManualBuilders(dict(A=['s1'], B=['s1']))
+        clock.advance(10)
+        self.brd.maybeStartBuildsOn(['A', 'B'])
+        clock.advance(2)
+        self.finishBuilder('A')
+        clock.advance(3)
+        self.finishBuilder('B')
+        self.assertEqual(self.brd.getMetrics(), dict(
+            A=dict(calls=1, wait=0.0, duration=2.0, max_duration=2.0),
+            B=dict(calls=1, wait=2.0, duration=3.0, max_duration=3.0)))
+        return self.quiet_deferred
+
     def do_test_sortBuilders(self, prioritizeBuilders, oldestRequestTimes,
-            expected, returnDeferred=False):
+            expected):
         self.addBuilders(oldestRequestTimes.keys())
         self.botmaster.prioritizeBuilders = prioritizeBuilders
 
         def mklambda(t): # work around variable-binding issues
-            if returnDeferred:
-                return lambda : defer.succeed(t)
-            else:
-                return lambda : t
+            return lambda : t
 
         for n, t in oldestRequestTimes.iteritems():
             if t is not None:
@@ -131,22 +268,6 @@ class Test(unittest.TestCase):
         d.addCallback(check)
         return d
 
-    def test_sortBuilders_default_sync(self):
-        return self.do_test_sortBuilders(None, # use the default sort
-                dict(bldr1=777, bldr2=999, bldr3=888),
-                ['bldr1', 'bldr3', 'bldr2'])
-
-    def test_sortBuilders_default_asyn(self):
-        return self.do_test_sortBuilders(None, # use the default sort
-                dict(bldr1=777, bldr2=999, bldr3=888),
-                ['bldr1', 'bldr3', 'bldr2'],
-                returnDeferred=True)
-
-    def test_sortBuilders_default_None(self):
-        return self.do_test_sortBuilders(None, # use the default sort
-                dict(bldr1=777, bldr2=None, bldr3=888),
-                ['bldr1', 'bldr3', 'bldr2'])
-
     def test_sortBuilders_custom(self):
         def prioritizeBuilders(master, builders):
             self.assertIdentical(master, self.master)
@@ -186,6 +186,24 @@ class TestBuilderBuildCreation(unittest.TestCase):
         return self.do_test_maybeStartBuild(rows=rows,
                 exp_claims=[11], exp_builds=[('test-slave2', [11])])
 
+    def test_maybeStartBuild_updates_index(self):
+        self.makeBuilder(patch_random=True)
+        self.setSlaveBuilders({'test-slave1':1})
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, buildername="bldr",
+                submitted_at=130000),
+            fakedb.BuildRequest(id=11, buildsetid=11, buildername="bldr",
+                submitted_at=135000),
+        ]
+        d = self.do_test_maybeStartBuild(rows=rows,
+                exp_claims=[10, 11], exp_builds=[('test-slave1', [10, 11])])
+        d.addCallback(lambda _ :
+            self.master.unclaimed_requests.getUnclaimedRequests('bldr'))
+        def check(brdicts):
+            self.assertEqual(brdicts, [])
+        d.addCallback(check)
+        return d
+
     def test_maybeStartBuild_chooseSlave_None(self):
         self.makeBuilder()
         self.bldr._chooseSlave = lambda avail : defer.succeed(None)
@@ -284,6 +302,35 @@ class TestBuilderBuildCreation(unittest.TestCase):
         return self.do_test_maybeStartBuild(rows=rows,
                 exp_claims=[11], exp_builds=[('test-slave2', [11])])
 
+    def test_maybeStartBuild_cancelled_request(self):
+        self.makeBuilder(patch_random=True)
+        self.master.maybeBuildsetComplete = lambda bsid : defer.succeed(None)
+        self.setSlaveBuilders({'test-slave1':1})
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, buildername="bldr",
+                submitted_at=130000),
+        ]
+        d = self.db.insertTestData(rows)
+        # load the index of unclaimed requests before cancelling
+        d.addCallback(lambda _ :
+            self.master.unclaimed_requests.getUnclaimedRequests('bldr'))
+        d.addCallback(lambda _ :
+            self.db.buildrequests.getBuildRequest(10))
+        d.addCallback(lambda brdict :
+            buildrequest.BuildRequest.fromBrdict(self.master, brdict))
+        d.addCallback(lambda breq : breq.cancelBuildRequest())
+        d.addCallback(lambda _ : self.bldr.maybeStartBuild())
+        def check(_):
+            self.assertBuildsStarted([])
+            self.assertTrue(self.db.buildrequests.reqs[10].complete)
+        d.addCallback(check)
+        d.addCallback(lambda _ :
+            self.master.unclaimed_requests.getUnclaimedRequests('bldr'))
+        def check_index(brdicts):
+            self.assertEqual(brdicts, [])
+        d.addCallback(check_index)
+        return d
+
     def test_maybeStartBuild_builder_stopped(self):
         self.makeBuilder()
 
@@ -493,6 +540,56 @@ class TestBuilderBuildCreation(unittest.TestCase):
         yield wfd
         self.assertEqual(wfd.getResult(), [ brdicts[1] ])
 
+    @defer.deferredGenerator
+    def test_mergeRequests_default(self):
+        self.makeBuilder()
+        wfd = defer.waitForDeferred(
+            self.db.insertTestData([
+                fakedb.SourceStamp(id=234, branch='trunk', revision='9283'),
+                fakedb.SourceStamp(id=235, branch='trunk', revision='9284'),
+                fakedb.Buildset(id=30, sourcestampid=234, reason='foo',
+                    submitted_at=1300305712, results=-1),
+                fakedb.Buildset(id=31, sourcestampid=235, reason='foo',
+                    submitted_at=1300305712, results=-1),
+                fakedb.BuildRequest(id=19, buildsetid=30, buildername='bldr',
+                    priority=13, submitted_at=1300305712, results=-1),
+                fakedb.BuildRequest(id=20, buildsetid=31, buildername='bldr',
+                    priority=13, submitted_at=1300305712, results=-1),
+                fakedb.BuildRequest(id=21, buildsetid=30, buildername='bldr',
+                    priority=13, submitted_at=1300305712, results=-1),
+            ]))
+        yield wfd
+        wfd.getResult()
+
+        wfd = defer.waitForDeferred(
+            defer.gatherResults([
+                self.db.buildrequests.getBuildRequest(id)
+                for id in (19, 20, 21)
+            ]))
+        yield wfd
+        brdicts = wfd.getResult()
+
+        # the default function does not need BuildRequest objects, and only
+        # fetches each buildset once
+        def is_not_called(*args):
+            self.fail("should not be called")
+        self.bldr._brdictToBuildRequest = is_not_called
+        self.db.buildsets.getBuildset = mock.Mock(
+                wraps=self.db.buildsets.getBuildset)
+        mergeRequests_fn = self.bldr._getMergeRequestsFn()
+
+        wfd = defer.waitForDeferred(
+            self.bldr._mergeRequests(brdicts[0], brdicts, mergeRequests_fn))
+        yield wfd
+        self.assertEqual(wfd.getResult(), [ brdicts[0], brdicts[2] ])
+
+        wfd = defer.waitForDeferred(
+            self.bldr._mergeRequests(brdicts[1], brdicts, mergeRequests_fn))
+        yield wfd
+        self.assertEqual(wfd.getResult(), [ brdicts[1] ])
+
+        self.assertEqual(self.db.buildsets.getBuildset.call_count, 3)
+
     def test_mergeRequests_no_merging(self):
         self.makeBuilder()
         breq = dict(dummy=1)
@@ -570,7 +667,7 @@ class TestGetOldestRequestTime(unittest.TestCase):
     def makeBuilder(self, name):
         self.bstatus = mock.Mock()
         self.factory = mock.Mock()
-        self.master = mock.Mock()
+        self.master = fakemaster.make_master()
         # only include the necessary required config
         config = dict(name=name, slavename="slv", builddir="bdir",
                      slavebuilddir="sbdir", factory=self.factory)
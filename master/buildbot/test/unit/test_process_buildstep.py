@@ -14,10 +14,13 @@
 # Copyright Buildbot Team Members
 
 import re
+import zlib
 
+import mock
 from twisted.trial import unittest
 
-from buildbot.process.buildstep import LoggingBuildStep, regex_log_evaluator
+from buildbot.process.buildstep import LoggingBuildStep, regex_log_evaluator, \
+     LoggedRemoteCommand
 from buildbot.status.results import FAILURE, SUCCESS, WARNINGS, EXCEPTION
 
 class FakeLogFile:
@@ -87,3 +90,53 @@ class TestLoggingBuildStep(unittest.TestCase):
         lbs = LoggingBuildStep(log_eval_func=eval)
         status = lbs.evaluateCommand(cmd)
         self.assertEqual(status, WARNINGS, "evaluateCommand didn't call log_eval_func or overrode its results")
+
+
+class RecordingRemoteCommand(LoggedRemoteCommand):
+    def __init__(self):
+        LoggedRemoteCommand.__init__(self, 'shell', {'command': 'make'})
+        self.updates = {}
+        self.added = []
+
+    def addStdout(self, data):
+        self.added.append(('stdout', data))
+    def addStderr(self, data):
+        self.added.append(('stderr', data))
+    def addHeader(self, data):
+        self.added.append(('header', data))
+    def addToLog(self, logname, data):
+        self.added.append((logname, data))
+
+class TestLoggedRemoteCommand(unittest.TestCase):
+    def startCommand(self, version):
+        cmd = RecordingRemoteCommand()
+        step = mock.Mock()
+        step.slaveVersionIsOlderThan.side_effect = \
+            lambda command, minversion : version < minversion
+        remote = mock.Mock()
+        cmd.run(step, remote)
+        return remote.callRemote.call_args[0][-1]
+
+    def test_start_logUpdates(self):
+        args = self.startCommand("2.16")
+        self.assertEqual(args, {'command': 'make', 'logUpdates': 'zlib'})
+
+    def test_start_logUpdates_old_slave(self):
+        args = self.startCommand("2.15")
+        self.assertEqual(args, {'command': 'make'})
+
+    def test_remoteUpdate_logs(self):
+        cmd = RecordingRemoteCommand()
+        cmd.remoteUpdate({'logs': [('stdout', 'a\n'), ('stderr', 'b\n'),
+                                   (('log', 'test.log'), 'c\n'),
+                                   ('stdout', 'd\n')]})
+        self.assertEqual(cmd.added, [('stdout', 'a\n'), ('stderr', 'b\n'),
+                                     ('test.log', 'c\n'), ('stdout', 'd\n')])
+        self.assertEqual(cmd.updates, {'log': [('test.log', 'c\n')]})
+
+    def test_remoteUpdate_zlogs(self):
+        cmd = RecordingRemoteCommand()
+        lengths = [('stdout', 3), ('stderr', 0), (('log', 'test.log'), 2)]
+        cmd.remoteUpdate({'zlogs': (lengths, zlib.compress('abcde'))})
+        self.assertEqual(cmd.added, [('stdout', 'abc'), ('stderr', ''),
+                                     ('test.log', 'de')])
@@ -0,0 +1,207 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import mock
+from twisted.trial import unittest
+from twisted.internet import task
+from buildbot.test.fake import fakedb
+from buildbot.process import unclaimed
+from buildbot.util import epoch2datetime
+
+class TestUnclaimedRequestIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.master = mock.Mock()
+        self.master.db = self.db = db = fakedb.FakeDBConnector(self)
+        self.master.master_name = db.buildrequests.MASTER_NAME
+        self.master.master_incarnation = db.buildrequests.MASTER_INCARNATION
+        self.index = unclaimed.UnclaimedRequestIndex(self.master,
+                                                     _reactor=self.clock)
+
+        # count the queries
+        self.db.buildrequests.getBuildRequests = mock.Mock(
+                wraps=self.db.buildrequests.getBuildRequests)
+
+        self.base_rows = [
+            fakedb.SourceStamp(id=21),
+            fakedb.Buildset(id=11, reason='because', sourcestampid=21),
+            fakedb.BuildRequest(id=111, submitted_at=3000,
+                        buildername='bldr1', buildsetid=11),
+            fakedb.BuildRequest(id=222, submitted_at=1000,
+                        buildername='bldr1', buildsetid=11),
+            fakedb.BuildRequest(id=333, submitted_at=2000,
+                        buildername='bldr1', claimed_at=2001, buildsetid=11),
+            fakedb.BuildRequest(id=444, submitted_at=2500,
+                        buildername='bldr2', buildsetid=11),
+        ]
+        return self.db.insertTestData(self.base_rows)
+
+    def assertRequests(self, buildername, exp_brids):
+        d = self.index.getUnclaimedRequests(buildername)
+        def check(brdicts):
+            self.assertEqual([ brd['brid'] for brd in brdicts ], exp_brids)
+        d.addCallback(check)
+        return d
+
+    def assertQueryCount(self, count):
+        self.assertEqual(self.db.buildrequests.getBuildRequests.call_count,
+                         count)
+
+    def addRequest(self, brid, buildername='bldr1', submitted_at=4000):
+        d = self.db.insertTestData([
+            fakedb.BuildRequest(id=brid, submitted_at=submitted_at,
+                        buildername=buildername, buildsetid=11) ])
+        d.addCallback(lambda _ : self.index.requestAdded(brid, buildername))
+        return d
+
+    def test_getUnclaimedRequests_sorted(self):
+        return self.assertRequests('bldr1', [ 222, 111 ])
+
+    def test_getUnclaimedRequests_none(self):
+        return self.assertRequests('bldr3', [])
+
+    def test_getUnclaimedRequests_one_query(self):
+        d = self.assertRequests('bldr1', [ 222, 111 ])
+        d.addCallback(lambda _ : self.assertRequests('bldr2', [ 444 ]))
+        d.addCallback(lambda _ : self.assertRequests('bldr1', [ 222, 111 ]))
+        d.addCallback(lambda _ : self.assertQueryCount(1))
+        return d
+
+    def test_getUnclaimedRequests_copies(self):
+        d = self.index.getUnclaimedRequests('bldr1')
+        def modify(brdicts):
+            brdicts[0]['brobj'] = 'xx'
+            del brdicts[1]
+        d.addCallback(modify)
+        d.addCallback(lambda _ : self.index.getUnclaimedRequests('bldr1'))
+        def check(brdicts):
+            self.assertEqual(len(brdicts), 2)
+            self.assertFalse('brobj' in brdicts[0])
+        d.addCallback(check)
+        return d
+
+    def test_getOldestRequestTime(self):
+        d = self.index.getOldestRequestTime('bldr1')
+        def check(rqtime):
+            self.assertEqual(rqtime, epoch2datetime(1000))
+        d.addCallback(check)
+        return d
+
+    def test_getOldestRequestTime_none(self):
+        d = self.index.getOldestRequestTime('bldr3')
+        def check(rqtime):
+            self.assertEqual(rqtime, None)
+        d.addCallback(check)
+        return d
+
+    def test_peekOldestRequestTime(self):
+        # nothing is known before the index is loaded
+        self.assertEqual(self.index.peekOldestRequestTime('bldr1'), None)
+        d = self.assertRequests('bldr1', [ 222, 111 ])
+        def check(_):
+            self.assertEqual(self.index.peekOldestRequestTime('bldr1'),
+                             epoch2datetime(1000))
+            self.assertEqual(self.index.peekOldestRequestTime('bldr3'), None)
+        d.addCallback(check)
+        return d
+
+    def test_load(self):
+        d = self.index.load()
+        def check(_):
+            self.assertEqual(self.index.peekOldestRequestTime('bldr1'),
+                             epoch2datetime(1000))
+            self.assertEqual(self.index.peekOldestRequestTime('bldr2'),
+                             epoch2datetime(2500))
+        d.addCallback(check)
+        # loading again does not query the database
+        d.addCallback(lambda _ : self.index.load())
+        d.addCallback(lambda _ : self.assertQueryCount(1))
+        return d
+
+    def test_peekOldestRequestTime_announced(self):
+        self.clock.advance(5000)
+        d = self.addRequest(555, buildername='bldr3')
+        def check(_):
+            # the request is assumed to have been submitted now
+            self.assertEqual(self.index.peekOldestRequestTime('bldr3'),
+                             epoch2datetime(5000))
+            self.assertQueryCount(0)
+        d.addCallback(check)
+        return d
+
+    def test_requestAdded(self):
+        d = self.assertRequests('bldr1', [ 222, 111 ])
+        d.addCallback(lambda _ : self.addRequest(555))
+        d.addCallback(lambda _ : self.addRequest(556, submitted_at=500))
+        d.addCallback(lambda _ : self.assertRequests('bldr2', [ 444 ]))
+        # no query is required for the builder without new requests
+        d.addCallback(lambda _ : self.assertQueryCount(1))
+        d.addCallback(lambda _ :
+                self.assertRequests('bldr1', [ 556, 222, 111, 555 ]))
+        def check_query(_):
+            self.assertQueryCount(2)
+            self.db.buildrequests.getBuildRequests.assert_called_with(
+                    buildername='bldr1', claimed=False, after_brid=554)
+        d.addCallback(check_query)
+        return d
+
+    def test_requestAdded_before_load(self):
+        d = self.addRequest(555)
+        d.addCallback(lambda _ :
+                self.assertRequests('bldr1', [ 222, 111, 555 ]))
+        d.addCallback(lambda _ : self.assertQueryCount(1))
+        return d
+
+    def test_removeRequests(self):
+        d = self.assertRequests('bldr1', [ 222, 111 ])
+        d.addCallback(lambda _ : self.index.removeRequests([ 222, 444, 999 ]))
+        d.addCallback(lambda _ : self.assertRequests('bldr1', [ 111 ]))
+        d.addCallback(lambda _ : self.assertRequests('bldr2', []))
+        d.addCallback(lambda _ : self.assertQueryCount(1))
+        return d
+
+    def test_removeRequests_before_load(self):
+        d = self.index.removeRequests([ 222 ])
+        d.addCallback(lambda _ : self.assertRequests('bldr1', [ 222, 111 ]))
+        return d
+
+    def test_invalidate(self):
+        d = self.assertRequests('bldr1', [ 222, 111 ])
+        def claim_elsewhere(_):
+            self.db.buildrequests.fakeClaimBuildRequest(222, 136000,
+                    master_name="interloper", master_incarnation="interloper")
+            self.index.invalidate('bldr1')
+        d.addCallback(claim_elsewhere)
+        d.addCallback(lambda _ : self.assertRequests('bldr1', [ 111 ]))
+        def check_query(_):
+            self.assertQueryCount(2)
+            self.db.buildrequests.getBuildRequests.assert_called_with(
+                    buildername='bldr1', claimed=False)
+        d.addCallback(check_query)
+        return d
+
+    def test_reconcile(self):
+        d = self.assertRequests('bldr1', [ 222, 111 ])
+        def claim_elsewhere(_):
+            self.db.buildrequests.fakeClaimBuildRequest(444, 136000,
+                    master_name="interloper", master_incarnation="interloper")
+        d.addCallback(claim_elsewhere)
+        d.addCallback(lambda _ : self.assertRequests('bldr2', [ 444 ]))
+        d.addCallback(lambda _ :
+                self.clock.advance(self.index.RECONCILE_INTERVAL))
+        d.addCallback(lambda _ : self.assertRequests('bldr2', []))
+        d.addCallback(lambda _ : self.assertQueryCount(2))
+        return d
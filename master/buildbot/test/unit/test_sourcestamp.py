@@ -14,6 +14,7 @@
 # Copyright Buildbot Team Members
 
 import mock
+from twisted.internet import defer
 from twisted.trial import unittest
 from buildbot.test.fake import fakedb, fakemaster
 from buildbot import sourcestamp
@@ -139,3 +140,49 @@ class TestBuilderBuildCreation(unittest.TestCase):
         self.assertEqual(abs_ss.revision, 'abcdef')
         self.assertEqual(abs_ss.project, 'p')
         self.assertEqual(abs_ss.repository, 'r')
+
+    def test_mergeKeyFromSsdict_matches_canBeMergedWith(self):
+        master = fakemaster.make_master()
+        master.db = fakedb.FakeDBConnector(self)
+        ss = lambda id, **kw : fakedb.SourceStamp(id=id, repository='r',
+                                    project='p', **kw)
+        master.db.insertTestData([
+            fakedb.Change(changeid=13, branch='trunk', revision='9283'),
+            fakedb.Change(changeid=14, branch='trunk', revision='9284'),
+            fakedb.Patch(id=99, subdir='/foo', patchlevel=3,
+                        patch_base64='LS0gKys='),
+            ss(1, branch='trunk', revision='9283'),
+            ss(2, branch='trunk', revision='9283'),
+            ss(3, branch='trunk', revision='9284'),
+            ss(4, branch='trunk', revision=None),
+            ss(5, branch='trunk', revision=None),
+            ss(6, branch='dev', revision='9283'),
+            ss(7, branch='trunk', revision='9283', patchid=99),
+            ss(8, branch='trunk', revision='9283'),
+            fakedb.SourceStampChange(sourcestampid=8, changeid=13),
+            ss(9, branch='trunk', revision='9284'),
+            fakedb.SourceStampChange(sourcestampid=9, changeid=14),
+            ss(10, branch='dev', revision='9284'),
+            fakedb.SourceStampChange(sourcestampid=10, changeid=14),
+        ])
+        d = defer.gatherResults([ master.db.sourcestamps.getSourceStamp(id)
+                                  for id in range(1, 11) ])
+        def make_sourcestamps(ssdicts):
+            d = defer.gatherResults([
+                    sourcestamp.SourceStamp.fromSsdict(master, ssdict)
+                    for ssdict in ssdicts ])
+            d.addCallback(lambda sourcestamps : zip(ssdicts, sourcestamps))
+            return d
+        d.addCallback(make_sourcestamps)
+        def check(pairs):
+            for ssdict1, ss1 in pairs:
+                key1 = sourcestamp.SourceStamp.mergeKeyFromSsdict(ssdict1)
+                for ssdict2, ss2 in pairs:
+                    if ss1 is ss2:
+                        continue
+                    key2 = sourcestamp.SourceStamp.mergeKeyFromSsdict(ssdict2)
+                    self.assertEqual(key1 is not None and key1 == key2,
+                            ss1.canBeMergedWith(ss2),
+                            "ssids %d and %d" % (ss1.ssid, ss2.ssid))
+        d.addCallback(check)
+        return d
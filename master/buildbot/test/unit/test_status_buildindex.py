@@ -0,0 +1,472 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import shutil
+import cPickle
+import mock
+from twisted.trial import unittest
+from buildbot.status import buildindex, builder, master
+from buildbot.status.results import SUCCESS, FAILURE
+from buildbot.sourcestamp import SourceStamp
+
+# these are at module level so that they can be pickled
+
+class FakeChange(object):
+    def __init__(self, who):
+        self.who = who
+
+class FakeBuild(object):
+    def __init__(self, number, branch='trunk', start=None, slavename='slv',
+                 who='dustin', results=0):
+        self.number = number
+        self.results = results
+        self.source = SourceStamp(branch=branch, revision=str(number * 10))
+        self.started = start or 1000 + number * 100
+        self.slavename = slavename
+        self.changes = [ FakeChange(who) ]
+
+    def getNumber(self):
+        return self.number
+    def getTimes(self):
+        return (self.started, self.started + 50)
+    def getSourceStamp(self, absolute=False):
+        return self.source
+    def getResults(self):
+        return self.results
+    def getSlavename(self):
+        return self.slavename
+    def getResponsibleUsers(self):
+        return [ c.who for c in self.changes ]
+    def getChanges(self):
+        return self.changes
+    def getSteps(self):
+        return []
+    def isFinished(self):
+        return True
+
+class TestBuildIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath('basedir')
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+
+    def tearDown(self):
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+
+    def test_summarize(self):
+        summary = buildindex.BuildIndex.summarize(FakeBuild(3))
+        self.assertEqual(summary, dict(number=3, start=1300, end=1350,
+            results=0, branch='trunk', revision='30', got_revision='30', patch=None,
+            slavename='slv',
+            blamelist=['dustin'], committers=['dustin']))
+
+    def test_get_empty(self):
+        index = buildindex.BuildIndex(self.basedir)
+        self.assertEqual(index.get(3), None)
+
+    def test_add_persists(self):
+        index = buildindex.BuildIndex(self.basedir)
+        index.add(FakeBuild(3))
+        index.add(FakeBuild(4, branch='dev'))
+        self.assertEqual(index.get(4)['branch'], 'dev')
+
+        # a new index reads the file
+        index = buildindex.BuildIndex(self.basedir)
+        self.assertEqual(index.get(3)['revision'], '30')
+        self.assertEqual(index.get(4)['branch'], 'dev')
+        self.assertEqual(index.get(5), None)
+
+    def test_corrupt_line(self):
+        index = buildindex.BuildIndex(self.basedir)
+        index.add(FakeBuild(3))
+        open(os.path.join(self.basedir, 'builds.index'), 'a').write('{"numb')
+
+        index = buildindex.BuildIndex(self.basedir)
+        self.assertEqual(index.get(3)['number'], 3)
+
+    def test_prune(self):
+        index = buildindex.BuildIndex(self.basedir)
+        for n in range(5):
+            index.add(FakeBuild(n))
+        index.prune(3)
+        self.assertEqual(index.get(2), None)
+        self.assertEqual(index.get(3)['number'], 3)
+
+        index = buildindex.BuildIndex(self.basedir)
+        self.assertEqual(index.get(2), None)
+        self.assertEqual(index.get(4)['number'], 4)
+
+    def test_missing_index(self):
+        # an upgraded builder, with build pickles but no index
+        for n in range(3):
+            cPickle.dump(FakeBuild(n),
+                         open(os.path.join(self.basedir, str(n)), 'wb'))
+        index = buildindex.BuildIndex(self.basedir)
+        self.assertEqual([ s['number'] for s in index.getSummaries() ],
+                         [ 0, 1, 2 ])
+        self.assertTrue(os.path.exists(
+                    os.path.join(self.basedir, 'builds.index')))
+
+    def test_rebuildIndexes(self):
+        builder_dir = os.path.join(self.basedir, 'bldr')
+        os.makedirs(builder_dir)
+        open(os.path.join(builder_dir, 'builder'), 'w').write('')
+        for n in range(3):
+            cPickle.dump(FakeBuild(n),
+                         open(os.path.join(builder_dir, str(n)), 'wb'))
+        os.makedirs(os.path.join(self.basedir, 'public_html'))
+
+        open(os.path.join(self.basedir, 'builds.timeline'), 'w').write('')
+
+        self.assertEqual(buildindex.rebuildIndexes(self.basedir),
+                         [ builder_dir ])
+        # the timeline is removed, to be rebuilt at startup
+        self.assertFalse(os.path.exists(
+                    os.path.join(self.basedir, 'builds.timeline')))
+
+        index = buildindex.BuildIndex(builder_dir)
+        self.assertEqual([ index.get(n)['number'] for n in range(3) ],
+                         [ 0, 1, 2 ])
+
+class TestBuilderStatusIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath('basedir')
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+
+        self.bs = builder.BuilderStatus('bldr')
+        self.bs.basedir = self.basedir
+        self.bs.nextBuildNumber = 10
+
+        # index all of the builds, and record any that are loaded
+        self.builds = {}
+        for n in range(10):
+            b = self.builds[n] = FakeBuild(n,
+                    branch=(n % 2) and 'odd' or 'even',
+                    who=(n == 3) and 'warner' or 'dustin')
+            self.bs.getBuildIndex().add(b)
+        self.loaded = []
+        def getBuildByNumber(number):
+            self.loaded.append(number)
+            return self.builds[number]
+        self.bs.getBuildByNumber = getBuildByNumber
+
+    def tearDown(self):
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+
+    def test_getBuildSummary(self):
+        self.assertEqual(self.bs.getBuildSummary(-1)['number'], 9)
+        self.assertEqual(self.bs.getBuildSummary(3)['blamelist'], ['warner'])
+        self.assertEqual(self.bs.getBuildSummary(10), None)
+        self.assertEqual(self.loaded, [])
+
+    def test_getBuildSummary_not_indexed(self):
+        self.builds[10] = FakeBuild(10)
+        self.bs.nextBuildNumber = 11
+        self.assertEqual(self.bs.getBuildSummary(10)['number'], 10)
+        self.assertEqual(self.loaded, [ 10 ])
+        # and now it's in the index
+        self.assertEqual(self.bs.getBuildIndex().get(10)['number'], 10)
+
+    def test_generateFinishedBuilds_branches(self):
+        builds = list(self.bs.generateFinishedBuilds(branches=['odd'],
+                                                     num_builds=2))
+        self.assertEqual([ b.getNumber() for b in builds ], [ 9, 7 ])
+        self.assertEqual(self.loaded, [ 9, 7 ])
+
+    def test_generateFinishedBuilds_finished_before(self):
+        builds = list(self.bs.generateFinishedBuilds(finished_before=1500,
+                                                     num_builds=1))
+        self.assertEqual([ b.getNumber() for b in builds ], [ 4 ])
+        self.assertEqual(self.loaded, [ 4 ])
+
+    def test_eventGenerator_committers(self):
+        self.bs.events = []
+        events = list(self.bs.eventGenerator(committers=['warner']))
+        self.assertEqual(events, [ self.builds[3] ])
+
+    def test_eventGenerator_minTime(self):
+        self.bs.events = []
+        events = list(self.bs.eventGenerator(branches=['even'], minTime=1550))
+        self.assertEqual(events, [ self.builds[8], self.builds[6] ])
+        self.assertEqual(self.loaded, [ 8, 6 ])
+
+class TestBuildTimeline(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath('basedir')
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+
+    def tearDown(self):
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+
+    def summary(self, number, start, **kwargs):
+        return buildindex.BuildIndex.summarize(
+                FakeBuild(number, start=start, **kwargs))
+
+    def entries(self, timeline, finished_before=None):
+        return [ (bn, number) for (_, bn, number, _, _)
+                 in timeline.generateEntries(finished_before) ]
+
+    def test_add_ordered(self):
+        timeline = buildindex.BuildTimeline(self.basedir)
+        self.assertFalse(timeline.exists())
+        timeline.add('a', self.summary(1, 100))
+        timeline.add('b', self.summary(1, 300))
+        timeline.add('a', self.summary(2, 200))
+        # duplicates are ignored
+        timeline.add('a', self.summary(2, 200))
+        self.assertTrue(timeline.exists())
+        self.assertEqual(self.entries(timeline),
+                         [ ('b', 1), ('a', 2), ('a', 1) ])
+        # finish times are start + 50
+        self.assertEqual(self.entries(timeline, finished_before=251),
+                         [ ('a', 2), ('a', 1) ])
+
+        # a new timeline reads the file
+        timeline = buildindex.BuildTimeline(self.basedir)
+        self.assertEqual(self.entries(timeline),
+                         [ ('b', 1), ('a', 2), ('a', 1) ])
+
+    def test_prune(self):
+        timeline = buildindex.BuildTimeline(self.basedir)
+        for n in range(4):
+            timeline.add('a', self.summary(n, 100 + n * 100))
+            timeline.add('b', self.summary(n, 101 + n * 100))
+        timeline.prune('a', 2)
+        self.assertEqual(self.entries(timeline),
+                [ ('b', 3), ('a', 3), ('b', 2), ('a', 2), ('b', 1), ('b', 0) ])
+
+        # the file is not re-written yet, but the pruning is still applied
+        # when it is loaded
+        timeline = buildindex.BuildTimeline(self.basedir)
+        self.assertEqual(self.entries(timeline),
+                [ ('b', 3), ('a', 3), ('b', 2), ('a', 2), ('b', 1), ('b', 0) ])
+        timeline.add('a', self.summary(4, 500))
+        timeline = buildindex.BuildTimeline(self.basedir)
+        self.assertEqual(self.entries(timeline),
+                [ ('a', 4), ('b', 3), ('a', 3), ('b', 2), ('a', 2), ('b', 1),
+                  ('b', 0) ])
+
+        # pruned entries are only removed from the file when they outnumber
+        # the remaining ones
+        timeline.prune('b', 4)
+        timeline = buildindex.BuildTimeline(self.basedir)
+        self.assertEqual(self.entries(timeline),
+                         [ ('a', 4), ('a', 3), ('a', 2) ])
+        lines = open(timeline._getFilename()).readlines()
+        self.assertEqual(len(lines), 3)
+
+    def test_rebuild(self):
+        bs = builder.BuilderStatus('bldr')
+        bs.basedir = self.basedir
+        for n in range(3):
+            bs.getBuildIndex().add(FakeBuild(n))
+        timeline = buildindex.BuildTimeline(self.basedir)
+        timeline.rebuild([ bs ])
+        timeline = buildindex.BuildTimeline(self.basedir)
+        self.assertEqual(self.entries(timeline),
+                [ ('bldr', 2), ('bldr', 1), ('bldr', 0) ])
+
+    def test_rebuild_unindexed(self):
+        # builders upgraded from an older version have no index yet
+        bs = builder.BuilderStatus('bldr')
+        bs.basedir = os.path.join(self.basedir, 'bldr')
+        os.makedirs(bs.basedir)
+        for n in range(3):
+            cPickle.dump(FakeBuild(n),
+                         open(os.path.join(bs.basedir, str(n)), 'wb'))
+        timeline = buildindex.BuildTimeline(self.basedir)
+        timeline.rebuild([ bs ])
+        self.assertEqual(self.entries(timeline),
+                [ ('bldr', 2), ('bldr', 1), ('bldr', 0) ])
+
+class TestStatusGenerateFinishedBuilds(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath('basedir')
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+
+        m = mock.Mock()
+        m.basedir = self.basedir
+        m.botmaster.builderNames = [ 'a', 'b' ]
+        m.botmaster.builders = {}
+        self.status = master.Status(m)
+
+        # builder 'a' has builds finishing at 150, 350, ..; 'b' at 250, 450, ..
+        self.loaded = []
+        for bn, offset in ('a', 100), ('b', 200):
+            bs = builder.BuilderStatus(bn)
+            bs.basedir = os.path.join(self.basedir, bn)
+            os.makedirs(bs.basedir)
+            bs.status = self.status
+            builds = dict([ (n, FakeBuild(n, start=offset + n * 200,
+                                          branch=(n % 2) and 'odd' or 'even',
+                                          results=(n == 2) and FAILURE
+                                                           or SUCCESS))
+                            for n in range(5) ])
+            for build in builds.values():
+                bs.getBuildIndex().add(build)
+            def getBuild(number, bn=bn, builds=builds):
+                self.loaded.append((bn, number))
+                return builds.get(number)
+            bs.getBuild = getBuild
+            m.botmaster.builders[bn] = mock.Mock()
+            m.botmaster.builders[bn].builder_status = bs
+
+    def tearDown(self):
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+
+    def generate(self, **kwargs):
+        return [ (b.getTimes()[1], b.getNumber())
+                 for b in self.status.generateFinishedBuilds(**kwargs) ]
+
+    def test_all(self):
+        self.assertEqual(self.generate(num_builds=4),
+                [ (1050, 4), (950, 4), (850, 3), (750, 3) ])
+        # only the builds that were produced were loaded
+        self.assertEqual(self.loaded,
+                [ ('b', 4), ('a', 4), ('b', 3), ('a', 3) ])
+        # and the timeline was created from the builders' indexes
+        self.assertTrue(self.status.getBuildTimeline().exists())
+
+    def test_builders_branches(self):
+        self.assertEqual(self.generate(builders=['a'], branches=['odd']),
+                [ (750, 3), (350, 1) ])
+        self.assertEqual(self.loaded, [ ('a', 3), ('a', 1) ])
+
+    def test_finished_before(self):
+        self.assertEqual(self.generate(finished_before=500),
+                [ (450, 1), (350, 1), (250, 0), (150, 0) ])
+
+    def test_results(self):
+        self.assertEqual(self.generate(results=[FAILURE]),
+                [ (650, 2), (550, 2) ])
+        self.assertEqual(len(self.loaded), 2)
+
+    def test_max_search(self):
+        self.assertEqual(self.generate(builders=['a'], branches=['even'],
+                                       max_search=2),
+                [ (950, 4) ])
+
+    def test_getSourceStampIndex(self):
+        index = self.status.getSourceStampIndex()
+        self.assertEqual(index.getBuilds('odd', '30'), dict(a=[3], b=[3]))
+        self.assertEqual(self.loaded, [])
+
+    def test_getSourceStampIndex_unindexed(self):
+        # builder 'b' was upgraded from an older version, and only has its
+        # build pickles
+        bs = self.status.getBuilder('b')
+        os.unlink(os.path.join(bs.basedir, 'builds.index'))
+        for n in range(5):
+            cPickle.dump(FakeBuild(n, branch=(n % 2) and 'odd' or 'even'),
+                         open(os.path.join(bs.basedir, str(n)), 'wb'))
+        bs.buildIndex = None
+        index = self.status.getSourceStampIndex()
+        self.assertEqual(index.getBuilds('odd', '30'), dict(a=[3], b=[3]))
+        self.assertEqual(self.loaded, [])
+
+    def test_buildFinished_adds(self):
+        bs = self.status.getBuilder('a')
+        build = FakeBuild(5, start=2000)
+        build.saveYourself = lambda : None
+        bs.currentBuilds = [ build ]
+        bs.prune = lambda : None
+        bs._buildFinished(build)
+        entries = self.status.getBuildTimeline().generateEntries()
+        self.assertEqual(entries.next()[:3], (2050, 'a', 5))
+        index = self.status.getSourceStampIndex()
+        self.assertEqual(index.getBuilds('trunk', '50'), dict(a=[5]))
+
+class TestSourceStampIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = buildindex.SourceStampIndex()
+
+    def stamps(self, **kwargs):
+        return [ key for key, start in self.index.generateStamps(**kwargs) ]
+
+    def test_getBuilds(self):
+        self.index.add('a', 1, 'trunk', '10', 100)
+        self.index.add('b', 7, 'trunk', '10', 110)
+        self.index.add('a', 2, 'trunk', '10', 120)
+        self.index.add('a', 3, 'trunk', '11', 130)
+        self.assertEqual(self.index.getBuilds('trunk', '10'),
+                         dict(a=[2, 1], b=[7]))
+        self.assertEqual(self.index.getBuilds('dev', '10'), {})
+
+    def test_getBuilds_patched(self):
+        # patched builds are kept apart from unpatched builds
+        patch = buildindex.patchKey((1, 'diff'))
+        self.index.add('a', 1, 'trunk', '10', 100)
+        self.index.add('a', 2, 'trunk', '10', 110, patch)
+        self.assertEqual(self.index.getBuilds('trunk', '10'), dict(a=[1]))
+        self.assertEqual(self.index.getBuilds('trunk', '10', patch),
+                         dict(a=[2]))
+        self.assertEqual(self.stamps(),
+                         [ ('trunk', '10', patch), ('trunk', '10', None) ])
+
+    def test_getHistory(self):
+        self.index.add('a', 1, 'trunk', '10', 100)
+        self.index.add('a', 2, None, '12', 120)
+        self.assertEqual(self.index.getHistory('a'),
+                         [ (2, None, '12'), (1, 'trunk', '10') ])
+        self.assertEqual(self.index.getHistory('b'), [])
+
+    def test_add_moves(self):
+        # a build started with no revision is moved once it is known
+        self.index.add('a', 1, 'trunk', None, 100)
+        self.index.add('a', 1, 'trunk', '10', 100)
+        self.assertEqual(self.index.getBuilds('trunk', None), {})
+        self.assertEqual(self.index.getBuilds('trunk', '10'), dict(a=[1]))
+        self.assertEqual(self.stamps(), [ ('trunk', '10', None) ])
+
+    def test_generateStamps(self):
+        self.index.add('a', 1, 'trunk', '10', 100)
+        self.index.add('b', 1, 'dev', '11', 110)
+        self.index.add('a', 2, 'trunk', '12', 120)
+        # rebuilding 10 makes it the most recent
+        self.index.add('b', 2, 'trunk', '10', 130)
+        self.assertEqual(list(self.index.generateStamps()),
+                [ (('trunk', '10', None), 100), (('trunk', '12', None), 120),
+                  (('dev', '11', None), 110) ])
+        self.assertEqual(self.stamps(branches=['dev']),
+                         [ ('dev', '11', None) ])
+        self.assertEqual(self.stamps(builders=['a']),
+                         [ ('trunk', '10', None), ('trunk', '12', None) ])
+
+    def test_prune(self):
+        self.index.add('a', 1, 'trunk', '10', 100)
+        self.index.add('a', 2, 'trunk', '11', 110)
+        self.index.add('b', 1, 'trunk', '11', 120)
+        self.index.prune('a', 2)
+        self.assertEqual(self.index.getHistory('a'), [ (2, 'trunk', '11') ])
+        self.assertEqual(self.stamps(), [ ('trunk', '11', None) ])
+        self.index.prune('b', 2)
+        self.assertEqual(self.index.getBuilds('trunk', '11'), dict(a=[2]))
@@ -0,0 +1,167 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import bz2
+import gzip
+import shutil
+from cStringIO import StringIO
+from twisted.trial import unittest
+from buildbot.status import logcompress
+
+class BlockCompression(unittest.TestCase):
+
+    method = 'bz2'
+
+    def setUp(self):
+        self.basedir = os.path.abspath('basedir')
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+        self.basename = os.path.join(self.basedir, 'log')
+        self.data = "".join([ "line %d\n" % i for i in range(1000) ])
+
+    def tearDown(self):
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+
+    def compressFile(self):
+        logcompress.compressFile(StringIO(self.data),
+                self.basename + '.' + self.method, self.basename + '.blocks',
+                self.method, blockSize=1000)
+
+    def test_compressFile(self):
+        self.compressFile()
+        blocks = logcompress.readBlocks(self.basename + '.blocks')
+        self.assertEqual(len(blocks), 9)
+        self.assertEqual(blocks[1][0], 1000)
+
+    def test_read(self):
+        self.compressFile()
+        f = logcompress.openCompressedLog(self.basename)
+        self.assertEqual(f.read(10), self.data[:10])
+        self.assertEqual(f.read(), self.data[10:])
+        self.assertEqual(f.read(), "")
+
+    def test_seek(self):
+        self.compressFile()
+        f = logcompress.openCompressedLog(self.basename)
+        for offset in [ 5000, 999, 7889, 0, 100000 ]:
+            f.seek(offset)
+            self.assertEqual(f.tell(), offset)
+            self.assertEqual(f.read(1500), self.data[offset:offset+1500])
+        f.seek(0, 2)
+        self.assertEqual(f.tell(), len(self.data))
+
+    def test_openCompressedLog_missing(self):
+        self.assertEqual(logcompress.openCompressedLog(self.basename), None)
+
+    def test_standard_format(self):
+        # each block is a complete bz2 stream
+        self.compressFile()
+        compressed = open(self.basename + '.bz2', 'rb').read()
+        blocks = logcompress.readBlocks(self.basename + '.blocks')
+        self.assertEqual(bz2.decompress(compressed[blocks[2][1]:blocks[3][1]]),
+                         self.data[2000:3000])
+
+    def test_LogCompressor(self):
+        c = logcompress.LogCompressor(self.basename + '.' + self.method,
+                self.basename + '.blocks', self.method)
+        c.blockSize = 1000
+        for i in range(0, len(self.data), 300):
+            c.write(self.data[i:i+300])
+        d = c.finish()
+        def check(_):
+            f = logcompress.openCompressedLog(self.basename)
+            self.assertEqual(f.read(), self.data)
+        d.addCallback(check)
+        return d
+
+    def test_LogCompressor_backpressure(self):
+        source = StringIO(self.data)
+        c = logcompress.LogCompressor(self.basename + '.' + self.method,
+                self.basename + '.blocks', self.method, source=source)
+        c.blockSize = 1000
+        c.maxPendingBlocks = 2
+        flushed = []
+        real_flushBlock = c._flushBlock
+        def _flushBlock():
+            flushed.append(c.inFlight)
+            real_flushBlock()
+        c._flushBlock = _flushBlock
+        for i in range(0, len(self.data), 300):
+            c.write(self.data[i:i+300])
+            self.assertTrue(c.inFlight <= 2)
+            self.assertTrue(c.pendingSize < 2000)
+        # the threads have not run yet, so compression is behind
+        self.assertTrue(c.lagging)
+        d = c.finish()
+        def check(_):
+            self.assertTrue(max(flushed) < 2)
+            f = logcompress.openCompressedLog(self.basename)
+            self.assertEqual(f.read(), self.data)
+        d.addCallback(check)
+        return d
+
+class BlockCompressionGz(BlockCompression):
+
+    method = 'gz'
+
+    def test_standard_format(self):
+        # the blocks form a valid multi-member gzip file
+        self.compressFile()
+        f = gzip.GzipFile(self.basename + '.gz')
+        self.assertEqual(f.read(), self.data)
+
+class MultiStreamBZ2File(unittest.TestCase):
+
+    # python's GzipFile already reads every member of a gzip file, but BZ2File
+    # stops after the first bz2 stream
+
+    def setUp(self):
+        self.basedir = os.path.abspath('basedir')
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+        self.filename = os.path.join(self.basedir, 'log.bz2')
+        self.data = "".join([ "line %d\n" % i for i in range(1000) ])
+
+    def tearDown(self):
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+
+    def test_read_seek(self):
+        # a block-compressed log whose block index is missing
+        logcompress.compressFile(StringIO(self.data), self.filename,
+                self.filename + '.blocks', 'bz2', blockSize=1000)
+        f = logcompress.MultiStreamBZ2File(self.filename)
+        f.readSize = 100
+        self.assertEqual(f.read(10), self.data[:10])
+        self.assertEqual(f.read(), self.data[10:])
+        self.assertEqual(f.read(), "")
+        for offset in [ 5000, 999, 7889, 0, 100000 ]:
+            f.seek(offset)
+            self.assertEqual(f.tell(), min(offset, len(self.data)))
+            self.assertEqual(f.read(1500), self.data[offset:offset+1500])
+        f.seek(0, 2)
+        self.assertEqual(f.tell(), len(self.data))
+        f.close()
+
+    def test_single_stream(self):
+        # logs compressed by older versions are a single stream
+        open(self.filename, 'wb').write(bz2.compress(self.data))
+        f = logcompress.MultiStreamBZ2File(self.filename)
+        self.assertEqual(f.read(), self.data)
+        f.close()
@@ -13,6 +13,8 @@
 #
 # Copyright Buildbot Team Members
 
+import os
+import shutil
 import mock
 import cStringIO
 from twisted.trial import unittest
@@ -42,3 +44,140 @@ class TestLogFileProducer(unittest.TestCase):
 
     # Remainder of LogFileProduer has a wacky interface that's not
     # well-defined, so it's not tested yet
+
+class TestLogFile(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath('basedir')
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+        step = mock.Mock()
+        step.build.builder.basedir = self.basedir
+        self.lf = logfile.LogFile(step, 'stdio', '1-log-stdio')
+        self.lf.chunkSize = 5
+
+    def tearDown(self):
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+
+    def addEntries(self):
+        self.lf.addHeader('hdr\n')
+        self.lf.addStdout('line 1\nline 2\nli')
+        self.lf.addStderr('err\n')
+        self.lf.addStdout('ne 3\nline 4\n')
+
+    def test_chunkIndex(self):
+        self.addEntries()
+        self.lf.finish()
+        index = self.lf.getChunkIndex()
+        self.assertEqual(len(index), 9)
+        self.assertEqual(index.getChunk(0), (logfile.HEADER, 0, 0, 4))
+        self.assertEqual(index.getChunk(1), (logfile.STDOUT, 8, 0, 5))
+        self.assertEqual(index.getTextLength(), len(self.lf.getText()))
+        self.assertEqual(index.findTextOffset(0), 1)
+        self.assertEqual(index.findTextOffset(16), 5) # the stderr chunk
+        self.assertEqual(index.findTextOffset(100), 9)
+
+    def test_chunkIndex_rebuild(self):
+        self.addEntries()
+        self.lf.finish()
+        records = [ self.lf.getChunkIndex().getChunk(n) for n in range(9) ]
+
+        os.unlink(self.lf.getIndexFilename())
+        self.lf.chunkIndex = None
+        index = self.lf.getChunkIndex()
+        self.assertEqual([ index.getChunk(n) for n in range(9) ], records)
+
+    def test_readlines(self):
+        self.addEntries()
+        lines = self.lf.readlines()
+        self.assertEqual(lines.next(), 'line 1\n')
+        self.assertEqual(list(lines), [ 'line 2\n', 'line 3\n', 'line 4\n' ])
+
+    def test_readlines_unterminated(self):
+        self.lf.addStdout('a\nb')
+        self.lf.finish()
+        self.assertEqual(list(self.lf.readlines()), [ 'a\n', 'b' ])
+
+    def test_getTailLines(self):
+        self.addEntries()
+        self.assertEqual(self.lf.getTailLines(2),
+                         [ 'ne 3\n', 'line 4\n' ])
+        self.assertEqual(self.lf.getTailLines(3, channels=[logfile.STDOUT]),
+                         [ 'line 2\n', 'line 3\n', 'line 4\n' ])
+        self.assertEqual(self.lf.getTailLines(10),
+                         self.lf.getText().splitlines(True))
+
+    def test_getTextRange(self):
+        self.addEntries()
+        text = self.lf.getText()
+        for start, end in [ (0, None), (3, 8), (15, 20), (20, None),
+                            (33, 40), (40, None) ]:
+            self.assertEqual(self.lf.getTextRange(start, end),
+                             text[start:end])
+
+    def test_getTextRange_finished(self):
+        self.addEntries()
+        self.lf.finish()
+        self.assertEqual(self.lf.getTextLength(), len(self.lf.getText()))
+        self.assertEqual(self.lf.getTextRange(10, 25),
+                         self.lf.getText()[10:25])
+
+    def test_stale_compress_files(self):
+        # temporary files left by an interrupted compression are removed when
+        # the log is next read
+        self.addEntries()
+        self.lf.finish()
+        tmpnames = [ self.lf.getFilename() + '.bz2.tmp',
+                     self.lf.getBlocksFilename() + '.tmp' ]
+        for tmpname in tmpnames:
+            open(tmpname, 'w').write('partial')
+        self.assertEqual(self.lf.getText(),
+                         'line 1\nline 2\nli'
+                         'err\nne 3\nline 4\n')
+        for tmpname in tmpnames:
+            self.assertFalse(os.path.exists(tmpname))
+
+    def test_compressLog_streaming(self):
+        self.lf.logCompressionLimit = 20
+        self.addEntries()
+        self.assertNotEqual(self.lf.compressor, None)
+        self.lf.finish()
+        text = self.lf.getText()
+        d = self.lf.compressLog()
+        def check(_):
+            self.assertFalse(os.path.exists(self.lf.getFilename()))
+            self.assertEqual(self.lf.getText(), text)
+            self.assertEqual(list(self.lf.readlines())[-1], 'line 4\n')
+            self.assertEqual(self.lf.getTextRange(20, 25), text[20:25])
+        d.addCallback(check)
+        return d
+
+    def test_compressLog_blocks_missing(self):
+        # without its block index, the whole of a multi-stream log is read
+        self.patch(logfile.logcompress.LogCompressor, 'blockSize', 10)
+        self.lf.logCompressionLimit = 20
+        self.addEntries()
+        self.lf.finish()
+        text = self.lf.getText()
+        d = self.lf.compressLog()
+        def check(_):
+            self.assertTrue(len(logfile.logcompress.readBlocks(
+                            self.lf.getBlocksFilename())) > 1)
+            os.unlink(self.lf.getBlocksFilename())
+            self.assertEqual(self.lf.getText(), text)
+        d.addCallback(check)
+        return d
+
+    def test_compressLog_gz(self):
+        self.lf.compressMethod = 'gz'
+        self.addEntries()
+        self.lf.finish()
+        text = self.lf.getText()
+        d = self.lf.compressLog()
+        def check(_):
+            self.assertTrue(os.path.exists(self.lf.getFilename() + '.gz'))
+            self.assertEqual(self.lf.getText(), text)
+        d.addCallback(check)
+        return d
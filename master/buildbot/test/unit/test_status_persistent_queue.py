@@ -140,8 +140,39 @@ class test_Queues(dirs.DirsMixin, unittest.TestCase):
     def testDiskQueue(self):
         self._test_helper(DiskQueue('fake_dir', maxItems=8))
 
+    def testDiskQueueSmallSegments(self):
+        self._test_helper(DiskQueue('fake_dir', maxItems=8, segmentItems=2,
+                                    syncItems=3))
+
     def testPersistentQueue(self):
         self._test_helper(PersistentQueue(MemoryQueue(3),
                                           DiskQueue('fake_dir', 5)))
 
+    def testDiskQueueReload(self):
+        q = DiskQueue('fake_dir', segmentItems=3)
+        for i in range(10):
+            q.pushItem(i)
+        self.assertEqual([0, 1, 2, 3], q.popChunk(4))
+        q.save()
+        # The first segment was completely read.
+        self.assertEqual(['segment.1', 'segment.2', 'segment.3', 'state'],
+                         sorted(os.listdir('fake_dir')))
+        q = DiskQueue('fake_dir', segmentItems=3)
+        self.assertEqual(6, q.nbItems())
+        self.assertEqual(range(4, 10), q.items())
+        self.assertEqual(range(4, 10), q.popChunk())
+
+    def testDiskQueuePartialItem(self):
+        q = DiskQueue('fake_dir', pickleFn=str, unpickleFn=str)
+        q.pushItem('foo')
+        q.save()
+        # Simulate a crash in the middle of an append.
+        f = open(os.path.join('fake_dir', 'segment.0'), 'ab')
+        f.write('\x00\x00\x01')
+        f.close()
+        q = DiskQueue('fake_dir', pickleFn=str, unpickleFn=str)
+        self.assertEqual(['foo'], q.items())
+        q.pushItem('bar')
+        self.assertEqual(['foo', 'bar'], q.popChunk())
+
 # vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,148 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import cgi
+import mock
+from twisted.trial import unittest
+
+from buildbot.process.properties import Properties
+from buildbot.status.status_push import SerializationCache, HttpStatusPush
+
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+
+class FakeStatusObject(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.text = ['compile']
+
+    def asDict(self):
+        self.calls += 1
+        return {'text': self.text, 'empty': []}
+
+
+class TestSerializationCache(unittest.TestCase):
+
+    def test_asDict_cached(self):
+        cache = SerializationCache()
+        obj = FakeStatusObject()
+        self.assertEqual({'text': ['compile']}, cache.asDict(obj))
+        self.assertEqual({'text': ['compile']}, cache.asDict(obj))
+        self.assertEqual(1, obj.calls)
+
+    def test_asDict_changed(self):
+        cache = SerializationCache(filter=False)
+        obj = FakeStatusObject()
+        cache.asDict(obj)
+        obj.text = ['compile', 'done']
+        cache.changed(obj)
+        self.assertEqual({'text': ['compile', 'done'], 'empty': []},
+                         cache.asDict(obj))
+        self.assertEqual(2, obj.calls)
+
+
+class TestHttpStatusPush(unittest.TestCase):
+
+    def makePush(self, **kwargs):
+        push = HttpStatusPush('http://example.com/push', maxDiskItems=0,
+                              **kwargs)
+        push.status = mock.Mock()
+        push.status.getTitle.return_value = 'proj'
+        push.queueNextServerPush = lambda: None
+        return push
+
+    def decode(self, data):
+        return json.loads(cgi.parse_qs(data)['packets'][0])
+
+    def test_popChunk_all(self):
+        push = self.makePush(chunkSize=10)
+        for i in range(3):
+            push.queue.pushItem({'id': i})
+        data, items = push.popChunk()
+        self.assertEqual([{'id': 0}, {'id': 1}, {'id': 2}], items)
+        self.assertEqual(items, self.decode(data))
+        self.assertEqual(0, push.queue.nbItems())
+
+    def test_popChunk_too_large(self):
+        push = self.makePush(chunkSize=10, maxHttpRequestSize=200)
+        for i in range(10):
+            push.queue.pushItem({'id': i, 'data': 'x' * 40})
+        data, items = push.popChunk()
+        self.assertTrue(len(data) < 200)
+        self.assertEqual(items, self.decode(data))
+        self.assertEqual(range(len(items)), [i['id'] for i in items])
+        self.assertEqual(10 - len(items), push.queue.nbItems())
+
+    def test_popChunk_drop(self):
+        push = self.makePush(chunkSize=10, maxHttpRequestSize=100)
+        push.queue.pushItem({'id': 0, 'data': 'x' * 200})
+        push.queue.pushItem({'id': 1})
+        data, items = push.popChunk()
+        self.assertEqual([{'id': 1}], items)
+        self.assertEqual(0, push.queue.nbItems())
+
+    def makeBuild(self, **props):
+        build = mock.Mock()
+        build.asDict.return_value = {'number': 1}
+        properties = Properties(**props)
+        build.getProperties.return_value = properties
+        return build, properties
+
+    def test_stepFinished_properties(self):
+        push = self.makePush()
+        build, properties = self.makeBuild(a=1)
+        step = FakeStatusObject()
+        push.stepFinished(build, step, 0)
+        payload = push.queue.popChunk()[0]['payload']
+        self.assertEqual([['a', 1, 'TEST']], payload['properties'])
+
+    def test_stepFinished_propertyDeltas(self):
+        push = self.makePush(propertyDeltas=True)
+        build, properties = self.makeBuild(a=1, b=2)
+        step = FakeStatusObject()
+        push.buildStarted('builder', build)
+        properties.setProperty('a', 3, 'test')
+        properties.setProperty('c', 4, 'test')
+        del properties.properties['b']
+        push.stepStarted(build, step)
+        push.stepFinished(build, step, 0)
+        started, stepStarted, stepFinished = push.queue.popChunk()
+        self.assertEqual([['a', 3, 'test'], ['c', 4, 'test']],
+                         stepStarted['payload']['propertiesChanged'])
+        self.assertEqual(['b'], stepStarted['payload']['propertiesRemoved'])
+        # Nothing changed since stepStarted.
+        self.assertFalse(stepFinished['payload']['propertiesChanged'])
+        self.assertFalse(stepFinished['payload']['propertiesRemoved'])
+        self.assertFalse('properties' in stepFinished['payload'])
+
+    def test_propertyDeltas_blackListed(self):
+        # changes are not recorded as sent by events which are not pushed
+        push = self.makePush(propertyDeltas=True,
+                             blackList=['buildStarted', 'stepETAUpdate'])
+        build, properties = self.makeBuild(a=1)
+        step = FakeStatusObject()
+        push.buildStarted('builder', build)
+        properties.setProperty('got_revision', '123', 'test')
+        push.stepETAUpdate(build, step, 10, [])
+        push.stepFinished(build, step, 0)
+        [stepFinished] = push.queue.popChunk()
+        self.assertEqual('stepFinished', stepFinished['event'])
+        self.assertEqual([['a', 1, 'TEST'], ['got_revision', '123', 'test']],
+                         sorted(stepFinished['payload']['propertiesChanged']))
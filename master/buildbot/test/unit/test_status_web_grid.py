@@ -0,0 +1,112 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from twisted.trial import unittest
+from buildbot.status.web import grid
+from buildbot.status.buildindex import SourceStampIndex
+from buildbot.sourcestamp import SourceStamp
+
+class FakeBuild(object):
+    def __init__(self, number, branch, revision):
+        self.number = number
+        self.source = SourceStamp(branch=branch, revision=revision,
+                                  repository='repo')
+    def getNumber(self):
+        return self.number
+    def getSourceStamp(self, absolute=False):
+        return self.source
+
+class FakeBuilderStatus(object):
+    def __init__(self, name, category=None):
+        self.name = name
+        self.category = category
+        self.builds = {}
+        self.loaded = []
+    def getName(self):
+        return self.name
+    def getBuild(self, number):
+        self.loaded.append(number)
+        return self.builds.get(number)
+
+class FakeStatus(object):
+    def __init__(self, builders):
+        self.builders = dict([ (b.name, b) for b in builders ])
+        self.index = SourceStampIndex()
+    def getBuilderNames(self):
+        return self.builders.keys()
+    def getBuilder(self, name):
+        return self.builders[name]
+    def getSourceStampIndex(self):
+        return self.index
+    def addBuild(self, bn, number, branch, revision, start, patch=None):
+        self.builders[bn].builds[number] = FakeBuild(number, branch, revision)
+        self.index.add(bn, number, branch, revision, start, patch)
+
+class TestGridStatusMixin(unittest.TestCase):
+
+    def setUp(self):
+        self.a = FakeBuilderStatus('a', category='x')
+        self.b = FakeBuilderStatus('b', category='y')
+        self.status = FakeStatus([ self.a, self.b ])
+        self.status.addBuild('a', 0, None, '10', 100)
+        self.status.addBuild('b', 0, None, '10', 105)
+        self.status.addBuild('a', 1, 'dev', '11', 110)
+        self.status.addBuild('b', 1, None, '12', 120)
+        self.status.addBuild('a', 2, None, '12', 130)
+        self.mixin = grid.GridStatusMixin()
+
+    def test_getBuilderNames(self):
+        self.assertEqual(self.mixin.getBuilderNames(self.status, []),
+                         [ 'a', 'b' ])
+        self.assertEqual(self.mixin.getBuilderNames(self.status, ['y']),
+                         [ 'b' ])
+
+    def test_getRecentSourcestamps(self):
+        self.assertEqual(self.mixin.getRecentSourcestamps(self.status, 2,
+                                        [ 'a', 'b' ], grid.ANYBRANCH),
+                         [ ('dev', '11', None), (None, '12', None) ])
+        self.assertEqual(self.mixin.getRecentSourcestamps(self.status, 5,
+                                        [ 'b' ], None),
+                         [ (None, '10', None), (None, '12', None) ])
+
+    def test_getRecentSourcestamps_patched(self):
+        # a try build of revision 12 gets its own column
+        self.status.addBuild('b', 2, None, '12', 140, 'p')
+        self.assertEqual(self.mixin.getRecentSourcestamps(self.status, 5,
+                                        [ 'a', 'b' ], grid.ANYBRANCH),
+                         [ (None, '10', None), ('dev', '11', None),
+                           (None, '12', None), (None, '12', 'p') ])
+        builds = self.mixin.getStampBuilds(self.status, self.b,
+                         [ (None, '12', None), (None, '12', 'p') ])
+        self.assertEqual([ b.getNumber() for b in builds ], [ 1, 2 ])
+
+    def test_getStampBuilds(self):
+        stamps = [ (None, '10', None), ('dev', '11', None) ]
+        builds = self.mixin.getStampBuilds(self.status, self.a, stamps)
+        self.assertEqual([ b.getNumber() for b in builds ], [ 0, 1 ])
+        builds = self.mixin.getStampBuilds(self.status, self.b, stamps)
+        self.assertEqual(builds[1], None)
+        # only the builds that are displayed are loaded
+        self.assertEqual(self.a.loaded, [ 0, 1 ])
+        self.assertEqual(self.b.loaded, [ 0 ])
+
+    def test_getStampDicts(self):
+        stamps = [ (None, '10', None), (None, '99', None) ]
+        builder_builds = [ [ None, None ],
+                           [ self.b.builds[0], None ] ]
+        dicts = self.mixin.getStampDicts(stamps, builder_builds)
+        # the first comes from the build, with its repository
+        self.assertEqual(dicts[0]['repository'], 'repo')
+        self.assertEqual(dicts[1]['revision'], '99')
@@ -0,0 +1,72 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import shutil
+import mock
+from twisted.trial import unittest
+from twisted.web import http
+from buildbot.status import logfile
+from buildbot.status.web import logs
+
+class TestTextLogRange(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath('basedir')
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+        os.makedirs(self.basedir)
+        step = mock.Mock()
+        step.build.builder.basedir = self.basedir
+        self.lf = logfile.LogFile(step, 'stdio', '1-log-stdio')
+        self.lf.addHeader('hdr\n')
+        self.lf.addStdout('0123456789')
+        self.lf.finish()
+
+        self.textlog = logs.TextLog(self.lf)
+        self.textlog.asText = True
+
+    def tearDown(self):
+        if os.path.exists(self.basedir):
+            shutil.rmtree(self.basedir)
+
+    def render(self, range_header):
+        req = mock.Mock()
+        req.getHeader = lambda name : (name == 'range' and range_header
+                                        or None)
+        headers = {}
+        req.setHeader = headers.__setitem__
+        return req, headers, self.textlog.render_GET(req)
+
+    def test_range(self):
+        req, headers, data = self.render('bytes=2-4')
+        req.setResponseCode.assert_called_with(http.PARTIAL_CONTENT)
+        self.assertEqual(data, '234')
+        self.assertEqual(headers['content-range'], 'bytes 2-4/10')
+
+    def test_range_suffix(self):
+        req, headers, data = self.render('bytes=-3')
+        self.assertEqual(data, '789')
+        self.assertEqual(headers['content-range'], 'bytes 7-9/10')
+
+    def test_range_open(self):
+        req, headers, data = self.render('bytes=8-')
+        self.assertEqual(data, '89')
+
+    def test_range_unsatisfiable(self):
+        req, headers, data = self.render('bytes=10-')
+        req.setResponseCode.assert_called_with(
+                http.REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(headers['content-range'], 'bytes */10')
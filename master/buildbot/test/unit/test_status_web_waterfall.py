@@ -0,0 +1,182 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import mock
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.web import http
+from buildbot.status.web import waterfall
+from buildbot.status.event import Event
+
+class FakeBuilderStatus(object):
+    def __init__(self, name, state='idle'):
+        self.name = name
+        self.state = state
+        self.events = []
+        self.watchers = []
+    def getName(self):
+        return self.name
+    def getState(self):
+        return (self.state, [])
+    def unsubscribe(self, receiver):
+        self.watchers.remove(receiver)
+
+class FakeStatus(object):
+    def __init__(self, builders):
+        self.builders = dict([ (b.name, b) for b in builders ])
+        self.watchers = []
+    def getBuilderNames(self, categories=None):
+        return sorted(self.builders)
+    def getBuilder(self, name):
+        return self.builders[name]
+    def subscribe(self, receiver):
+        self.watchers.append(receiver)
+        for name in self.getBuilderNames():
+            b = self.builders[name]
+            if receiver.builderAdded(name, b):
+                b.watchers.append(receiver)
+    def unsubscribe(self, receiver):
+        self.watchers.remove(receiver)
+
+class FakeRequest(object):
+    def __init__(self, args={}, if_none_match=None):
+        self.args = args
+        self.prepath = ['waterfall']
+        self.if_none_match = if_none_match
+        self.etag = None
+        self.code = http.OK
+    def setETag(self, etag):
+        self.etag = etag
+        if etag == self.if_none_match:
+            self.code = http.NOT_MODIFIED
+            return http.CACHED
+
+class TestWaterfallCache(unittest.TestCase):
+
+    def setUp(self):
+        self.bldr1 = FakeBuilderStatus('bldr1')
+        self.bldr2 = FakeBuilderStatus('bldr2')
+        self.status = FakeStatus([ self.bldr1, self.bldr2 ])
+        self.cache = waterfall.WaterfallCache()
+        self.cache.subscribe(self.status)
+
+    def test_subscribe(self):
+        self.assertEqual(self.status.watchers, [ self.cache ])
+        self.assertEqual(self.bldr1.watchers, [ self.cache ])
+        # subscribing again does nothing
+        self.cache.subscribe(self.status)
+        self.assertEqual(self.status.watchers, [ self.cache ])
+
+    def test_unsubscribe(self):
+        self.cache.unsubscribe()
+        self.assertEqual(self.status.watchers, [])
+        self.assertEqual(self.bldr1.watchers, [])
+        self.assertEqual(self.bldr2.watchers, [])
+
+    def test_getKey(self):
+        key1 = self.cache.getKey(FakeRequest(dict(branch=['a'], category=['x'])))
+        key2 = self.cache.getKey(FakeRequest(dict(category=['x'], branch=['a'])))
+        key3 = self.cache.getKey(FakeRequest(dict(branch=['b'])))
+        self.assertEqual(key1, key2)
+        self.assertNotEqual(key1, key3)
+
+    def test_get_put(self):
+        stamp = self.cache.getStamp(self.status)
+        self.assertEqual(self.cache.get('k', stamp), None)
+        self.cache.put('k', stamp, 'page')
+        self.assertEqual(self.cache.get('k', stamp), 'page')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_invalidated_by_status(self):
+        stamp = self.cache.getStamp(self.status)
+        self.cache.put('k', stamp, 'page')
+        self.cache.buildFinished('bldr1', mock.Mock(), 0)
+        new_stamp = self.cache.getStamp(self.status)
+        self.assertNotEqual(new_stamp, stamp)
+        self.assertEqual(self.cache.get('k', new_stamp), None)
+
+    def test_invalidated_by_event(self):
+        stamp = self.cache.getStamp(self.status)
+        e = Event()
+        e.started = 100
+        self.bldr2.events.append(e)
+        stamp2 = self.cache.getStamp(self.status)
+        self.assertNotEqual(stamp2, stamp)
+        e.finished = 200
+        self.assertNotEqual(self.cache.getStamp(self.status), stamp2)
+
+    def test_eta_interval(self):
+        self.patch(waterfall.util, 'now', lambda : 1000)
+        stamp = self.cache.getStamp(self.status)
+        self.bldr1.state = 'building'
+        self.patch(waterfall.util, 'now', lambda : 1001)
+        stamp_building = self.cache.getStamp(self.status)
+        self.patch(waterfall.util, 'now', lambda : 1100)
+        self.assertEqual(self.cache.getStamp(self.status)[0], stamp[0])
+        self.assertNotEqual(self.cache.getStamp(self.status), stamp_building)
+
+    def test_getETag(self):
+        stamp = self.cache.getStamp(self.status)
+        etag = self.cache.getETag('k', stamp)
+        self.assertEqual(etag, self.cache.getETag('k', stamp))
+        self.assertNotEqual(etag, self.cache.getETag('k2', stamp))
+        self.cache.changeAdded(mock.Mock())
+        self.assertNotEqual(etag,
+                self.cache.getETag('k', self.cache.getStamp(self.status)))
+
+class TestWaterfallStatusResource(unittest.TestCase):
+
+    def setUp(self):
+        self.status = FakeStatus([ FakeBuilderStatus('bldr1') ])
+        self.wf = waterfall.WaterfallStatusResource()
+        self.wf.getStatus = lambda request : self.status
+        self.renders = 0
+        def content_uncached(request, ctx):
+            self.renders += 1
+            return defer.succeed('page%d' % self.renders)
+        self.wf.content_uncached = content_uncached
+
+    def render(self, request):
+        d = defer.maybeDeferred(self.wf.content, request, {})
+        return d
+
+    def test_cached(self):
+        d = self.render(FakeRequest())
+        d.addCallback(lambda data : self.assertEqual(data, 'page1'))
+        d.addCallback(lambda _ : self.render(FakeRequest()))
+        d.addCallback(lambda data : self.assertEqual(data, 'page1'))
+        # a different filter is rendered separately
+        d.addCallback(lambda _ : self.render(FakeRequest(dict(branch=['b']))))
+        d.addCallback(lambda data : self.assertEqual(data, 'page2'))
+        def change(_):
+            self.wf.cache.changeAdded(mock.Mock())
+            return self.render(FakeRequest())
+        d.addCallback(change)
+        d.addCallback(lambda data : self.assertEqual(data, 'page3'))
+        return d
+
+    def test_not_modified(self):
+        req = FakeRequest()
+        d = self.render(req)
+        def conditional(_):
+            self.req2 = FakeRequest(if_none_match=req.etag)
+            return self.render(self.req2)
+        d.addCallback(conditional)
+        def check(data):
+            self.assertEqual(data, '')
+            self.assertEqual(self.req2.code, http.NOT_MODIFIED)
+            self.assertEqual(self.renders, 1)
+        d.addCallback(check)
+        return d
@@ -13,15 +13,22 @@
 #
 # Copyright Buildbot Team Members
 
-import tempfile, os
+import tempfile, os, shutil, tarfile
+from cStringIO import StringIO
 from twisted.trial import unittest
+from twisted.internet import defer
+try:
+    from hashlib import md5, sha1
+except ImportError:
+    from md5 import new as md5
+    from sha import new as sha1
 
 from mock import Mock
 
 from buildbot.process.properties import Properties
 from buildbot.util import json
 from buildbot.steps.transfer import StringDownload, JSONStringDownload, JSONPropertiesDownload, \
-    FileUpload
+    FileUpload, _DirectoryWriter
 
 class TestFileUpload(unittest.TestCase):
     def setUp(self):
@@ -94,6 +101,138 @@ class TestFileUpload(unittest.TestCase):
         self.assertAlmostEquals(timestamp[0],desttimestamp[0],places=5)
         self.assertAlmostEquals(timestamp[1],desttimestamp[1],places=5)
 
+    def startDelta(self, version, mode=None):
+        s = FileUpload(slavesrc='data', masterdest=self.destfile,
+                       blocksize=4, delta=True, mode=mode)
+        s.build = Mock()
+        s.build.getProperties.return_value = Properties()
+        s.build.getSlaveCommandVersion.return_value = version
+
+        s.step_status = Mock()
+        s.buildslave = Mock()
+        s.remote = Mock()
+
+        s.start()
+
+        for c in s.remote.method_calls:
+            name, command, args = c
+            commandName = command[3]
+            kwargs = command[-1]
+            if commandName == 'uploadFile':
+                return kwargs
+        self.assert_(False, "No uploadFile command found")
+
+    @defer.deferredGenerator
+    def testDelta(self):
+        open(self.destfile, "wb").write("aaaabbbbcc")
+        kwargs = self.startDelta("2.15")
+        self.assertEquals(kwargs['delta'], True)
+        writer = kwargs['writer']
+
+        wfd = defer.waitForDeferred(writer.remote_digest())
+        yield wfd
+        self.assertEquals(wfd.getResult(), sha1("aaaabbbbcc").hexdigest())
+        wfd = defer.waitForDeferred(writer.remote_signature(4, 1, 10))
+        yield wfd
+        signature = wfd.getResult()
+        self.assertEquals(len(signature), 2)
+        self.assertEquals(signature[0][1], md5("bbbb").digest())
+        writer.remote_writeDelta(['xx', 1, 0])
+        writer.remote_close()
+        self.assertEquals(open(self.destfile, "rb").read(), "xxbbbbaaaa")
+
+    def testDeltaKeep(self):
+        open(self.destfile, "wb").write("aaaabbbbcc")
+        os.chmod(self.destfile, 0600)
+        writer = self.startDelta("2.15", mode=0644)['writer']
+        tmpname = writer.tmpname
+        writer.remote_keep()
+        self.assertEquals(open(self.destfile, "rb").read(), "aaaabbbbcc")
+        self.assert_(not os.path.exists(tmpname))
+        self.assertEquals(os.stat(self.destfile).st_mode & 0777, 0644)
+
+    @defer.deferredGenerator
+    def testDeltaMissing(self):
+        writer = self.startDelta("2.15")['writer']
+        wfd = defer.waitForDeferred(writer.remote_digest())
+        yield wfd
+        self.assertEquals(wfd.getResult(), None)
+        writer.remote_close()
+
+    def testDeltaOldSlave(self):
+        kwargs = self.startDelta("2.14")
+        self.assert_('delta' not in kwargs)
+        kwargs['writer'].remote_close()
+
+class TestDirectoryWriter(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.destroot = os.path.join(self.basedir, 'dest')
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def makeArchive(self, files):
+        buf = StringIO()
+        archive = tarfile.open(mode='w|gz', fileobj=buf)
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, StringIO(data))
+        archive.close()
+        return buf.getvalue()
+
+    @defer.deferredGenerator
+    def testStreaming(self):
+        os.mkdir(self.destroot)
+        open(os.path.join(self.destroot, 'kept'), 'w').write('kept')
+        open(os.path.join(self.destroot, 'a'), 'w').write('old')
+        data = self.makeArchive([('a', 'new'), ('sub/b', 'x' * 100000)])
+
+        writer = _DirectoryWriter(self.destroot, None, 'gz', 0600)
+        for i in range(0, len(data), 512):
+            wfd = defer.waitForDeferred(
+                defer.maybeDeferred(writer.remote_write, data[i:i+512]))
+            yield wfd
+            wfd.getResult()
+            # only a few blocks are kept in memory
+            self.assertTrue(len(writer.pending) <= writer.maxPending + 1)
+        wfd = defer.waitForDeferred(writer.remote_unpack())
+        yield wfd
+        wfd.getResult()
+
+        read = lambda *p : open(os.path.join(self.destroot, *p)).read()
+        self.assertEqual(read('a'), 'new')
+        self.assertEqual(read('kept'), 'kept')
+        self.assertEqual(read('sub', 'b'), 'x' * 100000)
+        self.assertEqual(sorted(os.listdir(self.basedir)), ['dest'])
+
+    @defer.deferredGenerator
+    def testCancel(self):
+        writer = _DirectoryWriter(self.destroot, None, 'gz', 0600)
+        writer.remote_write(self.makeArchive([('a', 'data')])[:100])
+        writer.cancel()
+        wfd = defer.waitForDeferred(writer.extracted)
+        yield wfd
+        wfd.getResult()
+        self.assertEqual(os.listdir(self.basedir), [])
+
+    @defer.deferredGenerator
+    def testIdleTimeout(self):
+        self.patch(_DirectoryWriter, 'idleTimeout', 0.1)
+        writer = _DirectoryWriter(self.destroot, None, 'gz', 0600)
+        writer.remote_write(self.makeArchive([('a', 'data')])[:100])
+        # the slave never sends the rest of the archive
+        wfd = defer.waitForDeferred(writer.extracted)
+        yield wfd
+        wfd.getResult()
+        self.assertEqual(writer.aborted, "no data from the slave")
+        self.assertEqual(os.listdir(self.basedir), [])
+        self.assertRaises(IOError, writer.remote_write, 'more')
+        wfd = defer.waitForDeferred(writer.remote_unpack())
+        yield wfd
+        self.assertRaises(IOError, wfd.getResult)
+
 class TestStringDownload(unittest.TestCase):
     def testBasic(self):
         s = StringDownload("Hello World", "hello.txt")
@@ -120,6 +259,28 @@ class TestStringDownload(unittest.TestCase):
         else:
             self.assert_(False, "No downloadFile command found")
 
+    def testWindow(self):
+        s = StringDownload("Hello World", "hello.txt", window=2)
+        s.build = Mock()
+        s.build.getProperties.return_value = Properties()
+        s.build.getSlaveCommandVersion.return_value = "2.14"
+
+        s.step_status = Mock()
+        s.buildslave = Mock()
+        s.remote = Mock()
+
+        s.start()
+
+        for c in s.remote.method_calls:
+            name, command, args = c
+            commandName = command[3]
+            kwargs = command[-1]
+            if commandName == 'downloadFile':
+                self.assertEquals(kwargs['window'], 2)
+                break
+        else:
+            self.assert_(False, "No downloadFile command found")
+
 class TestJSONStringDownload(unittest.TestCase):
     def testBasic(self):
         msg = dict(message="Hello World")
@@ -335,3 +335,80 @@ class LRUCache(unittest.TestCase):
                 self.lru.get('p'))
         yield wfd
         self.check_result(wfd.getResult(), set(['P2P2']))
+
+    @defer.deferredGenerator
+    def test_peek(self):
+        self.assertEqual(self.lru.peek('p'), None)
+
+        wfd = defer.waitForDeferred(
+                self.lru.get('p'))
+        yield wfd
+        self.check_result(wfd.getResult(), short('p'), 0, 1)
+
+        self.assertEqual(self.lru.peek('p'), short('p'))
+        self.check_result(None, None, 1, 1)
+
+    @defer.deferredGenerator
+    def test_add(self):
+        self.lru.add('a', set(['AAA2']))
+        self.lru.add('n', None)
+
+        self.lru.miss_fn = self.long_miss_fn
+        wfd = defer.waitForDeferred(
+                self.lru.get('a'))
+        yield wfd
+        self.check_result(wfd.getResult(), set(['AAA2']), 1, 0)
+
+        wfd = defer.waitForDeferred(
+                self.lru.get('n'))
+        yield wfd
+        self.check_result(wfd.getResult(), long('n'), 1, 1)
+
+    def test_add_purges(self):
+        for c in 'abcd':
+            self.lru.add(c, short(c))
+        self.assertEqual(sorted(self.lru.cache.keys()), ['b', 'c', 'd'])
+        self.assertEqual(self.lru.evictions, 1)
+
+class SyncLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.lru = lru.SyncLRUCache(self.short_miss_fn, 3)
+
+    def short_miss_fn(self, key):
+        return short(key)
+
+    def test_get(self):
+        self.assertEqual(self.lru.get('a'), short('a'))
+        self.assertEqual(self.lru.get('a'), short('a'))
+        self.assertEqual((self.lru.hits, self.lru.misses), (1, 1))
+
+    def test_lru_expulsion(self):
+        # hold a strong reference to 'a' only
+        a = self.lru.get('a')
+        for c in 'bcd':
+            self.lru.get(c)
+        self.lru.get('a') # refhit
+        for c in 'efgh':
+            self.lru.get(c)
+        self.assertEqual(sorted(self.lru.cache.keys()), ['f', 'g', 'h'])
+        self.assertEqual((self.lru.hits, self.lru.refhits, self.lru.misses,
+                          self.lru.evictions), (0, 1, 8, 6))
+        self.assertTrue('a' in self.lru.keys())
+        self.assertTrue(a in self.lru.values())
+
+    def test_miss_fn_raises(self):
+        def miss_fn(key):
+            raise IndexError("no such key")
+        self.lru.miss_fn = miss_fn
+        self.assertRaises(IndexError, lambda : self.lru.get('a'))
+        self.assertEqual(self.lru.keys(), [])
+
+    def test_miss_fn_returns_none(self):
+        calls = []
+        def miss_fn(key):
+            calls.append(key)
+        self.lru.miss_fn = miss_fn
+        self.assertEqual(self.lru.get('a'), None)
+        self.assertEqual(self.lru.get('a'), None)
+        self.assertEqual(calls, ['a', 'a'])
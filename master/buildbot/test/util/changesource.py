@@ -22,7 +22,8 @@ class ChangeSourceMixin(object):
 
      - starting and stopping a ChangeSource service
      - a fake C{self.master.addChange}, which adds its args
-       to the list C{self.chagnes_added}
+       to the list C{self.chagnes_added}, and C{self.master.addChanges},
+       which adds each of its changes to the same list
     """
 
     changesource = None
@@ -37,6 +38,10 @@ class ChangeSourceMixin(object):
             return defer.succeed(change)
         self.master = mock.Mock()
         self.master.addChange = addChange
+        def addChanges(changelist):
+            self.changes_added.extend(changelist)
+            return defer.succeed([ mock.Mock() for kwargs in changelist ])
+        self.master.addChanges = addChanges
         return defer.succeed(None)
 
     def tearDownChangeSource(self):
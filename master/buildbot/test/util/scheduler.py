@@ -41,9 +41,15 @@ class FakeMaster(object):
         sub.unsubscribe = unsub
         return sub
 
-    def subscribeToChanges(self, callback):
+    def subscribeToChanges(self, callback, change_filter=None):
         assert not self.changes_subscr_cb
-        self.changes_subscr_cb = callback
+        if change_filter:
+            def filtered_callback(change):
+                if change_filter.filter_change(change):
+                    callback(change)
+            self.changes_subscr_cb = filtered_callback
+        else:
+            self.changes_subscr_cb = callback
         return self._makeSubscription('changes_subscr_cb')
 
     def subscribeToBuildsets(self, callback):
@@ -47,11 +47,12 @@ class AsyncLRUCache(object):
     @ivar hits: cache hits so far
     @ivar refhits: cache misses found in the weak ref dictionary, so far
     @ivar misses: cache misses leading to re-fetches, so far
+    @ivar evictions: values purged from the cache to limit its size, so far
     """
 
     __slots__ = ('max_size max_queue miss_fn '
                  'queue cache weakrefs refcount concurrent '
-                 'hits refhits misses'.split())
+                 'hits refhits misses evictions'.split())
     sentinel = object()
     QUEUE_SIZE_FACTOR = 10
 
@@ -71,7 +72,7 @@ class AsyncLRUCache(object):
         self.cache = {}
         self.weakrefs = WeakValueDictionary()
         self.concurrent = {}
-        self.hits = self.misses = self.refhits = 0
+        self.hits = self.misses = self.refhits = self.evictions = 0
         self.refcount = defaultdict(default_factory = lambda : 0)
 
     def get(self, key, **miss_fn_kwargs):
@@ -92,27 +93,10 @@ class AsyncLRUCache(object):
         """
         cache = self.cache
         weakrefs = self.weakrefs
-        refcount = self.refcount
         concurrent = self.concurrent
-        queue = self.queue
 
         # utility function to record recent use of this key
-        def ref_key():
-            queue.append(key)
-            refcount[key] = refcount.get(key, 0) + 1
-
-            # periodically compact the queue by eliminating duplicate keys
-            # while preserving order of most recent access.  Note that this
-            # is only required when the cache does not exceed its maximum
-            # size
-            if len(queue) > self.max_queue:
-                refcount.clear()
-                queue_appendleft = queue.appendleft
-                queue_appendleft(self.sentinel)
-                for k in ifilterfalse(refcount.__contains__,
-                                        iter(queue.pop, self.sentinel)):
-                    queue_appendleft(k)
-                    refcount[k] = 1
+        ref_key = lambda : self._ref_key(key)
 
         try:
             result = cache[key]
@@ -173,6 +157,26 @@ class AsyncLRUCache(object):
 
         return d
 
+    def _ref_key(self, key):
+        queue = self.queue
+        refcount = self.refcount
+
+        queue.append(key)
+        refcount[key] = refcount.get(key, 0) + 1
+
+        # periodically compact the queue by eliminating duplicate keys
+        # while preserving order of most recent access.  Note that this
+        # is only required when the cache does not exceed its maximum
+        # size
+        if len(queue) > self.max_queue:
+            refcount.clear()
+            queue_appendleft = queue.appendleft
+            queue_appendleft(self.sentinel)
+            for k in ifilterfalse(refcount.__contains__,
+                                    iter(queue.pop, self.sentinel)):
+                queue_appendleft(k)
+                refcount[k] = 1
+
     def _purge(self):
         if len(self.cache) <= self.max_size:
             return
@@ -191,6 +195,7 @@ class AsyncLRUCache(object):
                 refc = refcount[k] = refcount[k] - 1
             del cache[k]
             del refcount[k]
+            self.evictions += 1
 
     def put(self, key, value):
         """
@@ -209,6 +214,47 @@ class AsyncLRUCache(object):
         elif key in self.weakrefs:
             self.weakrefs[key] = value
 
+    def peek(self, key):
+        """
+        Return the value for the given key if it is available without invoking
+        the C{miss_fn}, or C{None} otherwise.  A value found this way counts
+        as a hit (or refhit) and a reference to the key, exactly as for
+        L{get}.
+
+        @param key: cache key
+        @returns: value or None (not a Deferred)
+        """
+        try:
+            result = self.cache[key]
+            self.hits += 1
+        except KeyError:
+            try:
+                result = self.weakrefs[key]
+                self.refhits += 1
+                self.cache[key] = result
+            except KeyError:
+                return None
+        self._ref_key(key)
+        self._purge()
+        return result
+
+    def add(self, key, value):
+        """
+        Add a value that was fetched by some means other than the C{miss_fn},
+        such as a bulk query, to the cache, recording a reference to the key.
+        As with the C{miss_fn}, a value of C{None} is not cached.
+
+        @param key: key to add
+        @param value: value for the key
+        @returns: nothing
+        """
+        if value is None:
+            return
+        self.cache[key] = value
+        self.weakrefs[key] = value
+        self._ref_key(key)
+        self._purge()
+
     def set_max_size(self, max_size):
         if self.max_size == max_size:
             return
@@ -216,3 +262,55 @@ class AsyncLRUCache(object):
         self.max_size = max_size
         self.max_queue = max_size * self.QUEUE_SIZE_FACTOR
         self._purge()
+
+class SyncLRUCache(AsyncLRUCache):
+    """
+
+    A least-recently-used cache like L{AsyncLRUCache}, but for objects that
+    can be fetched synchronously.  The C{miss_fn} returns the value directly,
+    and L{get} does the same.  Any exception raised by the C{miss_fn} is
+    passed on to the caller, and nothing is cached.
+
+    Getting, adding, and evicting values all take amortized constant time,
+    regardless of the size of the cache.
+    """
+
+    __slots__ = ('__weakref__',)
+
+    def get(self, key, **miss_fn_kwargs):
+        """
+        Fetch a value from the cache by key, invoking C{self.miss_fn(key)} if
+        the key is not in the cache.  The keyword arguments are handled as for
+        L{AsyncLRUCache.get}.
+
+        @param key: cache key
+        @param **miss_fn_kwargs: keyword arguments to  the miss_fn
+        @returns: value (not a Deferred)
+        """
+        result = self.peek(key)
+        if result is not None:
+            return result
+
+        self.misses += 1
+        result = self.miss_fn(key, **miss_fn_kwargs)
+        self.add(key, result)
+        return result
+
+    def keys(self):
+        """
+        Return the keys of all values that are available without invoking the
+        C{miss_fn}, including those that are only weakly referenced.  This
+        does not record a reference to any key.
+
+        @returns: list of keys
+        """
+        return self.weakrefs.keys()
+
+    def values(self):
+        """
+        Return all values that are available without invoking the C{miss_fn};
+        see L{keys}.
+
+        @returns: list of values
+        """
+        return self.weakrefs.values()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""Measures the throughput of file uploads and downloads between the slave's
+transfer commands and the master's _FileWriter and _FileReader, over a
+loopback PB connection, for several window sizes.
+
+Both buildbot and buildslave must be importable. A delay may be added to
+every write and read on the master side to simulate a high-latency link.
+
+usage: bench_file_transfer.py [sizeMB [latencyMs [blocksize]]]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer, reactor
+from twisted.spread import pb
+
+from buildbot.steps.transfer import _FileReader, _FileWriter
+from buildslave.commands.transfer import SlaveFileDownloadCommand, \
+    SlaveFileUploadCommand
+
+LATENCY = 0
+
+
+def delayed(result):
+    if not LATENCY:
+        return result
+    d = defer.Deferred()
+    reactor.callLater(LATENCY, d.callback, result)
+    return d
+
+
+class SlowFileWriter(_FileWriter):
+
+    def remote_write(self, data):
+        _FileWriter.remote_write(self, data)
+        return delayed(None)
+
+
+class SlowFileReader(_FileReader):
+
+    def remote_read(self, maxlength):
+        return delayed(_FileReader.remote_read(self, maxlength))
+
+
+class Root(pb.Root):
+
+    def remote_writer(self, path):
+        return SlowFileWriter(path, None, None)
+
+    def remote_reader(self, path):
+        return SlowFileReader(open(path, 'rb'))
+
+
+class FakeSlaveBuilder:
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+
+    def sendUpdate(self, status):
+        pass
+
+
+@defer.deferredGenerator
+def bench(basedir, root, size, blocksize):
+    for window in (1, 4, 16):
+        wfd = defer.waitForDeferred(
+            root.callRemote('writer', os.path.join(basedir, 'uploaded')))
+        yield wfd
+        writer = wfd.getResult()
+        cmd = SlaveFileUploadCommand(FakeSlaveBuilder(basedir), 'upload',
+                dict(workdir='.', slavesrc='source', writer=writer,
+                     maxsize=None, blocksize=blocksize, keepstamp=False,
+                     window=window))
+        start = time.time()
+        wfd = defer.waitForDeferred(cmd.doStart())
+        yield wfd
+        wfd.getResult()
+        upload = size / (time.time() - start)
+
+        wfd = defer.waitForDeferred(
+            root.callRemote('reader', os.path.join(basedir, 'source')))
+        yield wfd
+        reader = wfd.getResult()
+        cmd = SlaveFileDownloadCommand(FakeSlaveBuilder(basedir), 'download',
+                dict(workdir='.', slavedest='downloaded', reader=reader,
+                     maxsize=None, blocksize=blocksize, mode=None,
+                     window=window))
+        start = time.time()
+        wfd = defer.waitForDeferred(cmd.doStart())
+        yield wfd
+        wfd.getResult()
+        download = size / (time.time() - start)
+
+        print 'window %2d  upload %8.0f kB/s   download %8.0f kB/s' % (
+            window, upload / 1024, download / 1024)
+        source = open(os.path.join(basedir, 'source'), 'rb').read()
+        for name in ('uploaded', 'downloaded'):
+            if open(os.path.join(basedir, name), 'rb').read() != source:
+                print '%s file differs from the source' % name
+
+
+def main():
+    global LATENCY
+    size = 16
+    blocksize = 16 * 1024
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        LATENCY = int(sys.argv[2]) / 1000.0
+    if len(sys.argv) > 3:
+        blocksize = int(sys.argv[3])
+    size *= 1024 * 1024
+
+    basedir = tempfile.mkdtemp()
+    f = open(os.path.join(basedir, 'source'), 'wb')
+    f.write(os.urandom(size))
+    f.close()
+
+    port = reactor.listenTCP(0, pb.PBServerFactory(Root()),
+                             interface='127.0.0.1')
+    factory = pb.PBClientFactory()
+    reactor.connectTCP('127.0.0.1', port.getHost().port, factory)
+    d = factory.getRootObject()
+    d.addCallback(lambda root: bench(basedir, root, size, blocksize))
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    shutil.rmtree(basedir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""Compares the push and pop throughput of the segmented DiskQueue used by
+StatusPush with the older layout storing one file per item, and measures the
+migration from the older layout.
+
+usage: bench_persistent_queue.py [nbItems [chunkSize]]
+"""
+
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+
+from buildbot.status.persistent_queue import DiskQueue, ReadFile, WriteFile
+
+
+class OneFilePerItemQueue(object):
+    """The older DiskQueue layout, reduced to what is benchmarked."""
+
+    def __init__(self, path):
+        self.path = path
+        self.first = 1
+        self.last = 0
+        if not os.path.isdir(path):
+            os.mkdir(path)
+
+    def pushItem(self, item):
+        self.last += 1
+        WriteFile(os.path.join(self.path, str(self.last)), pickle.dumps(item))
+
+    def popChunk(self, nbItems):
+        ret = []
+        while nbItems and self.first <= self.last:
+            path = os.path.join(self.path, str(self.first))
+            ret.append(pickle.loads(ReadFile(path)))
+            os.remove(path)
+            self.first += 1
+            nbItems -= 1
+        return ret
+
+
+def event(i):
+    return {'event': 'stepFinished', 'id': i,
+            'payload': {'text': ['compile', 'ok'], 'results': [0, []],
+                        'properties': [['buildername', 'linux', 'Builder']]}}
+
+
+def bench(name, queue, nbItems, chunkSize):
+    start = time.time()
+    for i in xrange(nbItems):
+        queue.pushItem(event(i))
+    if hasattr(queue, 'save'):
+        queue.save()
+    pushed = time.time()
+    popped = 0
+    while popped < nbItems:
+        popped += len(queue.popChunk(chunkSize))
+    end = time.time()
+    print '%-20s push %8.0f items/s   pop %8.0f items/s' % (
+        name, nbItems / (pushed - start), nbItems / (end - pushed))
+
+
+def main():
+    nbItems = 20000
+    chunkSize = 200
+    if len(sys.argv) > 1:
+        nbItems = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        chunkSize = int(sys.argv[2])
+    tmp = tempfile.mkdtemp()
+    try:
+        bench('one file per item', OneFilePerItemQueue(
+            os.path.join(tmp, 'files')), nbItems, chunkSize)
+        bench('segmented', DiskQueue(os.path.join(tmp, 'segments'),
+                                     maxItems=nbItems), nbItems, chunkSize)
+
+        path = os.path.join(tmp, 'migrate')
+        legacy = OneFilePerItemQueue(path)
+        for i in xrange(nbItems):
+            legacy.pushItem(event(i))
+        start = time.time()
+        queue = DiskQueue(path, maxItems=nbItems)
+        print '%-20s %8.0f items/s' % ('migration',
+                                       queue.nbItems() / (time.time() - start))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
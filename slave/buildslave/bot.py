@@ -32,6 +32,17 @@ from buildslave import monkeypatches
 class UnknownCommand(pb.Error):
     pass
 
+def _updateSize(obj):
+    """Rough number of bytes of data in a status update"""
+    if isinstance(obj, basestring):
+        return len(obj)
+    if isinstance(obj, (list, tuple)):
+        return sum([ _updateSize(o) for o in obj ])
+    if isinstance(obj, dict):
+        return sum([ _updateSize(k) + _updateSize(v)
+                     for k, v in obj.iteritems() ])
+    return 0
+
 class SlaveBuilder(pb.Referenceable, service.Service):
 
     """This is the local representation of a single Builder: it handles a
@@ -54,9 +65,28 @@ class SlaveBuilder(pb.Referenceable, service.Service):
     # when the step is started
     remoteStep = None
 
+    # .logUpdates is the format in which the master wants the output of the
+    # current command: None for one update per log, 'list' for ordered lists
+    # of (logname, data) records, 'zlib' for compressed lists. It is set
+    # when the step is started.
+    logUpdates = None
+
+    # Updates sent while another is waiting for its acknowledgement are
+    # collected, and sent together when it arrives, or when they have waited
+    # updateDelay seconds or hold maxUpdateSize bytes of data.
+    updateDelay = 0.5
+    maxUpdateSize = 256*1024
+
+    # For scheduling future events
+    _reactor = reactor
+
     def __init__(self, name):
         #service.Service.__init__(self) # Service has no __init__ method
         self.setName(name)
+        self.pendingUpdates = []
+        self.pendingSize = 0
+        self.updatesInFlight = 0
+        self.updateTimer = None
 
     def __repr__(self):
         return "<SlaveBuilder '%s' at %d>" % (self.name, id(self))
@@ -78,6 +108,7 @@ class SlaveBuilder(pb.Referenceable, service.Service):
 
     def stopService(self):
         service.Service.stopService(self)
+        self._dropUpdates()
         if self.stopCommandOnShutdown:
             self.stopCommand()
 
@@ -104,6 +135,7 @@ class SlaveBuilder(pb.Referenceable, service.Service):
     def lostRemoteStep(self, remotestep):
         log.msg("lost remote step")
         self.remoteStep = None
+        self._dropUpdates()
         if self.stopCommandOnShutdown:
             self.stopCommand()
 
@@ -133,6 +165,7 @@ class SlaveBuilder(pb.Referenceable, service.Service):
             factory = registry.getFactory(command)
         except KeyError:
             raise UnknownCommand, "unrecognized SlaveCommand '%s'" % command
+        self.logUpdates = args.get('logUpdates')
         self.command = factory(self, stepId, args)
 
         log.msg(" startCommand:%s [id %s]" % (command,stepId))
@@ -172,7 +205,8 @@ class SlaveBuilder(pb.Referenceable, service.Service):
         L{buildbot.process.step.RemoteCommand} object, giving it a sequence
         number in the process. It adds the update to a queue, and asks the
         master to acknowledge the update so it can be removed from that
-        queue."""
+        queue. While an update is waiting for its acknowledgement, the next
+        ones are held back so they can be sent in a single message."""
 
         if not self.running:
             # .running comes from service.Service, and says whether the
@@ -184,10 +218,47 @@ class SlaveBuilder(pb.Referenceable, service.Service):
         # interoperability issues between new slaves and old masters.
         if self.remoteStep:
             update = [data, 0]
-            updates = [update]
-            d = self.remoteStep.callRemote("update", updates)
-            d.addCallback(self.ackUpdate)
-            d.addErrback(self._ackFailed, "SlaveBuilder.sendUpdate")
+            self.pendingUpdates.append(update)
+            if not self.updatesInFlight:
+                self._sendUpdates()
+                return
+            self.pendingSize += _updateSize(data)
+            if self.pendingSize >= self.maxUpdateSize:
+                self._sendUpdates()
+            elif not self.updateTimer:
+                self.updateTimer = self._reactor.callLater(self.updateDelay,
+                                                           self._sendUpdates)
+
+    def _sendUpdates(self):
+        """Send all the pending updates in a single message"""
+        if self.updateTimer:
+            if self.updateTimer.active():
+                self.updateTimer.cancel()
+            self.updateTimer = None
+        updates = self.pendingUpdates
+        self.pendingUpdates = []
+        self.pendingSize = 0
+        if not updates or not self.remoteStep:
+            return
+        self.updatesInFlight += 1
+        d = self.remoteStep.callRemote("update", updates)
+        d.addCallback(self.ackUpdate)
+        d.addErrback(self._ackFailed, "SlaveBuilder.sendUpdate")
+        d.addBoth(self._updateDone)
+
+    def _updateDone(self, _):
+        self.updatesInFlight -= 1
+        # send what came in meanwhile
+        if self.pendingUpdates:
+            self._sendUpdates()
+
+    def _dropUpdates(self):
+        if self.updateTimer:
+            if self.updateTimer.active():
+                self.updateTimer.cancel()
+            self.updateTimer = None
+        self.pendingUpdates = []
+        self.pendingSize = 0
 
     def ackUpdate(self, acknum):
         self.activity() # update the "last activity" timer
@@ -217,6 +288,8 @@ class SlaveBuilder(pb.Referenceable, service.Service):
             log.msg(" but we weren't running, quitting silently")
             return
         if self.remoteStep:
+            # the master must get all the updates before the completion
+            self._sendUpdates()
             self.remoteStep.dontNotifyOnDisconnect(self.lostRemoteStep)
             d = self.remoteStep.callRemote("complete", failure)
             d.addCallback(self.ackComplete)
@@ -235,11 +308,13 @@ class Bot(pb.Referenceable, service.MultiService):
     usePTY = None
     name = "bot"
 
-    def __init__(self, basedir, usePTY, unicode_encoding=None):
+    def __init__(self, basedir, usePTY, unicode_encoding=None,
+                 update_delay=None):
         service.MultiService.__init__(self)
         self.basedir = basedir
         self.usePTY = usePTY
         self.unicode_encoding = unicode_encoding or sys.getfilesystemencoding() or 'ascii'
+        self.update_delay = update_delay
         self.builders = {}
 
     def startService(self):
@@ -268,6 +343,8 @@ class Bot(pb.Referenceable, service.MultiService):
                 b = SlaveBuilder(name)
                 b.usePTY = self.usePTY
                 b.unicode_encoding = self.unicode_encoding
+                if self.update_delay is not None:
+                    b.updateDelay = self.update_delay
                 b.setServiceParent(self)
                 b.setBuilddir(builddir)
                 self.builders[name] = b
@@ -423,13 +500,15 @@ class BotFactory(ReconnectingPBClientFactory):
 class BuildSlave(service.MultiService):
     def __init__(self, buildmaster_host, port, name, passwd, basedir,
                  keepalive, usePTY, keepaliveTimeout=None, umask=None,
-                 maxdelay=300, unicode_encoding=None, allow_shutdown=None):
+                 maxdelay=300, unicode_encoding=None, allow_shutdown=None,
+                 update_delay=None):
 
         # note: keepaliveTimeout is ignored, but preserved here for
         # backward-compatibility
 
         service.MultiService.__init__(self)
-        bot = Bot(basedir, usePTY, unicode_encoding=unicode_encoding)
+        bot = Bot(basedir, usePTY, unicode_encoding=unicode_encoding,
+                  update_delay=update_delay)
         bot.setServiceParent(self)
         self.bot = bot
         if keepalive == 0:
@@ -31,7 +31,7 @@ from buildslave.commands import utils
 # this used to be a CVS $-style "Revision" auto-updated keyword, but since I
 # moved to Darcs as the primary repository, this is updated manually each
 # time this file is changed. The last cvs_ver that was here was 1.51 .
-command_version = "2.13"
+command_version = "2.16"
 
 # version history:
 #  >=1.17: commands are interruptable
@@ -61,6 +61,9 @@ command_version = "2.13"
 #  >= 2.11: Arch, Bazaar, and Monotone removed
 #  >= 2.12: SlaveShellCommand no longer accepts 'keep_stdin_open'
 #  >= 2.13: SlaveFileUploadCommand supports option 'keepstamp'
+#  >= 2.14: uploadFile, uploadDirectory and downloadFile accept 'window'
+#  >= 2.15: uploadFile and downloadFile accept 'delta'
+#  >= 2.16: all commands accept 'logUpdates'
 
 class Command:
     implements(ISlaveCommand)
@@ -13,15 +13,180 @@
 #
 # Copyright Buildbot Team Members
 
-import os, tarfile, tempfile
+import os, tarfile, tempfile, zlib
+try:
+    from hashlib import md5, sha1
+except ImportError:
+    from md5 import new as md5
+    from sha import new as sha1
 
-from twisted.python import log
-from twisted.internet import defer
+from twisted.python import log, failure
+from twisted.internet import defer, threads
 
 from buildslave.commands.base import Command
 
+def _fileDigest(fp):
+    """Return the SHA-1 hex digest of the contents of fp, and rewind it"""
+    h = sha1()
+    fp.seek(0)
+    while True:
+        data = fp.read(65536)
+        if not data:
+            break
+        h.update(data)
+    fp.seek(0)
+    return h.hexdigest()
+
+def _signatureIndex(signature):
+    """Map the weak checksums of a block signature, as returned by the
+    master's signature method, to dicts mapping strong checksums to the index
+    of the first block having them"""
+    index = {}
+    for i, (weak, strong) in enumerate(signature):
+        index.setdefault(weak, {}).setdefault(strong, i)
+    return index
+
+def _deltaScan(fp, blocksize, index):
+    """
+    Find the blocks of a signature in the file fp, at any offset.
+
+    Yields the contents of fp in order, as strings for the data that does not
+    match any block, and as the block index for each blocksize bytes that
+    match one.  The weak checksum is the adler32 of the block, rolled one
+    byte at a time between matches.
+    """
+    MOD = 65521
+    buf = ''
+    pos = 0         # start of the window in buf
+    literal = 0     # start of the data not yielded yet
+    a = b = None    # adler32 halves of the window, None to recompute
+    eof = False
+    while True:
+        if len(buf) - pos <= blocksize and not eof:
+            # drop what was yielded already and read more
+            buf = buf[literal:]
+            pos -= literal
+            literal = 0
+            more = fp.read(max(blocksize, 65536))
+            if more:
+                buf += more
+                continue
+            eof = True
+        if len(buf) - pos < blocksize:
+            break
+        if a is None:
+            weak = zlib.adler32(buf[pos:pos+blocksize]) & 0xffffffff
+            a, b = weak & 0xffff, weak >> 16
+        else:
+            weak = (b << 16) | a
+        if weak in index:
+            i = index[weak].get(md5(buf[pos:pos+blocksize]).digest())
+            if i is not None:
+                if pos > literal:
+                    yield buf[literal:pos]
+                yield i
+                pos += blocksize
+                literal = pos
+                a = None
+                continue
+        if len(buf) - pos == blocksize:
+            # nothing to roll in
+            break
+        out, new = ord(buf[pos]), ord(buf[pos+blocksize])
+        a = (a - out + new) % MOD
+        b = (b - blocksize * out + a - 1) % MOD
+        pos += 1
+        if pos - literal >= blocksize:
+            yield buf[literal:pos]
+            literal = pos
+    if len(buf) > literal:
+        yield buf[literal:]
+
 class TransferCommand(Command):
 
+    # number of blocks that may be in flight at once; masters send 'window'
+    # to slaves at command version 2.14 or later
+    window = 1
+    outstanding = 0
+
+    # whether to compare the file with the master's copy first, and only
+    # transfer what changed; sent by masters to slaves at command version
+    # 2.15 or later
+    delta = False
+    # number of block checksums fetched, or block instructions sent, at once
+    signaturePage = 1024
+
+    def _fetchSignature(self, remote):
+        """Fetch the block signature of the master's copy of the file from
+        remote, one page at a time"""
+        signature = []
+        d = defer.Deferred()
+        def fetch():
+            d1 = remote.callRemote('signature', self.blocksize,
+                                   len(signature), self.signaturePage)
+            d1.addCallbacks(got, d.errback)
+        def got(page):
+            signature.extend(page)
+            if len(page) < self.signaturePage:
+                d.callback(signature)
+            else:
+                fetch()
+        fetch()
+        return d
+
+    def _loop(self, fire_when_done):
+        """Call self._nextBlock until it returns True, keeping up to
+        self.window of the Deferreds it returns outstanding at once.
+
+        _nextBlock returns True when there are no more blocks, a Deferred for
+        a block in flight, or None when it must wait for an outstanding block
+        to finish before sending another."""
+        state = dict(outstanding=0, done=False, failed=False, pumping=False)
+
+        def pump():
+            # callRemote may fire synchronously; loop instead of recursing
+            if state['pumping']:
+                return
+            state['pumping'] = True
+            try:
+                while (not state['done'] and not state['failed'] and
+                       state['outstanding'] < self.window):
+                    self.outstanding = state['outstanding']
+                    try:
+                        d = self._nextBlock()
+                    except:
+                        fail(failure.Failure())
+                        return
+                    if d is True:
+                        state['done'] = True
+                    elif d is None:
+                        assert state['outstanding'], "nothing to wait for"
+                        break
+                    else:
+                        state['outstanding'] += 1
+                        d.addCallbacks(blockDone, blockFailed)
+            finally:
+                state['pumping'] = False
+            if (state['done'] and not state['failed'] and
+                not state['outstanding']):
+                fire_when_done.callback(None)
+
+        def blockDone(res):
+            state['outstanding'] -= 1
+            pump()
+
+        def blockFailed(why):
+            state['outstanding'] -= 1
+            fail(why)
+
+        def fail(why):
+            if not state['failed']:
+                state['failed'] = True
+                fire_when_done.errback(why)
+
+        pump()
+        return None
+
     def finished(self, res):
         if self.debug:
             log.msg('finished: stderr=%r, rc=%r' % (self.stderr, self.rc))
@@ -45,6 +210,103 @@ class TransferCommand(Command):
         # when it sees self.interrupted set.
 
 
+class _TarStream:
+    """
+    File-like object producing a tar archive of a directory, optionally
+    compressed, as it is read.  Only one block of a file's contents is read
+    at a time, so memory use does not depend on the size of the directory.
+    """
+
+    def __init__(self, path, compress, blocksize):
+        if compress == 'bz2':
+            mode = 'w|bz2'
+        elif compress == 'gz':
+            mode = 'w|gz'
+        else:
+            mode = 'w|'
+        self.blocksize = blocksize
+        # data written by the archive and not read yet
+        self.pending = []
+        self.pendingSize = 0
+        self.archive = tarfile.open(mode=mode, fileobj=self)
+        self.entries = self._walk(path, '')
+        # regular file whose contents are being added, and its size left
+        self.current = None
+        self.currentSize = 0
+        self.done = False
+
+    def _walk(self, path, arcname):
+        # same order as TarFile.add
+        yield path, arcname
+        if os.path.isdir(path) and not os.path.islink(path):
+            for name in sorted(os.listdir(path)):
+                for entry in self._walk(os.path.join(path, name),
+                                        os.path.join(arcname, name)):
+                    yield entry
+
+    def write(self, data):
+        # called by the archive
+        self.pending.append(data)
+        self.pendingSize += len(data)
+
+    def read(self, size):
+        while self.pendingSize < size and not self.done:
+            self._produce()
+        data = ''.join(self.pending)
+        if len(data) > size:
+            self.pending = [data[size:]]
+            data = data[:size]
+        else:
+            self.pending = []
+        self.pendingSize -= len(data)
+        return data
+
+    def _produce(self):
+        """Add the next block of the current file, or the next entry, to the
+        archive."""
+        if self.current is not None:
+            data = self.current.read(min(self.blocksize, self.currentSize))
+            if not data:
+                raise IOError("file %r shrank while being archived"
+                              % self.current.name)
+            self.archive.fileobj.write(data)
+            self.archive.offset += len(data)
+            self.currentSize -= len(data)
+            if self.currentSize == 0:
+                self.current.close()
+                self.current = None
+                # pad the contents to a whole number of blocks, as addfile
+                # would
+                remainder = self.archive.offset % tarfile.BLOCKSIZE
+                if remainder:
+                    self.archive.fileobj.write(
+                            tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                    self.archive.offset += tarfile.BLOCKSIZE - remainder
+            return
+
+        try:
+            path, arcname = self.entries.next()
+        except StopIteration:
+            self.archive.close()
+            self.done = True
+            return
+        tarinfo = self.archive.gettarinfo(path, arcname)
+        if tarinfo is None:
+            # sockets and the like can't be archived
+            return
+        # addfile writes the header only; the contents follow one block at a
+        # time
+        self.archive.addfile(tarinfo)
+        if tarinfo.isreg() and tarinfo.size:
+            self.current = open(path, 'rb')
+            self.currentSize = tarinfo.size
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+
 class SlaveFileUploadCommand(TransferCommand):
     """
     Upload a file from slave to build master
@@ -56,8 +318,17 @@ class SlaveFileUploadCommand(TransferCommand):
         - ['maxsize']:   max size (in bytes) of file to write
         - ['blocksize']: max size for each data block
         - ['keepstamp']: whether to preserve file modified and accessed times
+        - ['window']:    number of blocks to send before waiting for the
+                         first one to be acknowledged (optional)
+        - ['delta']:     whether to skip the upload if the master's copy is
+                         identical, and otherwise send only the blocks it
+                         lacks (optional)
     """
     debug = False
+    # whether the master's copy is identical, in delta mode
+    unchanged = False
+    # instructions to rebuild the file from the master's copy, in delta mode
+    scan = None
 
     def setup(self, args):
         self.workdir = args['workdir']
@@ -66,6 +337,8 @@ class SlaveFileUploadCommand(TransferCommand):
         self.remaining = args['maxsize']
         self.blocksize = args['blocksize']
         self.keepstamp = args['keepstamp']
+        self.window = args.get('window', 1)
+        self.delta = args.get('delta', False)
         self.stderr = None
         self.rc = 0
 
@@ -96,10 +369,18 @@ class SlaveFileUploadCommand(TransferCommand):
         self.sendStatus({'header': "sending %s" % self.path})
 
         d = defer.Deferred()
-        self._reactor.callLater(0, self._loop, d)
+        if self.delta and self.fp is not None:
+            d1 = self._startDelta()
+            d1.addCallbacks(lambda _ : self._loop(d), d.errback)
+        else:
+            self._reactor.callLater(0, self._loop, d)
         def _close_ok(res):
             self.fp = None
-            d1 = self.writer.callRemote("close")
+            if self.unchanged:
+                # the master keeps its copy
+                d1 = self.writer.callRemote("keep")
+            else:
+                d1 = self.writer.callRemote("close")
             def _utime_ok(res):
                 return self.writer.callRemote("utime", accessed_modified)
             if self.keepstamp:
@@ -120,17 +401,52 @@ class SlaveFileUploadCommand(TransferCommand):
         d.addBoth(self.finished)
         return d
 
-    def _loop(self, fire_when_done):
-        d = defer.maybeDeferred(self._writeBlock)
-        def _done(finished):
-            if finished:
-                fire_when_done.callback(None)
-            else:
-                self._loop(fire_when_done)
-        def _err(why):
-            fire_when_done.errback(why)
-        d.addCallbacks(_done, _err)
-        return None
+    def _startDelta(self):
+        """Compare the file with the master's copy, and prepare the
+        instructions to rebuild it from that copy"""
+        digest = _fileDigest(self.fp)
+        d = self.writer.callRemote('digest')
+        def check(masterDigest):
+            if masterDigest == digest:
+                self.unchanged = True
+                self.sendStatus({'header': "master copy is up to date\n"})
+                return
+            if masterDigest is None:
+                # nothing to start from; send the whole file
+                return
+            d1 = self._fetchSignature(self.writer)
+            def scan(signature):
+                self.scan = _deltaScan(self.fp, self.blocksize,
+                                       _signatureIndex(signature))
+            d1.addCallback(scan)
+            return d1
+        d.addCallback(check)
+        return d
+
+    def _nextBlock(self):
+        if self.unchanged:
+            return True
+        if self.scan is not None:
+            return self._writeDelta()
+        return self._writeBlock()
+
+    def _writeDelta(self):
+        """Send the next instructions to rebuild the file: data it lacks,
+        and indexes of the blocks of the master's copy to reuse"""
+        if self.interrupted:
+            return True
+        instructions = []
+        size = 0
+        for item in self.scan:
+            instructions.append(item)
+            if isinstance(item, str):
+                size += len(item)
+            if (size >= self.blocksize or
+                len(instructions) >= self.signaturePage):
+                break
+        if not instructions:
+            return True
+        return self.writer.callRemote('writeDelta', instructions)
 
     def _writeBlock(self):
         """Write a block of data to the remote writer"""
@@ -163,9 +479,7 @@ class SlaveFileUploadCommand(TransferCommand):
         if self.remaining is not None:
             self.remaining = self.remaining - len(data)
             assert self.remaining >= 0
-        d = self.writer.callRemote('write', data)
-        d.addCallback(lambda res: False)
-        return d
+        return self.writer.callRemote('write', data)
 
 
 class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
@@ -179,6 +493,8 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         - ['maxsize']:   max size (in bytes) of file to write
         - ['blocksize']: max size for each data block
         - ['compress']:  one of [None, 'bz2', 'gz']
+        - ['window']:    number of blocks to send before waiting for the
+                         first one to be acknowledged (optional)
     """
     debug = False
 
@@ -189,6 +505,7 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         self.remaining = args['maxsize']
         self.blocksize = args['blocksize']
         self.compress = args['compress']
+        self.window = args.get('window', 1)
         self.stderr = None
         self.rc = 0
 
@@ -202,22 +519,8 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
         if self.debug:
             log.msg("path: %r" % self.path)
 
-        # Create temporary archive
-        fd, self.tarname = tempfile.mkstemp()
-        fileobj = os.fdopen(fd, 'w')
-        if self.compress == 'bz2':
-            mode='w|bz2'
-        elif self.compress == 'gz':
-            mode='w|gz'
-        else:
-            mode = 'w'
-        archive = tarfile.open(name=self.tarname, mode=mode, fileobj=fileobj)
-        archive.add(self.path, '')
-        archive.close()
-        fileobj.close()
-
-        # Transfer it
-        self.fp = open(self.tarname, 'rb')
+        # the archive is produced as it is sent
+        self.fp = _TarStream(self.path, self.compress, self.blocksize)
 
         self.sendStatus({'header': "sending %s" % self.path})
 
@@ -235,7 +538,6 @@ class SlaveDirectoryUploadCommand(SlaveFileUploadCommand):
 
     def finished(self, res):
         self.fp.close()
-        os.remove(self.tarname)
         return TransferCommand.finished(self, res)
 
 
@@ -250,6 +552,11 @@ class SlaveFileDownloadCommand(TransferCommand):
         - ['maxsize']:   max size (in bytes) of file to write
         - ['blocksize']: max size for each data block
         - ['mode']:      access mode for the new file
+        - ['window']:    number of blocks to request before waiting for the
+                         first one to arrive (optional)
+        - ['delta']:     whether to keep the existing file if it is
+                         identical to the master's, and otherwise fetch only
+                         the blocks it lacks (optional)
     """
     debug = False
 
@@ -260,7 +567,22 @@ class SlaveFileDownloadCommand(TransferCommand):
         self.bytes_remaining = args['maxsize']
         self.blocksize = args['blocksize']
         self.mode = args['mode']
+        self.window = args.get('window', 1)
+        self.delta = args.get('delta', False)
+        self.fp = None
         self.stderr = None
+        # blocks received out of order, by sequence number
+        self.blocks = {}
+        self.nextRequest = 0
+        self.nextWrite = 0
+        self.eof = False
+        # in delta mode: the existing file, the number of blocks of the new
+        # one, the offsets in the existing file of those found there, and
+        # the temporary file the new one is written to
+        self.basis = None
+        self.nblocks = None
+        self.localBlocks = {}
+        self.tmpname = None
         self.rc = 0
 
     def start(self):
@@ -276,10 +598,28 @@ class SlaveFileDownloadCommand(TransferCommand):
         if not os.path.exists(dirname):
             os.makedirs(dirname)
 
+        d = defer.Deferred()
+        if self.delta and os.path.isfile(self.path):
+            d1 = self._startDelta()
+            d1.addCallbacks(lambda _ : self._loop(d), d.errback)
+        else:
+            self._open(self.path)
+            self._reactor.callLater(0, self._loop, d)
+        def _close(res):
+            # close the file, but pass through any errors from _loop
+            d1 = self.reader.callRemote('close')
+            d1.addErrback(log.err, 'while trying to close reader')
+            d1.addCallback(lambda ignored: res)
+            return d1
+        d.addBoth(_close)
+        d.addBoth(self.finished)
+        return d
+
+    def _open(self, path):
         try:
-            self.fp = open(self.path, 'wb')
+            self.fp = open(path, 'wb')
             if self.debug:
-                log.msg("Opened '%s' for download" % self.path)
+                log.msg("Opened '%s' for download" % path)
             if self.mode is not None:
                 # note: there is a brief window during which the new file
                 # will have the buildslave's default (umask) mode before we
@@ -288,77 +628,148 @@ class SlaveFileDownloadCommand(TransferCommand):
                 # is possible to call os.umask() before and after the open()
                 # call, but cleaning up from exceptions properly is more of a
                 # nuisance that way).
-                os.chmod(self.path, self.mode)
+                os.chmod(path, self.mode)
         except IOError:
             # TODO: this still needs cleanup
             self.fp = None
-            self.stderr = "Cannot open file '%s' for download" % self.path
+            self.stderr = "Cannot open file '%s' for download" % path
             self.rc = 1
             if self.debug:
-                log.msg("Cannot open file '%s' for download" % self.path)
-
-        d = defer.Deferred()
-        self._reactor.callLater(0, self._loop, d)
-        def _close(res):
-            # close the file, but pass through any errors from _loop
-            d1 = self.reader.callRemote('close')
-            d1.addErrback(log.err, 'while trying to close reader')
-            d1.addCallback(lambda ignored: res)
+                log.msg("Cannot open file '%s' for download" % path)
+
+    def _startDelta(self):
+        """Compare the existing file with the master's, and find the blocks
+        of the master's file it already has"""
+        basis = open(self.path, 'rb')
+        digest = _fileDigest(basis)
+        d = self.reader.callRemote('digest')
+        def check(masterDigest):
+            if masterDigest == digest:
+                basis.close()
+                if self.mode is not None:
+                    os.chmod(self.path, self.mode)
+                self.sendStatus({'header': "%s is up to date\n" % self.path})
+                return
+            self.basis = basis
+            d1 = self._fetchSignature(self.reader)
+            # scanning the file is CPU-bound
+            d1.addCallback(lambda signature :
+                    threads.deferToThread(self._findBlocks, signature))
+            d1.addCallback(self._openTemporary)
             return d1
-        d.addBoth(_close)
-        d.addBoth(self.finished)
+        d.addCallback(check)
         return d
 
-    def _loop(self, fire_when_done):
-        d = defer.maybeDeferred(self._readBlock)
-        def _done(finished):
-            if finished:
-                fire_when_done.callback(None)
+    def _findBlocks(self, signature):
+        """Find the offsets in the existing file of the blocks of the
+        master's file"""
+        index = _signatureIndex(signature)
+        found = {}
+        offset = 0
+        for item in _deltaScan(self.basis, self.blocksize, index):
+            if isinstance(item, str):
+                offset += len(item)
             else:
-                self._loop(fire_when_done)
-        def _err(why):
-            fire_when_done.errback(why)
-        d.addCallbacks(_done, _err)
-        return None
+                found.setdefault(item, offset)
+                offset += self.blocksize
+        # blocks with the same contents are all found at the first one's
+        for i, (weak, strong) in enumerate(signature):
+            first = index[weak][strong]
+            if first in found:
+                self.localBlocks[i] = found[first]
+        return len(signature)
+
+    def _openTemporary(self, nblocks):
+        # the existing file is read while the new one is written beside it
+        self.nblocks = nblocks
+        fd, self.tmpname = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        os.close(fd)
+        self._open(self.tmpname)
+
+    def _nextBlock(self):
+        if self.nblocks is not None:
+            return self._copyBlock()
+        return self._readBlock()
+
+    def _copyBlock(self):
+        """Copy the next block from the existing file if it has it, and
+        read it from the master otherwise"""
+        if (self.interrupted or self.fp is None or
+            self.nextRequest == self.nblocks):
+            return True
+        seq = self.nextRequest
+        self.nextRequest += 1
+        if seq in self.localBlocks:
+            self.basis.seek(self.localBlocks[seq])
+            data = self.basis.read(self.blocksize)
+            self._writeData(data, seq, len(data))
+            return defer.succeed(None)
+        d = self.reader.callRemote('read', self.blocksize,
+                                   seq * self.blocksize)
+        d.addCallback(self._writeData, seq, self.blocksize)
+        return d
 
     def _readBlock(self):
         """Read a block of data from the remote reader."""
 
-        if self.interrupted or self.fp is None:
+        if self.interrupted or self.fp is None or self.eof:
             if self.debug:
                 log.msg('SlaveFileDownloadCommand._readBlock(): end')
             return True
 
+        # bytes_remaining does not count the blocks in flight
         length = self.blocksize
         if self.bytes_remaining is not None and length > self.bytes_remaining:
             length = self.bytes_remaining
 
         if length <= 0:
+            if self.outstanding:
+                # wait, the blocks in flight may come back short
+                return None
             if self.stderr is None:
                 self.stderr = "Maximum filesize reached, truncating file '%s'" \
                                 % self.path
                 self.rc = 1
             return True
         else:
+            if self.bytes_remaining is not None:
+                self.bytes_remaining = self.bytes_remaining - length
+            seq = self.nextRequest
+            self.nextRequest += 1
             d = self.reader.callRemote('read', length)
-            d.addCallback(self._writeData)
+            d.addCallback(self._writeData, seq, length)
             return d
 
-    def _writeData(self, data):
+    def _writeData(self, data, seq, length):
         if self.debug:
             log.msg('SlaveFileDownloadCommand._readBlock(): readlen=%d' %
                     len(data))
-        if len(data) == 0:
-            return True
-
         if self.bytes_remaining is not None:
-            self.bytes_remaining = self.bytes_remaining - len(data)
+            self.bytes_remaining = self.bytes_remaining + length - len(data)
             assert self.bytes_remaining >= 0
-        self.fp.write(data)
-        return False
+        if len(data) == 0:
+            self.eof = True
+
+        # write the blocks in the order they were requested
+        self.blocks[seq] = data
+        while self.nextWrite in self.blocks:
+            data = self.blocks.pop(self.nextWrite)
+            self.nextWrite += 1
+            if self.fp is not None:
+                self.fp.write(data)
 
     def finished(self, res):
         if self.fp is not None:
             self.fp.close()
+        if self.basis is not None:
+            self.basis.close()
+        if self.tmpname is not None:
+            if (self.rc == 0 and not self.interrupted and
+                not isinstance(res, failure.Failure)):
+                # on windows, os.rename does not automatically unlink
+                os.unlink(self.path)
+                os.rename(self.tmpname, self.path)
+            else:
+                os.unlink(self.tmpname)
 
         return TransferCommand.finished(self, res)
@@ -25,6 +25,7 @@ import re
 import subprocess
 import traceback
 import stat
+import zlib
 from collections import deque
 
 from twisted.python import runtime, log
@@ -217,6 +218,9 @@ class RunProcess:
     BUFFER_SIZE = 64*1024
     BUFFER_TIMEOUT = 5
 
+    # Don't bother compressing 'zlib' updates smaller than this
+    COMPRESS_MIN = 512
+
     # For sending elapsed time:
     startTime = None
     elapsedTime = None
@@ -321,6 +325,7 @@ class RunProcess:
         self.buffered = deque()
         self.buflen = 0
         self.buftimer = None
+        self.logUpdates = self.builder.logUpdates
 
         if usePTY == "slave-config":
             self.usePTY = self.builder.usePTY
@@ -559,10 +564,66 @@ class RunProcess:
         self.buftimer = None
         self._sendBuffers()
 
+    def _sendRecords(self, records):
+        """
+        Send records, a list of (logname, chunks) tuples, as a single 'logs'
+        update, or a 'zlogs' update if the master accepts compressed ones and
+        that saves space
+        """
+        records = [ (logname, "".join(chunks)) for logname, chunks in records ]
+        if self.logUpdates == 'zlib':
+            data = "".join([ d for logname, d in records ])
+            if len(data) >= self.COMPRESS_MIN:
+                compressed = zlib.compress(data)
+                if len(compressed) < len(data):
+                    lengths = [ (logname, len(d)) for logname, d in records ]
+                    self.sendStatus({'zlogs': (lengths, compressed)})
+                    return
+        self.sendStatus({'logs': records})
+
     def _sendBuffers(self):
         """
         Send all the content in our buffers.
         """
+        if self.logUpdates:
+            self._sendBuffersAsRecords()
+        else:
+            self._sendBuffersAsLogs()
+        self.buflen = 0
+        if self.buftimer:
+            if self.buftimer.active():
+                self.buftimer.cancel()
+            self.buftimer = None
+
+    def _sendBuffersAsRecords(self):
+        """
+        Send the buffers as ordered lists of (logname, data) records, with
+        consecutive data for the same log merged, and at most about
+        CHUNK_LIMIT bytes of data per update
+        """
+        records = []
+        msg_size = 0
+        while self.buffered:
+            logname, data = self.buffered.popleft()
+            for chunk in self._chunkForSend(data):
+                if len(chunk) == 0: continue
+                if records and records[-1][0] == logname:
+                    records[-1][1].append(chunk)
+                else:
+                    records.append((logname, [chunk]))
+                msg_size += len(chunk)
+                if msg_size >= self.CHUNK_LIMIT:
+                    self._sendRecords(records)
+                    records = []
+                    msg_size = 0
+        if records:
+            self._sendRecords(records)
+
+    def _sendBuffersAsLogs(self):
+        """
+        Send the buffers as updates with a key for each log, for masters that
+        do not accept lists of records
+        """
         msg = {}
         msg_size = 0
         lastlog = None
@@ -575,9 +636,8 @@ class RunProcess:
             # out the message so far.  This is because the message is
             # transferred as a dictionary, which makes the ordering of keys
             # unspecified, and makes it impossible to interleave data from
-            # different logs.  A future enhancement could be to change the
-            # master to support a list of (logname, data) tuples instead of a
-            # dictionary.
+            # different logs.  Masters that accept lists of (logname, data)
+            # tuples get those instead, from _sendBuffersAsRecords.
             # On our first pass through this loop lastlog is None
             if lastlog is None:
                 lastlog = logname
@@ -603,13 +663,8 @@ class RunProcess:
                     msg = {}
                     logdata = msg.setdefault(logname, [])
                     msg_size = 0
-        self.buflen = 0
         if logdata:
             self._sendMessage(msg)
-        if self.buftimer:
-            if self.buftimer.active():
-                self.buftimer.cancel()
-            self.buftimer = None
 
     def _addToBuffers(self, logname, data):
         """
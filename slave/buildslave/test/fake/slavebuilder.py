@@ -22,10 +22,12 @@ class FakeSlaveBuilder:
     showing the updates.  Set debug to True to show updates as they happen.
     """
     debug = False
-    def __init__(self, usePTY=False, basedir="/slavebuilder/basedir"):
+    def __init__(self, usePTY=False, basedir="/slavebuilder/basedir",
+                 logUpdates=None):
         self.updates = []
         self.basedir = basedir
         self.usePTY = usePTY
+        self.logUpdates = logUpdates
 
     def sendUpdate(self, data):
         if self.debug:
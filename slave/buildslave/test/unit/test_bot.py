@@ -260,6 +260,27 @@ class TestSlaveBuilder(command.CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_startCommand_logUpdates(self):
+        st = FakeStep()
+
+        self.patch_runprocess(
+            Expect([ 'echo', 'hello' ], os.path.join(self.basedir, 'sb', 'workdir'))
+            + { 'rc' : 0 }
+            + 0,
+        )
+
+        d = self.sb.callRemote("startCommand", FakeRemote(st),
+                               "13", "shell", dict(
+                                        command=[ 'echo', 'hello' ],
+                                        workdir='workdir',
+                                        logUpdates='zlib',
+                                    ))
+        d.addCallback(lambda _ : st.wait_for_finish())
+        def check(_):
+            self.assertEqual(self.sb.original.logUpdates, 'zlib')
+        d.addCallback(check)
+        return d
+
     def test_startCommand_interruptCommand(self):
         # set up a fake step to receive updates
         st = FakeStep()
@@ -328,6 +349,77 @@ class TestSlaveBuilder(command.CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+class SlowStep(object):
+    # a fake step that acknowledges updates only when told to
+
+    def __init__(self):
+        self.updates = []
+        self.acks = []
+
+    def remote_update(self, updates):
+        self.updates.append([ u[0] for u in updates ])
+        d = defer.Deferred()
+        self.acks.append(d)
+        return d
+
+    def ack(self):
+        self.acks.pop(0).callback(0)
+
+class TestSlaveBuilderUpdates(unittest.TestCase):
+
+    def setUp(self):
+        self.sb = bot.SlaveBuilder('sb')
+        self.sb.running = True
+        self.clock = self.sb._reactor = task.Clock()
+        self.step = SlowStep()
+        self.sb.remoteStep = FakeRemote(self.step)
+
+    def test_coalesced(self):
+        self.sb.sendUpdate({'stdout': 'a'})
+        self.sb.sendUpdate({'stdout': 'b'})
+        self.sb.sendUpdate({'stderr': 'c'})
+        self.assertEqual(self.step.updates, [[{'stdout': 'a'}]])
+        self.step.ack()
+        self.assertEqual(self.step.updates, [[{'stdout': 'a'}],
+                             [{'stdout': 'b'}, {'stderr': 'c'}]])
+        self.step.ack()
+        self.sb.sendUpdate({'rc': 0})
+        self.assertEqual(self.step.updates[-1], [{'rc': 0}])
+
+    def test_delay(self):
+        self.sb.updateDelay = 2
+        self.sb.sendUpdate({'stdout': 'a'})
+        self.sb.sendUpdate({'stdout': 'b'})
+        self.clock.advance(1)
+        self.assertEqual(len(self.step.updates), 1)
+        self.sb.sendUpdate({'stdout': 'c'})
+        self.clock.advance(1)
+        self.assertEqual(self.step.updates, [[{'stdout': 'a'}],
+                             [{'stdout': 'b'}, {'stdout': 'c'}]])
+        # the late acks don't send anything more
+        self.step.ack()
+        self.step.ack()
+        self.assertEqual(len(self.step.updates), 2)
+
+    def test_maxUpdateSize(self):
+        self.sb.maxUpdateSize = 20
+        self.sb.sendUpdate({'stdout': 'a'})
+        self.sb.sendUpdate({'stdout': 'b' * 4})
+        self.sb.sendUpdate({'logs': [('stdout', 'c' * 4)]})
+        self.assertEqual(self.step.updates, [[{'stdout': 'a'}],
+                             [{'stdout': 'bbbb'},
+                              {'logs': [('stdout', 'cccc')]}]])
+
+    def test_commandComplete(self):
+        self.sb.sendUpdate({'stdout': 'a'})
+        self.sb.sendUpdate({'rc': 0})
+        self.step.remote_complete = lambda failure : self.step.updates.append(
+                'complete')
+        self.sb.commandComplete(None)
+        self.assertEqual(self.step.updates, [[{'stdout': 'a'}], [{'rc': 0}],
+                                             'complete'])
+        self.assertFalse(self.clock.getDelayedCalls())
+
 class TestBotFactory(unittest.TestCase):
 
     def setUp(self):
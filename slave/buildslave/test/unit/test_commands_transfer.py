@@ -17,7 +17,13 @@ import os
 import sys
 import shutil
 import tarfile
+import zlib
 import StringIO
+try:
+    from hashlib import md5, sha1
+except ImportError:
+    from md5 import new as md5
+    from sha import new as sha1
 
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
@@ -46,6 +52,41 @@ class FakeMasterMethods(object):
         self.read = False
         self.data = ''
 
+        # master's copy of the file for delta transfers, with the blocks
+        # copied from it
+        self.copy = None
+        self.copied = []
+
+    def remote_digest(self):
+        self.add_update('digest')
+        if self.copy is None:
+            return None
+        return sha1(self.copy).hexdigest()
+
+    def remote_signature(self, blocksize, first, count):
+        self.add_update('signature %d' % first)
+        self.blocksize = blocksize
+        signature = []
+        for i in range(first, first + count):
+            block = self.copy[i*blocksize:(i+1)*blocksize]
+            if not block:
+                break
+            signature.append((zlib.adler32(block) & 0xffffffff,
+                              md5(block).digest()))
+        return signature
+
+    def remote_writeDelta(self, instructions):
+        for item in instructions:
+            if isinstance(item, str):
+                self.remote_write(item)
+            else:
+                self.copied.append(item)
+                self.data += self.copy[item*self.blocksize:
+                                       (item+1)*self.blocksize]
+
+    def remote_keep(self):
+        self.add_update('keep')
+
     def remote_write(self, data):
         if self.count_writes:
             self.add_update('write %d' % len(data))
@@ -61,13 +102,15 @@ class FakeMasterMethods(object):
             reactor.callLater(0.01, d.callback, None)
             return d
 
-    def remote_read(self, length):
+    def remote_read(self, length, offset=None):
         if self.count_reads:
             self.add_update('read %d' % length)
         elif not self.read:
             self.add_update('read(s)')
             self.read = True
 
+        if offset is not None:
+            return self.copy[offset:offset+length]
         if not self.data:
             return ''
 
@@ -213,6 +256,33 @@ class TestUploadFile(CommandTestMixin, unittest.TestCase):
         dl.addCallback(check)
         return dl
 
+    def test_window(self):
+        self.fakemaster.count_writes = True    # get actual byte counts
+        self.fakemaster.delay_write = True
+        self.fakemaster.keep_data = True
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=1000,
+            blocksize=64,
+            keepstamp=False,
+            window=4,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertEqual(self.get_updates(), [
+                    {'header': 'sending %s' % self.datafile},
+                    'write 64', 'write 64', 'write 52', 'close',
+                    {'rc': 0}
+                ])
+            self.assertEqual(self.fakemaster.data, "this is some data\n" * 10)
+        d.addCallback(check)
+        return d
+
     def test_timestamp(self):
         self.fakemaster.count_writes = True    # get actual byte counts
         timestamp = ( os.path.getatime(self.datafile),
@@ -239,6 +309,89 @@ class TestUploadFile(CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_delta_unchanged(self):
+        self.fakemaster.copy = "this is some data\n" * 10
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=64,
+            keepstamp=False,
+            delta=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertEqual(self.get_updates(), [
+                    {'header': 'sending %s' % self.datafile},
+                    'digest',
+                    {'header': 'master copy is up to date\n'},
+                    'keep',
+                    {'rc': 0}
+                ])
+        d.addCallback(check)
+        return d
+
+    def test_delta(self):
+        self.fakemaster.count_writes = True    # get actual byte counts
+        self.fakemaster.keep_data = True
+        data = "this is some data\n" * 10
+        # the master's copy lacks the first bytes, and has other ones at the
+        # end
+        self.fakemaster.copy = data[5:] + "old data"
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=64,
+            keepstamp=False,
+            delta=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertEqual(self.get_updates(), [
+                    {'header': 'sending %s' % self.datafile},
+                    'digest', 'signature 0',
+                    'write 5', 'write 47', 'close',
+                    {'rc': 0}
+                ])
+            self.assertEqual(self.fakemaster.copied, [0, 1])
+            self.assertEqual(self.fakemaster.data, data)
+        d.addCallback(check)
+        return d
+
+    def test_delta_new(self):
+        self.fakemaster.count_writes = True    # get actual byte counts
+
+        self.make_command(transfer.SlaveFileUploadCommand, dict(
+            workdir='workdir',
+            slavesrc='data',
+            writer=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=64,
+            keepstamp=False,
+            delta=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertEqual(self.get_updates(), [
+                    {'header': 'sending %s' % self.datafile},
+                    'digest',
+                    'write 64', 'write 64', 'write 52', 'close',
+                    {'rc': 0}
+                ])
+        d.addCallback(check)
+        return d
+
 class TestSlaveDirectoryUpload(CommandTestMixin, unittest.TestCase):
 
     def setUp(self):
@@ -355,6 +508,58 @@ class TestDownloadFile(CommandTestMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_window(self):
+        self.fakemaster.delay_read = True
+        self.fakemaster.data = test_data = '1234' * 13
+
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=16,
+            mode=0777,
+            window=3,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertEqual(self.get_updates(), [
+                    'read(s)', 'close',
+                    {'rc': 0}
+                ])
+            datafile = os.path.join(self.basedir, 'data')
+            self.assertEqual(open(datafile).read(), test_data)
+        d.addCallback(check)
+        return d
+
+    def test_window_maxsize(self):
+        # blocks in flight that come back short don't count against maxsize
+        self.fakemaster.data = test_data = 'tenchars--' * 2
+
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=50,
+            blocksize=16,
+            mode=0777,
+            window=4,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertEqual(self.get_updates(), [
+                    'read(s)', 'close',
+                    {'rc': 0}
+                ])
+            datafile = os.path.join(self.basedir, 'data')
+            self.assertEqual(open(datafile).read(), test_data)
+        d.addCallback(check)
+        return d
+
     def test_mkdir(self):
         self.fakemaster.data = test_data = 'hi'
 
@@ -465,3 +670,62 @@ class TestDownloadFile(CommandTestMixin, unittest.TestCase):
         dl.addCallback(check)
         return dl
 
+    def test_delta_unchanged(self):
+        datafile = os.path.join(self.basedir, 'data')
+        open(datafile, 'wb').write('1234' * 13)
+        self.fakemaster.copy = '1234' * 13
+
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=32,
+            mode=0777,
+            delta=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertEqual(self.get_updates(), [
+                    'digest',
+                    {'header': '%s is up to date\n'
+                               % os.path.join(self.basedir, '.', 'data')},
+                    'close',
+                    {'rc': 0}
+                ])
+            if runtime.platformType != 'win32':
+                self.assertEqual(os.stat(datafile).st_mode & 0777, 0777)
+        d.addCallback(check)
+        return d
+
+    def test_delta(self):
+        self.fakemaster.count_reads = True    # get actual byte counts
+        datafile = os.path.join(self.basedir, 'data')
+        # the slave's copy has the middle block of the new file, at another
+        # offset
+        open(datafile, 'wb').write('xx' + 'b' * 16 + 'old')
+        self.fakemaster.copy = test_data = 'a' * 16 + 'b' * 16 + 'c' * 10
+
+        self.make_command(transfer.SlaveFileDownloadCommand, dict(
+            workdir='.',
+            slavedest='data',
+            reader=FakeRemote(self.fakemaster),
+            maxsize=None,
+            blocksize=16,
+            mode=None,
+            delta=True,
+        ))
+
+        d = self.run_command()
+
+        def check(_):
+            self.assertEqual(self.get_updates(), [
+                    'digest', 'signature 0', 'read 16', 'read 16', 'close',
+                    {'rc': 0}
+                ])
+            self.assertEqual(open(datafile).read(), test_data)
+            self.assertEqual(os.listdir(self.basedir), ['data'])
+        d.addCallback(check)
+        return d
@@ -18,6 +18,7 @@ import re
 import os
 import time
 import signal
+import zlib
 
 from twisted.trial import unittest
 from twisted.internet import task, defer, reactor
@@ -512,6 +513,47 @@ class TestLogging(BasedirMixin, unittest.TestCase):
         s._addToBuffers('stdout', data)
         self.failUnlessEqual(len(b.updates), 1)
 
+    def testSendRecords(self):
+        b = FakeSlaveBuilder(False, self.basedir, logUpdates='list')
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        s._addToBuffers('stdout', 'hello ')
+        s._addToBuffers('stdout', 'there ')
+        s._addToBuffers('stderr', 'DIEEEEEEE')
+        s._addToBuffers(('log', 'test.log'), 'logged')
+        s._addToBuffers('stdout', 'world')
+        s._sendBuffers()
+        self.failUnlessEqual(b.updates, [
+            {'logs': [('stdout', 'hello there '), ('stderr', 'DIEEEEEEE'),
+                      (('log', 'test.log'), 'logged'), ('stdout', 'world')]},
+            ])
+
+    def testSendRecordsChunked(self):
+        b = FakeSlaveBuilder(False, self.basedir, logUpdates='list')
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        data = "x" * (runprocess.RunProcess.CHUNK_LIMIT * 3 / 2)
+        s._addToBuffers('stdout', data)
+        s._sendBuffers()
+        self.failUnlessEqual(len(b.updates), 2)
+
+    def testSendRecordsCompressed(self):
+        b = FakeSlaveBuilder(False, self.basedir, logUpdates='zlib')
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        s._addToBuffers('stdout', 'compile foo.c\n' * 100)
+        s._addToBuffers('stderr', 'foo.c: warning\n' * 100)
+        s._sendBuffers()
+        self.failUnlessEqual(len(b.updates), 1)
+        lengths, compressed = b.updates[0]['zlogs']
+        self.failUnlessEqual(lengths, [('stdout', 1400), ('stderr', 1500)])
+        self.failUnlessEqual(zlib.decompress(compressed),
+                             'compile foo.c\n' * 100 + 'foo.c: warning\n' * 100)
+
+    def testSendRecordsSmallUncompressed(self):
+        b = FakeSlaveBuilder(False, self.basedir, logUpdates='zlib')
+        s = runprocess.RunProcess(b, stdoutCommand('hello'), self.basedir)
+        s._addToBuffers('stdout', 'hello')
+        s._sendBuffers()
+        self.failUnlessEqual(b.updates, [{'logs': [('stdout', 'hello')]}])
+
 class TestLogFileWatcher(BasedirMixin, unittest.TestCase):
     def setUp(self):
         self.setUpBasedir()